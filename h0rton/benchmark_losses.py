@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""Benchmarking the forward and backward passes of the Gaussian NLLs over batch size, number of parameters, and rank.
+
+For each full-rank loss class and each combination of batch size and `Y_dim`, the wall-clock time of evaluating the NLL of random network outputs and backpropagating it is printed for the packed-triangular kernel (`packed=True`, the default), the dense kernel that forms the precision matrix (`packed=False`), and the `torch.distributions` implementation in `h0rton.losses.gaussian_nll_native`. The absolute difference of the packed loss from the dense one is printed alongside.
+
+For each low-rank loss class, the same is printed over `Y_dim`, batch size, and the rank of the low-rank portion of the covariance matrix, comparing the Woodbury kernel in `h0rton.losses.gaussian_nll` against `torch.distributions`.
+
+Finally, for each likelihood, the forward and backward passes are timed separately in every backend implementing it (`gaussian_nll`, `gaussian_nll_native`, and the numpy `gaussian_nll_cpu`, forward only) over `Y_dim`, batch size, and float type, along with the agreement of the loss and its gradient with the float64 default backend (see `h0rton.losses.backend_selection`). This is the benchmark that `model.likelihood_backend='auto'` runs at the start of training.
+
+Example
+-------
+To run this script, pass in the grid to benchmark::
+
+    $ python h0rton/benchmark_losses.py --Y_dims 4 10 20 --batch_sizes 32 200 1000 --ranks 1 2 4 8 --dtypes float32 float64
+
+"""
+import sys
+import time
+import argparse
+from addict import Dict
+import pandas as pd
+import torch
+import h0rton.losses
+
+default_losses = ['FullRankGaussianNLL', 'DoubleGaussianNLL']
+default_low_rank_losses = ['LowRankGaussianNLL', 'DoubleLowRankGaussianNLL']
+default_backend_losses = ['DiagonalGaussianNLL', 'LowRankGaussianNLL', 'FullRankGaussianNLL', 'DoubleLowRankGaussianNLL', 'DoubleGaussianNLL']
+
+def parse_args():
+    """Parse command-line arguments
+
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--losses', default=default_losses, dest='losses', type=str, nargs='+',
+                        help='names of the full-rank loss classes in h0rton.losses to benchmark (Default: FullRankGaussianNLL DoubleGaussianNLL)')
+    parser.add_argument('--low_rank_losses', default=default_low_rank_losses, dest='low_rank_losses', type=str, nargs='+',
+                        help='names of the low-rank loss classes in h0rton.losses to benchmark (Default: LowRankGaussianNLL DoubleLowRankGaussianNLL)')
+    parser.add_argument('--backend_losses', default=default_backend_losses, dest='backend_losses', type=str, nargs='+',
+                        help='names of the loss classes in h0rton.losses to benchmark across backends (Default: all but MixtureGaussianNLL)')
+    parser.add_argument('--dtypes', default=['float32', 'float64'], dest='dtypes', type=str, nargs='+',
+                        help='float types of the backend benchmark (Default: float32 float64)')
+    parser.add_argument('--ranks', default=[1, 2, 4, 8], dest='ranks', type=int, nargs='+',
+                        help='ranks of the low-rank portion of the covariance matrix (Default: 1 2 4 8)')
+    parser.add_argument('--Y_dims', default=[4, 10, 20], dest='Y_dims', type=int, nargs='+',
+                        help='numbers of parameters (Default: 4 10 20)')
+    parser.add_argument('--batch_sizes', default=[32, 200, 1000], dest='batch_sizes', type=int, nargs='+',
+                        help='batch sizes (Default: 32 200 1000)')
+    parser.add_argument('--n_repeats', default=20, dest='n_repeats', type=int,
+                        help='number of timed forward and backward passes, of which the fastest is reported (Default: 20)')
+    parser.add_argument('--device_type', default='cpu', dest='device_type', type=str,
+                        help='device on which to run the losses (Default: cpu)')
+    args = parser.parse_args()
+    # sys.argv rerouting for setuptools entry point
+    if args is None:
+        args = Dict()
+        args.losses = default_losses
+    return args
+
+def time_forward_backward(loss_fn, pred, target, n_repeats):
+    """Time the evaluation and backpropagation of a loss on a fixed batch
+
+    Parameters
+    ----------
+    loss_fn : callable
+        instance of a loss class in `h0rton.losses`
+    pred : torch.Tensor of shape `[batch_size, out_dim]`
+        network output
+    target : torch.Tensor of shape `[batch_size, Y_dim]`
+        labels
+    n_repeats : int
+        number of timed calls
+
+    Returns
+    -------
+    tuple
+        the fastest time in seconds and the loss value
+
+    """
+    pred = pred.clone().requires_grad_(True)
+    times = []
+    for _ in range(n_repeats + 1):
+        pred.grad = None
+        if pred.is_cuda:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        loss = loss_fn(pred, target)
+        loss.backward()
+        if pred.is_cuda:
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    # The first call is a warm-up
+    return min(times[1:]), loss.item()
+
+def main():
+    args = parse_args()
+    device = torch.device(args.device_type)
+    torch.manual_seed(123)
+    rows = []
+    for loss_name in args.losses:
+        for Y_dim in args.Y_dims:
+            packed_fn = getattr(h0rton.losses, loss_name)(Y_dim=Y_dim, device=device)
+            dense_fn = getattr(h0rton.losses, loss_name)(Y_dim=Y_dim, device=device, packed=False)
+            native_fn = getattr(h0rton.losses, loss_name + 'Native')(Y_dim=Y_dim, device=device)
+            for batch_size in args.batch_sizes:
+                # Small elements of the precision Cholesky factor, for a well-conditioned precision matrix
+                pred = 0.1*torch.randn(batch_size, packed_fn.out_dim, device=device)
+                target = torch.randn(batch_size, Y_dim, device=device)
+                packed_time, packed_loss = time_forward_backward(packed_fn, pred, target, args.n_repeats)
+                dense_time, dense_loss = time_forward_backward(dense_fn, pred, target, args.n_repeats)
+                native_time, _ = time_forward_backward(native_fn, pred, target, args.n_repeats)
+                rows.append(dict(loss=loss_name, Y_dim=Y_dim, batch_size=batch_size,
+                                 packed_time=packed_time, dense_time=dense_time, native_time=native_time,
+                                 speedup_over_dense=dense_time/packed_time,
+                                 abs_diff=abs(packed_loss - dense_loss)))
+    print(pd.DataFrame(rows).to_string(index=False))
+    rows = []
+    for loss_name in args.low_rank_losses:
+        for Y_dim in args.Y_dims:
+            for rank in args.ranks:
+                loss_fn = getattr(h0rton.losses, loss_name)(Y_dim=Y_dim, device=device, rank=rank)
+                native_fn = getattr(h0rton.losses, loss_name + 'Native')(Y_dim=Y_dim, device=device, rank=rank)
+                for batch_size in args.batch_sizes:
+                    pred = 0.1*torch.randn(batch_size, loss_fn.out_dim, device=device)
+                    target = torch.randn(batch_size, Y_dim, device=device)
+                    woodbury_time, woodbury_loss = time_forward_backward(loss_fn, pred, target, args.n_repeats)
+                    native_time, native_loss = time_forward_backward(native_fn, pred, target, args.n_repeats)
+                    rows.append(dict(loss=loss_name, Y_dim=Y_dim, rank=rank, batch_size=batch_size,
+                                     woodbury_time=woodbury_time, native_time=native_time,
+                                     speedup_over_native=native_time/woodbury_time,
+                                     abs_diff=abs(woodbury_loss - native_loss)))
+    print(pd.DataFrame(rows).to_string(index=False))
+    tables = []
+    for loss_name in args.backend_losses:
+        for Y_dim in args.Y_dims:
+            table = h0rton.losses.benchmark_likelihood_backends(loss_name, Y_dim, args.batch_sizes, [getattr(torch, dtype) for dtype in args.dtypes], device, args.n_repeats)
+            table.insert(0, 'Y_dim', Y_dim)
+            table.insert(0, 'loss', loss_name)
+            tables.append(table)
+    print(pd.concat(tables).drop(columns='class_name').to_string(index=False))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""Benchmarking the sampling of the Gaussian BNN posteriors over batch size and number of samples.
+
+For each posterior class and each combination of batch size and number of samples per lens, the wall-clock time of `sample` is printed for the numpy (`*CPU`) and torch implementations, on random network outputs of the given `Y_dim`. As a reference, the full-rank rows also time sampling lens by lens with `scipy.stats.multivariate_normal`, which needs the covariance matrix of each lens.
+
+Example
+-------
+To run this script, pass in the number of parameters along with the grid to benchmark::
+
+    $ python h0rton/benchmark_sampling.py --Y_dim 10 --batch_sizes 1 32 200 --n_samples 100 1000 10000
+
+"""
+import sys
+import time
+import argparse
+from addict import Dict
+import numpy as np
+import pandas as pd
+import torch
+from scipy.stats import multivariate_normal
+from h0rton.h0_inference import gaussian_bnn_posterior, gaussian_bnn_posterior_cpu
+
+default_posteriors = ['FullRankGaussianBNNPosterior', 'DoubleGaussianBNNPosterior', 'DoubleLowRankGaussianBNNPosterior']
+
+def parse_args():
+    """Parse command-line arguments
+
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--Y_dim', default=10, dest='Y_dim', type=int,
+                        help='number of parameters (Default: 10)')
+    parser.add_argument('--posteriors', default=default_posteriors, dest='posteriors', type=str, nargs='+',
+                        help='names of the posterior classes in h0rton.h0_inference.gaussian_bnn_posterior to benchmark (Default: full-rank and mixtures)')
+    parser.add_argument('--batch_sizes', default=[1, 32, 200], dest='batch_sizes', type=int, nargs='+',
+                        help='numbers of lenses (Default: 1 32 200)')
+    parser.add_argument('--n_samples', default=[100, 1000, 10000], dest='n_samples', type=int, nargs='+',
+                        help='numbers of samples per lens (Default: 100 1000 10000)')
+    parser.add_argument('--n_repeats', default=3, dest='n_repeats', type=int,
+                        help='number of timed calls, of which the fastest is reported (Default: 3)')
+    args = parser.parse_args()
+    # sys.argv rerouting for setuptools entry point
+    if args is None:
+        args = Dict()
+        args.Y_dim = sys.argv[0]
+    return args
+
+def get_random_pred(posterior_name, Y_dim, batch_size, rng):
+    """Draw network outputs that define a well-conditioned posterior of each lens
+
+    """
+    d = Y_dim
+    tril_idx = np.tril_indices(d)
+    tril_len = len(tril_idx[0])
+    def mu():
+        return rng.randn(batch_size, d)
+    def tril_elements():
+        # Log of the diagonal around 0, small off-diagonal elements
+        return 0.1*rng.randn(batch_size, tril_len)
+    def low_rank():
+        return np.concatenate([0.1*rng.randn(batch_size, d), 0.1*rng.randn(batch_size, 2*d)], axis=1)
+    alpha = rng.randn(batch_size, 1)
+    if posterior_name == 'FullRankGaussianBNNPosterior':
+        return np.concatenate([mu(), tril_elements()], axis=1)
+    elif posterior_name == 'DoubleGaussianBNNPosterior':
+        return np.concatenate([mu(), tril_elements(), mu(), tril_elements(), alpha], axis=1)
+    elif posterior_name == 'DoubleLowRankGaussianBNNPosterior':
+        return np.concatenate([mu(), low_rank(), mu(), low_rank(), alpha], axis=1)
+    elif posterior_name == 'LowRankGaussianBNNPosterior':
+        return np.concatenate([mu(), low_rank()], axis=1)
+    else:
+        return np.concatenate([mu(), 0.1*rng.randn(batch_size, d)], axis=1)
+
+def sample_per_lens(bnn_post, n_samples):
+    """Reference full-rank sampling that inverts the precision matrix and calls scipy for each lens
+
+    """
+    samples = np.zeros([bnn_post.batch_size, n_samples, bnn_post.Y_dim])
+    for b in range(bnn_post.batch_size):
+        cov_mat = np.linalg.inv(bnn_post.prec_tril[b] @ bnn_post.prec_tril[b].T)
+        samples[b] = multivariate_normal.rvs(mean=bnn_post.mu[b], cov=cov_mat, size=[n_samples,]).reshape(n_samples, -1)
+    return samples
+
+def time_call(fn, n_repeats):
+    """Best wall-clock time of `n_repeats` calls, in seconds
+
+    """
+    times = []
+    for i in range(n_repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def main():
+    args = parse_args()
+    torch.set_default_tensor_type('torch.DoubleTensor')
+    rng = np.random.RandomState(123)
+    Y_mean = np.zeros(args.Y_dim)
+    Y_std = np.ones(args.Y_dim)
+    rows = []
+    for posterior_name in args.posteriors:
+        for batch_size in args.batch_sizes:
+            pred = get_random_pred(posterior_name, args.Y_dim, batch_size, rng)
+            cpu_post = getattr(gaussian_bnn_posterior_cpu, posterior_name + 'CPU')(args.Y_dim, Y_mean, Y_std)
+            cpu_post.set_sliced_pred(pred)
+            torch_post = getattr(gaussian_bnn_posterior, posterior_name)(args.Y_dim, torch.device('cpu'), Y_mean, Y_std)
+            torch_post.set_sliced_pred(torch.from_numpy(pred))
+            for n_samples in args.n_samples:
+                row = dict(posterior=posterior_name, batch_size=batch_size, n_samples=n_samples)
+                row['numpy'] = time_call(lambda: cpu_post.sample(n_samples, 0), args.n_repeats)
+                row['torch'] = time_call(lambda: torch_post.sample(n_samples, 0), args.n_repeats)
+                if posterior_name == 'FullRankGaussianBNNPosterior':
+                    row['per_lens'] = time_call(lambda: sample_per_lens(cpu_post, n_samples), args.n_repeats)
+                rows.append(row)
+    summary = pd.DataFrame(rows)
+    print("Y_dim: {:d}, times in seconds".format(args.Y_dim))
+    print(summary.to_string(index=False))
+
+if __name__ == '__main__':
+    main()
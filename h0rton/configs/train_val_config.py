@@ -59,6 +59,11 @@ class TrainValConfig:
         import h0rton.losses
         if not hasattr(h0rton.losses, self.model.likelihood_class):
             raise TypeError("Likelihood class supplied in cfg doesn't exist.")
+        if 'likelihood_backend' in self.model and self.model.likelihood_backend != 'auto':
+            if self.model.likelihood_backend not in h0rton.losses.trainable_backends:
+                raise ValueError("Likelihood backend must be 'auto' or one of {}.".format(h0rton.losses.trainable_backends))
+            if h0rton.losses.get_backend_class_name(self.model.likelihood_class, self.model.likelihood_backend) is None:
+                raise ValueError("Likelihood class supplied in cfg isn't implemented in the likelihood backend.")
 
     def preset_default(self):
         """Preset default config values
@@ -71,6 +76,8 @@ class TrainValConfig:
         # FIXME: doesn't check for contents of baobab config file, just the file names
         if self.data.train_baobab_cfg_path == self.data.val_baobab_cfg_path:
             warnings.warn("You're training and validating on the same dataset.", UserWarning, stacklevel=2)
+        if 'likelihood_backend' not in self.model:
+            self.model.likelihood_backend = 'gaussian_nll'
         if 'float_type' not in self.data:
             self.data.float_type = 'FloatTensor'
             warnings.warn("Float type not provided. Defaulting to float32...")
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""Evaluating the calibration of stored BNN predictions on the test set, without sampling.
+
+The predictions are read either from a prediction store entry (`<prediction_store_dir>/<key>.npz`, holding the raw MC dropout outputs) or from a parametric posterior export (`bnn_posterior.npz`). For every test lens, the credible level at which the true label is first included is evaluated analytically from the Gaussian mixture parameters, per parameter and jointly (see `h0rton.h0_inference.calibration`). The coverage curves are saved as a CSV file and the coverage at 1, 2, and 3 sigma is printed.
+
+Example
+-------
+To run this script, pass in the path to the stored predictions and the inference config file that produced them::
+
+    $ python h0rton/evaluate_calibration.py pred_store/<key>.npz h0rton/h0_inference_config.json --out_path coverage.csv
+
+"""
+import sys
+import argparse
+from addict import Dict
+import numpy as np
+import torch
+import h0rton.losses
+from h0rton.configs import TrainValConfig, TestConfig
+from h0rton.trainval_data import XYData
+from h0rton.h0_inference.bnn_posterior_export import ParametricBNNPosterior
+from h0rton.h0_inference.calibration import get_truth_levels, get_coverage_curves, get_coverage_summary
+
+def parse_args():
+    """Parse command-line arguments
+
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('predictions_path', help='path to a prediction store entry or a parametric posterior export')
+    parser.add_argument('test_config_file_path', help='path to the user-defined inference config file')
+    parser.add_argument('--out_path', default='coverage.csv', dest='out_path', type=str,
+                        help='path of the CSV file of coverage curves (Default: coverage.csv)')
+    parser.add_argument('--n_levels', default=101, dest='n_levels', type=int,
+                        help='number of credible levels in [0, 1] for the coverage curves (Default: 101)')
+    args = parser.parse_args()
+    # sys.argv rerouting for setuptools entry point
+    if args is None:
+        args = Dict()
+        args.predictions_path = sys.argv[0]
+        args.test_config_file_path = sys.argv[1]
+    return args
+
+def main():
+    args = parse_args()
+    test_cfg = TestConfig.from_file(args.test_config_file_path)
+    cfg = TrainValConfig.from_file(test_cfg.train_val_config_file_path)
+    with np.load(args.predictions_path) as stored:
+        is_raw = 'pred' in stored.files
+    if is_raw:
+        stored = dict(np.load(args.predictions_path))
+        loss_fn = getattr(h0rton.losses, cfg.model.likelihood_class)(Y_dim=len(cfg.data.Y_cols), device=torch.device('cpu'), **cfg.model.likelihood_kwargs)
+        bnn_post = ParametricBNNPosterior.from_pred(stored['pred'], loss_fn.posterior_name, stored['Y_mean'], stored['Y_std'], stored['n_dropout_per_lens'], cfg.data.Y_cols, loss_fn.posterior_kwargs)
+    else:
+        bnn_post = ParametricBNNPosterior.from_file(args.predictions_path)
+    # Labels of the first n_lenses test lenses, whitened with the stats stored along with the predictions
+    test_data = XYData(is_train=False,
+                       Y_cols=cfg.data.Y_cols,
+                       float_type=cfg.data.float_type,
+                       define_src_pos_wrt_lens=cfg.data.define_src_pos_wrt_lens,
+                       rescale_pixels=cfg.data.rescale_pixels,
+                       rescale_pixels_type=cfg.data.rescale_pixels_type,
+                       log_pixels=cfg.data.log_pixels,
+                       add_pixel_noise=cfg.data.add_pixel_noise,
+                       eff_exposure_time=cfg.data.eff_exposure_time,
+                       train_Y_mean=bnn_post.Y_mean.reshape(1, -1),
+                       train_Y_std=bnn_post.Y_std.reshape(1, -1),
+                       train_baobab_cfg_path=cfg.data.train_baobab_cfg_path,
+                       val_baobab_cfg_path=test_cfg.data.test_baobab_cfg_path,
+                       for_cosmology=False)
+    levels = get_truth_levels(bnn_post, test_data.Y_array[:bnn_post.n_lenses])
+    curves = get_coverage_curves(levels, cfg.data.Y_cols, np.linspace(0.0, 1.0, args.n_levels))
+    curves.to_csv(args.out_path, index=False)
+    print("Coverage of {:d} lenses, saved as a function of the credible level at {:s}".format(bnn_post.n_lenses, args.out_path))
+    summary = get_coverage_summary(levels, cfg.data.Y_cols)
+    for name, coverage in summary.items():
+        print("{:s}: {:.3f}".format(name, coverage))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""Comparing several trained BNNs on the validation set in a single pass over the data.
+
+Each validation batch is loaded once and evaluated by every network, optionally with the networks spread across worker processes. The script prints one table with, per checkpoint, the validation NLL, the MAE of the predicted means, log-determinant stats of the predicted covariance, and the coverage of the central 68% and 95% marginal intervals of the MC dropout posterior.
+
+The validation data and whitening come from the first training config. Checkpoints trained with a different architecture, likelihood, or dropout rate (e.g. the dropout variants in `experiments/v*`) can be given their own training configs with `--cfg_paths`, as long as they predict the same `Y_cols`. Inference-only artifacts carry these settings themselves.
+
+Example
+-------
+To run this script, pass in the path to the training config file and the checkpoints::
+
+    $ python h0rton/evaluate_checkpoints.py experiments/v2/train_val_cfg.json resnet34_epoch=149.mdl resnet34_epoch=199.mdl --n_workers 2 --out_path comparison.csv
+
+"""
+import os
+import sys
+import argparse
+from addict import Dict
+import torch
+from torch.utils.data import DataLoader
+from h0rton.trainval_data import XYData
+from h0rton.configs import TrainValConfig
+import h0rton.train_utils as train_utils
+import h0rton.script_utils as script_utils
+
+def parse_args():
+    """Parse command-line arguments
+
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('user_cfg_path', help='path to the user-defined training config file defining the validation data')
+    parser.add_argument('checkpoint_paths', type=str, nargs='+', help='paths to the training checkpoints or inference-only artifacts')
+    parser.add_argument('--cfg_paths', default=None, dest='cfg_paths', type=str, nargs='+',
+                        help='training config file of each checkpoint, in the same order (Default: user_cfg_path for all)')
+    parser.add_argument('--n_dropout', default=1, dest='n_dropout', type=int,
+                        help='number of MC dropout passes per batch (Default: 1)')
+    parser.add_argument('--n_samples_per_dropout', default=50, dest='n_samples_per_dropout', type=int,
+                        help='number of posterior samples per MC dropout pass used for the interval coverage (Default: 50)')
+    parser.add_argument('--n_workers', default=0, dest='n_workers', type=int,
+                        help='number of worker processes across which the networks are spread (Default: 0, i.e. evaluate in the main process)')
+    parser.add_argument('--out_path', default=None, dest='out_path', type=str,
+                        help='path to a .csv file in which to save the comparison table (Default: None)')
+    args = parser.parse_args()
+    # sys.argv rerouting for setuptools entry point
+    if args is None:
+        args = Dict()
+        args.user_cfg_path = sys.argv[0]
+    return args
+
+def main():
+    args = parse_args()
+    cfg = TrainValConfig.from_file(args.user_cfg_path)
+    device = torch.device(cfg.device_type)
+    if device.type == 'cuda':
+        torch.set_default_tensor_type('torch.cuda.' + cfg.data.float_type)
+    else:
+        torch.set_default_tensor_type('torch.' + cfg.data.float_type)
+    script_utils.seed_everything(cfg.global_seed)
+    cfg_paths = args.cfg_paths if args.cfg_paths is not None else [args.user_cfg_path]*len(args.checkpoint_paths)
+    if len(cfg_paths) != len(args.checkpoint_paths):
+        raise ValueError("Provide one training config per checkpoint.")
+    specs = []
+    for checkpoint_path, cfg_path in zip(args.checkpoint_paths, cfg_paths):
+        ckpt_cfg = TrainValConfig.from_file(cfg_path)
+        if list(ckpt_cfg.data.Y_cols) != list(cfg.data.Y_cols):
+            raise ValueError("{:s} predicts different Y_cols from {:s}.".format(cfg_path, args.user_cfg_path))
+        specs.append(dict(name=os.path.basename(checkpoint_path),
+                          checkpoint_path=checkpoint_path,
+                          architecture=ckpt_cfg.model.architecture,
+                          likelihood_class=ckpt_cfg.model.likelihood_class,
+                          likelihood_kwargs=ckpt_cfg.model.likelihood_kwargs,
+                          dropout_rate=ckpt_cfg.model.dropout_rate))
+    train_data = XYData(is_train=True,
+                        Y_cols=cfg.data.Y_cols,
+                        float_type=cfg.data.float_type,
+                        define_src_pos_wrt_lens=cfg.data.define_src_pos_wrt_lens,
+                        rescale_pixels=cfg.data.rescale_pixels,
+                        rescale_pixels_type=cfg.data.rescale_pixels_type,
+                        log_pixels=cfg.data.log_pixels,
+                        add_pixel_noise=cfg.data.add_pixel_noise,
+                        eff_exposure_time=cfg.data.eff_exposure_time,
+                        train_Y_mean=None,
+                        train_Y_std=None,
+                        train_baobab_cfg_path=cfg.data.train_baobab_cfg_path,
+                        val_baobab_cfg_path=cfg.data.val_baobab_cfg_path,
+                        for_cosmology=False)
+    val_data = XYData(is_train=False,
+                      Y_cols=cfg.data.Y_cols,
+                      float_type=cfg.data.float_type,
+                      define_src_pos_wrt_lens=cfg.data.define_src_pos_wrt_lens,
+                      rescale_pixels=cfg.data.rescale_pixels,
+                      rescale_pixels_type=cfg.data.rescale_pixels_type,
+                      log_pixels=cfg.data.log_pixels,
+                      add_pixel_noise=cfg.data.add_pixel_noise,
+                      eff_exposure_time=cfg.data.eff_exposure_time,
+                      train_Y_mean=train_data.train_Y_mean,
+                      train_Y_std=train_data.train_Y_std,
+                      train_baobab_cfg_path=cfg.data.train_baobab_cfg_path,
+                      val_baobab_cfg_path=cfg.data.val_baobab_cfg_path,
+                      for_cosmology=False)
+    val_loader = DataLoader(val_data, batch_size=min(len(val_data), cfg.optim.batch_size), shuffle=False, drop_last=True)
+    summary = train_utils.evaluate_checkpoints(specs, val_loader, cfg.data.Y_cols, train_data.train_Y_mean, train_data.train_Y_std,
+                                               n_dropout=args.n_dropout,
+                                               n_samples_per_dropout=args.n_samples_per_dropout,
+                                               seed=cfg.global_seed,
+                                               device=device,
+                                               n_workers=args.n_workers)
+    print(summary.to_string())
+    if args.out_path is not None:
+        summary.to_csv(args.out_path)
+        print("Comparison table saved at {:s}".format(args.out_path))
+
+if __name__ == '__main__':
+    main()
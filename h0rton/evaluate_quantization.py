@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""Comparing an int8-quantized BNN against its float counterpart on the validation set.
+
+The script reports, for the float and quantized models, the validation NLL, the coverage of the central 68% and 95% marginal intervals of the MC dropout posterior, and the CPU latency of a forward pass, so that one can decide per checkpoint whether the quantized model is good enough.
+
+Example
+-------
+To run this script, pass in the path to the training config file and the checkpoint (or inference-only artifact)::
+
+    $ python h0rton/evaluate_quantization.py experiments/v2/train_val_cfg.json resnet34_epoch=199.mdl --mode static
+
+"""
+import sys
+import argparse
+from addict import Dict
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import DataLoader
+from h0rton.trainval_data import XYData
+from h0rton.configs import TrainValConfig
+import h0rton.losses
+import h0rton.models
+import h0rton.train_utils as train_utils
+import h0rton.script_utils as script_utils
+from h0rton.h0_inference import gaussian_bnn_posterior_cpu
+
+def parse_args():
+    """Parse command-line arguments
+
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('user_cfg_path', help='path to the user-defined training config file')
+    parser.add_argument('checkpoint_path', help='path to the training checkpoint or inference-only artifact')
+    parser.add_argument('--mode', default='static', dest='mode', type=str,
+                        help='quantization mode, one of [dynamic, static] (Default: static)')
+    parser.add_argument('--n_dropout', default=20, dest='n_dropout', type=int,
+                        help='number of MC dropout passes (Default: 20)')
+    parser.add_argument('--n_samples_per_dropout', default=50, dest='n_samples_per_dropout', type=int,
+                        help='number of posterior samples per MC dropout pass used for the interval coverage (Default: 50)')
+    parser.add_argument('--n_calibration_batches', default=4, dest='n_calibration_batches', type=int,
+                        help='number of validation batches used to calibrate the activation ranges for static quantization (Default: 4)')
+    args = parser.parse_args()
+    # sys.argv rerouting for setuptools entry point
+    if args is None:
+        args = Dict()
+        args.user_cfg_path = sys.argv[0]
+    return args
+
+def evaluate(net, val_loader, loss_fn, bnn_post, n_dropout, n_samples_per_dropout, seed):
+    """Evaluate the NLL and interval coverage of a network on the validation set
+
+    """
+    script_utils.seed_everything(seed)
+    nll = []
+    coverage_68 = []
+    coverage_95 = []
+    net.eval()
+    with torch.no_grad():
+        for X_v, Y_v in val_loader:
+            samples = []
+            for d in range(n_dropout):
+                pred_v = net(X_v)
+                nll.append(loss_fn(pred_v, Y_v).item())
+                bnn_post.set_sliced_pred(pred_v.numpy())
+                samples.append(bnn_post.sample(n_samples_per_dropout, sample_seed=seed + d))
+            samples = np.concatenate(samples, axis=1) # [batch_size, n_dropout*n_samples_per_dropout, Y_dim]
+            coverage_68.append(train_utils.get_interval_coverage(samples, Y_v.numpy(), 0.68))
+            coverage_95.append(train_utils.get_interval_coverage(samples, Y_v.numpy(), 0.95))
+    return dict(nll=np.mean(nll), coverage_68=np.mean(coverage_68), coverage_95=np.mean(coverage_95))
+
+def main():
+    args = parse_args()
+    cfg = TrainValConfig.from_file(args.user_cfg_path)
+    # Quantized kernels only run on the CPU
+    device = torch.device('cpu')
+    torch.set_default_tensor_type('torch.FloatTensor')
+    script_utils.seed_everything(cfg.global_seed)
+    train_data = XYData(is_train=True,
+                        Y_cols=cfg.data.Y_cols,
+                        float_type='FloatTensor',
+                        define_src_pos_wrt_lens=cfg.data.define_src_pos_wrt_lens,
+                        rescale_pixels=cfg.data.rescale_pixels,
+                        rescale_pixels_type=cfg.data.rescale_pixels_type,
+                        log_pixels=cfg.data.log_pixels,
+                        add_pixel_noise=cfg.data.add_pixel_noise,
+                        eff_exposure_time=cfg.data.eff_exposure_time,
+                        train_Y_mean=None,
+                        train_Y_std=None,
+                        train_baobab_cfg_path=cfg.data.train_baobab_cfg_path,
+                        val_baobab_cfg_path=cfg.data.val_baobab_cfg_path,
+                        for_cosmology=False)
+    val_data = XYData(is_train=False,
+                      Y_cols=cfg.data.Y_cols,
+                      float_type='FloatTensor',
+                      define_src_pos_wrt_lens=cfg.data.define_src_pos_wrt_lens,
+                      rescale_pixels=cfg.data.rescale_pixels,
+                      rescale_pixels_type=cfg.data.rescale_pixels_type,
+                      log_pixels=cfg.data.log_pixels,
+                      add_pixel_noise=cfg.data.add_pixel_noise,
+                      eff_exposure_time=cfg.data.eff_exposure_time,
+                      train_Y_mean=train_data.train_Y_mean,
+                      train_Y_std=train_data.train_Y_std,
+                      train_baobab_cfg_path=cfg.data.train_baobab_cfg_path,
+                      val_baobab_cfg_path=cfg.data.val_baobab_cfg_path,
+                      for_cosmology=False)
+    val_loader = DataLoader(val_data, batch_size=min(len(val_data), cfg.optim.batch_size), shuffle=False, drop_last=True)
+    Y_dim = val_data.Y_dim
+    loss_fn = getattr(h0rton.losses, cfg.model.likelihood_class)(Y_dim=Y_dim, device=device, **cfg.model.likelihood_kwargs)
+    # Coverage is evaluated in the whitened space
+    bnn_post = getattr(gaussian_bnn_posterior_cpu, loss_fn.posterior_name + 'CPU')(Y_dim, np.zeros(Y_dim), np.ones(Y_dim), **loss_fn.posterior_kwargs)
+    # Float model
+    if args.checkpoint_path.endswith('.safetensors'):
+        net, _ = h0rton.models.load_inference_artifact(args.checkpoint_path, device)
+    else:
+        net = getattr(h0rton.models, cfg.model.architecture)(num_classes=loss_fn.out_dim, dropout_rate=cfg.model.dropout_rate)
+        net, _ = train_utils.load_state_dict_test(args.checkpoint_path, net, cfg.optim.n_epochs, device)
+    net.eval()
+    # Quantized model
+    if args.mode == 'dynamic':
+        q_net = h0rton.models.quantize_dynamic(net)
+    elif args.mode == 'static':
+        calibration_X = []
+        for batch_idx, (X_v, Y_v) in enumerate(val_loader):
+            if batch_idx == args.n_calibration_batches:
+                break
+            calibration_X.append(X_v)
+        q_net = h0rton.models.quantize_static(net, calibration_X)
+    else:
+        raise ValueError("Quantization mode must be one of [dynamic, static].")
+    X_latency = next(iter(val_loader))[0]
+    summary = {}
+    for name, model in [('float', net), ('int8_{:s}'.format(args.mode), q_net)]:
+        summary[name] = evaluate(model, val_loader, loss_fn, bnn_post, args.n_dropout, args.n_samples_per_dropout, cfg.global_seed)
+        summary[name]['latency'] = h0rton.models.measure_latency(model, X_latency)
+    summary = pd.DataFrame(summary).T
+    summary['speedup'] = summary.loc['float', 'latency']/summary['latency']
+    print(summary.to_string())
+
+if __name__ == '__main__':
+    main()
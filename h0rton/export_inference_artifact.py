@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""Exporting a trained BNN as an inference-only artifact.
+
+The artifact holds the model weights (optionally with batchnorm folded into the convolutions) along with the architecture, dropout rate, likelihood class, predicted columns, and whitening stats, and loads with memory mapping. Point `state_dict_path` in the test config to it in place of the full training checkpoint.
+
+Example
+-------
+To run this script, pass in the path to the training config file, the checkpoint, and the destination::
+
+    $ python h0rton/export_inference_artifact.py experiments/v2/train_val_cfg.json resnet34_epoch=199.mdl resnet34.safetensors --fold_bn
+
+"""
+import sys
+import argparse
+from addict import Dict
+from h0rton.trainval_data import XYData
+from h0rton.configs import TrainValConfig
+import h0rton.train_utils as train_utils
+
+def parse_args():
+    """Parse command-line arguments
+
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('user_cfg_path', help='path to the user-defined training config file')
+    parser.add_argument('checkpoint_path', help='path to the training checkpoint')
+    parser.add_argument('artifact_path', help='destination of the inference-only artifact')
+    parser.add_argument('--fold_bn', default=False, dest='fold_bn', action='store_true',
+                        help='fold batchnorm into the convolutions (Default: False)')
+    args = parser.parse_args()
+    # sys.argv rerouting for setuptools entry point
+    if args is None:
+        args = Dict()
+        args.user_cfg_path = sys.argv[0]
+    return args
+
+def main():
+    args = parse_args()
+    cfg = TrainValConfig.from_file(args.user_cfg_path)
+    # Whitening stats of the training set
+    train_data = XYData(is_train=True,
+                        Y_cols=cfg.data.Y_cols,
+                        float_type=cfg.data.float_type,
+                        define_src_pos_wrt_lens=cfg.data.define_src_pos_wrt_lens,
+                        rescale_pixels=cfg.data.rescale_pixels,
+                        rescale_pixels_type=cfg.data.rescale_pixels_type,
+                        log_pixels=cfg.data.log_pixels,
+                        add_pixel_noise=cfg.data.add_pixel_noise,
+                        eff_exposure_time=cfg.data.eff_exposure_time,
+                        train_Y_mean=None,
+                        train_Y_std=None,
+                        train_baobab_cfg_path=cfg.data.train_baobab_cfg_path,
+                        val_baobab_cfg_path=None,
+                        for_cosmology=False)
+    artifact_path = train_utils.export_inference_artifact(args.checkpoint_path,
+                                                          args.artifact_path,
+                                                          cfg.model.architecture,
+                                                          cfg.model.dropout_rate,
+                                                          cfg.model.likelihood_class,
+                                                          cfg.data.Y_cols,
+                                                          train_data.train_Y_mean,
+                                                          train_data.train_Y_std,
+                                                          likelihood_kwargs=cfg.model.likelihood_kwargs,
+                                                          fold_bn=args.fold_bn)
+    print("Inference-only artifact saved at {:s}".format(artifact_path))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""Exporting a trained BNN as an ONNX or TorchScript graph for serving.
+
+Batchnorm is folded into the convolutions and the dropout ops stay stochastic, so each call of the exported graph is one MC dropout pass. The format is set by the extension of the destination: `.onnx` for ONNX, `.pt` for TorchScript. Run the graph with `h0rton.models.ExportedBNN`, which returns the raw predictions in the `[n_lenses, n_dropout, out_dim]` layout of the PyTorch path.
+
+Example
+-------
+To run this script, pass in the path to the training config file, the checkpoint (or inference-only artifact), and the destination::
+
+    $ python h0rton/export_inference_graph.py experiments/v2/train_val_cfg.json resnet34_epoch=199.mdl resnet34.onnx
+
+"""
+import sys
+import argparse
+from addict import Dict
+import torch
+from h0rton.trainval_data import XYData
+from h0rton.configs import TrainValConfig
+import h0rton.losses
+import h0rton.models
+import h0rton.train_utils as train_utils
+
+def parse_args():
+    """Parse command-line arguments
+
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('user_cfg_path', help='path to the user-defined training config file')
+    parser.add_argument('checkpoint_path', help='path to the training checkpoint or the inference-only artifact')
+    parser.add_argument('graph_path', help='destination of the exported graph, ending in .onnx or .pt')
+    parser.add_argument('--no_fold_bn', default=False, dest='no_fold_bn', action='store_true',
+                        help='keep batchnorm as separate ops instead of folding it into the convolutions (Default: False)')
+    parser.add_argument('--opset_version', default=17, dest='opset_version', type=int,
+                        help='ONNX opset, at least 12 (Default: 17)')
+    args = parser.parse_args()
+    # sys.argv rerouting for setuptools entry point
+    if args is None:
+        args = Dict()
+        args.user_cfg_path = sys.argv[0]
+    return args
+
+def main():
+    args = parse_args()
+    cfg = TrainValConfig.from_file(args.user_cfg_path)
+    torch.set_default_tensor_type('torch.FloatTensor')
+    device = torch.device('cpu')
+    # Whitening stats of the training set
+    train_data = XYData(is_train=True,
+                        Y_cols=cfg.data.Y_cols,
+                        float_type=cfg.data.float_type,
+                        define_src_pos_wrt_lens=cfg.data.define_src_pos_wrt_lens,
+                        rescale_pixels=cfg.data.rescale_pixels,
+                        rescale_pixels_type=cfg.data.rescale_pixels_type,
+                        log_pixels=cfg.data.log_pixels,
+                        add_pixel_noise=cfg.data.add_pixel_noise,
+                        eff_exposure_time=cfg.data.eff_exposure_time,
+                        train_Y_mean=None,
+                        train_Y_std=None,
+                        train_baobab_cfg_path=cfg.data.train_baobab_cfg_path,
+                        val_baobab_cfg_path=None,
+                        for_cosmology=False)
+    if args.checkpoint_path.endswith('.safetensors'):
+        net, _ = h0rton.models.load_inference_artifact(args.checkpoint_path, device)
+    else:
+        loss_fn = getattr(h0rton.losses, cfg.model.likelihood_class)(Y_dim=len(cfg.data.Y_cols), device=device, **cfg.model.likelihood_kwargs)
+        net = getattr(h0rton.models, cfg.model.architecture)(num_classes=loss_fn.out_dim, dropout_rate=cfg.model.dropout_rate)
+        net, epoch = train_utils.load_state_dict_test(args.checkpoint_path, net, cfg.optim.n_epochs, device)
+    metadata = h0rton.models.get_inference_metadata(net,
+                                                    cfg.model.architecture,
+                                                    cfg.model.dropout_rate,
+                                                    cfg.model.likelihood_class,
+                                                    cfg.data.Y_cols,
+                                                    train_data.train_Y_mean,
+                                                    train_data.train_Y_std,
+                                                    cfg.model.likelihood_kwargs)
+    fold_bn = not args.no_fold_bn
+    if args.graph_path.endswith('.onnx'):
+        h0rton.models.export_onnx(net, args.graph_path, train_data.X_dim, fold_bn=fold_bn, metadata=metadata, opset_version=args.opset_version)
+    else:
+        h0rton.models.export_torchscript(net, args.graph_path, train_data.X_dim, fold_bn=fold_bn, metadata=metadata)
+    print("Inference graph saved at {:s}".format(args.graph_path))
+
+if __name__ == '__main__':
+    main()
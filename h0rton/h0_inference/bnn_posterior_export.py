@@ -0,0 +1,339 @@
+"""Compact, parametric export of the MC dropout BNN posterior
+
+Rather than a fixed number of samples, the export stores the Gaussian mixture parameters of every MC dropout pass, so any number of samples can later be drawn without re-running the network.
+
+"""
+import numpy as np
+from scipy.special import softmax
+from h0rton.h0_inference.gaussian_bnn_posterior_cpu import sigmoid, get_chunk_seed
+
+__all__ = ['get_mixture_params', 'ParametricBNNPosterior', 'load_bnn_posterior_samples']
+
+def _get_tril(tril_elements, Y_dim):
+    """Build the lower-triangular Cholesky factor of the precision matrix from its log-Cholesky parameterization
+
+    Parameters
+    ----------
+    tril_elements : np.array of shape `[n, Y_dim*(Y_dim + 1)//2]`
+        row-major lower-triangular elements with the log of the diagonal
+
+    Returns
+    -------
+    np.array of shape `[n, Y_dim, Y_dim]`
+
+    """
+    tril_idx = np.tril_indices(Y_dim)
+    tril = np.zeros([tril_elements.shape[0], Y_dim, Y_dim])
+    tril[:, tril_idx[0], tril_idx[1]] = tril_elements
+    diag_idx = np.arange(Y_dim)
+    tril[:, diag_idx, diag_idx] = np.exp(tril[:, diag_idx, diag_idx])
+    return tril
+
+def _get_low_rank_prec_tril(logvar, F):
+    """Get the Cholesky factor of the precision matrix of a low-rank plus diagonal covariance
+
+    Parameters
+    ----------
+    logvar : np.array of shape `[n, Y_dim]`
+        log of the diagonal elements of the covariance matrix
+    F : np.array of shape `[n, Y_dim, rank]`
+        low-rank portion of the covariance matrix
+
+    Returns
+    -------
+    np.array of shape `[n, Y_dim, Y_dim]`
+
+    """
+    cov_mat = np.matmul(F, np.swapaxes(F, 1, 2))
+    diag_idx = np.arange(logvar.shape[1])
+    cov_mat[:, diag_idx, diag_idx] += np.exp(logvar)
+    return np.linalg.cholesky(np.linalg.inv(cov_mat))
+
+def _get_categorical_mixture_params(pred, Y_dim, n_components=3, cov_type='full_rank', rank=2):
+    """Convert raw network outputs of `h0rton.losses.MixtureGaussianNLL` into Gaussian mixture parameters
+
+    See `get_mixture_params` for the return value.
+
+    """
+    d = Y_dim # for readability
+    n = pred.shape[0]
+    K = n_components
+    component_dim = dict(diagonal=2*d, low_rank=(2 + rank)*d, full_rank=d + d*(d + 1)//2)[cov_type]
+    components = pred[:, :K*component_dim].reshape(n*K, component_dim)
+    if cov_type == 'diagonal':
+        prec_diag = np.exp(-0.5*components[:, d:])
+        prec_tril = prec_diag[:, :, np.newaxis]*np.eye(d)[np.newaxis, :, :]
+    elif cov_type == 'low_rank':
+        prec_tril = _get_low_rank_prec_tril(components[:, d:2*d], components[:, 2*d:].reshape([n*K, d, rank]))
+    else:
+        prec_tril = _get_tril(components[:, d:], d)
+    return dict(mu=components[:, :d].reshape(n, K, d), prec_tril=prec_tril.reshape(n, K, d, d), weights=softmax(pred[:, K*component_dim:], axis=1))
+
+def get_mixture_params(pred, posterior_name, Y_dim, posterior_kwargs=None):
+    """Convert raw network outputs into Gaussian mixture parameters, with each component's precision matrix in Cholesky form
+
+    All the likelihood classes in `h0rton.losses` are supported. Diagonal and low-rank covariances are converted to the same precision Cholesky representation as the full-rank ones. The rank of the low-rank covariances is read off the width of `pred`.
+
+    Parameters
+    ----------
+    pred : np.array of shape `[n, out_dim]`
+        raw network output
+    posterior_name : str
+        `posterior_name` attribute of the likelihood class used in training
+    Y_dim : int
+        number of predicted parameters
+    posterior_kwargs : dict
+        `posterior_kwargs` attribute of the likelihood class used in training, i.e. `n_components`, `cov_type`, and `rank` for `MixtureGaussianBNNPosterior`. Default: None
+
+    Returns
+    -------
+    dict
+        `mu` of shape `[n, n_components, Y_dim]`, `prec_tril` of shape `[n, n_components, Y_dim, Y_dim]`, and `weights` of shape `[n, n_components]`
+
+    """
+    d = Y_dim # for readability
+    n = pred.shape[0]
+    tril_len = d*(d + 1)//2
+    if posterior_name == 'DiagonalGaussianBNNPosterior':
+        mu = [pred[:, :d]]
+        prec_diag = np.exp(-0.5*pred[:, d:2*d])
+        prec_tril = [prec_diag[:, :, np.newaxis]*np.eye(d)[np.newaxis, :, :]]
+        w2 = None
+    elif posterior_name == 'LowRankGaussianBNNPosterior':
+        rank = pred.shape[1]//d - 2 # out_dim = Y_dim*(2 + rank)
+        mu = [pred[:, :d]]
+        prec_tril = [_get_low_rank_prec_tril(pred[:, d:2*d], pred[:, 2*d:].reshape([n, d, rank]))]
+        w2 = None
+    elif posterior_name == 'DoubleLowRankGaussianBNNPosterior':
+        r = (pred.shape[1] - 1)//(2*d) - 2 # out_dim = 2*Y_dim*(2 + rank) + 1
+        mu = [pred[:, :d], pred[:, (2 + r)*d:(3 + r)*d]]
+        prec_tril = [_get_low_rank_prec_tril(pred[:, d:2*d], pred[:, 2*d:(2 + r)*d].reshape([n, d, r])),
+                     _get_low_rank_prec_tril(pred[:, (3 + r)*d:(4 + r)*d], pred[:, (4 + r)*d:(4 + 2*r)*d].reshape([n, d, r]))]
+        w2 = 0.5*sigmoid(pred[:, -1])
+    elif posterior_name == 'FullRankGaussianBNNPosterior':
+        mu = [pred[:, :d]]
+        prec_tril = [_get_tril(pred[:, d:d + tril_len], d)]
+        w2 = None
+    elif posterior_name == 'DoubleGaussianBNNPosterior':
+        mu = [pred[:, :d], pred[:, d + tril_len:2*d + tril_len]]
+        prec_tril = [_get_tril(pred[:, d:d + tril_len], d),
+                     _get_tril(pred[:, 2*d + tril_len:-1], d)]
+        w2 = 0.5*sigmoid(pred[:, -1])
+    elif posterior_name == 'MixtureGaussianBNNPosterior':
+        return _get_categorical_mixture_params(pred, Y_dim, **(posterior_kwargs or {}))
+    else:
+        raise NotImplementedError("Posterior {:s} is not supported.".format(posterior_name))
+    weights = np.ones([n, 1]) if w2 is None else np.stack([1.0 - w2, w2], axis=1)
+    return dict(mu=np.stack(mu, axis=1), prec_tril=np.stack(prec_tril, axis=1), weights=weights)
+
+class ParametricBNNPosterior:
+    """MC dropout BNN posterior represented by per-pass Gaussian mixture parameters, from which samples are drawn on demand
+
+    The parameters live in the whitened space, as predicted by the network, and samples are unwhitened with the training-set stats stored alongside them.
+
+    """
+    def __init__(self, mu, prec_tril, weights, Y_mean, Y_std, n_dropout_per_lens=None, Y_cols=None):
+        """
+        Parameters
+        ----------
+        mu : np.array of shape `[n_lenses, n_dropout, n_components, Y_dim]`
+            whitened component means
+        prec_tril : np.array of shape `[n_lenses, n_dropout, n_components, Y_dim, Y_dim]`
+            lower-triangular Cholesky factors of the whitened component precision matrices
+        weights : np.array of shape `[n_lenses, n_dropout, n_components]`
+            mixture weights
+        Y_mean : np.array of shape `[Y_dim,]`
+            training-set mean used for whitening
+        Y_std : np.array of shape `[Y_dim,]`
+            training-set std used for whitening
+        n_dropout_per_lens : np.array of shape `[n_lenses,]`
+            number of valid MC dropout passes per lens, the rest being padding. Default: all passes are valid
+        Y_cols : list of str
+            names of the parameters
+
+        """
+        self.mu = mu
+        self.prec_tril = prec_tril
+        self.weights = weights
+        self.Y_mean = np.asarray(Y_mean).reshape(-1)
+        self.Y_std = np.asarray(Y_std).reshape(-1)
+        self.n_lenses, self.n_dropout, self.n_components, self.Y_dim = self.mu.shape
+        if n_dropout_per_lens is None:
+            n_dropout_per_lens = np.full(self.n_lenses, self.n_dropout)
+        self.n_dropout_per_lens = np.asarray(n_dropout_per_lens)
+        self.Y_cols = None if Y_cols is None else list(Y_cols)
+
+    @classmethod
+    def from_pred(cls, pred, posterior_name, Y_mean, Y_std, n_dropout_per_lens=None, Y_cols=None, posterior_kwargs=None):
+        """Alternative constructor from raw MC dropout network outputs
+
+        Parameters
+        ----------
+        pred : np.array of shape `[n_lenses, n_dropout, out_dim]`
+            raw network outputs, possibly NaN-padded beyond `n_dropout_per_lens`
+        posterior_name : str
+            `posterior_name` attribute of the likelihood class used in training
+        posterior_kwargs : dict
+            `posterior_kwargs` attribute of the likelihood class used in training. Default: None
+
+        See `__init__` for the other parameters.
+
+        """
+        n_lenses, n_dropout, out_dim = pred.shape
+        Y_dim = len(np.asarray(Y_mean).reshape(-1))
+        if n_dropout_per_lens is None:
+            n_dropout_per_lens = np.full(n_lenses, n_dropout)
+        valid = np.arange(n_dropout)[np.newaxis, :] < np.asarray(n_dropout_per_lens)[:, np.newaxis] # [n_lenses, n_dropout]
+        # Padded passes are filled with the first pass of the same lens, so that they stay well-defined
+        flat_pred = np.where(valid[:, :, np.newaxis], pred, pred[:, :1, :]).reshape(n_lenses*n_dropout, out_dim)
+        params = get_mixture_params(flat_pred, posterior_name, Y_dim, posterior_kwargs)
+        mu = params['mu'].reshape(n_lenses, n_dropout, -1, Y_dim)
+        prec_tril = params['prec_tril'].reshape(n_lenses, n_dropout, -1, Y_dim, Y_dim)
+        weights = params['weights'].reshape(n_lenses, n_dropout, -1)
+        return cls(mu, prec_tril, weights, Y_mean, Y_std, n_dropout_per_lens, Y_cols)
+
+    @classmethod
+    def from_file(cls, path):
+        """Alternative constructor that reads an export written by `save`
+
+        Parameters
+        ----------
+        path : str or os.path object
+            path to the `.npz` file
+
+        """
+        with np.load(path, allow_pickle=False) as f:
+            Y_cols = f['Y_cols'].tolist() if 'Y_cols' in f.files else None
+            return cls(f['mu'], f['prec_tril'], f['weights'], f['Y_mean'], f['Y_std'], f['n_dropout_per_lens'], Y_cols)
+
+    def save(self, path):
+        """Write the mixture parameters and whitening stats to a `.npz` file
+
+        The file size depends only on the number of lenses and MC dropout passes, not on the number of samples drawn later.
+
+        Parameters
+        ----------
+        path : str or os.path object
+
+        """
+        to_save = dict(mu=self.mu, prec_tril=self.prec_tril, weights=self.weights, Y_mean=self.Y_mean, Y_std=self.Y_std, n_dropout_per_lens=self.n_dropout_per_lens)
+        if self.Y_cols is not None:
+            to_save['Y_cols'] = np.array(self.Y_cols)
+        np.savez(path, **to_save)
+
+    def sample(self, n_samples_per_dropout, lens_idx=None, sample_seed=None):
+        """Draw samples from each MC dropout pass
+
+        Parameters
+        ----------
+        n_samples_per_dropout : int
+            number of samples per MC dropout pass
+        lens_idx : array-like of int
+            lenses to sample. Default: all lenses
+        sample_seed : int
+            seed for the samples. Default: None
+
+        Returns
+        -------
+        np.array of shape `[n_lenses, n_dropout, n_samples_per_dropout, Y_dim]`
+            unwhitened samples, laid out like the `samples.npy` export and NaN for the padded passes
+
+        """
+        lens_idx = np.arange(self.n_lenses) if lens_idx is None else np.asarray(lens_idx)
+        return self._sample(np.random.RandomState(sample_seed), n_samples_per_dropout, lens_idx)
+
+    def sample_chunks(self, n_samples_per_dropout, chunk_size=1000, lens_idx=None, sample_seed=None):
+        """Draw samples from each MC dropout pass in chunks of at most `chunk_size` samples per pass, so that memory doesn't grow with `n_samples_per_dropout`
+
+        Parameters
+        ----------
+        chunk_size : int
+            maximum number of samples per MC dropout pass in each chunk
+
+        See `sample` for the other parameters. Chunk `k` is seeded with `h0rton.h0_inference.gaussian_bnn_posterior_cpu.get_chunk_seed(sample_seed, k)`, so a single chunk reproduces `sample`.
+
+        Yields
+        ------
+        np.array of shape `[n_lenses, n_dropout, n_chunk, Y_dim]`
+            unwhitened samples, with `n_chunk` equal to `chunk_size` except possibly for the last chunk
+
+        """
+        lens_idx = np.arange(self.n_lenses) if lens_idx is None else np.asarray(lens_idx)
+        for chunk_idx, start in enumerate(range(0, n_samples_per_dropout, chunk_size)):
+            rng = np.random.RandomState(get_chunk_seed(sample_seed, chunk_idx))
+            yield self._sample(rng, min(chunk_size, n_samples_per_dropout - start), lens_idx)
+
+    def save_samples(self, path, n_samples_per_dropout, chunk_size=1000, sample_seed=None):
+        """Write samples in the layout of the `samples.npy` export, chunk by chunk, without holding them all in memory
+
+        Parameters
+        ----------
+        path : str or os.path object
+            path to the `.npy` file
+
+        See `sample_chunks` for the other parameters.
+
+        """
+        out = np.lib.format.open_memmap(path, mode='w+', dtype=np.float64, shape=(self.n_lenses, self.n_dropout, n_samples_per_dropout, self.Y_dim))
+        start = 0
+        for chunk in self.sample_chunks(n_samples_per_dropout, chunk_size, sample_seed=sample_seed):
+            out[:, :, start:start + chunk.shape[2], :] = chunk
+            start += chunk.shape[2]
+        out.flush()
+        del out
+
+    def _sample(self, rng, n_samples_per_dropout, lens_idx):
+        """Draw samples from each MC dropout pass of the given lenses with the given random state
+
+        """
+        mu = self.mu[lens_idx] # [n_lenses, n_dropout, n_components, Y_dim]
+        prec_tril = self.prec_tril[lens_idx]
+        weights = self.weights[lens_idx]
+        n_lenses = len(lens_idx)
+        # Pick a mixture component for each sample
+        cum_weights = np.cumsum(weights, axis=-1)
+        unif = rng.rand(n_lenses, self.n_dropout, n_samples_per_dropout, 1)
+        component = np.minimum(np.sum(unif > cum_weights[:, :, np.newaxis, :], axis=-1), self.n_components - 1) # [n_lenses, n_dropout, n_samples]
+        # x = mu + L^{-T} eps, where the precision matrix is L L^T, i.e. x^T = mu^T + eps^T L^{-1}
+        inv_tril = np.linalg.inv(prec_tril) # [n_lenses, n_dropout, n_components, Y_dim, Y_dim]
+        eps = rng.randn(n_lenses, self.n_dropout, n_samples_per_dropout, self.Y_dim)
+        samples = np.empty([n_lenses, self.n_dropout, n_samples_per_dropout, self.Y_dim])
+        # Each component is broadcast over the samples rather than gathering a matrix per sample
+        for c in range(self.n_components):
+            samples_c = mu[:, :, c, np.newaxis, :] + np.matmul(eps, inv_tril[:, :, c])
+            np.copyto(samples, samples_c, where=(component == c)[..., np.newaxis])
+        samples = samples*self.Y_std + self.Y_mean
+        samples[np.arange(self.n_dropout)[np.newaxis, :] >= self.n_dropout_per_lens[lens_idx][:, np.newaxis]] = np.nan
+        return samples
+
+def load_bnn_posterior_samples(path, n_samples_per_dropout=None, sample_seed=None, chunk_size=None):
+    """Read BNN posterior samples from either export format, e.g. in the demo notebooks
+
+    Parameters
+    ----------
+    path : str or os.path object
+        path to a `samples.npy` file or to a parametric `.npz` export written by `ParametricBNNPosterior.save`
+    n_samples_per_dropout : int
+        number of samples per MC dropout pass to draw from a parametric export. Ignored for `samples.npy`.
+    sample_seed : int
+        seed for the samples drawn from a parametric export. Default: None
+    chunk_size : int
+        if given, return a generator over chunks of at most `chunk_size` samples per pass instead of a single array. A `samples.npy` file is then memory-mapped and read chunk by chunk. Default: None
+
+    Returns
+    -------
+    np.array of shape `[n_lenses, n_dropout, n_samples_per_dropout, Y_dim]`, or a generator of such arrays with at most `chunk_size` samples per pass
+        unwhitened samples
+
+    """
+    if str(path).endswith('.npy'):
+        if chunk_size is None:
+            return np.load(path)
+        samples = np.load(path, mmap_mode='r')
+        return (np.array(samples[:, :, start:start + chunk_size, :]) for start in range(0, samples.shape[2], chunk_size))
+    if n_samples_per_dropout is None:
+        raise ValueError("n_samples_per_dropout must be specified for a parametric export.")
+    bnn_post = ParametricBNNPosterior.from_file(path)
+    if chunk_size is None:
+        return bnn_post.sample(n_samples_per_dropout, sample_seed=sample_seed)
+    return bnn_post.sample_chunks(n_samples_per_dropout, chunk_size, sample_seed=sample_seed)
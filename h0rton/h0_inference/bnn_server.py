@@ -0,0 +1,514 @@
+"""Long-lived local BNN inference service
+
+The service holds one or more loaded networks so that interactive work, e.g. in the demo notebooks, doesn't pay the model load and warm-up cost on every call. Concurrent requests for the same network are queued and coalesced into a single batch of MC dropout passes, which is run once the batch is full or the oldest request has waited for the latency deadline. The service is exposed over HTTP on localhost with the standard library only, and arrays travel as base64-encoded `.npy` bytes.
+
+"""
+import io
+import json
+import time
+import queue
+import base64
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib import request as urllib_request
+from urllib.error import HTTPError
+import numpy as np
+import torch
+import h0rton.losses
+import h0rton.models
+from h0rton.h0_inference.mc_dropout_utils import get_mc_dropout_preds
+from h0rton.h0_inference.bnn_posterior_export import ParametricBNNPosterior
+
+__all__ = ['encode_array', 'decode_array', 'RequestBatcher', 'BNNService', 'make_server', 'BNNClient']
+
+valid_outputs = ['pred', 'mean', 'samples']
+
+def encode_array(array):
+    """Encode an array as base64 `.npy` bytes, for sending in a JSON body
+
+    """
+    buffer = io.BytesIO()
+    np.save(buffer, np.asarray(array), allow_pickle=False)
+    return base64.b64encode(buffer.getvalue()).decode('ascii')
+
+def decode_array(encoded):
+    """Decode an array encoded with `encode_array`
+
+    """
+    return np.load(io.BytesIO(base64.b64decode(encoded)), allow_pickle=False)
+
+class _PendingRequest:
+    """Request waiting in the queue of a `RequestBatcher`
+
+    """
+    def __init__(self, payload, n_items):
+        self.payload = payload
+        self.n_items = n_items
+        self.submitted_at = time.perf_counter()
+        self.started_at = None
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class RequestBatcher:
+    """Coalesces concurrent requests into batches, processed in a single worker thread
+
+    A batch is closed when it holds `max_batch_size` items or when its oldest request has waited `max_wait` seconds, whichever comes first. A single request larger than `max_batch_size` is processed on its own.
+
+    """
+    def __init__(self, process_batch, max_batch_size=64, max_wait=0.01, n_latencies=1000):
+        """
+        Parameters
+        ----------
+        process_batch : callable
+            maps a list of request payloads to the list of their results
+        max_batch_size : int
+            maximum number of items (e.g. lens images) per batch
+        max_wait : float
+            latency deadline, in seconds, after which a batch is processed even if not full
+        n_latencies : int
+            number of most recent requests used for the latency percentiles
+
+        """
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.n_requests = 0
+        self.n_items = 0
+        self.n_batches = 0
+        self.n_errors = 0
+        self.latencies = deque(maxlen=n_latencies)
+        self.queue_waits = deque(maxlen=n_latencies)
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def submit(self, payload, n_items=1):
+        """Queue a request and block until its result is ready
+
+        Parameters
+        ----------
+        payload : object
+            passed to `process_batch` along with the other requests in the batch
+        n_items : int
+            number of items the request counts for towards `max_batch_size`
+
+        Returns
+        -------
+        object
+            the result for this payload
+
+        """
+        pending = _PendingRequest(payload, n_items)
+        self.queue.put(pending)
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def close(self):
+        """Stop the worker thread once the requests already queued are processed
+
+        """
+        self.queue.put(None)
+        self.worker.join()
+
+    def _collect_batch(self, first):
+        """Gather queued requests behind `first` until the batch is full or the deadline passes
+
+        Returns
+        -------
+        batch : list of _PendingRequest
+        stop : bool
+            whether the shutdown signal was received
+
+        """
+        batch = [first]
+        n_items = first.n_items
+        deadline = first.submitted_at + self.max_wait
+        while n_items < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                pending = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if pending is None:
+                return batch, True
+            batch.append(pending)
+            n_items += pending.n_items
+        return batch, False
+
+    def _run(self):
+        stop = False
+        while not stop:
+            first = self.queue.get()
+            if first is None:
+                break
+            batch, stop = self._collect_batch(first)
+            started_at = time.perf_counter()
+            for pending in batch:
+                pending.started_at = started_at
+            try:
+                results = self.process_batch([pending.payload for pending in batch])
+                for pending, result in zip(batch, results):
+                    pending.result = result
+            except Exception as e:
+                for pending in batch:
+                    pending.error = e
+            finished_at = time.perf_counter()
+            with self.lock:
+                self.n_batches += 1
+                self.n_requests += len(batch)
+                self.n_items += sum(pending.n_items for pending in batch)
+                self.n_errors += len(batch) if batch[0].error is not None else 0
+                for pending in batch:
+                    self.latencies.append(finished_at - pending.submitted_at)
+                    self.queue_waits.append(pending.started_at - pending.submitted_at)
+            for pending in batch:
+                pending.done.set()
+
+    def get_metrics(self):
+        """Summarize the queue depth, batching, and latency
+
+        Returns
+        -------
+        dict
+            `queue_depth` is the number of requests waiting now. Latencies are in seconds, from submission to result, over the most recent requests. `queue_wait` is the part of the latency spent waiting for the batch to close.
+
+        """
+        with self.lock:
+            latencies = np.array(self.latencies)
+            queue_waits = np.array(self.queue_waits)
+            metrics = dict(queue_depth=self.queue.qsize(),
+                           n_requests=self.n_requests,
+                           n_items=self.n_items,
+                           n_batches=self.n_batches,
+                           n_errors=self.n_errors,
+                           mean_batch_size=self.n_items/max(self.n_batches, 1))
+        for name, values in [('latency', latencies), ('queue_wait', queue_waits)]:
+            for q in [50, 95, 99]:
+                metrics['{:s}_p{:d}'.format(name, q)] = float(np.percentile(values, q)) if len(values) > 0 else None
+            metrics['{:s}_mean'.format(name)] = float(np.mean(values)) if len(values) > 0 else None
+        return metrics
+
+class BNNService:
+    """Holds loaded BNNs and serves MC dropout predictions or BNN posterior samples from them
+
+    Each network gets its own `RequestBatcher`, so requests for different networks don't wait on each other.
+
+    """
+    def __init__(self, device=torch.device('cpu'), max_batch_size=64, max_wait=0.01, forward_batch_size=None):
+        """
+        Parameters
+        ----------
+        device : torch.device object
+            device on which to run the networks
+        max_batch_size : int
+            maximum number of lenses coalesced into a batch
+        max_wait : float
+            latency deadline, in seconds, for closing a batch
+        forward_batch_size : int
+            maximum number of images per forward pass within a batch. Default: the whole batch at once
+
+        """
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.forward_batch_size = forward_batch_size
+        self.models = {}
+        self.lock = threading.Lock()
+
+    def add_model(self, name, net, likelihood_class, Y_mean, Y_std, Y_cols=None, X_dim=None, likelihood_kwargs={}):
+        """Register a network that's already built and loaded with trained weights
+
+        Parameters
+        ----------
+        name : str
+            name under which requests refer to the network
+        net : torch.nn.Module
+            BNN whose dropout layers stay active at evaluation time
+        likelihood_class : str
+            name of the likelihood class in `h0rton.losses` used in training
+        Y_mean : np.array of shape `[Y_dim,]`
+            training-set mean used for whitening
+        Y_std : np.array of shape `[Y_dim,]`
+            training-set std used for whitening
+        Y_cols : list of str
+            names of the predicted parameters
+        X_dim : int
+            number of pixels on each side of the input image. If given, the network is warmed up with a forward pass. Otherwise, the first request sets the image size that later requests must match.
+        likelihood_kwargs : dict
+            keyword arguments of the likelihood class besides `Y_dim` and `device`, e.g. `n_components` for `MixtureGaussianNLL`
+
+        """
+        if name in self.models:
+            raise ValueError("A model named {:s} is already loaded.".format(name))
+        net = net.to(self.device).eval()
+        n_filters = next(module for module in net.modules() if isinstance(module, torch.nn.Conv2d)).in_channels
+        if X_dim is not None:
+            with torch.no_grad():
+                net(torch.zeros(1, n_filters, X_dim, X_dim, device=self.device))
+        loss_fn = getattr(h0rton.losses, likelihood_class)(Y_dim=len(np.asarray(Y_mean).reshape(-1)), device=self.device, **likelihood_kwargs)
+        model = dict(net=net,
+                     likelihood_class=likelihood_class,
+                     posterior_name=loss_fn.posterior_name,
+                     posterior_kwargs=loss_fn.posterior_kwargs,
+                     Y_mean=np.asarray(Y_mean, dtype=float).reshape(-1),
+                     Y_std=np.asarray(Y_std, dtype=float).reshape(-1),
+                     Y_cols=None if Y_cols is None else list(Y_cols),
+                     out_dim=net.fc.out_features,
+                     n_filters=n_filters,
+                     X_dim=X_dim)
+        model['batcher'] = RequestBatcher(lambda payloads: self._process_batch(model, payloads), max_batch_size=self.max_batch_size, max_wait=self.max_wait)
+        self.models[name] = model
+
+    def load_model(self, name, artifact_path, X_dim=None):
+        """Load and register a network from an inference-only artifact
+
+        Parameters
+        ----------
+        name : str
+            name under which requests refer to the network
+        artifact_path : str or os.path object
+            path to an artifact written by `h0rton.models.save_inference_artifact`
+        X_dim : int
+            number of pixels on each side of the input image, for warming up the network
+
+        """
+        net, metadata = h0rton.models.load_inference_artifact(artifact_path, self.device)
+        self.add_model(name, net, metadata['likelihood_class'], metadata['Y_mean'], metadata['Y_std'], metadata['Y_cols'], X_dim=X_dim, likelihood_kwargs=metadata['likelihood_kwargs'])
+
+    def get_model_info(self):
+        """Describe the loaded networks
+
+        Returns
+        -------
+        dict
+            maps each name to its `likelihood_class`, `Y_cols`, and `out_dim`
+
+        """
+        return {name: dict(likelihood_class=model['likelihood_class'], Y_cols=model['Y_cols'], out_dim=model['out_dim']) for name, model in self.models.items()}
+
+    def get_metrics(self):
+        """Get the queue depth and latency metrics of each network
+
+        Returns
+        -------
+        dict
+            maps each name to the output of `RequestBatcher.get_metrics`
+
+        """
+        return {name: model['batcher'].get_metrics() for name, model in self.models.items()}
+
+    def predict(self, X, model=None, n_dropout=20, output='pred', whitened=True, n_samples_per_dropout=1, sample_seed=None):
+        """Get MC dropout predictions or BNN posterior samples for some lenses, blocking until they're ready
+
+        Parameters
+        ----------
+        X : np.array of shape `[n_lenses, n_filters, X_dim, X_dim]`
+            input images, preprocessed as in training
+        model : str
+            name of the network. Default: the only loaded network
+        n_dropout : int
+            number of MC dropout passes
+        output : str
+            one of `pred` (raw network outputs, whitened only), `mean` (mean of the predicted Gaussian mixture for each pass), or `samples` (BNN posterior samples)
+        whitened : bool
+            whether to return `mean` or `samples` in the whitened space rather than in physical units
+        n_samples_per_dropout : int
+            number of samples per MC dropout pass, for `samples`
+        sample_seed : int
+            seed for the samples. Default: None
+
+        Returns
+        -------
+        np.array
+            of shape `[n_lenses, n_dropout, out_dim]` for `pred`, `[n_lenses, n_dropout, Y_dim]` for `mean`, and `[n_lenses, n_dropout, n_samples_per_dropout, Y_dim]` for `samples`
+
+        """
+        if model is None:
+            if len(self.models) != 1:
+                raise ValueError("model must be specified when {:d} models are loaded.".format(len(self.models)))
+            model = next(iter(self.models))
+        if model not in self.models:
+            raise ValueError("No model named {:s} is loaded.".format(str(model)))
+        if output not in valid_outputs:
+            raise ValueError("output must be one of {}.".format(valid_outputs))
+        if output == 'pred' and not whitened:
+            raise ValueError("Raw network outputs are only available in the whitened space.")
+        X = np.asarray(X)
+        if not (np.issubdtype(X.dtype, np.floating) or np.issubdtype(X.dtype, np.integer)):
+            raise ValueError("X must hold real numbers, not {:s}.".format(str(X.dtype)))
+        X = X.astype(np.float32, copy=False)
+        self._check_input_shape(self.models[model], X.shape)
+        payload = dict(X=X, n_dropout=int(n_dropout), output=output, whitened=whitened, n_samples_per_dropout=int(n_samples_per_dropout), sample_seed=sample_seed)
+        return self.models[model]['batcher'].submit(payload, n_items=X.shape[0])
+
+    def _check_input_shape(self, model, X_shape):
+        """Refuse a request whose images can't be batched with the others before it reaches the queue
+
+        """
+        if len(X_shape) != 4 or X_shape[2] != X_shape[3]:
+            raise ValueError("X must have shape [n_lenses, n_filters, X_dim, X_dim].")
+        if X_shape[1] != model['n_filters']:
+            raise ValueError("X has {:d} filters but the network takes {:d}.".format(X_shape[1], model['n_filters']))
+        with self.lock:
+            if model['X_dim'] is None:
+                model['X_dim'] = X_shape[2]
+        if X_shape[2] != model['X_dim']:
+            raise ValueError("X has images of {:d} pixels on a side but the network takes {:d}.".format(X_shape[2], model['X_dim']))
+
+    def _process_batch(self, model, payloads):
+        """Run the MC dropout passes for all the requests in a batch at once, then format each request's output
+
+        The batch gets as many passes as the most demanding request, and each request keeps its first `n_dropout`.
+
+        """
+        X = torch.from_numpy(np.concatenate([payload['X'] for payload in payloads], axis=0)).to(self.device)
+        n_dropout = max(payload['n_dropout'] for payload in payloads)
+        pred = get_mc_dropout_preds(model['net'], X, n_dropout, batch_size=self.forward_batch_size) # [n_lenses, n_dropout, out_dim]
+        results = []
+        start = 0
+        for payload in payloads:
+            end = start + payload['X'].shape[0]
+            results.append(self._format_output(model, pred[start:end, :payload['n_dropout'], :], payload))
+            start = end
+        return results
+
+    def _format_output(self, model, pred, payload):
+        """Convert the raw outputs of one request into the requested output
+
+        """
+        if payload['output'] == 'pred':
+            return pred
+        Y_dim = len(model['Y_mean'])
+        if payload['whitened']:
+            Y_mean, Y_std = np.zeros(Y_dim), np.ones(Y_dim)
+        else:
+            Y_mean, Y_std = model['Y_mean'], model['Y_std']
+        bnn_post = ParametricBNNPosterior.from_pred(pred, model['posterior_name'], Y_mean, Y_std, Y_cols=model['Y_cols'], posterior_kwargs=model['posterior_kwargs'])
+        if payload['output'] == 'mean':
+            mean = np.sum(bnn_post.weights[..., np.newaxis]*bnn_post.mu, axis=2) # [n_lenses, n_dropout, Y_dim]
+            return mean*Y_std + Y_mean
+        return bnn_post.sample(payload['n_samples_per_dropout'], sample_seed=payload['sample_seed'])
+
+    def close(self):
+        """Stop the batching threads
+
+        """
+        for model in self.models.values():
+            model['batcher'].close()
+
+class _BNNRequestHandler(BaseHTTPRequestHandler):
+    """HTTP handler exposing a `BNNService`
+
+    `GET /models` describes the loaded networks, `GET /metrics` reports the queue depth and latency, and `POST /predict` takes the keyword arguments of `BNNService.predict` as a JSON body, with `X` encoded by `encode_array`.
+
+    """
+    def _send_json(self, status, body):
+        encoded = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(encoded)))
+        self.end_headers()
+        self.wfile.write(encoded)
+
+    def do_GET(self):
+        if self.path == '/models':
+            self._send_json(200, self.server.service.get_model_info())
+        elif self.path == '/metrics':
+            self._send_json(200, self.server.service.get_metrics())
+        else:
+            self._send_json(404, dict(error="Unknown path {:s}".format(self.path)))
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self._send_json(404, dict(error="Unknown path {:s}".format(self.path)))
+            return
+        try:
+            kwargs = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+            kwargs['X'] = decode_array(kwargs['X'])
+            result = self.server.service.predict(**kwargs)
+        except (ValueError, KeyError, TypeError) as e:
+            self._send_json(400, dict(error=str(e)))
+            return
+        except Exception as e:
+            # Any other failure, e.g. of the forward pass, must still answer the client
+            self._send_json(500, dict(error="{:s}: {:s}".format(type(e).__name__, str(e))))
+            return
+        self._send_json(200, dict(result=encode_array(result)))
+
+    def log_message(self, format, *args):
+        # Keep the notebook or terminal running the service quiet
+        pass
+
+def make_server(service, host='127.0.0.1', port=8765):
+    """Build an HTTP server for a `BNNService`, handling each connection in its own thread so that concurrent requests can be batched
+
+    Parameters
+    ----------
+    service : BNNService
+    host : str
+        address to bind. Default: localhost only
+    port : int
+        port to bind. Use 0 to pick a free port.
+
+    Returns
+    -------
+    http.server.ThreadingHTTPServer
+        call `serve_forever` to start serving, e.g. in a background thread, and `shutdown` to stop
+
+    """
+    server = ThreadingHTTPServer((host, port), _BNNRequestHandler)
+    server.daemon_threads = True
+    server.service = service
+    return server
+
+class BNNClient:
+    """Client for a BNN service started with `make_server`, e.g. from a notebook
+
+    """
+    def __init__(self, url='http://127.0.0.1:8765', timeout=600):
+        """
+        Parameters
+        ----------
+        url : str
+            base URL of the service
+        timeout : float
+            timeout of each call, in seconds
+
+        """
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def _call(self, path, body=None):
+        data = None if body is None else json.dumps(body).encode('utf-8')
+        req = urllib_request.Request(self.url + path, data=data, headers={'Content-Type': 'application/json'})
+        try:
+            with urllib_request.urlopen(req, timeout=self.timeout) as response:
+                return json.loads(response.read().decode('utf-8'))
+        except HTTPError as e:
+            raise ValueError(json.loads(e.read().decode('utf-8'))['error'])
+
+    def get_model_info(self):
+        """See `BNNService.get_model_info`
+
+        """
+        return self._call('/models')
+
+    def get_metrics(self):
+        """See `BNNService.get_metrics`
+
+        """
+        return self._call('/metrics')
+
+    def predict(self, X, **kwargs):
+        """See `BNNService.predict`, which takes the same arguments
+
+        """
+        body = dict(kwargs, X=encode_array(np.asarray(X, dtype=np.float32)))
+        return decode_array(self._call('/predict', body)['result'])
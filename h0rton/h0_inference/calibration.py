@@ -0,0 +1,124 @@
+"""Calibration diagnostics of the BNN posteriors, computed analytically from the Gaussian mixture parameters
+
+For each lens, the MC dropout posterior is the equal-weight mixture, over the valid passes, of the Gaussian (or two-Gaussian) posterior of each pass. Instead of sampling it, the credible level at which each true label is first included is evaluated directly:
+
+* per parameter, the level of the central interval whose boundary passes through the truth, `|2 F(y) - 1|`, where `F` is the analytic CDF of the 1D marginal mixture,
+* jointly, the level of the HPD ellipsoid through the truth, `chi2_{Y_dim}(r^2)`, where `r` is the Mahalanobis distance of the truth. For a mixture, the mixture is replaced by the Gaussian with the same mean and covariance.
+
+For a single Gaussian, both are exact. The coverage at credible level `c` is then the fraction of lenses whose truth level is at most `c`, which for a calibrated posterior equals `c`.
+
+"""
+import numpy as np
+import pandas as pd
+from scipy.stats import chi2
+from h0rton.h0_inference.gaussian_bnn_posterior_cpu import get_mixture_cdf
+
+__all__ = ['get_truth_levels', 'get_coverage_curves', 'get_coverage_summary']
+
+def _get_pass_weights(bnn_post):
+    """Weights of every (pass, component) pair in the MC dropout mixture of each lens, with the padded passes weighted 0
+
+    """
+    valid = np.arange(bnn_post.n_dropout)[np.newaxis, :] < bnn_post.n_dropout_per_lens[:, np.newaxis] # [n_lenses, n_dropout]
+    weights = bnn_post.weights*valid[:, :, np.newaxis]/bnn_post.n_dropout_per_lens[:, np.newaxis, np.newaxis]
+    return weights.reshape(bnn_post.n_lenses, -1) # [n_lenses, n_dropout*n_components]
+
+def get_truth_levels(bnn_post, Y, whitened=True):
+    """Get the credible levels at which the true labels are first included, for all lenses at once
+
+    Parameters
+    ----------
+    bnn_post : h0rton.h0_inference.bnn_posterior_export.ParametricBNNPosterior
+        MC dropout posteriors of the lenses
+    Y : np.array of shape `[n_lenses, Y_dim]`
+        true labels
+    whitened : bool
+        whether `Y` is whitened with the training-set stats of `bnn_post`, like the network outputs
+
+    Returns
+    -------
+    dict
+        `marginal` of shape `[n_lenses, Y_dim]`, the central-interval level of each parameter, and `joint` of shape `[n_lenses,]`, the HPD level of all parameters together
+
+    """
+    Y = np.asarray(Y, dtype=float)
+    if not whitened:
+        Y = (Y - bnn_post.Y_mean)/bnn_post.Y_std
+    n_lenses, Y_dim = bnn_post.n_lenses, bnn_post.Y_dim
+    weights = _get_pass_weights(bnn_post) # [n_lenses, n_mix]
+    mu = bnn_post.mu.reshape(n_lenses, -1, Y_dim) # [n_lenses, n_mix, Y_dim]
+    # The covariance matrix of each component is L^{-T} L^{-1}, for precision matrix L L^T
+    inv_tril = np.linalg.inv(bnn_post.prec_tril.reshape(n_lenses, -1, Y_dim, Y_dim))
+    cov = np.matmul(np.swapaxes(inv_tril, -1, -2), inv_tril) # [n_lenses, n_mix, Y_dim, Y_dim]
+    # Marginal levels from the exact 1D mixture CDFs, one mixture per (lens, parameter)
+    sd = np.sqrt(np.diagonal(cov, axis1=-2, axis2=-1)) # [n_lenses, n_mix, Y_dim]
+    flat = lambda arr: np.swapaxes(arr, 1, 2).reshape(n_lenses*Y_dim, -1)
+    cdf, _ = get_mixture_cdf(Y.reshape(-1, 1), np.repeat(weights, Y_dim, axis=0), flat(mu), flat(sd))
+    marginal = np.abs(2.0*cdf.reshape(n_lenses, Y_dim) - 1.0)
+    # Joint levels from the Mahalanobis distance to the moment-matched Gaussian
+    mean = np.sum(weights[:, :, np.newaxis]*mu, axis=1) # [n_lenses, Y_dim]
+    second_moment = cov + mu[:, :, :, np.newaxis]*mu[:, :, np.newaxis, :]
+    total_cov = np.sum(weights[:, :, np.newaxis, np.newaxis]*second_moment, axis=1) - mean[:, :, np.newaxis]*mean[:, np.newaxis, :]
+    resid = np.linalg.solve(np.linalg.cholesky(total_cov), (Y - mean)[:, :, np.newaxis])[:, :, 0]
+    joint = chi2.cdf(np.sum(resid**2.0, axis=1), df=Y_dim)
+    return dict(marginal=marginal, joint=joint)
+
+def get_coverage_curves(levels, Y_cols=None, credible_levels=None):
+    """Get the fraction of lenses whose truth falls within the credible regions, as a function of the credible level
+
+    Parameters
+    ----------
+    levels : dict
+        output of `get_truth_levels`
+    Y_cols : list of str
+        names of the parameters, used as column names. Default: `param_0`, `param_1`, ...
+    credible_levels : array-like
+        credible levels at which to evaluate the coverage. Default: 101 levels spaced evenly in [0, 1]
+
+    Returns
+    -------
+    pd.DataFrame
+        columns `credible_level`, `joint`, and one per parameter
+
+    """
+    if credible_levels is None:
+        credible_levels = np.linspace(0.0, 1.0, 101)
+    credible_levels = np.asarray(credible_levels, dtype=float)
+    Y_dim = levels['marginal'].shape[1]
+    if Y_cols is None:
+        Y_cols = ['param_{:d}'.format(i) for i in range(Y_dim)]
+    curves = dict(credible_level=credible_levels)
+    curves['joint'] = np.mean(levels['joint'][:, np.newaxis] <= credible_levels[np.newaxis, :], axis=0)
+    marginal_coverage = np.mean(levels['marginal'][:, :, np.newaxis] <= credible_levels[np.newaxis, np.newaxis, :], axis=0) # [Y_dim, n_levels]
+    for i, col in enumerate(Y_cols):
+        curves[col] = marginal_coverage[i]
+    return pd.DataFrame(curves)
+
+def get_coverage_summary(levels, Y_cols=None, credible_levels=[0.6827, 0.9545, 0.9973]):
+    """Summarize the coverage at a few credible levels, e.g. for logging
+
+    Parameters
+    ----------
+    levels : dict
+        output of `get_truth_levels`
+    Y_cols : list of str
+        names of the parameters. Default: `param_0`, `param_1`, ...
+    credible_levels : list of float
+        credible levels to report. Default: 1, 2, and 3 sigma
+
+    Returns
+    -------
+    dict
+        `coverage_<level>_joint`, `coverage_<level>_marginal` (averaged over the parameters), and `coverage_<level>_<Y_col>` for each parameter, with `<level>` the credible level in percent, e.g. `68`
+
+    """
+    curves = get_coverage_curves(levels, Y_cols, credible_levels)
+    param_cols = [col for col in curves.columns if col not in ['credible_level', 'joint']]
+    summary = {}
+    for _, row in curves.iterrows():
+        name = 'coverage_{:d}'.format(int(100.0*row['credible_level']))
+        summary['{:s}_joint'.format(name)] = row['joint']
+        summary['{:s}_marginal'.format(name)] = np.mean(row[param_cols].values)
+        for col in param_cols:
+            summary['{:s}_{:s}'.format(name, col)] = row[col]
+    return summary
@@ -2,7 +2,8 @@ from abc import ABC, abstractmethod
 import random
 import numpy as np
 import torch
-__all__ = ['BaseGaussianBNNPosterior', 'DiagonalGaussianBNNPosterior', 'LowRankGaussianBNNPosterior', 'DoubleLowRankGaussianBNNPosterior', 'FullRankGaussianBNNPosterior', 'DoubleGaussianBNNPosterior']
+from h0rton.h0_inference.gaussian_bnn_posterior_cpu import get_chunk_seed, sampling_methods, get_mixture_quantiles, get_mixture_hpd_interval
+__all__ = ['BaseGaussianBNNPosterior', 'DiagonalGaussianBNNPosterior', 'LowRankGaussianBNNPosterior', 'DoubleLowRankGaussianBNNPosterior', 'FullRankGaussianBNNPosterior', 'DoubleGaussianBNNPosterior', 'MixtureGaussianBNNPosterior']
 
 class BaseGaussianBNNPosterior(ABC):
     """Abstract base class to represent the Gaussian BNN posterior
@@ -48,7 +49,7 @@ class BaseGaussianBNNPosterior(ABC):
         torch.backends.cudnn.benchmark = False
 
     @abstractmethod
-    def sample(self, n_samples, sample_seed=None):
+    def sample(self, n_samples, sample_seed=None, sampling='mc'):
         """Sample from the Gaussian posterior. Must be overridden by subclasses.
 
         Parameters
@@ -57,6 +58,8 @@ class BaseGaussianBNNPosterior(ABC):
             how many samples to obtain
         sample_seed : int
             seed for the samples. Default: None
+        sampling : str
+            one of `h0rton.h0_inference.gaussian_bnn_posterior_cpu.sampling_methods`. Default: `mc`
 
         Returns
         -------
@@ -66,13 +69,149 @@ class BaseGaussianBNNPosterior(ABC):
         """
         return NotImplemented
 
+    def sample_chunks(self, n_samples, chunk_size=10000, sample_seed=None, sampling='mc'):
+        """Sample in chunks of at most `chunk_size` samples per lens, so that memory doesn't grow with `n_samples`
+
+        Parameters
+        ----------
+        n_samples : int
+            total number of samples per lens
+        chunk_size : int
+            maximum number of samples per lens in each chunk
+        sample_seed : int
+            seed for the samples. Chunk `k` is seeded with `h0rton.h0_inference.gaussian_bnn_posterior_cpu.get_chunk_seed(sample_seed, k)`. Default: None
+        sampling : str
+            one of `h0rton.h0_inference.gaussian_bnn_posterior_cpu.sampling_methods`, applied within each chunk. Default: `mc`
+
+        Yields
+        ------
+        np.array of shape `[self.batch_size, n_chunk, self.Y_dim]`
+            samples, with `n_chunk` equal to `chunk_size` except possibly for the last chunk
+
+        """
+        for chunk_idx, start in enumerate(range(0, n_samples, chunk_size)):
+            yield self.sample(min(chunk_size, n_samples - start), get_chunk_seed(sample_seed, chunk_idx), sampling)
+
+    def get_standard_normal(self, n_samples, n_latent, sampling='mc', device=None, dtype=None):
+        """Draw standard normal variates for each lens, to be mapped to posterior samples by the `transform_*` methods
+
+        Parameters
+        ----------
+        n_samples : int
+            how many draws per lens
+        n_latent : int
+            number of standard normal variates per draw
+        sampling : str
+            `mc` for independent draws. `antithetic` for pairs `eps`, `-eps` laid out next to each other, so that any leading subset of the draws is mostly paired. `qmc` for an independently scrambled Sobol sequence per lens, mapped through the inverse normal CDF. The Sobol points are best balanced when `n_samples` is a power of 2.
+        device : torch.device
+            device of the draws
+        dtype : torch.dtype
+            type of the draws
+
+        Returns
+        -------
+        torch.Tensor of shape `[self.batch_size, n_samples, n_latent]`
+
+        """
+        if sampling == 'mc':
+            return torch.randn(self.batch_size, n_samples, n_latent, device=device, dtype=dtype)
+        elif sampling == 'antithetic':
+            eps = torch.randn(self.batch_size, (n_samples + 1)//2, 1, n_latent, device=device, dtype=dtype)
+            eps = torch.cat([eps, -eps], dim=2).reshape(self.batch_size, -1, n_latent)
+            return eps[:, :n_samples, :]
+        elif sampling == 'qmc':
+            seeds = torch.randint(2**31, [self.batch_size]).tolist()
+            unif = torch.stack([torch.quasirandom.SobolEngine(n_latent, scramble=True, seed=seed).draw(n_samples, dtype=torch.float64) for seed in seeds], dim=0)
+            # Scrambled points are never exactly 0 or 1 in practice, but guard the inverse CDF anyway
+            eps = 2.0**0.5*torch.erfinv(2.0*torch.clamp(unif, 1.e-12, 1.0 - 1.e-12) - 1.0)
+            return eps.to(device=device, dtype=dtype)
+        else:
+            raise ValueError("sampling must be one of {}.".format(sampling_methods))
+
     @abstractmethod
-    def get_hpd_interval(self):
-        """Get the highest posterior density (HPD) interval
+    def get_marginal_components(self):
+        """Get the Gaussian components of the marginal posterior of each parameter, in whitened units. Must be overridden by subclasses.
+
+        Returns
+        -------
+        weights : torch.Tensor of shape `[self.batch_size, n_components]`
+            component weights
+        mu : torch.Tensor of shape `[self.batch_size, self.Y_dim, n_components]`
+            component means
+        sd : torch.Tensor of shape `[self.batch_size, self.Y_dim, n_components]`
+            component standard deviations
 
         """
         return NotImplemented
 
+    def _get_unwhitened_marginals(self):
+        """Marginal components in unwhitened units, flattened over lenses and parameters, as numpy arrays for the root-find
+
+        """
+        weights, mu, sd = [arr.data.cpu().double() for arr in self.get_marginal_components()]
+        n_components = weights.shape[1]
+        Y_mean = self.Y_mean.cpu().double().reshape(1, -1, 1)
+        Y_std = self.Y_std.cpu().double().reshape(1, -1, 1)
+        mu = (mu*Y_std + Y_mean).reshape(-1, n_components)
+        sd = (sd*Y_std).reshape(-1, n_components)
+        weights = torch.repeat_interleave(weights, self.Y_dim, dim=0)
+        return weights.numpy(), mu.numpy(), sd.numpy()
+
+    def get_marginal_quantiles(self, q):
+        """Get marginal quantiles of every parameter for all lenses at once, without sampling
+
+        Parameters
+        ----------
+        q : float or array-like of shape `[n_q,]`
+            probabilities in (0, 1)
+
+        Returns
+        -------
+        np.array of shape `[self.batch_size, self.Y_dim, n_q]`
+            unwhitened quantiles
+
+        """
+        q = np.atleast_1d(q).astype(float)
+        quantiles = get_mixture_quantiles(q, *self._get_unwhitened_marginals())
+        return quantiles.reshape(self.batch_size, self.Y_dim, len(q))
+
+    def get_hpd_interval(self, credible_mass=0.6827, n_grid=101):
+        """Get the highest posterior density (HPD) interval of the marginal posterior of every parameter for all lenses at once, without sampling
+
+        Parameters
+        ----------
+        credible_mass : float
+            probability content of the interval. Default: 0.6827, i.e. 1 sigma
+        n_grid : int
+            number of candidate intervals for the mixtures. See `h0rton.h0_inference.gaussian_bnn_posterior_cpu.get_mixture_hpd_interval`.
+
+        Returns
+        -------
+        np.array of shape `[self.batch_size, self.Y_dim, 2]`
+            unwhitened lower and upper bounds
+
+        """
+        interval = get_mixture_hpd_interval(credible_mass, *self._get_unwhitened_marginals(), n_grid=n_grid)
+        return interval.reshape(self.batch_size, self.Y_dim, 2)
+
+    def get_full_rank_marginal_sd(self, prec_tril):
+        """Get the marginal standard deviations of a Gaussian with a full-rank covariance matrix
+
+        Parameters
+        ----------
+        prec_tril : torch.Tensor of shape `[self.batch_size, self.Y_dim, self.Y_dim]`
+            lower-triangular Cholesky factor `L` of the precision matrix, as returned by `get_prec_tril`
+
+        Returns
+        -------
+        torch.Tensor of shape `[self.batch_size, self.Y_dim]`
+
+        """
+        # The covariance matrix is L^{-T} L^{-1}, whose diagonal holds the squared column norms of L^{-1}
+        eye = torch.eye(self.Y_dim, device=prec_tril.device, dtype=prec_tril.dtype).expand_as(prec_tril)
+        inv_tril = torch.linalg.solve_triangular(prec_tril, eye, upper=False)
+        return torch.sqrt(torch.sum(inv_tril**2.0, dim=1))
+
     def transform_back_mu(self, tensor):
         """Transform back, i.e. unwhiten, the tensor of central values
 
@@ -139,7 +278,56 @@ class BaseGaussianBNNPosterior(ABC):
         sample = sample*self.Y_std.unsqueeze(1) + self.Y_mean.unsqueeze(1)
         return sample
 
-    def sample_low_rank(self, n_samples, mu, logvar, F):
+    def transform_diagonal(self, eps, mu, logvar):
+        """Map standard normal draws to samples from a single Gaussian posterior with diagonal covariance matrix
+
+        Parameters
+        ----------
+        eps : torch.Tensor of shape `[self.batch_size, n_samples, self.Y_dim]`
+            standard normal draws
+        mu : torch.Tensor of shape `[self.batch_size, self.Y_dim]`
+            network prediction of the mu (mean parameter) of the BNN posterior
+        logvar : torch.Tensor of shape `[self.batch_size, self.Y_dim]`
+            network prediction of the log of the diagonal elements of the covariance matrix
+
+        Returns
+        -------
+        torch.Tensor of shape `[self.batch_size, n_samples, self.Y_dim]`
+            unwhitened samples
+
+        """
+        samples = eps*torch.exp(0.5*logvar.unsqueeze(1)) + mu.unsqueeze(1)
+        samples = self.unwhiten_back(samples)
+        return samples
+
+    def transform_low_rank(self, eps, mu, logvar, F):
+        """Map standard normal draws to samples from a single Gaussian posterior with a full but low-rank plus diagonal covariance matrix
+
+        Parameters
+        ----------
+        eps : torch.Tensor of shape `[self.batch_size, n_samples, self.rank + self.Y_dim]`
+            standard normal draws for the low-rank and diagonal portions, in this order
+        mu : torch.Tensor of shape `[self.batch_size, self.Y_dim]`
+            network prediction of the mu (mean parameter) of the BNN posterior
+        logvar : torch.Tensor of shape `[self.batch_size, self.Y_dim]`
+            network prediction of the log of the diagonal elements of the covariance matrix
+        F : torch.Tensor of shape `[self.batch_size, self.Y_dim, self.rank]`
+            network prediction of the low rank portion of the covariance matrix
+
+        Returns
+        -------
+        torch.Tensor of shape `[self.batch_size, n_samples, self.Y_dim]`
+            unwhitened samples
+
+        """
+        eps_low_rank = eps[:, :, :self.rank]
+        eps_diag = eps[:, :, self.rank:]
+        half_var = torch.exp(0.5*logvar) # [self.batch_size, self.Y_dim]
+        samples = torch.bmm(eps_low_rank, F.transpose(1, 2)) + mu.unsqueeze(1) + half_var.unsqueeze(1)*eps_diag
+        samples = self.unwhiten_back(samples)
+        return samples
+
+    def sample_low_rank(self, n_samples, mu, logvar, F, sampling='mc'):
         """Sample from a single Gaussian posterior with a full but low-rank plus diagonal covariance matrix
 
         Parameters
@@ -152,6 +340,8 @@ class BaseGaussianBNNPosterior(ABC):
             network prediction of the log of the diagonal elements of the covariance matrix
         F : torch.Tensor of shape `[self.batch_size, self.Y_dim, self.rank]`
             network prediction of the low rank portion of the covariance matrix
+        sampling : str
+            one of `h0rton.h0_inference.gaussian_bnn_posterior_cpu.sampling_methods`. Default: `mc`
 
         Returns
         -------
@@ -159,21 +349,56 @@ class BaseGaussianBNNPosterior(ABC):
             samples
 
         """
-        #F = torch.unsqueeze(F, dim=1).repeat(1, n_samples, 1, 1) # [self.batch_size, n_samples, self.Y_dim, self.rank]
-        F = F.repeat(n_samples, 1, 1) # [self.batch_size*n_samples, self.Y_dim, self.rank]
-        mu = mu.repeat(n_samples, 1) # [self.batch_size*n_samples, self.Y_dim]
-        logvar = logvar.repeat(n_samples, 1) # [self.batch_size*n_samples, self.Y_dim]
-        eps_low_rank = torch.randn(self.batch_size*n_samples, self.rank, 1)
-        eps_diag = torch.randn(self.batch_size*n_samples, self.Y_dim)
-        half_var = torch.exp(0.5*logvar) # [self.batch_size*n_samples, self.Y_dim]
-        samples = torch.bmm(F, eps_low_rank).squeeze() + mu + half_var*eps_diag
-        samples = samples.reshape(n_samples, self.batch_size, self.Y_dim)
-        samples = samples.transpose(0, 1)
-        samples = self.unwhiten_back(samples)
+        eps = self.get_standard_normal(n_samples, self.rank + self.Y_dim, sampling, device=mu.device, dtype=mu.dtype)
+        samples = self.transform_low_rank(eps, mu, logvar, F)
         samples = samples.data.cpu().numpy()
         return samples
 
-    def sample_full_rank(self, n_samples, mu, tril_elements, as_numpy=True):
+    def get_prec_tril(self, tril_elements):
+        """Build the batched lower-triangular Cholesky factor of the precision matrix from its log-Cholesky parameterization
+
+        Parameters
+        ----------
+        tril_elements : torch.Tensor of shape `[self.batch_size, tril_len]`
+            network prediction of lower-triangular matrix in the log-Cholesky decomposition of the precision matrix
+
+        Returns
+        -------
+        torch.Tensor of shape `[self.batch_size, self.Y_dim, self.Y_dim]`
+            lower-triangular matrix `L` such that the precision matrix is `L L^T`
+
+        """
+        tril_idx = torch.tril_indices(self.Y_dim, self.Y_dim, offset=0, device=tril_elements.device)
+        tril = torch.zeros([tril_elements.shape[0], self.Y_dim, self.Y_dim], device=tril_elements.device, dtype=tril_elements.dtype)
+        tril[:, tril_idx[0], tril_idx[1]] = tril_elements
+        diag_idx = torch.arange(self.Y_dim, device=tril_elements.device)
+        tril[:, diag_idx, diag_idx] = torch.exp(tril[:, diag_idx, diag_idx])
+        return tril
+
+    def transform_full_rank(self, eps, mu, prec_tril):
+        """Map standard normal draws to samples from a single Gaussian posterior with a full-rank covariance matrix
+
+        Parameters
+        ----------
+        eps : torch.Tensor of shape `[self.batch_size, n_samples, self.Y_dim]`
+            standard normal draws
+        mu : torch.Tensor of shape `[self.batch_size, self.Y_dim]`
+            network prediction of the mu (mean parameter) of the BNN posterior
+        prec_tril : torch.Tensor of shape `[self.batch_size, self.Y_dim, self.Y_dim]`
+            lower-triangular Cholesky factor of the precision matrix, as returned by `get_prec_tril`
+
+        Returns
+        -------
+        torch.Tensor of shape `[self.batch_size, n_samples, self.Y_dim]`
+            unwhitened samples
+
+        """
+        # x = mu + L^{-T} eps, where the precision matrix is L L^T, i.e. x^T L = eps^T solved for all lenses and samples at once
+        samples = torch.linalg.solve_triangular(prec_tril, eps, upper=False, left=False) + mu.unsqueeze(1)
+        samples = self.unwhiten_back(samples)
+        return samples
+
+    def sample_full_rank(self, n_samples, mu, prec_tril, as_numpy=True, sampling='mc'):
         """Sample from a single Gaussian posterior with a full-rank covariance matrix
 
         Parameters
@@ -182,8 +407,10 @@ class BaseGaussianBNNPosterior(ABC):
             how many samples to obtain
         mu : torch.Tensor of shape `[self.batch_size, self.Y_dim]`
             network prediction of the mu (mean parameter) of the BNN posterior
-        tril_elements : torch.Tensor of shape `[self.batch_size, tril_len]`
-            network prediction of lower-triangular matrix in the log-Cholesky decomposition of the precision matrix
+        prec_tril : torch.Tensor of shape `[self.batch_size, self.Y_dim, self.Y_dim]`
+            lower-triangular Cholesky factor of the precision matrix, as returned by `get_prec_tril`
+        sampling : str
+            one of `h0rton.h0_inference.gaussian_bnn_posterior_cpu.sampling_methods`. Default: `mc`
 
         Returns
         -------
@@ -191,22 +418,137 @@ class BaseGaussianBNNPosterior(ABC):
             samples
 
         """
-        samples = torch.zeros([self.batch_size, n_samples, self.Y_dim])
-        for b in range(self.batch_size):
-            tril = torch.zeros([self.Y_dim, self.Y_dim], device=self.device, dtype=None)
-            tril[self.tril_idx[0], self.tril_idx[1]] = tril_elements[b, :]
-            log_diag_tril = torch.diagonal(tril, offset=0, dim1=0, dim2=1)
-            tril[torch.eye(self.Y_dim, dtype=bool)] = torch.exp(log_diag_tril)
-            prec_mat = torch.mm(tril, tril.T) # [Y_dim, Y_dim]
-            mvn = torch.distributions.multivariate_normal.MultivariateNormal(loc=mu[b, :], precision_matrix=prec_mat)
-            sample_b = mvn.sample([n_samples,])
-            samples[b, :, :] = sample_b
-        samples = self.unwhiten_back(samples)
+        eps = self.get_standard_normal(n_samples, self.Y_dim, sampling, device=mu.device, dtype=mu.dtype)
+        samples = self.transform_full_rank(eps, mu, prec_tril)
         if as_numpy:
             return samples.cpu().numpy()
         else:
             return samples
 
+    def sample_mixture(self, n_samples, n_latent, transform_first, transform_second, sampling='mc'):
+        """Sample from a mixture of two Gaussians with second-component weight `self.w2`, drawing only as many standard normals as each component is assigned
+
+        The draws of each component are laid out in a buffer padded to the lens with the most samples of that component, so that all lenses are transformed at once.
+
+        Parameters
+        ----------
+        n_samples : int
+            how many samples to obtain
+        n_latent : int
+            number of standard normal draws per sample
+        transform_first : callable
+            maps standard normal draws of shape `[self.batch_size, n, n_latent]` to samples of shape `[self.batch_size, n, self.Y_dim]` from the first Gaussian
+        transform_second : callable
+            same as `transform_first`, for the second Gaussian
+        sampling : str
+            one of `h0rton.h0_inference.gaussian_bnn_posterior_cpu.sampling_methods`. With `antithetic` or `qmc`, the component assignment is stratified as well: each lens gets `n_samples*self.w2` samples from the second Gaussian, rounded up or down at random, and the samples come grouped by component. Default: `mc`
+
+        Returns
+        -------
+        np.array of shape `[self.batch_size, n_samples, self.Y_dim]`
+            samples
+
+        """
+        # Determine first vs. second Gaussian
+        unif2 = self.get_assignment_uniform(n_samples, sampling)
+        second_gaussian = (self.w2 > unif2)
+        samples = self.sample_components(second_gaussian.long(), n_latent, [transform_first, transform_second], sampling)
+        samples = samples.data.cpu().numpy()
+        return samples
+
+    def sample_categorical(self, n_samples, n_latent, weights, transforms, sampling='mc'):
+        """Sample from a mixture of any number of Gaussians, assigning the samples to the components by inverting the CDF of the weights
+
+        Parameters
+        ----------
+        n_samples : int
+            how many samples to obtain
+        n_latent : int
+            number of standard normal draws per sample
+        weights : torch.Tensor of shape `[self.batch_size, n_components]`
+            weights of the components, summing to 1 for each lens
+        transforms : list of callables
+            the transform of each component, as in `sample_mixture`
+        sampling : str
+            one of `h0rton.h0_inference.gaussian_bnn_posterior_cpu.sampling_methods`. With `antithetic` or `qmc`, the component assignment is stratified as in `sample_mixture`. Default: `mc`
+
+        Returns
+        -------
+        np.array of shape `[self.batch_size, n_samples, self.Y_dim]`
+            samples
+
+        """
+        unif = self.get_assignment_uniform(n_samples, sampling)
+        # The component of each sample is the number of inner CDF boundaries below its uniform draw
+        cdf = torch.cumsum(weights, dim=1)[:, :-1].unsqueeze(1) # [self.batch_size, 1, n_components - 1]
+        component = torch.sum(unif.unsqueeze(2) >= cdf, dim=2) # [self.batch_size, n_samples]
+        samples = self.sample_components(component, n_latent, transforms, sampling)
+        samples = samples.data.cpu().numpy()
+        return samples
+
+    def get_assignment_uniform(self, n_samples, sampling='mc'):
+        """Draw the uniform variates that assign the samples of each lens to the mixture components
+
+        Parameters
+        ----------
+        n_samples : int
+            how many samples to obtain
+        sampling : str
+            one of `h0rton.h0_inference.gaussian_bnn_posterior_cpu.sampling_methods`. Default: `mc`
+
+        Returns
+        -------
+        torch.Tensor of shape `[self.batch_size, n_samples]`
+            independent draws if `sampling` is `mc`, and sorted, stratified draws otherwise
+
+        """
+        device = self.mu.device
+        if sampling == 'mc':
+            return torch.rand(self.batch_size, n_samples, device=device)
+        else:
+            # Systematic sampling, i.e. one uniform draw per lens shifted across `n_samples` equal strata
+            return (torch.arange(n_samples, device=device) + torch.rand(self.batch_size, 1, device=device))/n_samples
+
+    def sample_components(self, component, n_latent, transforms, sampling='mc'):
+        """Draw the samples of a mixture given the component assigned to each sample, drawing only as many standard normals as each component is assigned
+
+        The draws of each component are laid out in a buffer padded to the lens with the most samples of that component, so that all lenses are transformed at once.
+
+        Parameters
+        ----------
+        component : torch.Tensor of shape `[self.batch_size, n_samples]`
+            index of the component assigned to each sample
+        n_latent : int
+            number of standard normal draws per sample
+        transforms : list of callables
+            the transform of each component, as in `sample_mixture`
+        sampling : str
+            one of `h0rton.h0_inference.gaussian_bnn_posterior_cpu.sampling_methods`. Default: `mc`
+
+        Returns
+        -------
+        torch.Tensor of shape `[self.batch_size, n_samples, self.Y_dim]`
+            samples
+
+        """
+        device = self.mu.device
+        samples = torch.empty([self.batch_size, component.shape[1], self.Y_dim], device=device, dtype=self.mu.dtype)
+        for k, transform in enumerate(transforms):
+            is_component = (component == k)
+            lens_idx, sample_idx = torch.nonzero(is_component, as_tuple=True)
+            if len(lens_idx) == 0:
+                continue
+            # Position of each sample among the samples of its lens assigned to this component
+            rank = (torch.cumsum(is_component.long(), dim=1) - 1)[lens_idx, sample_idx]
+            if sampling == 'mc':
+                eps = torch.zeros([self.batch_size, int(rank.max()) + 1, n_latent], device=device, dtype=self.mu.dtype)
+                eps[lens_idx, rank] = torch.randn(len(lens_idx), n_latent, device=device, dtype=self.mu.dtype)
+            else:
+                # Each lens uses the leading draws of its antithetic or Sobol sequence
+                eps = self.get_standard_normal(int(rank.max()) + 1, n_latent, sampling, device=device, dtype=self.mu.dtype)
+            samples[lens_idx, sample_idx] = transform(eps)[lens_idx, rank]
+        return samples
+
 class DiagonalGaussianBNNPosterior(BaseGaussianBNNPosterior):
     """The negative log likelihood (NLL) for a single Gaussian with diagonal covariance matrix
         
@@ -224,7 +566,7 @@ class DiagonalGaussianBNNPosterior(BaseGaussianBNNPosterior):
         self.logvar = pred[:, d:]
         self.cov_diag = torch.exp(self.logvar)
 
-    def sample(self, n_samples, sample_seed):
+    def sample(self, n_samples, sample_seed, sampling='mc'):
         """Sample from a Gaussian posterior with diagonal covariance matrix
 
         Parameters
@@ -233,6 +575,8 @@ class DiagonalGaussianBNNPosterior(BaseGaussianBNNPosterior):
             how many samples to obtain
         sample_seed : int
             seed for the samples. Default: None
+        sampling : str
+            one of `h0rton.h0_inference.gaussian_bnn_posterior_cpu.sampling_methods`. Default: `mc`
 
         Returns
         -------
@@ -241,25 +585,24 @@ class DiagonalGaussianBNNPosterior(BaseGaussianBNNPosterior):
 
         """
         self.seed_samples(sample_seed)
-        eps = torch.randn(self.batch_size, n_samples, self.Y_dim)
-        samples = eps*torch.exp(0.5*self.logvar.unsqueeze(1)) + self.mu.unsqueeze(1)
-        samples = self.unwhiten_back(samples)
+        eps = self.get_standard_normal(n_samples, self.Y_dim, sampling)
+        samples = self.transform_diagonal(eps, self.mu, self.logvar)
         samples = samples.data.cpu().numpy()
         return samples
 
-    def get_hpd_interval(self):
-        return NotImplementedError
+    def get_marginal_components(self):
+        return torch.ones([self.batch_size, 1], device=self.mu.device, dtype=self.mu.dtype), self.mu.unsqueeze(2), torch.exp(0.5*self.logvar).unsqueeze(2)
 
 class LowRankGaussianBNNPosterior(BaseGaussianBNNPosterior):
     """The negative log likelihood (NLL) for a single Gaussian with diagonal covariance matrix
         
-    `BaseGaussianNLL.__init__` docstring for the parameter description.
+    `BaseGaussianNLL.__init__` docstring for the parameter description. `rank` is the rank of the low-rank portion of the covariance matrix.
 
     """
-    def __init__(self, Y_dim, device, Y_mean=None, Y_std=None):
+    def __init__(self, Y_dim, device, Y_mean=None, Y_std=None, rank=2):
         super(LowRankGaussianBNNPosterior, self).__init__(Y_dim, device, Y_mean, Y_std)
-        self.out_dim = self.Y_dim*4
-        self.rank = 2 # FIXME: hardcoded
+        self.rank = rank
+        self.out_dim = self.Y_dim*(2 + self.rank)
 
     def set_sliced_pred(self, pred):
         d = self.Y_dim # for readability
@@ -271,44 +614,45 @@ class LowRankGaussianBNNPosterior(BaseGaussianBNNPosterior):
         self.cov_diag = torch.exp(self.logvar) + torch.diagonal(F_F_tran, dim1=1, dim2=2) # [n_lenses, d]
         self.cov_mat = torch.diag_embed(self.logvar) + F_F_tran
 
-    def sample(self, n_samples, sample_seed):
+    def sample(self, n_samples, sample_seed, sampling='mc'):
         self.seed_samples(sample_seed)
-        return self.sample_low_rank(n_samples, self.mu, self.logvar, self.F)
+        return self.sample_low_rank(n_samples, self.mu, self.logvar, self.F, sampling)
 
-    def get_hpd_interval(self):
-        return NotImplementedError
+    def get_marginal_components(self):
+        return torch.ones([self.batch_size, 1], device=self.mu.device, dtype=self.mu.dtype), self.mu.unsqueeze(2), torch.sqrt(self.cov_diag).unsqueeze(2)
 
 class DoubleLowRankGaussianBNNPosterior(BaseGaussianBNNPosterior):
     """The negative log likelihood (NLL) for a single Gaussian with diagonal covariance matrix
         
-    `BaseGaussianNLL.__init__` docstring for the parameter description.
+    `BaseGaussianNLL.__init__` docstring for the parameter description. `rank` is the rank of the low-rank portion of the covariance matrix.
 
     """
-    def __init__(self, Y_dim, device, Y_mean=None, Y_std=None):
+    def __init__(self, Y_dim, device, Y_mean=None, Y_std=None, rank=2):
         super(DoubleLowRankGaussianBNNPosterior, self).__init__(Y_dim, device, Y_mean, Y_std)
-        self.out_dim = self.Y_dim*8 + 1
-        self.rank = 2 # FIXME: hardcoded
+        self.rank = rank
+        self.out_dim = 2*self.Y_dim*(2 + self.rank) + 1
 
     def set_sliced_pred(self, pred):
         d = self.Y_dim # for readability
+        r = self.rank
         self.batch_size = pred.shape[0]
         # First gaussian
         self.mu = pred[:, :d]
         self.logvar = pred[:, d:2*d]
-        self.F = pred[:, 2*d:4*d].reshape([self.batch_size, self.Y_dim, self.rank])
+        self.F = pred[:, 2*d:(2 + r)*d].reshape([self.batch_size, self.Y_dim, self.rank])
         F_F_tran = torch.bmm(self.F, torch.transpose(self.F, 1, 2)) # [n_lenses, d, d]
         self.cov_diag = torch.exp(self.logvar) + torch.diagonal(F_F_tran, dim1=1, dim2=2) # [n_lenses, d]
         self.cov_mat = torch.diag_embed(self.logvar) + F_F_tran
         # Second gaussian
-        self.mu2 = pred[:, 4*d:5*d]
-        self.logvar2 = pred[:, 5*d:6*d]
-        self.F2 = pred[:, 6*d:8*d].reshape([self.batch_size, self.Y_dim, self.rank])
+        self.mu2 = pred[:, (2 + r)*d:(3 + r)*d]
+        self.logvar2 = pred[:, (3 + r)*d:(4 + r)*d]
+        self.F2 = pred[:, (4 + r)*d:(4 + 2*r)*d].reshape([self.batch_size, self.Y_dim, self.rank])
         F_F_tran2 = torch.bmm(self.F2, torch.transpose(self.F2, 1, 2))
         self.cov_diag2 = torch.exp(self.logvar2) + torch.diagonal(F_F_tran2, dim1=1, dim2=2)
         self.cov_mat2 = torch.diag_embed(self.logvar2) + F_F_tran2
         self.w2 = 0.5*self.sigmoid(pred[:, -1].reshape(-1, 1))
         
-    def sample(self, n_samples, sample_seed):
+    def sample(self, n_samples, sample_seed, sampling='mc'):
         """Sample from a mixture of two Gaussians, each with a full but constrained as low-rank plus diagonal covariance
 
         Parameters
@@ -317,6 +661,8 @@ class DoubleLowRankGaussianBNNPosterior(BaseGaussianBNNPosterior):
             how many samples to obtain
         sample_seed : int
             seed for the samples. Default: None
+        sampling : str
+            one of `h0rton.h0_inference.gaussian_bnn_posterior_cpu.sampling_methods`. Default: `mc`
 
         Returns
         -------
@@ -325,21 +671,16 @@ class DoubleLowRankGaussianBNNPosterior(BaseGaussianBNNPosterior):
 
         """
         self.seed_samples(sample_seed)
-        samples = torch.zeros([self.batch_size, n_samples, self.Y_dim], device=self.device)
-        # Determine first vs. second Gaussian
-        unif2 = torch.rand(self.batch_size, n_samples)
-        second_gaussian = (self.w2 > unif2)
-        # Sample from second Gaussian
-        samples2 = torch.Tensor(self.sample_low_rank(n_samples, self.mu2, self.logvar2, self.F2))
-        samples[second_gaussian, :] = samples2[second_gaussian, :]
-        # Sample from first Gaussian
-        samples1 = torch.Tensor(self.sample_low_rank(n_samples, self.mu, self.logvar, self.F))
-        samples[~second_gaussian, :] = samples1[~second_gaussian, :]
-        samples = samples.data.cpu().numpy()
-        return samples
+        return self.sample_mixture(n_samples, self.rank + self.Y_dim,
+                                   lambda eps: self.transform_low_rank(eps, self.mu, self.logvar, self.F),
+                                   lambda eps: self.transform_low_rank(eps, self.mu2, self.logvar2, self.F2),
+                                   sampling)
 
-    def get_hpd_interval(self):
-        return NotImplementedError
+    def get_marginal_components(self):
+        weights = torch.cat([1.0 - self.w2, self.w2], dim=1)
+        mu = torch.stack([self.mu, self.mu2], dim=2)
+        sd = torch.sqrt(torch.stack([self.cov_diag, self.cov_diag2], dim=2))
+        return weights, mu, sd
 
 class FullRankGaussianBNNPosterior(BaseGaussianBNNPosterior):
     """The negative log likelihood (NLL) for a single Gaussian with diagonal covariance matrix
@@ -358,13 +699,14 @@ class FullRankGaussianBNNPosterior(BaseGaussianBNNPosterior):
         self.batch_size = pred.shape[0]
         self.mu = pred[:, :d]
         self.tril_elements = pred[:, d:self.out_dim]
+        self.prec_tril = self.get_prec_tril(self.tril_elements)
 
-    def sample(self, n_samples, sample_seed):
+    def sample(self, n_samples, sample_seed, sampling='mc'):
         self.seed_samples(sample_seed)
-        return self.sample_full_rank(n_samples, self.mu, self.tril_elements)
+        return self.sample_full_rank(n_samples, self.mu, self.prec_tril, sampling=sampling)
 
-    def get_hpd_interval(self):
-        return NotImplementedError
+    def get_marginal_components(self):
+        return torch.ones([self.batch_size, 1], device=self.mu.device, dtype=self.mu.dtype), self.mu.unsqueeze(2), self.get_full_rank_marginal_sd(self.prec_tril).unsqueeze(2)
 
 class DoubleGaussianBNNPosterior(BaseGaussianBNNPosterior):
     """The negative log likelihood (NLL) for a single Gaussian with diagonal covariance matrix
@@ -386,10 +728,12 @@ class DoubleGaussianBNNPosterior(BaseGaussianBNNPosterior):
         self.tril_elements = pred[:, d:d+self.tril_len]
         self.mu2 = pred[:, d+self.tril_len:2*d+self.tril_len]
         self.tril_elements2 = pred[:, 2*d+self.tril_len:-1]
+        self.prec_tril = self.get_prec_tril(self.tril_elements)
+        self.prec_tril2 = self.get_prec_tril(self.tril_elements2)
         #print(pred[:, -1])
         self.w2 = 0.5*self.sigmoid(pred[:, -1].reshape(-1, 1))
         
-    def sample(self, n_samples, sample_seed):
+    def sample(self, n_samples, sample_seed, sampling='mc'):
         """Sample from a mixture of two Gaussians, each with a full but constrained as low-rank plus diagonal covariance
 
         Parameters
@@ -398,6 +742,8 @@ class DoubleGaussianBNNPosterior(BaseGaussianBNNPosterior):
             how many samples to obtain
         sample_seed : int
             seed for the samples. Default: None
+        sampling : str
+            one of `h0rton.h0_inference.gaussian_bnn_posterior_cpu.sampling_methods`. Default: `mc`
 
         Returns
         -------
@@ -406,18 +752,96 @@ class DoubleGaussianBNNPosterior(BaseGaussianBNNPosterior):
 
         """
         self.seed_samples(sample_seed)
-        samples = torch.zeros([self.batch_size, n_samples, self.Y_dim], device=self.device)
-        # Determine first vs. second Gaussian
-        unif2 = torch.rand(self.batch_size, n_samples)
-        second_gaussian = (self.w2 > unif2)
-        # Sample from second Gaussian
-        samples2 = self.sample_full_rank(n_samples, self.mu2, self.tril_elements2, as_numpy=False)
-        samples[second_gaussian, :] = samples2[second_gaussian, :]
-        # Sample from first Gaussian
-        samples1 = self.sample_full_rank(n_samples, self.mu, self.tril_elements, as_numpy=False)
-        samples[~second_gaussian, :] = samples1[~second_gaussian, :]
-        samples = samples.data.cpu().numpy()
-        return samples
+        return self.sample_mixture(n_samples, self.Y_dim,
+                                   lambda eps: self.transform_full_rank(eps, self.mu, self.prec_tril),
+                                   lambda eps: self.transform_full_rank(eps, self.mu2, self.prec_tril2),
+                                   sampling)
 
-    def get_hpd_interval(self):
-        return NotImplementedError
\ No newline at end of file
+    def get_marginal_components(self):
+        weights = torch.cat([1.0 - self.w2, self.w2], dim=1)
+        mu = torch.stack([self.mu, self.mu2], dim=2)
+        sd = torch.stack([self.get_full_rank_marginal_sd(self.prec_tril), self.get_full_rank_marginal_sd(self.prec_tril2)], dim=2)
+        return weights, mu, sd
+
+class MixtureGaussianBNNPosterior(BaseGaussianBNNPosterior):
+    """The BNN posterior for a mixture of `n_components` Gaussians with covariance matrices of the same family, matching `h0rton.losses.MixtureGaussianNLL`
+
+    See `h0rton.losses.MixtureGaussianNLL` for the layout of the network prediction and the description of `n_components`, `cov_type`, and `rank`.
+
+    """
+    def __init__(self, Y_dim, device, Y_mean=None, Y_std=None, n_components=3, cov_type='full_rank', rank=2):
+        super(MixtureGaussianBNNPosterior, self).__init__(Y_dim, device, Y_mean, Y_std)
+        d = self.Y_dim # for readability
+        if cov_type == 'diagonal':
+            self.component_dim = 2*d
+            self.n_latent = d
+        elif cov_type == 'low_rank':
+            self.component_dim = (2 + rank)*d
+            self.n_latent = rank + d
+        elif cov_type == 'full_rank':
+            self.component_dim = d + d*(d + 1)//2
+            self.n_latent = d
+        else:
+            raise ValueError("cov_type must be one of 'diagonal', 'low_rank', or 'full_rank'.")
+        self.n_components = n_components
+        self.cov_type = cov_type
+        self.rank = rank
+        self.out_dim = n_components*(self.component_dim + 1)
+
+    def set_sliced_pred(self, pred):
+        d = self.Y_dim # for readability
+        K = self.n_components
+        self.batch_size = pred.shape[0]
+        components = pred[:, :K*self.component_dim].reshape(self.batch_size, K, self.component_dim)
+        self.weights = torch.softmax(pred[:, K*self.component_dim:], dim=1) # [self.batch_size, K]
+        self.mu = components[:, :, :d] # [self.batch_size, K, d]
+        if self.cov_type == 'full_rank':
+            prec_tril = self.get_prec_tril(components[:, :, d:].reshape(self.batch_size*K, -1))
+            self.prec_tril = prec_tril.reshape(self.batch_size, K, d, d)
+        else:
+            self.logvar = components[:, :, d:2*d]
+            if self.cov_type == 'low_rank':
+                self.F = components[:, :, 2*d:].reshape(self.batch_size, K, d, self.rank)
+
+    def get_component_transform(self, k):
+        """Get the map from standard normal draws to samples of the `k`-th component, for all lenses
+
+        """
+        if self.cov_type == 'diagonal':
+            return lambda eps: self.transform_diagonal(eps, self.mu[:, k], self.logvar[:, k])
+        elif self.cov_type == 'low_rank':
+            return lambda eps: self.transform_low_rank(eps, self.mu[:, k], self.logvar[:, k], self.F[:, k])
+        else:
+            return lambda eps: self.transform_full_rank(eps, self.mu[:, k], self.prec_tril[:, k])
+
+    def sample(self, n_samples, sample_seed, sampling='mc'):
+        """Sample from the mixture, assigning the samples of all lenses to the components at once
+
+        Parameters
+        ----------
+        n_samples : int
+            how many samples to obtain
+        sample_seed : int
+            seed for the samples. Default: None
+        sampling : str
+            one of `h0rton.h0_inference.gaussian_bnn_posterior_cpu.sampling_methods`. Default: `mc`
+
+        Returns
+        -------
+        np.array of shape `[self.batch_size, n_samples, self.Y_dim]`
+            samples
+
+        """
+        self.seed_samples(sample_seed)
+        transforms = [self.get_component_transform(k) for k in range(self.n_components)]
+        return self.sample_categorical(n_samples, self.n_latent, self.weights, transforms, sampling)
+
+    def get_marginal_components(self):
+        K = self.n_components
+        if self.cov_type == 'diagonal':
+            sd = torch.exp(0.5*self.logvar)
+        elif self.cov_type == 'low_rank':
+            sd = torch.sqrt(torch.exp(self.logvar) + torch.sum(self.F**2.0, dim=3))
+        else:
+            sd = self.get_full_rank_marginal_sd(self.prec_tril.reshape(self.batch_size*K, self.Y_dim, self.Y_dim)).reshape(self.batch_size, K, self.Y_dim)
+        return self.weights, self.mu.transpose(1, 2), sd.transpose(1, 2)
@@ -1,8 +1,12 @@
 from abc import ABC, abstractmethod
 import random
 import numpy as np
-from scipy.stats import multivariate_normal
-__all__ = ['BaseGaussianBNNPosteriorCPU', 'DiagonalGaussianBNNPosteriorCPU', 'LowRankGaussianBNNPosteriorCPU', 'DoubleLowRankGaussianBNNPosteriorCPU', 'FullRankGaussianBNNPosteriorCPU', 'DoubleGaussianBNNPosteriorCPU', 'sigmoid', 'logsigmoid']
+from scipy.stats import qmc
+from scipy.special import ndtr, ndtri, softmax
+__all__ = ['BaseGaussianBNNPosteriorCPU', 'DiagonalGaussianBNNPosteriorCPU', 'LowRankGaussianBNNPosteriorCPU', 'DoubleLowRankGaussianBNNPosteriorCPU', 'FullRankGaussianBNNPosteriorCPU', 'DoubleGaussianBNNPosteriorCPU', 'MixtureGaussianBNNPosteriorCPU', 'sigmoid', 'logsigmoid', 'get_chunk_seed', 'sampling_methods', 'get_mixture_cdf', 'get_mixture_quantiles', 'get_mixture_hpd_interval']
+
+# `mc`: independent draws, `antithetic`: pairs of draws mirrored about the mean, `qmc`: scrambled Sobol points
+sampling_methods = ['mc', 'antithetic', 'qmc']
 
 def sigmoid(x):
     return np.where(x >= 0, 
@@ -14,6 +18,144 @@ def logsigmoid(x):
                     -np.log1p(np.exp(-x)), 
                     x - np.log1p(np.exp(x)))
 
+def get_chunk_seed(sample_seed, chunk_idx):
+    """Seed of a chunk of samples drawn by `sample_chunks`
+
+    The first chunk uses `sample_seed` itself, so that drawing all samples in a single chunk reproduces `sample`. Later chunks get seeds derived from both `sample_seed` and `chunk_idx`, which don't collide with the `sample_seed + d` seeds that callers use for consecutive MC dropout passes.
+
+    Parameters
+    ----------
+    sample_seed : int or None
+        seed for the whole sequence of chunks. If None, the chunks are not seeded.
+    chunk_idx : int
+        index of the chunk
+
+    Returns
+    -------
+    int or None
+
+    """
+    if sample_seed is None or chunk_idx == 0:
+        return sample_seed
+    return int(np.random.SeedSequence([sample_seed, chunk_idx]).generate_state(1)[0])
+
+def get_mixture_cdf(x, weights, mu, sd):
+    """Evaluate the CDF and PDF of 1D Gaussian mixtures
+
+    Parameters
+    ----------
+    x : np.array of shape `[n_mixtures, n_x]`
+        where to evaluate
+    weights : np.array of shape `[n_mixtures, n_components]`
+        component weights, summing to 1
+    mu : np.array of shape `[n_mixtures, n_components]`
+        component means
+    sd : np.array of shape `[n_mixtures, n_components]`
+        component standard deviations
+
+    Returns
+    -------
+    tuple of np.array of shape `[n_mixtures, n_x]`
+        the CDF and PDF
+
+    """
+    z = (x[:, :, np.newaxis] - mu[:, np.newaxis, :])/sd[:, np.newaxis, :] # [n_mixtures, n_x, n_components]
+    w = weights[:, np.newaxis, :]
+    cdf = np.sum(w*ndtr(z), axis=-1)
+    pdf = np.sum(w*np.exp(-0.5*z**2.0)/(np.sqrt(2.0*np.pi)*sd[:, np.newaxis, :]), axis=-1)
+    return cdf, pdf
+
+def get_mixture_quantiles(q, weights, mu, sd, tol=1.e-10, max_iter=100):
+    """Get the quantiles of 1D Gaussian mixtures by a root-find on their CDFs, vectorized over mixtures and quantiles
+
+    Each root is found by Newton steps, falling back to bisection whenever a step leaves the bracket, which initially spans all components out to 10 standard deviations. A single Gaussian is inverted analytically.
+
+    Parameters
+    ----------
+    q : np.array of shape `[n_mixtures, n_q]` or `[n_q,]`
+        probabilities in (0, 1)
+    weights : np.array of shape `[n_mixtures, n_components]`
+        component weights, summing to 1
+    mu : np.array of shape `[n_mixtures, n_components]`
+        component means
+    sd : np.array of shape `[n_mixtures, n_components]`
+        component standard deviations
+    tol : float
+        tolerance on the CDF at the returned quantiles
+    max_iter : int
+        maximum number of iterations
+
+    Returns
+    -------
+    np.array of shape `[n_mixtures, n_q]`
+        the quantiles
+
+    """
+    q = np.broadcast_to(q, (mu.shape[0], np.shape(q)[-1]))
+    if mu.shape[1] == 1:
+        return mu + sd*ndtri(q)
+    n_mixtures, n_q = q.shape
+    # One row per (mixture, quantile) pair, so that converged rows can be dropped
+    q = q.reshape(-1, 1)
+    weights, mu, sd = [np.repeat(arr, n_q, axis=0) for arr in [weights, mu, sd]]
+    lower = np.min(mu - 10.0*sd, axis=1, keepdims=True)
+    upper = np.max(mu + 10.0*sd, axis=1, keepdims=True)
+    # Start from the quantiles of the moment-matched Gaussian
+    mean = np.sum(weights*mu, axis=1, keepdims=True)
+    var = np.sum(weights*(sd**2.0 + mu**2.0), axis=1, keepdims=True) - mean**2.0
+    x = np.clip(mean + np.sqrt(var)*ndtri(q), lower, upper)
+    active = np.arange(len(q))
+    for i in range(max_iter):
+        cdf, pdf = get_mixture_cdf(x[active], weights[active], mu[active], sd[active])
+        residual = cdf - q[active]
+        is_active = np.abs(residual[:, 0]) >= tol
+        active, residual, pdf = active[is_active], residual[is_active], pdf[is_active]
+        if len(active) == 0:
+            break
+        x_active = x[active]
+        # The CDF is increasing, so the sign of the residual tells on which side the root lies
+        lower[active] = np.where(residual < 0.0, x_active, lower[active])
+        upper[active] = np.where(residual > 0.0, x_active, upper[active])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_newton = x_active - residual/pdf
+        x[active] = np.where((x_newton > lower[active]) & (x_newton < upper[active]), x_newton, 0.5*(lower[active] + upper[active]))
+    return x.reshape(n_mixtures, n_q)
+
+def get_mixture_hpd_interval(credible_mass, weights, mu, sd, n_grid=101):
+    """Get the shortest intervals holding a given probability of 1D Gaussian mixtures
+
+    For a single Gaussian this is the central interval. For a mixture, the interval is the shortest among the `n_grid` intervals `[Q(p), Q(p + credible_mass)]` with lower tail probabilities `p` spaced evenly in `[0, 1 - credible_mass]`, where `Q` is the quantile function. For a bimodal mixture whose highest density region splits into two intervals, this is the shortest single interval covering both.
+
+    Parameters
+    ----------
+    credible_mass : float
+        probability content of the interval
+    weights : np.array of shape `[n_mixtures, n_components]`
+        component weights, summing to 1
+    mu : np.array of shape `[n_mixtures, n_components]`
+        component means
+    sd : np.array of shape `[n_mixtures, n_components]`
+        component standard deviations
+    n_grid : int
+        number of candidate intervals for mixtures
+
+    Returns
+    -------
+    np.array of shape `[n_mixtures, 2]`
+        lower and upper bounds
+
+    """
+    if mu.shape[1] == 1:
+        return get_mixture_quantiles(np.array([0.5 - 0.5*credible_mass, 0.5 + 0.5*credible_mass]), weights, mu, sd)
+    # Keep the extreme tail probabilities away from 0 and 1, where the quantiles diverge
+    p_lower = np.linspace(0.0, 1.0 - credible_mass, n_grid)
+    p_lower = np.clip(p_lower, 1.e-6, 1.0 - credible_mass - 1.e-6)
+    bounds = get_mixture_quantiles(np.concatenate([p_lower, p_lower + credible_mass]), weights, mu, sd)
+    lower, upper = bounds[:, :n_grid], bounds[:, n_grid:]
+    shortest = np.argmin(upper - lower, axis=1)
+    idx = np.arange(mu.shape[0])
+    return np.stack([lower[idx, shortest], upper[idx, shortest]], axis=1)
+
 class BaseGaussianBNNPosteriorCPU(ABC):
     """Abstract base class to represent the Gaussian BNN posterior
 
@@ -53,7 +195,7 @@ class BaseGaussianBNNPosteriorCPU(ABC):
         random.seed(sample_seed)
 
     @abstractmethod
-    def sample(self, n_samples, sample_seed=None):
+    def sample(self, n_samples, sample_seed=None, sampling='mc'):
         """Sample from the Gaussian posterior. Must be overridden by subclasses.
 
         Parameters
@@ -62,6 +204,8 @@ class BaseGaussianBNNPosteriorCPU(ABC):
             how many samples to obtain
         sample_seed : int
             seed for the samples. Default: None
+        sampling : str
+            one of `sampling_methods`. Default: `mc`
 
         Returns
         -------
@@ -71,13 +215,145 @@ class BaseGaussianBNNPosteriorCPU(ABC):
         """
         return NotImplemented
 
+    def sample_chunks(self, n_samples, chunk_size=10000, sample_seed=None, sampling='mc'):
+        """Sample in chunks of at most `chunk_size` samples per lens, so that memory doesn't grow with `n_samples`
+
+        Parameters
+        ----------
+        n_samples : int
+            total number of samples per lens
+        chunk_size : int
+            maximum number of samples per lens in each chunk
+        sample_seed : int
+            seed for the samples. Chunk `k` is seeded with `get_chunk_seed(sample_seed, k)`. Default: None
+        sampling : str
+            one of `sampling_methods`, applied within each chunk. Default: `mc`
+
+        Yields
+        ------
+        np.array of shape `[self.batch_size, n_chunk, self.Y_dim]`
+            samples, with `n_chunk` equal to `chunk_size` except possibly for the last chunk
+
+        """
+        for chunk_idx, start in enumerate(range(0, n_samples, chunk_size)):
+            yield self.sample(min(chunk_size, n_samples - start), get_chunk_seed(sample_seed, chunk_idx), sampling)
+
+    def get_standard_normal(self, n_samples, n_latent, sampling='mc'):
+        """Draw standard normal variates for each lens, to be mapped to posterior samples by the `transform_*` methods
+
+        Parameters
+        ----------
+        n_samples : int
+            how many draws per lens
+        n_latent : int
+            number of standard normal variates per draw
+        sampling : str
+            `mc` for independent draws. `antithetic` for pairs `eps`, `-eps` laid out next to each other, so that any leading subset of the draws is mostly paired. `qmc` for an independently scrambled Sobol sequence per lens, mapped through the inverse normal CDF. The Sobol points are best balanced when `n_samples` is a power of 2.
+
+        Returns
+        -------
+        np.array of shape `[self.batch_size, n_samples, n_latent]`
+
+        """
+        if sampling == 'mc':
+            return np.random.randn(self.batch_size, n_samples, n_latent)
+        elif sampling == 'antithetic':
+            eps = np.random.randn(self.batch_size, (n_samples + 1)//2, 1, n_latent)
+            eps = np.concatenate([eps, -eps], axis=2).reshape(self.batch_size, -1, n_latent)
+            return eps[:, :n_samples, :]
+        elif sampling == 'qmc':
+            unif = np.empty([self.batch_size, n_samples, n_latent])
+            m = int(np.ceil(np.log2(max(n_samples, 1))))
+            for b, seed in enumerate(np.random.randint(2**31, size=self.batch_size)):
+                unif[b] = qmc.Sobol(d=n_latent, scramble=True, seed=seed).random_base2(m)[:n_samples]
+            # Scrambled points are never exactly 0 or 1 in practice, but guard the inverse CDF anyway
+            return ndtri(np.clip(unif, 1.e-12, 1.0 - 1.e-12))
+        else:
+            raise ValueError("sampling must be one of {}.".format(sampling_methods))
+
     @abstractmethod
-    def get_hpd_interval(self):
-        """Get the highest posterior density (HPD) interval
+    def get_marginal_components(self):
+        """Get the Gaussian components of the marginal posterior of each parameter, in whitened units. Must be overridden by subclasses.
+
+        Returns
+        -------
+        weights : np.array of shape `[self.batch_size, n_components]`
+            component weights
+        mu : np.array of shape `[self.batch_size, self.Y_dim, n_components]`
+            component means
+        sd : np.array of shape `[self.batch_size, self.Y_dim, n_components]`
+            component standard deviations
 
         """
         return NotImplemented
 
+    def _get_unwhitened_marginals(self):
+        """Marginal components in unwhitened units, flattened over lenses and parameters
+
+        """
+        weights, mu, sd = self.get_marginal_components()
+        n_components = weights.shape[1]
+        Y_mean = self.Y_mean.reshape(1, -1, 1)
+        Y_std = self.Y_std.reshape(1, -1, 1)
+        mu = (mu*Y_std + Y_mean).reshape(-1, n_components)
+        sd = (sd*Y_std).reshape(-1, n_components)
+        weights = np.repeat(weights, self.Y_dim, axis=0)
+        return weights, mu, sd
+
+    def get_marginal_quantiles(self, q):
+        """Get marginal quantiles of every parameter for all lenses at once, without sampling
+
+        Parameters
+        ----------
+        q : float or array-like of shape `[n_q,]`
+            probabilities in (0, 1)
+
+        Returns
+        -------
+        np.array of shape `[self.batch_size, self.Y_dim, n_q]`
+            unwhitened quantiles
+
+        """
+        q = np.atleast_1d(q).astype(float)
+        quantiles = get_mixture_quantiles(q, *self._get_unwhitened_marginals())
+        return quantiles.reshape(self.batch_size, self.Y_dim, len(q))
+
+    def get_hpd_interval(self, credible_mass=0.6827, n_grid=101):
+        """Get the highest posterior density (HPD) interval of the marginal posterior of every parameter for all lenses at once, without sampling
+
+        Parameters
+        ----------
+        credible_mass : float
+            probability content of the interval. Default: 0.6827, i.e. 1 sigma
+        n_grid : int
+            number of candidate intervals for the mixtures. See `get_mixture_hpd_interval`.
+
+        Returns
+        -------
+        np.array of shape `[self.batch_size, self.Y_dim, 2]`
+            unwhitened lower and upper bounds
+
+        """
+        interval = get_mixture_hpd_interval(credible_mass, *self._get_unwhitened_marginals(), n_grid=n_grid)
+        return interval.reshape(self.batch_size, self.Y_dim, 2)
+
+    def get_full_rank_marginal_sd(self, prec_tril):
+        """Get the marginal standard deviations of a Gaussian with a full-rank covariance matrix
+
+        Parameters
+        ----------
+        prec_tril : np.array of shape `[self.batch_size, self.Y_dim, self.Y_dim]`
+            lower-triangular Cholesky factor `L` of the precision matrix, as returned by `get_prec_tril`
+
+        Returns
+        -------
+        np.array of shape `[self.batch_size, self.Y_dim]`
+
+        """
+        # The covariance matrix is L^{-T} L^{-1}, whose diagonal holds the squared column norms of L^{-1}
+        inv_tril = np.linalg.inv(prec_tril)
+        return np.sqrt(np.sum(inv_tril**2.0, axis=1))
+
     def transform_back_mu(self, array):
         """Transform back, i.e. unwhiten, the tensor of central values
 
@@ -112,19 +388,112 @@ class BaseGaussianBNNPosteriorCPU(ABC):
         sample = sample*np.expand_dims(self.Y_std, 1) + np.expand_dims(self.Y_mean, 1)
         return sample
 
-    def sample_low_rank(self, n_samples, mu, logvar, F):
+    def transform_diagonal(self, eps, mu, logvar):
+        """Map standard normal draws to samples from a single Gaussian posterior with diagonal covariance matrix
+
+        Parameters
+        ----------
+        eps : np.array of shape `[self.batch_size, n_samples, self.Y_dim]`
+            standard normal draws
+        mu : np.array of shape `[self.batch_size, self.Y_dim]`
+            network prediction of the mu (mean parameter) of the BNN posterior
+        logvar : np.array of shape `[self.batch_size, self.Y_dim]`
+            network prediction of the log of the diagonal elements of the covariance matrix
+
+        Returns
+        -------
+        np.array of shape `[self.batch_size, n_samples, self.Y_dim]`
+            unwhitened samples
+
+        """
+        samples = eps*np.exp(0.5*np.expand_dims(logvar, 1)) + np.expand_dims(mu, 1)
+        samples = self.unwhiten_back(samples)
+        return samples
+
+    def transform_low_rank(self, eps, mu, logvar, F):
+        """Map standard normal draws to samples from a single Gaussian posterior with a full but low-rank plus diagonal covariance matrix
+
+        Parameters
+        ----------
+        eps : np.array of shape `[self.batch_size, n_samples, self.rank + self.Y_dim]`
+            standard normal draws for the low-rank and diagonal portions, in this order
+        mu : np.array of shape `[self.batch_size, self.Y_dim]`
+            network prediction of the mu (mean parameter) of the BNN posterior
+        logvar : np.array of shape `[self.batch_size, self.Y_dim]`
+            network prediction of the log of the diagonal elements of the covariance matrix
+        F : np.array of shape `[self.batch_size, self.Y_dim, self.rank]`
+            network prediction of the low rank portion of the covariance matrix
+
+        Returns
+        -------
+        np.array of shape `[self.batch_size, n_samples, self.Y_dim]`
+            unwhitened samples
+
+        """
+        eps_low_rank = eps[:, :, :self.rank]
+        eps_diag = eps[:, :, self.rank:]
+        half_var = np.exp(0.5*logvar) # [self.batch_size, self.Y_dim]
+        samples = np.matmul(eps_low_rank, np.swapaxes(F, 1, 2)) + np.expand_dims(mu, 1) + np.expand_dims(half_var, 1)*eps_diag
+        samples = self.unwhiten_back(samples)
+        return samples
+
+    def sample_low_rank(self, n_samples, mu, logvar, F, sampling='mc'):
         """Sample from a single Gaussian posterior with a full but low-rank plus diagonal covariance matrix
 
         Parameters
         ----------
         n_samples : int
             how many samples to obtain
-        mu : torch.Tensor of shape `[self.batch_size, self.Y_dim]`
+        mu : np.array of shape `[self.batch_size, self.Y_dim]`
             network prediction of the mu (mean parameter) of the BNN posterior
-        logvar : torch.Tensor of shape `[self.batch_size, self.Y_dim]`
+        logvar : np.array of shape `[self.batch_size, self.Y_dim]`
             network prediction of the log of the diagonal elements of the covariance matrix
-        F : torch.Tensor of shape `[self.batch_size, self.Y_dim, self.rank]`
+        F : np.array of shape `[self.batch_size, self.Y_dim, self.rank]`
             network prediction of the low rank portion of the covariance matrix
+        sampling : str
+            one of `sampling_methods`. Default: `mc`
+
+        Returns
+        -------
+        np.array of shape `[self.batch_size, n_samples, self.Y_dim]`
+            samples
+
+        """
+        eps = self.get_standard_normal(n_samples, self.rank + self.Y_dim, sampling)
+        return self.transform_low_rank(eps, mu, logvar, F)
+
+    def get_prec_tril(self, tril_elements):
+        """Build the batched lower-triangular Cholesky factor of the precision matrix from its log-Cholesky parameterization
+
+        Parameters
+        ----------
+        tril_elements : np.array of shape `[self.batch_size, tril_len]`
+            network prediction of lower-triangular matrix in the log-Cholesky decomposition of the precision matrix
+
+        Returns
+        -------
+        np.array of shape `[self.batch_size, self.Y_dim, self.Y_dim]`
+            lower-triangular matrix `L` such that the precision matrix is `L L^T`
+
+        """
+        tril_idx = np.tril_indices(self.Y_dim)
+        tril = np.zeros([tril_elements.shape[0], self.Y_dim, self.Y_dim])
+        tril[:, tril_idx[0], tril_idx[1]] = tril_elements
+        diag_idx = np.arange(self.Y_dim)
+        tril[:, diag_idx, diag_idx] = np.exp(tril[:, diag_idx, diag_idx])
+        return tril
+
+    def transform_full_rank(self, eps, mu, prec_tril):
+        """Map standard normal draws to samples from a single Gaussian posterior with a full-rank covariance matrix
+
+        Parameters
+        ----------
+        eps : np.array of shape `[self.batch_size, n_samples, self.Y_dim]`
+            standard normal draws
+        mu : np.array of shape `[self.batch_size, self.Y_dim]`
+            network prediction of the mu (mean parameter) of the BNN posterior
+        prec_tril : np.array of shape `[self.batch_size, self.Y_dim, self.Y_dim]`
+            lower-triangular Cholesky factor of the precision matrix, as returned by `get_prec_tril`
 
         Returns
         -------
@@ -132,29 +501,26 @@ class BaseGaussianBNNPosteriorCPU(ABC):
             samples
 
         """
-        #F = torch.unsqueeze(F, dim=1).repeat(1, n_samples, 1, 1) # [self.batch_size, n_samples, self.Y_dim, self.rank]
-        F = np.repeat(F, repeats=n_samples, axis=0) # [self.batch_size*n_samples, self.Y_dim, self.rank]
-        mu = np.repeat(mu, repeats=n_samples, axis=0) # [self.batch_size*n_samples, self.Y_dim]
-        logvar = np.repeat(logvar, repeats=n_samples, axis=0) # [self.batch_size*n_samples, self.Y_dim]
-        eps_low_rank = np.random.randn(self.batch_size*n_samples, self.rank, 1)
-        eps_diag = np.random.randn(self.batch_size*n_samples, self.Y_dim)
-        half_var = np.exp(0.5*logvar) # [self.batch_size*n_samples, self.Y_dim]
-        samples = np.matmul(F, eps_low_rank).squeeze() + mu + half_var*eps_diag # [self.batch_size*n_samples, self.Y_dim]
-        samples = samples.reshape(self.batch_size, n_samples, self.Y_dim)
-        #samples = samples.transpose((1, 0, 2)) # [self.batch_size, n_samples, self.Y_dim]
+        # x = mu + L^{-T} eps, where the precision matrix is L L^T. numpy has no batched triangular solve,
+        # so the small triangular factor of each lens is inverted once and applied to all its samples in one matmul.
+        inv_tril = np.linalg.inv(prec_tril) # [self.batch_size, self.Y_dim, self.Y_dim]
+        samples = np.matmul(eps, inv_tril) + np.expand_dims(mu, 1)
+        samples = self.unwhiten_back(samples)
         return samples
-    
-    def sample_full_rank(self, n_samples, mu, tril_elements):
+
+    def sample_full_rank(self, n_samples, mu, prec_tril, sampling='mc'):
         """Sample from a single Gaussian posterior with a full-rank covariance matrix
 
         Parameters
         ----------
         n_samples : int
             how many samples to obtain
-        mu : torch.Tensor of shape `[self.batch_size, self.Y_dim]`
+        mu : np.array of shape `[self.batch_size, self.Y_dim]`
             network prediction of the mu (mean parameter) of the BNN posterior
-        tril_elements : torch.Tensor of shape `[self.batch_size, tril_len]`
-            network prediction of lower-triangular matrix in the log-Cholesky decomposition of the precision matrix
+        prec_tril : np.array of shape `[self.batch_size, self.Y_dim, self.Y_dim]`
+            lower-triangular Cholesky factor of the precision matrix, as returned by `get_prec_tril`
+        sampling : str
+            one of `sampling_methods`. Default: `mc`
 
         Returns
         -------
@@ -162,17 +528,125 @@ class BaseGaussianBNNPosteriorCPU(ABC):
             samples
 
         """
-        samples = np.zeros([self.batch_size, n_samples, self.Y_dim])
-        for b in range(self.batch_size):
-            tril = np.zeros([self.Y_dim, self.Y_dim])
-            tril[self.tril_idx[0], self.tril_idx[1]] = tril_elements[b, :]
-            log_diag_tril = np.diagonal(tril, offset=0, axis1=0, axis2=1)
-            tril[np.eye(self.Y_dim).astype(bool)] = np.exp(log_diag_tril)
-            prec_mat = np.dot(tril, tril.T) # [Y_dim, Y_dim]
-            cov_mat = np.linalg.inv(prec_mat)
-            sample_b = multivariate_normal.rvs(mean=mu[b, :], cov=cov_mat, size=[n_samples,])
-            samples[b, :, :] = sample_b
-        samples = self.unwhiten_back(samples)
+        eps = self.get_standard_normal(n_samples, self.Y_dim, sampling)
+        return self.transform_full_rank(eps, mu, prec_tril)
+
+    def sample_mixture(self, n_samples, n_latent, transform_first, transform_second, sampling='mc'):
+        """Sample from a mixture of two Gaussians with second-component weight `self.w2`, drawing only as many standard normals as each component is assigned
+
+        The draws of each component are laid out in a buffer padded to the lens with the most samples of that component, so that all lenses are transformed at once.
+
+        Parameters
+        ----------
+        n_samples : int
+            how many samples to obtain
+        n_latent : int
+            number of standard normal draws per sample
+        transform_first : callable
+            maps standard normal draws of shape `[self.batch_size, n, n_latent]` to samples of shape `[self.batch_size, n, self.Y_dim]` from the first Gaussian
+        transform_second : callable
+            same as `transform_first`, for the second Gaussian
+        sampling : str
+            one of `sampling_methods`. With `antithetic` or `qmc`, the component assignment is stratified as well: each lens gets `n_samples*self.w2` samples from the second Gaussian, rounded up or down at random, and the samples come grouped by component. Default: `mc`
+
+        Returns
+        -------
+        np.array of shape `[self.batch_size, n_samples, self.Y_dim]`
+            samples
+
+        """
+        # Determine first vs. second Gaussian
+        unif2 = self.get_assignment_uniform(n_samples, sampling)
+        second_gaussian = (self.w2 > unif2)
+        return self.sample_components(second_gaussian.astype(int), n_latent, [transform_first, transform_second], sampling)
+
+    def sample_categorical(self, n_samples, n_latent, weights, transforms, sampling='mc'):
+        """Sample from a mixture of any number of Gaussians, assigning the samples to the components by inverting the CDF of the weights
+
+        Parameters
+        ----------
+        n_samples : int
+            how many samples to obtain
+        n_latent : int
+            number of standard normal draws per sample
+        weights : np.array of shape `[self.batch_size, n_components]`
+            weights of the components, summing to 1 for each lens
+        transforms : list of callables
+            the transform of each component, as in `sample_mixture`
+        sampling : str
+            one of `sampling_methods`. With `antithetic` or `qmc`, the component assignment is stratified as in `sample_mixture`. Default: `mc`
+
+        Returns
+        -------
+        np.array of shape `[self.batch_size, n_samples, self.Y_dim]`
+            samples
+
+        """
+        unif = self.get_assignment_uniform(n_samples, sampling)
+        # The component of each sample is the number of inner CDF boundaries below its uniform draw
+        cdf = np.cumsum(weights, axis=1)[:, np.newaxis, :-1] # [self.batch_size, 1, n_components - 1]
+        component = np.sum(unif[:, :, np.newaxis] >= cdf, axis=2) # [self.batch_size, n_samples]
+        return self.sample_components(component, n_latent, transforms, sampling)
+
+    def get_assignment_uniform(self, n_samples, sampling='mc'):
+        """Draw the uniform variates that assign the samples of each lens to the mixture components
+
+        Parameters
+        ----------
+        n_samples : int
+            how many samples to obtain
+        sampling : str
+            one of `sampling_methods`. Default: `mc`
+
+        Returns
+        -------
+        np.array of shape `[self.batch_size, n_samples]`
+            independent draws if `sampling` is `mc`, and sorted, stratified draws otherwise
+
+        """
+        if sampling == 'mc':
+            return np.random.rand(self.batch_size, n_samples)
+        else:
+            # Systematic sampling, i.e. one uniform draw per lens shifted across `n_samples` equal strata
+            return (np.arange(n_samples) + np.random.rand(self.batch_size, 1))/n_samples
+
+    def sample_components(self, component, n_latent, transforms, sampling='mc'):
+        """Draw the samples of a mixture given the component assigned to each sample, drawing only as many standard normals as each component is assigned
+
+        The draws of each component are laid out in a buffer padded to the lens with the most samples of that component, so that all lenses are transformed at once.
+
+        Parameters
+        ----------
+        component : np.array of shape `[self.batch_size, n_samples]`
+            index of the component assigned to each sample
+        n_latent : int
+            number of standard normal draws per sample
+        transforms : list of callables
+            the transform of each component, as in `sample_mixture`
+        sampling : str
+            one of `sampling_methods`. Default: `mc`
+
+        Returns
+        -------
+        np.array of shape `[self.batch_size, n_samples, self.Y_dim]`
+            samples
+
+        """
+        samples = np.empty([self.batch_size, component.shape[1], self.Y_dim])
+        for k, transform in enumerate(transforms):
+            is_component = (component == k)
+            lens_idx, sample_idx = np.nonzero(is_component)
+            if len(lens_idx) == 0:
+                continue
+            # Position of each sample among the samples of its lens assigned to this component
+            rank = (np.cumsum(is_component, axis=1) - 1)[lens_idx, sample_idx]
+            if sampling == 'mc':
+                eps = np.zeros([self.batch_size, rank.max() + 1, n_latent])
+                eps[lens_idx, rank] = np.random.randn(len(lens_idx), n_latent)
+            else:
+                # Each lens uses the leading draws of its antithetic or Sobol sequence
+                eps = self.get_standard_normal(rank.max() + 1, n_latent, sampling)
+            samples[lens_idx, sample_idx] = transform(eps)[lens_idx, rank]
         return samples
 
 class DiagonalGaussianBNNPosteriorCPU(BaseGaussianBNNPosteriorCPU):
@@ -199,7 +673,7 @@ class DiagonalGaussianBNNPosteriorCPU(BaseGaussianBNNPosteriorCPU):
         #assert np.array_equal(cov_diag.shape, [batch_size, self.Y_dim])
         #np.apply_along_axis(np.diag, -1, np.exp(logvar)) # for diagonal
 
-    def sample(self, n_samples, sample_seed):
+    def sample(self, n_samples, sample_seed, sampling='mc'):
         """Sample from a Gaussian posterior with diagonal covariance matrix
 
         Parameters
@@ -208,6 +682,8 @@ class DiagonalGaussianBNNPosteriorCPU(BaseGaussianBNNPosteriorCPU):
             how many samples to obtain
         sample_seed : int
             seed for the samples. Default: None
+        sampling : str
+            one of `sampling_methods`. Default: `mc`
 
         Returns
         -------
@@ -216,24 +692,22 @@ class DiagonalGaussianBNNPosteriorCPU(BaseGaussianBNNPosteriorCPU):
 
         """
         self.seed_samples(sample_seed)
-        eps = np.random.randn(self.batch_size, n_samples, self.Y_dim)
-        samples = eps*np.exp(0.5*np.expand_dims(self.logvar, 1)) + np.expand_dims(self.mu, 1)
-        samples = self.unwhiten_back(samples)
-        return samples
+        eps = self.get_standard_normal(n_samples, self.Y_dim, sampling)
+        return self.transform_diagonal(eps, self.mu, self.logvar)
 
-    def get_hpd_interval(self):
-        return NotImplementedError
+    def get_marginal_components(self):
+        return np.ones([self.batch_size, 1]), self.mu[:, :, np.newaxis], np.exp(0.5*self.logvar)[:, :, np.newaxis]
 
 class LowRankGaussianBNNPosteriorCPU(BaseGaussianBNNPosteriorCPU):
     """The negative log likelihood (NLL) for a single Gaussian with diagonal covariance matrix
         
-    `BaseGaussianNLL.__init__` docstring for the parameter description.
+    `BaseGaussianNLL.__init__` docstring for the parameter description. `rank` is the rank of the low-rank portion of the covariance matrix.
 
     """
-    def __init__(self, Y_dim, Y_mean=None, Y_std=None):
+    def __init__(self, Y_dim, Y_mean=None, Y_std=None, rank=2):
         super(LowRankGaussianBNNPosteriorCPU, self).__init__(Y_dim, Y_mean, Y_std)
-        self.out_dim = self.Y_dim*4
-        self.rank = 2 # FIXME: hardcoded
+        self.rank = rank
+        self.out_dim = self.Y_dim*(2 + self.rank)
 
     def set_sliced_pred(self, pred):
         d = self.Y_dim # for readability
@@ -245,42 +719,44 @@ class LowRankGaussianBNNPosteriorCPU(BaseGaussianBNNPosteriorCPU):
         #F_tran_F = np.matmul(self.F, np.swapaxes(self.F, 1, 2))
         #self.cov_diag = np.exp(self.logvar) + np.diagonal(F_tran_F, axis1=1, axis2=2)
 
-    def sample(self, n_samples, sample_seed):
+    def sample(self, n_samples, sample_seed, sampling='mc'):
         self.seed_samples(sample_seed)
-        return self.sample_low_rank(n_samples, self.mu, self.logvar, self.F)
+        return self.sample_low_rank(n_samples, self.mu, self.logvar, self.F, sampling)
 
-    def get_hpd_interval(self):
-        return NotImplementedError
+    def get_marginal_components(self):
+        sd = np.sqrt(np.exp(self.logvar) + np.sum(self.F**2.0, axis=2))
+        return np.ones([self.batch_size, 1]), self.mu[:, :, np.newaxis], sd[:, :, np.newaxis]
 
 class DoubleLowRankGaussianBNNPosteriorCPU(BaseGaussianBNNPosteriorCPU):
     """The negative log likelihood (NLL) for a single Gaussian with diagonal covariance matrix
         
-    `BaseGaussianNLL.__init__` docstring for the parameter description.
+    `BaseGaussianNLL.__init__` docstring for the parameter description. `rank` is the rank of the low-rank portion of the covariance matrix.
 
     """
-    def __init__(self, Y_dim, Y_mean=None, Y_std=None):
+    def __init__(self, Y_dim, Y_mean=None, Y_std=None, rank=2):
         super(DoubleLowRankGaussianBNNPosteriorCPU, self).__init__(Y_dim, Y_mean, Y_std)
-        self.out_dim = self.Y_dim*8 + 1
-        self.rank = 2 # FIXME: hardcoded
+        self.rank = rank
+        self.out_dim = 2*self.Y_dim*(2 + self.rank) + 1
 
     def set_sliced_pred(self, pred):
         d = self.Y_dim # for readability
+        r = self.rank
         #pred = pred.cpu().numpy()
         self.w2 = 0.5*self.sigmoid(pred[:, -1].reshape(-1, 1))
         self.batch_size = pred.shape[0]
         self.mu = pred[:, :d]
         self.logvar = pred[:, d:2*d]
-        self.F = pred[:, 2*d:4*d].reshape([self.batch_size, self.Y_dim, self.rank])
+        self.F = pred[:, 2*d:(2 + r)*d].reshape([self.batch_size, self.Y_dim, self.rank])
         #F_tran_F = np.matmul(self.F, np.swapaxes(self.F, 1, 2))
         #self.cov_diag = np.exp(self.logvar) + np.diagonal(F_tran_F, axis1=1, axis2=2)
-        self.mu2 = pred[:, 4*d:5*d]
-        self.logvar2 = pred[:, 5*d:6*d]
-        self.F2 = pred[:, 6*d:8*d].reshape([self.batch_size, self.Y_dim, self.rank])
+        self.mu2 = pred[:, (2 + r)*d:(3 + r)*d]
+        self.logvar2 = pred[:, (3 + r)*d:(4 + r)*d]
+        self.F2 = pred[:, (4 + r)*d:(4 + 2*r)*d].reshape([self.batch_size, self.Y_dim, self.rank])
         #F_tran_F2 = np.matmul(self.F2, np.swapaxes(self.F2, 1, 2))
         #self.cov_diag2 = np.exp(self.logvar2) + np.diagonal(F_tran_F2, axis1=1, axis2=2)
         
         
-    def sample(self, n_samples, sample_seed):
+    def sample(self, n_samples, sample_seed, sampling='mc'):
         """Sample from a mixture of two Gaussians, each with a full but constrained as low-rank plus diagonal covariance
 
         Parameters
@@ -289,6 +765,8 @@ class DoubleLowRankGaussianBNNPosteriorCPU(BaseGaussianBNNPosteriorCPU):
             how many samples to obtain
         sample_seed : int
             seed for the samples. Default: None
+        sampling : str
+            one of `sampling_methods`. Default: `mc`
 
         Returns
         -------
@@ -297,20 +775,16 @@ class DoubleLowRankGaussianBNNPosteriorCPU(BaseGaussianBNNPosteriorCPU):
 
         """
         self.seed_samples(sample_seed)
-        samples = np.zeros([self.batch_size, n_samples, self.Y_dim])
-        # Determine first vs. second Gaussian
-        unif2 = np.random.rand(self.batch_size, n_samples)
-        second_gaussian = (self.w2 > unif2)
-        # Sample from second Gaussian
-        samples2 = self.sample_low_rank(n_samples, self.mu2, self.logvar2, self.F2)
-        samples[second_gaussian, :] = samples2[second_gaussian, :]
-        # Sample from first Gaussian
-        samples1 = self.sample_low_rank(n_samples, self.mu, self.logvar, self.F)
-        samples[~second_gaussian, :] = samples1[~second_gaussian, :]
-        return samples
+        return self.sample_mixture(n_samples, self.rank + self.Y_dim,
+                                   lambda eps: self.transform_low_rank(eps, self.mu, self.logvar, self.F),
+                                   lambda eps: self.transform_low_rank(eps, self.mu2, self.logvar2, self.F2),
+                                   sampling)
 
-    def get_hpd_interval(self):
-        return NotImplementedError
+    def get_marginal_components(self):
+        weights = np.concatenate([1.0 - self.w2, self.w2], axis=1)
+        mu = np.stack([self.mu, self.mu2], axis=2)
+        sd = np.sqrt(np.stack([np.exp(self.logvar) + np.sum(self.F**2.0, axis=2), np.exp(self.logvar2) + np.sum(self.F2**2.0, axis=2)], axis=2))
+        return weights, mu, sd
 
 class FullRankGaussianBNNPosteriorCPU(BaseGaussianBNNPosteriorCPU):
     """The negative log likelihood (NLL) for a single Gaussian with diagonal covariance matrix
@@ -330,13 +804,14 @@ class FullRankGaussianBNNPosteriorCPU(BaseGaussianBNNPosteriorCPU):
         self.batch_size = pred.shape[0]
         self.mu = pred[:, :d]
         self.tril_elements = pred[:, d:self.out_dim]
+        self.prec_tril = self.get_prec_tril(self.tril_elements)
 
-    def sample(self, n_samples, sample_seed):
+    def sample(self, n_samples, sample_seed, sampling='mc'):
         self.seed_samples(sample_seed)
-        return self.sample_full_rank(n_samples, self.mu, self.tril_elements)
+        return self.sample_full_rank(n_samples, self.mu, self.prec_tril, sampling)
 
-    def get_hpd_interval(self):
-        return NotImplementedError
+    def get_marginal_components(self):
+        return np.ones([self.batch_size, 1]), self.mu[:, :, np.newaxis], self.get_full_rank_marginal_sd(self.prec_tril)[:, :, np.newaxis]
 
 class DoubleGaussianBNNPosteriorCPU(BaseGaussianBNNPosteriorCPU):
     """The negative log likelihood (NLL) for a single Gaussian with diagonal covariance matrix
@@ -359,9 +834,11 @@ class DoubleGaussianBNNPosteriorCPU(BaseGaussianBNNPosteriorCPU):
         self.tril_elements = pred[:, d:d+self.tril_len]
         self.mu2 = pred[:, d+self.tril_len:2*d+self.tril_len]
         self.tril_elements2 = pred[:, 2*d+self.tril_len:-1]
+        self.prec_tril = self.get_prec_tril(self.tril_elements)
+        self.prec_tril2 = self.get_prec_tril(self.tril_elements2)
         self.w2 = 0.5*self.sigmoid(pred[:, -1].reshape(-1, 1))
         
-    def sample(self, n_samples, sample_seed):
+    def sample(self, n_samples, sample_seed, sampling='mc'):
         """Sample from a mixture of two Gaussians, each with a full but constrained as low-rank plus diagonal covariance
 
         Parameters
@@ -370,6 +847,8 @@ class DoubleGaussianBNNPosteriorCPU(BaseGaussianBNNPosteriorCPU):
             how many samples to obtain
         sample_seed : int
             seed for the samples. Default: None
+        sampling : str
+            one of `sampling_methods`. Default: `mc`
 
         Returns
         -------
@@ -378,19 +857,96 @@ class DoubleGaussianBNNPosteriorCPU(BaseGaussianBNNPosteriorCPU):
 
         """
         self.seed_samples(sample_seed)
-        samples = np.zeros([self.batch_size, n_samples, self.Y_dim])
-        # Determine first vs. second Gaussian
-        unif2 = np.random.rand(self.batch_size, n_samples)
-        second_gaussian = (self.w2 > unif2)
-        # Sample from second Gaussian
-        samples2 = self.sample_full_rank(n_samples, self.mu2, self.tril_elements2)
-        samples[second_gaussian, :] = samples2[second_gaussian, :]
-        # Sample from first Gaussian
-        samples1 = self.sample_full_rank(n_samples, self.mu, self.tril_elements)
-        samples[~second_gaussian, :] = samples1[~second_gaussian, :]
-        return samples
+        return self.sample_mixture(n_samples, self.Y_dim,
+                                   lambda eps: self.transform_full_rank(eps, self.mu, self.prec_tril),
+                                   lambda eps: self.transform_full_rank(eps, self.mu2, self.prec_tril2),
+                                   sampling)
+
+    def get_marginal_components(self):
+        weights = np.concatenate([1.0 - self.w2, self.w2], axis=1)
+        mu = np.stack([self.mu, self.mu2], axis=2)
+        sd = np.stack([self.get_full_rank_marginal_sd(self.prec_tril), self.get_full_rank_marginal_sd(self.prec_tril2)], axis=2)
+        return weights, mu, sd
+
+class MixtureGaussianBNNPosteriorCPU(BaseGaussianBNNPosteriorCPU):
+    """The BNN posterior for a mixture of `n_components` Gaussians with covariance matrices of the same family, matching `h0rton.losses.MixtureGaussianNLL`
+
+    See `h0rton.losses.MixtureGaussianNLL` for the layout of the network prediction and the description of `n_components`, `cov_type`, and `rank`.
+
+    """
+    def __init__(self, Y_dim, Y_mean=None, Y_std=None, n_components=3, cov_type='full_rank', rank=2):
+        super(MixtureGaussianBNNPosteriorCPU, self).__init__(Y_dim, Y_mean, Y_std)
+        d = self.Y_dim # for readability
+        if cov_type == 'diagonal':
+            self.component_dim = 2*d
+            self.n_latent = d
+        elif cov_type == 'low_rank':
+            self.component_dim = (2 + rank)*d
+            self.n_latent = rank + d
+        elif cov_type == 'full_rank':
+            self.component_dim = d + d*(d + 1)//2
+            self.n_latent = d
+        else:
+            raise ValueError("cov_type must be one of 'diagonal', 'low_rank', or 'full_rank'.")
+        self.n_components = n_components
+        self.cov_type = cov_type
+        self.rank = rank
+        self.out_dim = n_components*(self.component_dim + 1)
+
+    def set_sliced_pred(self, pred):
+        d = self.Y_dim # for readability
+        K = self.n_components
+        self.batch_size = pred.shape[0]
+        components = pred[:, :K*self.component_dim].reshape(self.batch_size, K, self.component_dim)
+        self.weights = softmax(pred[:, K*self.component_dim:], axis=1) # [self.batch_size, K]
+        self.mu = components[:, :, :d] # [self.batch_size, K, d]
+        if self.cov_type == 'full_rank':
+            prec_tril = self.get_prec_tril(components[:, :, d:].reshape(self.batch_size*K, -1))
+            self.prec_tril = prec_tril.reshape(self.batch_size, K, d, d)
+        else:
+            self.logvar = components[:, :, d:2*d]
+            if self.cov_type == 'low_rank':
+                self.F = components[:, :, 2*d:].reshape(self.batch_size, K, d, self.rank)
+
+    def get_component_transform(self, k):
+        """Get the map from standard normal draws to samples of the `k`-th component, for all lenses
+
+        """
+        if self.cov_type == 'diagonal':
+            return lambda eps: self.transform_diagonal(eps, self.mu[:, k], self.logvar[:, k])
+        elif self.cov_type == 'low_rank':
+            return lambda eps: self.transform_low_rank(eps, self.mu[:, k], self.logvar[:, k], self.F[:, k])
+        else:
+            return lambda eps: self.transform_full_rank(eps, self.mu[:, k], self.prec_tril[:, k])
 
-    def get_hpd_interval(self):
-        return NotImplementedError
+    def sample(self, n_samples, sample_seed, sampling='mc'):
+        """Sample from the mixture, assigning the samples of all lenses to the components at once
 
+        Parameters
+        ----------
+        n_samples : int
+            how many samples to obtain
+        sample_seed : int
+            seed for the samples. Default: None
+        sampling : str
+            one of `sampling_methods`. Default: `mc`
 
+        Returns
+        -------
+        np.array of shape `[self.batch_size, n_samples, self.Y_dim]`
+            samples
+
+        """
+        self.seed_samples(sample_seed)
+        transforms = [self.get_component_transform(k) for k in range(self.n_components)]
+        return self.sample_categorical(n_samples, self.n_latent, self.weights, transforms, sampling)
+
+    def get_marginal_components(self):
+        K = self.n_components
+        if self.cov_type == 'diagonal':
+            sd = np.exp(0.5*self.logvar)
+        elif self.cov_type == 'low_rank':
+            sd = np.sqrt(np.exp(self.logvar) + np.sum(self.F**2.0, axis=3))
+        else:
+            sd = self.get_full_rank_marginal_sd(self.prec_tril.reshape(self.batch_size*K, self.Y_dim, self.Y_dim)).reshape(self.batch_size, K, self.Y_dim)
+        return self.weights, np.swapaxes(self.mu, 1, 2), np.swapaxes(sd, 1, 2)
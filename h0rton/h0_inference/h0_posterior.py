@@ -1,12 +1,11 @@
 import numpy as np
-import mpmath as mp
 from astropy.cosmology import FlatLambdaCDM
 import baobab.sim_utils.kinematics_utils as kinematics_utils
 from lenstronomy.LensModel.lens_model import LensModel
 from lenstronomy.PointSource.point_source import PointSource
 from lenstronomy.Analysis.td_cosmography import TDCosmography
 from scipy.stats import norm
-from h0rton.h0_inference import h0_utils
+from h0rton.h0_inference import h0_utils, lens_equation_solver
 
 __all__ = ['H0Posterior']
 
@@ -15,6 +14,8 @@ class H0Posterior:
 
     """
     required_params = ["lens_mass_center_x", "src_light_center_x","lens_mass_center_y", "src_light_center_y", "lens_mass_gamma", "lens_mass_theta_E", "lens_mass_e1", "lens_mass_e2", "external_shear_gamma1", "external_shear_gamma2", "src_light_R_sersic"]
+    h0_fiducial = 70.0 # H0 at which the time delays of the vectorized samplers are computed before rescaling
+    batched_lens_model_lists = [['PEMD', 'SHEAR'], ['EPL', 'SHEAR']] # lens models supported by `lens_equation_solver`
     def __init__(self, H0_prior, kappa_ext_prior,  kwargs_model, baobab_time_delays, Om0, define_src_pos_wrt_lens, exclude_vel_disp=True, aniso_param_prior=None, kinematics=None, kappa_transformed=True, kwargs_lens_eqn_solver={}):
         """
 
@@ -216,6 +217,30 @@ class H0Posterior:
             i += 1
         return 1.0 - 1.0/x
 
+    def sample_kappa_ext_many(self, size, random_state, transformed=None):
+        """Sample the external convergence many times at once
+
+        Parameters
+        ----------
+        size : int or tuple
+            shape of the output
+        random_state : np.random.RandomState object
+        transformed : bool
+            whether the prior is over 1/(1 - kappa_ext). Default: `self.kappa_transformed`
+
+        """
+        if transformed is None:
+            transformed = self.kappa_transformed
+        x = np.asarray(self.kappa_ext_prior.rvs(size=size, random_state=random_state), dtype=float)
+        if not transformed:
+            return x
+        with np.errstate(divide='ignore'):
+            redraw = ~np.isfinite(1.0 - 1.0/x)
+            while np.any(redraw):
+                x[redraw] = self.kappa_ext_prior.rvs(size=np.sum(redraw), random_state=random_state)
+                redraw = ~np.isfinite(1.0 - 1.0/x)
+        return 1.0 - 1.0/x
+
     def sample_aniso_param(self, random_state):
         return self.aniso_param_prior.rvs(random_state=random_state)
 
@@ -260,7 +285,7 @@ class H0Posterior:
         Returns
         -------
         tuple of floats
-            the candidate H0 and its weight
+            the candidate H0 and the log of its weight
 
         """
         # Samples from the lens posterior are reinterpreted as samples from the lens model prior in the H0 inference stage
@@ -296,31 +321,32 @@ class H0Posterior:
             ll_vd = h0_utils.gaussian_ll_pdf(inferred_vd, self.measured_vd, self.measured_vd_err)
         # Time delays
         inferred_td, x_image, y_image = td_cosmo.time_delays(kwargs_lens, lens_prior_sample['kwargs_ps'], kappa_ext=k_ext)
-        if len(inferred_td) > len(self.measured_td_wrt0) + 1:
-            inferred_td, x_image, y_image = self.chuck_images(inferred_td, x_image, y_image)
-        if lens_prior_sample['requires_reordering']:
-            increasing_dec_i = np.argsort(y_image)
-            inferred_td = h0_utils.reorder_to_tdlmc(inferred_td, increasing_dec_i, self.abcd_ordering_i)
-        else:
-            inferred_td = np.array(inferred_td)
-        inferred_td_wrt0 = inferred_td[1:] - inferred_td[0]
+        inferred_td_wrt0 = self.get_td_wrt0(inferred_td, x_image, y_image, lens_prior_sample['requires_reordering'])
         #print(inferred_td, self.measured_td)
         ll_td = np.sum(h0_utils.gaussian_ll_pdf(inferred_td_wrt0, self.measured_td_wrt0, self.measured_td_err))
         log_w = ll_vd + ll_td
-        weight = mp.exp(log_w)
-        return h0_candidate, weight
+        return h0_candidate, log_w
 
     def set_truth_lens_model(self, sampled_lens_model_raw):
         # Set once per lens
         # Samples from the lens posterior are reinterpreted as samples from the lens model prior in the H0 inference stage
         self.kwargs_model.update(dict(point_source_model_list=['SOURCE_POSITION']))
         self.lens_prior_sample = self.format_lens_model(sampled_lens_model_raw)
-        cosmo = FlatLambdaCDM(H0=70.0, Om0=self.Om0) # fiducial cosmology, doesn't matter
-        td_cosmo = TDCosmography(self.z_lens, self.z_src, self.kwargs_model, cosmo_fiducial=cosmo, kwargs_lens_eqn_solver=self.kwargs_lens_eqn_solver)
-        _, x_image, y_image = td_cosmo.time_delays(self.lens_prior_sample['kwargs_lens'], self.lens_prior_sample['kwargs_ps'], kappa_ext=0.0)
-        while len(y_image) not in [2, 4]:
+        x_image, y_image = None, None
+        if self.kwargs_model['lens_model_list'] in self.batched_lens_model_lists:
+            # Warm start from the measured image positions
+            lens_params, ra_source, dec_source = lens_equation_solver.get_lens_params({k: [v] for k, v in dict(sampled_lens_model_raw).items()}, self.define_src_pos_wrt_lens)
+            images = lens_equation_solver.solve_lens_equation(lens_params, ra_source, dec_source, self.true_img_ra, self.true_img_dec, **self._get_batched_solver_kwargs())
+            if images['is_consistent'][0]:
+                x_image = images['x_image'][0][images['mask'][0]]
+                y_image = images['y_image'][0][images['mask'][0]]
+        if x_image is None:
+            cosmo = FlatLambdaCDM(H0=70.0, Om0=self.Om0) # fiducial cosmology, doesn't matter
+            td_cosmo = TDCosmography(self.z_lens, self.z_src, self.kwargs_model, cosmo_fiducial=cosmo, kwargs_lens_eqn_solver=self.kwargs_lens_eqn_solver)
             _, x_image, y_image = td_cosmo.time_delays(self.lens_prior_sample['kwargs_lens'], self.lens_prior_sample['kwargs_ps'], kappa_ext=0.0)
-            #raise ValueError("Defective lens?")
+            while len(y_image) not in [2, 4]:
+                _, x_image, y_image = td_cosmo.time_delays(self.lens_prior_sample['kwargs_lens'], self.lens_prior_sample['kwargs_ps'], kappa_ext=0.0)
+                #raise ValueError("Defective lens?")
         self.kwargs_model.update(dict(point_source_model_list=['LENSED_POSITION']))
         self.kwargs_image = [dict(ra_image=x_image, dec_image=y_image)]
 
@@ -336,7 +362,7 @@ class H0Posterior:
         Returns
         -------
         tuple of floats
-            the candidate H0 and its weight
+            the candidate H0 and the log of its weight
 
         """
         #increasing_dec_i = lens_prior_sample['increasing_dec_i']
@@ -352,20 +378,204 @@ class H0Posterior:
         # Time delays
         inferred_td, x_image, y_image = td_cosmo.time_delays(self.lens_prior_sample['kwargs_lens'], self.kwargs_image, kappa_ext=k_ext)
         #print(inferred_td, y_image)
+        inferred_td_wrt0 = self.get_td_wrt0(inferred_td, x_image, y_image, self.lens_prior_sample['requires_reordering'])
+        #print(inferred_td_wrt0, self.measured_td_wrt0)
+        ll_td = np.sum(h0_utils.gaussian_ll_pdf(inferred_td_wrt0, self.measured_td_wrt0, self.measured_td_err))
+        log_w = ll_td
+        return h0_candidate, log_w
+
+    def get_td_wrt0(self, inferred_td, x_image, y_image, requires_reordering):
+        """Convert the time delays of the images predicted by lenstronomy into time delays relative to the first image in the order of the measured ones
+
+        Extra images are removed with `chuck_images`.
+
+        Returns
+        -------
+        np.array
+            time delays relative to the first image, of shape `[n_img - 1,]` unless the lens model predicts fewer images than measured
+
+        """
         if len(inferred_td) > len(self.measured_td_wrt0) + 1:
             inferred_td, x_image, y_image = self.chuck_images(inferred_td, x_image, y_image)
-            #print("after correct: ", inferred_td, y_image)
-        if self.lens_prior_sample['requires_reordering']:
+        if requires_reordering:
             increasing_dec_i = np.argsort(y_image)
             inferred_td = h0_utils.reorder_to_tdlmc(inferred_td, increasing_dec_i, self.abcd_ordering_i)
         else:
             inferred_td = np.array(inferred_td)
-        inferred_td_wrt0 = inferred_td[1:] - inferred_td[0]
-        #print(inferred_td_wrt0, self.measured_td_wrt0)
-        ll_td = np.sum(h0_utils.gaussian_ll_pdf(inferred_td_wrt0, self.measured_td_wrt0, self.measured_td_err))
-        log_w = ll_td
-        weight = mp.exp(log_w)
-        return h0_candidate, weight
+        return inferred_td[1:] - inferred_td[0]
+
+    def get_fiducial_td_cosmo(self):
+        """Tool for getting the time delays at H0 = `h0_fiducial`, which the vectorized samplers rescale to every H0 draw
+
+        """
+        cosmo = FlatLambdaCDM(H0=self.h0_fiducial, Om0=self.Om0)
+        return TDCosmography(self.z_lens, self.z_src, self.kwargs_model, cosmo_fiducial=cosmo, kwargs_lens_eqn_solver=self.kwargs_lens_eqn_solver)
+
+    def _get_batched_solver_kwargs(self):
+        """Options of `lens_equation_solver.solve_lens_equation` shared with the lenstronomy solver options in `kwargs_lens_eqn_solver`
+
+        """
+        return {k: v for k, v in self.kwargs_lens_eqn_solver.items() if k in ['min_distance', 'num_iter_max', 'precision_limit']}
+
+    def get_fiducial_td_wrt0(self, lens_model_sample, td_cosmo):
+        """Get the time delays at H0 = `h0_fiducial` and zero external convergence of one lens-model sample, solving the lens equation with lenstronomy
+
+        Parameters
+        ----------
+        lens_model_sample : pd.Series
+            sampled lens model parameters, pre-formatting
+        td_cosmo : TDCosmography object
+            output of `get_fiducial_td_cosmo`
+
+        Returns
+        -------
+        np.array of shape `[n_img - 1,]`
+            time delays relative to the first image in the order of the measured ones, or NaN if the lens equation solver fails or predicts fewer images than measured
+
+        """
+        lens_prior_sample = self.format_lens_model(lens_model_sample)
+        try:
+            inferred_td, x_image, y_image = td_cosmo.time_delays(lens_prior_sample['kwargs_lens'], lens_prior_sample['kwargs_ps'], kappa_ext=0.0)
+        except Exception:
+            # Lens equation solver failures get zero weight, as they are dropped in the inference scripts
+            return np.full(len(self.measured_td_wrt0), np.nan)
+        if len(inferred_td) < self.n_img:
+            return np.full(len(self.measured_td_wrt0), np.nan)
+        return self.get_td_wrt0(inferred_td, x_image, y_image, lens_prior_sample['requires_reordering'])
+
+    def get_fiducial_td_wrt0_many(self, lens_model_samples):
+        """Get the time delays at H0 = `h0_fiducial` and zero external convergence of many lens-model samples, solving the lens equation for all of them at once
+
+        The solver is warm-started from the images of the mean lens model. Lens-model samples whose image count is inconsistent with the lens model or smaller than the measured one, e.g. because the batched solver missed an image, fall back to the lenstronomy solver one at a time (see `get_fiducial_td_wrt0`), so that they aren't dropped from the H0 samples.
+
+        Parameters
+        ----------
+        lens_model_samples : pd.DataFrame
+            sampled lens model parameters, pre-formatting, one per row
+
+        Returns
+        -------
+        np.array of shape `[n_lens_models, n_img - 1]`
+            time delays relative to the first image in the order of the measured ones
+
+        """
+        n_lens_models = len(lens_model_samples)
+        lens_params, ra_source, dec_source = lens_equation_solver.get_lens_params(lens_model_samples, self.define_src_pos_wrt_lens)
+        mean_lens_model = lens_model_samples.mean()
+        try:
+            mean_prior_sample = self.format_lens_model(mean_lens_model)
+            _, init_ra, init_dec = self.get_fiducial_td_cosmo().time_delays(mean_prior_sample['kwargs_lens'], mean_prior_sample['kwargs_ps'], kappa_ext=0.0)
+        except Exception:
+            init_ra, init_dec = None, None
+        images = lens_equation_solver.solve_lens_equation(lens_params, ra_source, dec_source, init_ra, init_dec, mean_lens_model['lens_mass_center_x'], mean_lens_model['lens_mass_center_y'], **self._get_batched_solver_kwargs())
+        cosmo = FlatLambdaCDM(H0=self.h0_fiducial, Om0=self.Om0)
+        inferred_td = lens_equation_solver.get_time_delays(images['x_image'], images['y_image'], lens_params, self.z_lens, self.z_src, cosmo)
+        fiducial_td_wrt0 = np.full([n_lens_models, self.n_img - 1], np.nan)
+        # Images are in order of increasing dec
+        is_n_img = images['is_consistent'] & (images['n_images'] == self.n_img)
+        reordered_td = inferred_td[is_n_img][:, :self.n_img][:, self.abcd_ordering_i]
+        fiducial_td_wrt0[is_n_img] = reordered_td[:, 1:] - reordered_td[:, [0]]
+        # Extra images are removed one lens model at a time
+        for i in np.where(images['is_consistent'] & (images['n_images'] > self.n_img))[0]:
+            mask = images['mask'][i]
+            fiducial_td_wrt0[i] = self.get_td_wrt0(inferred_td[i][mask], images['x_image'][i][mask], images['y_image'][i][mask], True)
+        # The rest are solved one at a time with lenstronomy
+        td_cosmo = self.get_fiducial_td_cosmo()
+        for i in np.where(~images['is_consistent'] | (images['n_images'] < self.n_img))[0]:
+            fiducial_td_wrt0[i] = self.get_fiducial_td_wrt0(lens_model_samples.iloc[i], td_cosmo)
+        return fiducial_td_wrt0
+
+    def get_h0_samples(self, lens_model_samples, n_draws_per_lens_model, random_state):
+        """Get many MC samples from the H0Posterior, with the time-delay likelihood evaluated for all draws at once
+
+        Unlike `get_h0_sample`, which solves the lens equation and evaluates the time delays for every (H0, kappa_ext) draw, the time delays are computed once per lens-model sample at H0 = `h0_fiducial` and zero external convergence, and rescaled analytically to each draw (see `h0_utils.get_td_log_likelihood`). For the lens models in `batched_lens_model_lists`, the lens equation is solved for all lens-model samples at once (see `get_fiducial_td_wrt0_many`). Lens-model samples for which the lens equation solver fails or predicts fewer images than measured get zero weight.
+
+        Parameters
+        ----------
+        lens_model_samples : pd.DataFrame
+            sampled lens model parameters, pre-formatting, one per row
+        n_draws_per_lens_model : int
+            number of (H0, kappa_ext) draws for each lens-model sample
+        random_state : np.random.RandomState object or int
+
+        Returns
+        -------
+        tuple
+            the candidate H0 and the log of their weights, both of shape `[n_lens_models, n_draws_per_lens_model]`
+
+        """
+        if not self.exclude_vel_disp:
+            raise NotImplementedError("The vectorized sampler only supports the time delay likelihood. Use get_h0_sample for the velocity dispersion likelihood.")
+        if not isinstance(random_state, np.random.RandomState):
+            random_state = np.random.RandomState(random_state)
+        n_lens_models = len(lens_model_samples)
+        if self.kwargs_model['lens_model_list'] in self.batched_lens_model_lists:
+            fiducial_td_wrt0 = self.get_fiducial_td_wrt0_many(lens_model_samples)
+        else:
+            td_cosmo = self.get_fiducial_td_cosmo()
+            fiducial_td_wrt0 = np.full([n_lens_models, len(self.measured_td_wrt0)], np.nan)
+            for i in range(n_lens_models):
+                fiducial_td_wrt0[i] = self.get_fiducial_td_wrt0(lens_model_samples.iloc[i], td_cosmo)
+        size = [n_lens_models, n_draws_per_lens_model]
+        h0_candidates = np.asarray(self.H0_prior.rvs(size=size, random_state=random_state), dtype=float)
+        k_ext = self.sample_kappa_ext_many(size, random_state)
+        log_w = h0_utils.get_td_log_likelihood(fiducial_td_wrt0, self.h0_fiducial, h0_candidates, k_ext, self.measured_td_wrt0, self.measured_td_err)
+        log_w[np.isnan(log_w)] = -np.inf
+        return h0_candidates, log_w
+
+    def get_h0_samples_truth(self, n_samples, random_state):
+        """Get many MC samples from the H0Posterior for the lens model set by `set_truth_lens_model`, in one vectorized call
+
+        The vectorized counterpart of `get_h0_sample_truth`: the time delays are computed once at H0 = `h0_fiducial` and zero external convergence, and rescaled to each (H0, kappa_ext) draw.
+
+        Parameters
+        ----------
+        n_samples : int
+            number of H0 samples
+        random_state : np.random.RandomState object or int
+
+        Returns
+        -------
+        tuple
+            the candidate H0 and the log of their weights, both of shape `[n_samples,]`
+
+        """
+        if not isinstance(random_state, np.random.RandomState):
+            random_state = np.random.RandomState(random_state)
+        fiducial_td_wrt0 = self.get_fiducial_td_wrt0_truth()
+        h0_candidates = np.asarray(self.H0_prior.rvs(size=n_samples, random_state=random_state), dtype=float)
+        k_ext = self.sample_kappa_ext_many(n_samples, random_state, transformed=True)
+        log_w = h0_utils.get_td_log_likelihood(fiducial_td_wrt0[np.newaxis, :], self.h0_fiducial, h0_candidates[np.newaxis, :], k_ext[np.newaxis, :], self.measured_td_wrt0, self.measured_td_err)
+        return h0_candidates, log_w[0]
+
+    def get_fiducial_td_wrt0_truth(self):
+        """Get the time delays at H0 = `h0_fiducial` and zero external convergence of the lens model set by `set_truth_lens_model`
+
+        Returns
+        -------
+        np.array of shape `[n_img - 1,]`
+            time delays relative to the first image in the order of the measured ones
+
+        """
+        td_cosmo = self.get_fiducial_td_cosmo()
+        inferred_td, x_image, y_image = td_cosmo.time_delays(self.lens_prior_sample['kwargs_lens'], self.kwargs_image, kappa_ext=0.0)
+        return self.get_td_wrt0(inferred_td, x_image, y_image, self.lens_prior_sample['requires_reordering'])
+
+    def get_h0_samples_truth_adaptive(self, target_n_eff, max_n_samples, block_size, random_state, adapt_proposal=False, defensive_weight=0.1):
+        """Get MC samples from the H0Posterior for the lens model set by `set_truth_lens_model`, drawing blocks of samples until the effective sample size of the weights reaches `target_n_eff`
+
+        See `h0_utils.sample_h0_adaptive` for the parameters. As in `get_h0_samples_truth`, the prior over kappa_ext is over 1/(1 - kappa_ext).
+
+        Returns
+        -------
+        tuple
+            the candidate H0 and the log of their weights, both of shape `[n_samples,]`, and a dict with the effective sample size `n_eff`, the number of samples `n_samples` and blocks `n_blocks`, and `reached_target`
+
+        """
+        fiducial_td_wrt0 = self.get_fiducial_td_wrt0_truth()[np.newaxis, :]
+        log_likelihood_fn = lambda h0, kappa_ext: h0_utils.get_td_log_likelihood(fiducial_td_wrt0, self.h0_fiducial, h0[np.newaxis, :], kappa_ext[np.newaxis, :], self.measured_td_wrt0, self.measured_td_err)[0]
+        h0_candidates, _, log_w, info = h0_utils.sample_h0_adaptive(log_likelihood_fn, self.H0_prior, self.kappa_ext_prior, target_n_eff, max_n_samples, block_size, random_state, kappa_transformed=True, adapt_proposal=adapt_proposal, defensive_weight=defensive_weight)
+        return h0_candidates, log_w, info
 
     def chuck_images(self, inferred_td, x_image, y_image):
         """If the number of predicted images are greater than the measured, choose the images that best correspond to the measured.
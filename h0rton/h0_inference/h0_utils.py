@@ -5,17 +5,20 @@ from lenstronomy.Cosmo.lens_cosmo import LensCosmo
 from hierarc.Sampling.mcmc_sampling import MCMCSampler
 import corner
 import matplotlib.pyplot as plt
-from scipy.stats import norm, median_abs_deviation
+from scipy.stats import norm, median_abs_deviation, multivariate_normal
+from scipy.special import logsumexp
 
-__all__ = ["reorder_to_tdlmc", "pred_to_natural_gaussian", "CosmoConverter", "get_lognormal_stats", "get_lognormal_stats_naive", "get_normal_stats", "get_normal_stats_naive", "remove_outliers_from_lognormal", "combine_lenses", "gaussian_ll_pdf"]
+__all__ = ["reorder_to_tdlmc", "pred_to_natural_gaussian", "CosmoConverter", "get_lognormal_stats", "get_lognormal_stats_naive", "get_normal_stats", "get_normal_stats_naive", "remove_outliers_from_lognormal", "combine_lenses", "gaussian_ll_pdf", "get_td_log_likelihood", "get_normalized_weights", "get_n_eff", "sample_h0_adaptive"]
 
 MAD_to_sig = 1.0/norm.ppf(0.75) # 1.4826 built into scipy, so not used.
 
 class DeltaFunction:
     def __init__(self, true_value=0.0):
         self.true_value = true_value
-    def rvs(self, random_state=None):
-        return self.true_value
+    def rvs(self, size=None, random_state=None):
+        if size is None:
+            return self.true_value
+        return np.full(size, self.true_value, dtype=float)
 
 def gaussian_ll_pdf(x, mu, sigma):
     """Evaluates the (unnormalized) log of the normal PDF at point x
@@ -33,6 +36,36 @@ def gaussian_ll_pdf(x, mu, sigma):
     log_pdf = -0.5*(x - mu)**2.0/sigma**2.0 #- np.log(sigma) - 0.5*np.log(2.0*np.pi)
     return log_pdf
 
+def get_td_log_likelihood(fiducial_td_wrt0, h0_fiducial, h0, kappa_ext, measured_td_wrt0, measured_td_err):
+    """Evaluate the (unnormalized) time-delay log likelihood of many (H0, kappa_ext) draws per lens model at once
+
+    The time delays scale as `D_dt(H0)*(1 - kappa_ext)*Delta phi`, where the Fermat potential differences `Delta phi` depend only on the lens model and `D_dt` is inversely proportional to H0 at fixed Om0. So the time delays at any (H0, kappa_ext) follow from those at a fiducial H0 and zero external convergence.
+
+    Parameters
+    ----------
+    fiducial_td_wrt0 : np.array of shape `[n_lens_models, n_img - 1]`
+        time delays in days relative to the first image, at H0 = `h0_fiducial` and zero external convergence
+    h0_fiducial : float
+        fiducial H0 in km/s/Mpc
+    h0 : np.array of shape `[n_lens_models, n_draws]`
+        H0 draws in km/s/Mpc
+    kappa_ext : np.array of shape `[n_lens_models, n_draws]`
+        external convergence draws
+    measured_td_wrt0 : np.array of shape `[n_img - 1,]`
+        measured time delays in days relative to the first image
+    measured_td_err : float or np.array of shape `[n_img - 1,]`
+        time delay measurement error in days
+
+    Returns
+    -------
+    np.array of shape `[n_lens_models, n_draws]`
+        log likelihood, summed over the images
+
+    """
+    scaling = h0_fiducial/h0*(1.0 - kappa_ext) # [n_lens_models, n_draws]
+    inferred_td_wrt0 = fiducial_td_wrt0[:, np.newaxis, :]*scaling[:, :, np.newaxis] # [n_lens_models, n_draws, n_img - 1]
+    return np.sum(gaussian_ll_pdf(inferred_td_wrt0, measured_td_wrt0, measured_td_err), axis=-1)
+
 def reorder_to_tdlmc(img_array, increasing_dec_i, abcd_ordering_i):
     """Apply the permutation scheme for reordering the list of ra, dec, and time delays to conform to the order in the TDLMC challenge
 
@@ -120,16 +153,165 @@ def get_lognormal_stats(all_samples):
                  )
     return stats
 
-def get_lognormal_stats_naive(all_samples, all_weights=None):
-    """Compute lognormal stats assuming the samples are drawn from a lognormal distribution
+def get_normalized_weights(all_log_weights, all_samples=None):
+    """Normalize importance weights given in log space, so that weights far below or above the float range are never exponentiated on their own
+
+    Samples with a NaN sample or a NaN or infinite log weight are invalid. A log weight of -inf, i.e. a zero weight, is also treated as invalid.
+
+    Parameters
+    ----------
+    all_log_weights : np.array
+        log weights, possibly including NaN and infinite values
+    all_samples : np.array
+        samples corresponding to `all_log_weights`. Default: None
+
+    Returns
+    -------
+    tuple
+        boolean mask of the valid samples and their weights normalized to sum to unity
+
+    """
+    all_log_weights = np.asarray(all_log_weights, dtype=np.float64)
+    is_valid = np.isfinite(all_log_weights)
+    if all_samples is not None:
+        is_valid &= ~np.isnan(all_samples)
+    log_weights = all_log_weights[is_valid]
+    return is_valid, np.exp(log_weights - logsumexp(log_weights))
+
+def get_n_eff(all_log_weights):
+    """Compute the Kish effective sample size, `(sum w)^2/sum w^2`, of importance weights given in log space
+
+    Parameters
+    ----------
+    all_log_weights : np.array
+        log weights. NaN and -inf values count as zero weights.
+
+    Returns
+    -------
+    float
+        effective sample size, 0 if all weights are zero
+
+    """
+    all_log_weights = np.asarray(all_log_weights, dtype=np.float64)
+    log_weights = all_log_weights[~np.isnan(all_log_weights) & (all_log_weights > -np.inf)]
+    if len(log_weights) == 0:
+        return 0.0
+    return float(np.exp(2.0*logsumexp(log_weights) - logsumexp(2.0*log_weights)))
+
+def sample_h0_adaptive(log_likelihood_fn, h0_prior, kappa_ext_prior, target_n_eff, max_n_samples, block_size, random_state, kappa_transformed=True, adapt_proposal=False, defensive_weight=0.1, proposal_inflation=1.5, min_n_eff_to_adapt=10.0):
+    """Importance-sample H0 and kappa_ext in blocks until the effective sample size of the weights reaches a target
+
+    The first block is drawn from the prior, so that the log weights are the log likelihood. If `adapt_proposal`, every later block is drawn from the defensive mixture `defensive_weight*prior + (1 - defensive_weight)*g` (Hesterberg 1995), where `g` is a Gaussian fit to the weighted samples so far, widened by `proposal_inflation`, and the log weights gain `log prior - log proposal`. The prior component keeps the weights bounded by `likelihood/defensive_weight` even if `g` misses part of the posterior. The Gaussian is over H0 and the variable the kappa_ext prior is defined over (1/(1 - kappa_ext) if `kappa_transformed`), capturing their degeneracy in the time delays, or over H0 alone if the kappa_ext prior has no `logpdf`, e.g. `DeltaFunction`.
+
+    Parameters
+    ----------
+    log_likelihood_fn : callable
+        maps the H0 and kappa_ext draws, both of shape `[n,]`, to their log likelihood of shape `[n,]`
+    h0_prior : scipy rv_continuous object
+    kappa_ext_prior : scipy rv_continuous object or DeltaFunction
+        prior over kappa_ext, or over 1/(1 - kappa_ext) if `kappa_transformed`
+    target_n_eff : float
+        effective sample size (see `get_n_eff`) at which to stop
+    max_n_samples : int
+        largest number of samples to draw
+    block_size : int
+        number of samples drawn between checks of the effective sample size
+    random_state : np.random.RandomState object or int
+    kappa_transformed : bool
+        whether `kappa_ext_prior` is over 1/(1 - kappa_ext)
+    adapt_proposal : bool
+        whether to refine the proposal towards the high-weight region after each block
+    defensive_weight : float
+        weight of the prior in the mixture proposal, in (0, 1]
+    proposal_inflation : float
+        factor by which the std of the Gaussian fit is widened
+    min_n_eff_to_adapt : float
+        effective sample size under which the proposal stays the prior, as the Gaussian fit would be unreliable
+
+    Returns
+    -------
+    tuple
+        the H0 and kappa_ext samples and their log weights, each of shape `[n_samples,]`, and a dict with the final effective sample size `n_eff`, the number of samples `n_samples` and blocks `n_blocks`, and `reached_target`
+
+    """
+    if not isinstance(random_state, np.random.RandomState):
+        random_state = np.random.RandomState(random_state)
+    adapt_kappa = hasattr(kappa_ext_prior, 'logpdf')
+    h0_blocks, kappa_ext_blocks, log_w_blocks, theta_blocks = [], [], [], []
+    proposal = None # mean and covariance of the Gaussian component
+    n_samples = 0
+    n_eff = 0.0
+    while n_samples < max_n_samples:
+        size = min(block_size, max_n_samples - n_samples)
+        h0 = np.asarray(h0_prior.rvs(size=size, random_state=random_state), dtype=float)
+        x = np.asarray(kappa_ext_prior.rvs(size=size, random_state=random_state), dtype=float)
+        log_prior_ratio = np.zeros(size)
+        if proposal is not None:
+            mean, cov = proposal
+            from_gaussian = random_state.rand(size) >= defensive_weight
+            theta_gaussian = random_state.multivariate_normal(mean, cov, size=size)
+            h0[from_gaussian] = theta_gaussian[from_gaussian, 0]
+            if adapt_kappa:
+                x[from_gaussian] = theta_gaussian[from_gaussian, 1]
+        theta = np.stack([h0, x], axis=1)[:, :(2 if adapt_kappa else 1)]
+        if proposal is not None:
+            log_prior = h0_prior.logpdf(h0) + (kappa_ext_prior.logpdf(x) if adapt_kappa else 0.0)
+            log_gaussian = multivariate_normal.logpdf(theta, mean, cov).reshape(size)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                log_proposal = np.logaddexp(np.log(defensive_weight) + log_prior, np.log1p(-defensive_weight) + log_gaussian)
+                log_prior_ratio = log_prior - log_proposal
+        with np.errstate(divide='ignore', invalid='ignore'):
+            kappa_ext = 1.0 - 1.0/x if kappa_transformed else x
+            log_w = log_likelihood_fn(h0, kappa_ext) + log_prior_ratio
+        # Outside the prior support or kappa_ext undefined
+        log_w[~np.isfinite(log_w)] = -np.inf
+        h0_blocks.append(h0)
+        kappa_ext_blocks.append(kappa_ext)
+        log_w_blocks.append(log_w)
+        theta_blocks.append(theta)
+        n_samples += size
+        n_eff = get_n_eff(np.concatenate(log_w_blocks))
+        if n_eff >= target_n_eff:
+            break
+        if adapt_proposal and n_eff >= min_n_eff_to_adapt:
+            is_valid, weights = get_normalized_weights(np.concatenate(log_w_blocks))
+            theta_valid = np.concatenate(theta_blocks)[is_valid]
+            mean = np.sum(weights[:, np.newaxis]*theta_valid, axis=0)
+            cov = np.atleast_2d(np.cov(theta_valid, rowvar=False, aweights=weights))*proposal_inflation**2.0
+            proposal = (mean, cov)
+    info = dict(n_eff=n_eff,
+                n_samples=n_samples,
+                n_blocks=len(log_w_blocks),
+                reached_target=bool(n_eff >= target_n_eff))
+    return np.concatenate(h0_blocks), np.concatenate(kappa_ext_blocks), np.concatenate(log_w_blocks), info
+
+def _get_log_weights(all_samples, all_weights, all_log_weights):
+    """Get the log weights from either the weights or the log weights, defaulting to uniform weights
 
     """
+    if all_log_weights is not None:
+        return all_log_weights
     if all_weights is None:
-        all_weights = np.ones_like(all_samples)
-    is_nan_mask = np.logical_or(np.logical_or(np.isnan(all_weights), ~np.isfinite(all_weights)), np.isnan(all_samples))
-    all_weights[~is_nan_mask] = all_weights[~is_nan_mask]/np.sum(all_weights[~is_nan_mask])
-    samples = all_samples[~is_nan_mask]
-    weights = all_weights[~is_nan_mask]
+        return np.zeros(np.shape(all_samples))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.log(np.asarray(all_weights, dtype=np.float64))
+
+def get_lognormal_stats_naive(all_samples, all_weights=None, all_log_weights=None):
+    """Compute lognormal stats assuming the samples are drawn from a lognormal distribution
+
+    Parameters
+    ----------
+    all_samples : np.array
+        samples, possibly including NaN values
+    all_weights : np.array
+        weights corresponding to `all_samples`. Default: None, i.e. uniform weights unless `all_log_weights` is given
+    all_log_weights : np.array
+        log weights corresponding to `all_samples`, used instead of `all_weights` if given
+
+    """
+    log_weights = _get_log_weights(all_samples, all_weights, all_log_weights)
+    is_valid, weights = get_normalized_weights(log_weights, all_samples)
+    samples = all_samples[is_valid]
     n_samples = len(samples)
     log_samples = np.log(samples)
     mu = np.average(log_samples, weights=weights)
@@ -155,14 +337,29 @@ def get_normal_stats(all_samples):
                  )
     return stats
 
-def get_normal_stats_naive(all_samples, all_weights):
-    is_nan_mask = np.logical_or(np.logical_or(np.isnan(all_weights), ~np.isfinite(all_weights)), np.isnan(all_samples))
-    all_weights[~is_nan_mask] = all_weights[~is_nan_mask]/np.sum(all_weights[~is_nan_mask])
-    samples = all_samples[~is_nan_mask]
-    weights = all_weights[~is_nan_mask]
+def get_normal_stats_naive(all_samples, all_weights=None, all_log_weights=None):
+    """Compute the weighted mean and std of the samples
+
+    Parameters
+    ----------
+    all_samples : np.array
+        samples, possibly including NaN values
+    all_weights : np.array
+        weights corresponding to `all_samples`. Default: None, i.e. uniform weights unless `all_log_weights` is given
+    all_log_weights : np.array
+        log weights corresponding to `all_samples`, used instead of `all_weights` if given
+
+    Returns
+    -------
+    dict
+        the mean and std, along with the valid samples and their normalized weights
+
+    """
+    log_weights = _get_log_weights(all_samples, all_weights, all_log_weights)
+    is_valid, weights = get_normalized_weights(log_weights, all_samples)
+    samples = all_samples[is_valid]
     mean = np.average(samples, weights=weights)
     std = np.average((samples - mean)**2.0, weights=weights)**0.5
-    #print(mean, std)
     stats = dict(
                  mean=mean,
                  std=std,
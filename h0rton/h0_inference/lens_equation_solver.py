@@ -0,0 +1,295 @@
+"""Solving the lens equation for many PEMD + SHEAR lens-model samples at once
+
+The image positions of every lens-model sample are found by Newton iterations run in lockstep over all samples and starting points as NumPy array operations, instead of calling the lenstronomy solver once per sample. The PEMD deflection and Hessian follow the elliptical power law of Tessore & Metcalf (2015), in the same parameterization as lenstronomy's `PEMD` and `EPL` profiles, so no compiled `fastell4py` is needed.
+
+Each sample is started from the images of a reference model, e.g. the BNN mean model, shifted to the sample's lens center, and from rings of points around the lens center. Converged solutions within `min_distance` of one another are merged, solutions at the lens center (the infinitely demagnified central image) are dropped, and the remaining images are returned as arrays padded with NaN, with a mask of the valid images and a flag of whether the image count is consistent with a PEMD + SHEAR lens.
+
+"""
+import numpy as np
+from scipy.special import hyp2f1
+from lenstronomy.Cosmo.lens_cosmo import LensCosmo
+
+__all__ = ['lens_param_names', 'get_lens_params', 'get_deflection', 'get_hessian', 'get_fermat_potential', 'solve_lens_equation', 'get_time_delays']
+
+lens_param_names = ['theta_E', 'gamma', 'e1', 'e2', 'center_x', 'center_y', 'gamma1', 'gamma2', 'ra_0', 'dec_0']
+
+def get_lens_params(lens_model_samples, define_src_pos_wrt_lens=True):
+    """Convert lens-model samples in the Baobab column convention into the arrays taken by the solver
+
+    The shear is centered at the lens center, as in `H0Posterior.format_lens_model`.
+
+    Parameters
+    ----------
+    lens_model_samples : pd.DataFrame or dict of array-like
+        lens-model samples, one per row
+    define_src_pos_wrt_lens : bool
+        whether the source position is defined relative to the lens center
+
+    Returns
+    -------
+    tuple
+        dict of the lens parameters in `lens_param_names`, each of shape `[n_samples,]`, and the source positions `ra_source` and `dec_source`, each of shape `[n_samples,]`
+
+    """
+    get = lambda col: np.atleast_1d(np.asarray(lens_model_samples[col], dtype=float))
+    lens_params = dict(theta_E=get('lens_mass_theta_E'),
+                       gamma=get('lens_mass_gamma'),
+                       e1=get('lens_mass_e1'),
+                       e2=get('lens_mass_e2'),
+                       center_x=get('lens_mass_center_x'),
+                       center_y=get('lens_mass_center_y'),
+                       gamma1=get('external_shear_gamma1'),
+                       gamma2=get('external_shear_gamma2'),
+                       ra_0=get('lens_mass_center_x'),
+                       dec_0=get('lens_mass_center_y'))
+    ra_source = get('src_light_center_x')
+    dec_source = get('src_light_center_y')
+    if define_src_pos_wrt_lens:
+        ra_source = ra_source + lens_params['center_x']
+        dec_source = dec_source + lens_params['center_y']
+    return lens_params, ra_source, dec_source
+
+def _get_major_axis_frame(x, y, lens_params):
+    """Convert the lens parameters into the critical radius, slope, axis ratio, and orientation of the PEMD and rotate the positions into its major-axis frame
+
+    All lens parameters are broadcast against the positions along the first axis.
+
+    """
+    expand = lambda arr: np.asarray(arr, dtype=float).reshape((-1,) + (1,)*(np.ndim(x) - 1))
+    theta_E, gamma, e1, e2 = [expand(lens_params[k]) for k in ['theta_E', 'gamma', 'e1', 'e2']]
+    # Same conversion as lenstronomy.Util.param_util.ellipticity2phi_q
+    phi = np.arctan2(e2, e1)/2.0
+    c = np.minimum(np.sqrt(e1**2.0 + e2**2.0), 0.9999)
+    q = (1.0 - c)/(1.0 + c)
+    b = theta_E*np.sqrt(q)
+    t = gamma - 1.0
+    x_ = x - expand(lens_params['center_x'])
+    y_ = y - expand(lens_params['center_y'])
+    cos, sin = np.cos(phi), np.sin(phi)
+    x__ = cos*x_ + sin*y_
+    y__ = -sin*x_ + cos*y_
+    return x__, y__, b, t, q, cos, sin
+
+def _get_major_axis_deflection(x, y, b, t, q):
+    """Deflection of the PEMD in its major-axis frame, eq. (22) of Tessore & Metcalf (2015)
+
+    """
+    Z = q*x + 1j*y
+    R = np.maximum(np.abs(Z), 1.e-9)
+    # Positions at the lens center evaluate to 0/0, which is set to a large finite deflection below
+    with np.errstate(divide='ignore', invalid='ignore'):
+        R_omega = Z*hyp2f1(1.0, t/2.0, 2.0 - t/2.0, -(1.0 - q)/(1.0 + q)*(Z/np.conj(Z)))
+    alpha = 2.0/(1.0 + q)*(b/R)**t*R_omega
+    return np.nan_to_num(alpha.real, posinf=1.e10, neginf=-1.e10), np.nan_to_num(alpha.imag, posinf=1.e10, neginf=-1.e10)
+
+def get_deflection(x, y, lens_params):
+    """Deflection of the PEMD + SHEAR lens at many positions of many lens-model samples
+
+    Parameters
+    ----------
+    x : np.array of shape `[n_samples, ...]`
+        ra of the positions in arcsec
+    y : np.array of shape `[n_samples, ...]`
+        dec of the positions in arcsec
+    lens_params : dict
+        lens parameters in `lens_param_names`, each of shape `[n_samples,]`
+
+    Returns
+    -------
+    tuple of np.array
+        deflection `alpha_x`, `alpha_y`, each with the shape of `x`
+
+    """
+    x__, y__, b, t, q, cos, sin = _get_major_axis_frame(x, y, lens_params)
+    f__x, f__y = _get_major_axis_deflection(x__, y__, b, t, q)
+    # Rotate back
+    f_x = cos*f__x - sin*f__y
+    f_y = sin*f__x + cos*f__y
+    expand = lambda arr: np.asarray(arr, dtype=float).reshape((-1,) + (1,)*(np.ndim(x) - 1))
+    gamma1, gamma2 = expand(lens_params['gamma1']), expand(lens_params['gamma2'])
+    x_s = x - expand(lens_params['ra_0'])
+    y_s = y - expand(lens_params['dec_0'])
+    return f_x + gamma1*x_s + gamma2*y_s, f_y + gamma2*x_s - gamma1*y_s
+
+def get_hessian(x, y, lens_params):
+    """Hessian of the lensing potential of the PEMD + SHEAR lens at many positions of many lens-model samples
+
+    See `get_deflection` for the parameters.
+
+    Returns
+    -------
+    tuple of np.array
+        `f_xx`, `f_xy`, `f_yy`, each with the shape of `x`
+
+    """
+    x__, y__, b, t, q, cos, sin = _get_major_axis_frame(x, y, lens_params)
+    R = np.maximum(np.hypot(q*x__, y__), 1.e-8)
+    r = np.maximum(np.hypot(x__, y__), 1.e-8)
+    cos_r, sin_r = x__/r, y__/r
+    cos2, sin2 = 2.0*cos_r**2.0 - 1.0, 2.0*sin_r*cos_r
+    # Convergence, eq. (2)
+    kappa = np.nan_to_num((2.0 - t)/2.0*(b/R)**t, posinf=1.e10, neginf=-1.e10)
+    alpha_x, alpha_y = _get_major_axis_deflection(x__, y__, b, t, q)
+    # Shear, eq. (17) with the corrigendum
+    gamma1__ = np.nan_to_num((1.0 - t)*(alpha_x*cos_r - alpha_y*sin_r)/r - kappa*cos2, posinf=1.e10, neginf=-1.e10)
+    gamma2__ = np.nan_to_num((1.0 - t)*(alpha_y*cos_r + alpha_x*sin_r)/r - kappa*sin2, posinf=1.e10, neginf=-1.e10)
+    # Rotate back the shear, which transforms with twice the angle
+    cos_2phi, sin_2phi = cos**2.0 - sin**2.0, 2.0*sin*cos
+    expand = lambda arr: np.asarray(arr, dtype=float).reshape((-1,) + (1,)*(np.ndim(x) - 1))
+    gamma1 = cos_2phi*gamma1__ - sin_2phi*gamma2__ + expand(lens_params['gamma1'])
+    gamma2 = sin_2phi*gamma1__ + cos_2phi*gamma2__ + expand(lens_params['gamma2'])
+    return kappa + gamma1, gamma2, kappa - gamma1
+
+def get_fermat_potential(x, y, lens_params):
+    """Fermat potential of the PEMD + SHEAR lens at image positions of many lens-model samples
+
+    The source position is that of each image ray-traced back to the source plane, as in lenstronomy.
+
+    See `get_deflection` for the parameters.
+
+    Returns
+    -------
+    np.array
+        Fermat potential in arcsec^2, with the shape of `x`
+
+    """
+    x__, y__, b, t, q, _, _ = _get_major_axis_frame(x, y, lens_params)
+    f__x, f__y = _get_major_axis_deflection(x__, y__, b, t, q)
+    # PEMD potential, eq. (15), invariant under the rotation
+    potential = (x__*f__x + y__*f__y)/(2.0 - t)
+    expand = lambda arr: np.asarray(arr, dtype=float).reshape((-1,) + (1,)*(np.ndim(x) - 1))
+    gamma1, gamma2 = expand(lens_params['gamma1']), expand(lens_params['gamma2'])
+    x_s = x - expand(lens_params['ra_0'])
+    y_s = y - expand(lens_params['dec_0'])
+    potential = potential + 0.5*gamma1*(x_s**2.0 - y_s**2.0) + gamma2*x_s*y_s
+    alpha_x, alpha_y = get_deflection(x, y, lens_params)
+    return 0.5*(alpha_x**2.0 + alpha_y**2.0) - potential
+
+def solve_lens_equation(lens_params, ra_source, dec_source, init_ra=None, init_dec=None, init_center_x=None, init_center_y=None, n_ring=8, ring_radii=(0.3, 1.0, 1.5), num_iter_max=50, precision_limit=1.e-10, min_distance=0.01, max_step=0.1, max_images=5, allowed_n_images=(2, 4)):
+    """Find the image positions of many PEMD + SHEAR lens-model samples with Newton iterations vectorized over the samples and starting points
+
+    Parameters
+    ----------
+    lens_params : dict
+        lens parameters in `lens_param_names`, each of shape `[n_samples,]`
+    ra_source : np.array of shape `[n_samples,]`
+        ra of the source positions in arcsec
+    dec_source : np.array of shape `[n_samples,]`
+        dec of the source positions in arcsec
+    init_ra : np.array of shape `[n_init,]` or `[n_samples, n_init]`
+        ra of the images of a reference model, e.g. the BNN mean model, used as warm starts. Default: None, i.e. only the rings of starting points
+    init_dec : np.array of shape `[n_init,]` or `[n_samples, n_init]`
+        dec of the warm-start images
+    init_center_x : float
+        lens center of the reference model. If given, the warm starts are shifted by each sample's offset from it. Default: None
+    init_center_y : float
+        lens center of the reference model
+    n_ring : int
+        number of additional starting points spaced evenly on each ring around each sample's lens center
+    ring_radii : tuple of float
+        radii of the rings in units of `theta_E`
+    num_iter_max : int
+        number of Newton iterations
+    precision_limit : float
+        squared distance in arcsec^2 between the ray-traced image and the source under which a solution is converged
+    min_distance : float
+        distance in arcsec under which two solutions are the same image, and under which a solution at the lens center is dropped as the central image
+    max_step : float
+        largest Newton step in units of `theta_E`, which keeps the iterations from jumping across the lens center
+    max_images : int
+        width of the padded output arrays
+    allowed_n_images : tuple of int
+        image counts considered consistent with a PEMD + SHEAR lens
+
+    Returns
+    -------
+    dict
+        `x_image` and `y_image` of shape `[n_samples, max_images]`, in order of increasing dec and padded with NaN, `mask` of shape `[n_samples, max_images]` marking the valid images, `n_images` of shape `[n_samples,]`, and `is_consistent` of shape `[n_samples,]`, whether `n_images` is one of `allowed_n_images`
+
+    """
+    ra_source = np.atleast_1d(np.asarray(ra_source, dtype=float))
+    dec_source = np.atleast_1d(np.asarray(dec_source, dtype=float))
+    n_samples = len(ra_source)
+    theta_E = np.asarray(lens_params['theta_E'], dtype=float)[:, np.newaxis]
+    center_x = np.asarray(lens_params['center_x'], dtype=float)[:, np.newaxis]
+    center_y = np.asarray(lens_params['center_y'], dtype=float)[:, np.newaxis]
+    # Starting points, [n_samples, n_start]
+    ring_angle = 2.0*np.pi*(np.arange(n_ring) + 0.5)/n_ring
+    ring_x = np.concatenate([r*np.cos(ring_angle + i*np.pi/n_ring) for i, r in enumerate(ring_radii)])
+    ring_y = np.concatenate([r*np.sin(ring_angle + i*np.pi/n_ring) for i, r in enumerate(ring_radii)])
+    start_x = [center_x + theta_E*ring_x[np.newaxis, :]]
+    start_y = [center_y + theta_E*ring_y[np.newaxis, :]]
+    if init_ra is not None:
+        init_ra = np.broadcast_to(np.atleast_2d(init_ra), (n_samples, np.shape(init_ra)[-1]))
+        init_dec = np.broadcast_to(np.atleast_2d(init_dec), (n_samples, np.shape(init_dec)[-1]))
+        if init_center_x is not None:
+            init_ra = init_ra + (center_x - init_center_x)
+            init_dec = init_dec + (center_y - init_center_y)
+        start_x.insert(0, init_ra)
+        start_y.insert(0, init_dec)
+    x = np.concatenate(start_x, axis=1)
+    y = np.concatenate(start_y, axis=1)
+    src_x = ra_source[:, np.newaxis]
+    src_y = dec_source[:, np.newaxis]
+    for _ in range(num_iter_max):
+        alpha_x, alpha_y = get_deflection(x, y, lens_params)
+        res_x = x - alpha_x - src_x
+        res_y = y - alpha_y - src_y
+        f_xx, f_xy, f_yy = get_hessian(x, y, lens_params)
+        # Solve A delta = res for the Jacobian A = I - Hessian of the lens equation
+        a_xx, a_xy, a_yy = 1.0 - f_xx, -f_xy, 1.0 - f_yy
+        det = a_xx*a_yy - a_xy**2.0
+        det = np.where(np.abs(det) < 1.e-12, 1.e-12, det)
+        step_x = (a_yy*res_x - a_xy*res_y)/det
+        step_y = (a_xx*res_y - a_xy*res_x)/det
+        step_size = np.hypot(step_x, step_y)
+        damping = np.minimum(1.0, max_step*theta_E/np.maximum(step_size, 1.e-15))
+        x = x - damping*step_x
+        y = y - damping*step_y
+    alpha_x, alpha_y = get_deflection(x, y, lens_params)
+    converged = ((x - alpha_x - src_x)**2.0 + (y - alpha_y - src_y)**2.0 < precision_limit) & np.isfinite(x) & np.isfinite(y)
+    # Drop the central image
+    converged &= np.hypot(x - center_x, y - center_y) > min_distance
+    # Merge duplicate solutions, keeping the first of each group
+    dist = np.hypot(x[:, :, np.newaxis] - x[:, np.newaxis, :], y[:, :, np.newaxis] - y[:, np.newaxis, :]) # [n_samples, n_start, n_start]
+    earlier = np.tril(np.ones(dist.shape[1:], dtype=bool), k=-1)[np.newaxis, :, :] # [1, j, i] True where i < j
+    is_duplicate = np.any((dist < min_distance) & earlier & converged[:, np.newaxis, :], axis=2)
+    is_image = converged & ~is_duplicate
+    n_images = np.sum(is_image, axis=1)
+    # Pad, in order of increasing dec
+    sort_key = np.where(is_image, y, np.inf)
+    order = np.argsort(sort_key, axis=1)[:, :max_images]
+    x_image = np.take_along_axis(np.where(is_image, x, np.nan), order, axis=1)
+    y_image = np.take_along_axis(np.where(is_image, y, np.nan), order, axis=1)
+    if x_image.shape[1] < max_images:
+        pad = np.full([n_samples, max_images - x_image.shape[1]], np.nan)
+        x_image = np.concatenate([x_image, pad], axis=1)
+        y_image = np.concatenate([y_image, pad], axis=1)
+    mask = np.isfinite(x_image)
+    return dict(x_image=x_image, y_image=y_image, mask=mask, n_images=n_images, is_consistent=np.isin(n_images, allowed_n_images))
+
+def get_time_delays(x_image, y_image, lens_params, z_lens, z_src, cosmo, kappa_ext=0.0):
+    """Time delays of padded image arrays of many lens-model samples
+
+    Parameters
+    ----------
+    x_image : np.array of shape `[n_samples, max_images]`
+        ra of the images, padded with NaN, e.g. from `solve_lens_equation`
+    y_image : np.array of shape `[n_samples, max_images]`
+        dec of the images
+    lens_params : dict
+        lens parameters in `lens_param_names`, each of shape `[n_samples,]`
+    z_lens : float
+    z_src : float
+    cosmo : astropy.cosmology object
+    kappa_ext : float or np.array of shape `[n_samples, 1]`
+        external convergence
+
+    Returns
+    -------
+    np.array of shape `[n_samples, max_images]`
+        time delays in days, NaN for the padding
+
+    """
+    fermat_pot = get_fermat_potential(x_image, y_image, lens_params)
+    return LensCosmo(z_lens, z_src, cosmo=cosmo).time_delay_units(fermat_pot, kappa_ext)
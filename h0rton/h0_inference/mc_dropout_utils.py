@@ -0,0 +1,144 @@
+import numpy as np
+import torch
+
+__all__ = ['RunningMoments', 'get_mc_dropout_preds', 'get_adaptive_mc_dropout_preds']
+
+class RunningMoments:
+    """Per-lens running mean and covariance of a vector quantity, updated with Welford's algorithm
+
+    """
+    def __init__(self, n_lenses, dim):
+        """
+        Parameters
+        ----------
+        n_lenses : int
+            number of lenses to track
+        dim : int
+            dimension of the vector quantity
+
+        """
+        self.count = np.zeros(n_lenses, dtype=int)
+        self.mean = np.zeros([n_lenses, dim])
+        self.M2 = np.zeros([n_lenses, dim, dim])
+
+    def update(self, x, idx):
+        """Add one new observation for each of the lenses in `idx`
+
+        Parameters
+        ----------
+        x : np.array of shape `[len(idx), dim]`
+            new observations
+        idx : np.array of shape `[len(idx),]`
+            indices of the lenses being updated
+
+        """
+        self.count[idx] += 1
+        delta = x - self.mean[idx] # [n_active, dim]
+        self.mean[idx] += delta/self.count[idx][:, np.newaxis]
+        delta2 = x - self.mean[idx] # [n_active, dim]
+        self.M2[idx] += delta[:, :, np.newaxis]*delta2[:, np.newaxis, :]
+
+    @property
+    def cov(self):
+        """Unbiased sample covariance, zero for lenses with fewer than two observations
+
+        """
+        denom = np.maximum(self.count - 1, 1).reshape(-1, 1, 1)
+        return self.M2/denom
+
+def _forward_in_batches(net, X, batch_size):
+    """Run one stochastic forward pass over X, in chunks of at most `batch_size`
+
+    """
+    pred = [net(X[start:start + batch_size]) for start in range(0, X.shape[0], batch_size)]
+    return torch.cat(pred, dim=0).cpu().numpy()
+
+def get_mc_dropout_preds(net, X, n_dropout, batch_size=None):
+    """Get a fixed number of MC dropout predictions for every lens
+
+    Parameters
+    ----------
+    net : torch.nn.Module
+        BNN whose dropout layers stay active at evaluation time
+    X : torch.Tensor of shape `[n_lenses, n_filters, X_dim, X_dim]`
+        input images, already on the device of `net`
+    n_dropout : int
+        number of MC dropout passes
+    batch_size : int
+        maximum number of images per forward pass. Default: all lenses at once
+
+    Returns
+    -------
+    np.array of shape `[n_lenses, n_dropout, out_dim]`
+        raw network outputs for each pass
+
+    """
+    n_lenses = X.shape[0]
+    batch_size = n_lenses if batch_size is None else batch_size
+    with torch.no_grad():
+        net.eval()
+        preds = [_forward_in_batches(net, X, batch_size) for d in range(n_dropout)]
+    return np.stack(preds, axis=1)
+
+def get_adaptive_mc_dropout_preds(net, X, Y_dim, block_size=5, min_passes=10, max_passes=100, tol=0.01, batch_size=None):
+    """Get MC dropout predictions, drawing passes in blocks until the predictive moments of each lens converge
+
+    After every block, the running mean and covariance of the predicted means `mu` across passes are compared with those after the previous block. A lens stops receiving passes once the largest absolute change in both falls below `tol`, as long as it has had at least `min_passes`. Lenses with a narrow epistemic spread therefore stop early, while the rest keep going until `max_passes`.
+
+    Parameters
+    ----------
+    net : torch.nn.Module
+        BNN whose dropout layers stay active at evaluation time
+    X : torch.Tensor of shape `[n_lenses, n_filters, X_dim, X_dim]`
+        input images, already on the device of `net`
+    Y_dim : int
+        number of predicted parameters. The first `Y_dim` output columns are taken to be the (whitened) means, as is the case for all the likelihood classes in `h0rton.losses`.
+    block_size : int
+        number of passes drawn between convergence checks
+    min_passes : int
+        minimum number of passes per lens
+    max_passes : int
+        maximum number of passes per lens
+    tol : float
+        convergence tolerance on the change in the running mean and covariance, in whitened units
+    batch_size : int
+        maximum number of images per forward pass. Default: all active lenses at once
+
+    Returns
+    -------
+    preds : np.array of shape `[n_lenses, max_passes, out_dim]`
+        raw network outputs for each pass, padded with NaN beyond the passes used for each lens
+    n_passes : np.array of shape `[n_lenses,]`
+        number of passes used for each lens
+
+    """
+    if min_passes > max_passes:
+        raise ValueError("min_passes must not exceed max_passes.")
+    n_lenses = X.shape[0]
+    batch_size = n_lenses if batch_size is None else batch_size
+    moments = RunningMoments(n_lenses, Y_dim)
+    preds = None
+    active = np.arange(n_lenses)
+    prev_mean = np.full([n_lenses, Y_dim], np.inf)
+    prev_cov = np.full([n_lenses, Y_dim, Y_dim], np.inf)
+    with torch.no_grad():
+        net.eval()
+        while len(active) > 0:
+            X_active = X[torch.as_tensor(active, device=X.device)]
+            n_block = min(block_size, max_passes - moments.count[active[0]])
+            for _ in range(n_block):
+                pred = _forward_in_batches(net, X_active, batch_size) # [n_active, out_dim]
+                if preds is None:
+                    preds = np.full([n_lenses, max_passes, pred.shape[1]], np.nan)
+                preds[active, moments.count[active], :] = pred
+                moments.update(pred[:, :Y_dim], active)
+            # Convergence check on the lenses that just received a block
+            mean_change = np.max(np.abs(moments.mean[active] - prev_mean[active]), axis=1)
+            cov_change = np.max(np.abs(moments.cov[active] - prev_cov[active]), axis=(1, 2))
+            prev_mean[active] = moments.mean[active]
+            prev_cov[active] = moments.cov[active]
+            converged = np.logical_and(mean_change < tol, cov_change < tol)
+            converged = np.logical_and(converged, moments.count[active] >= min_passes)
+            exhausted = moments.count[active] >= max_passes
+            active = active[~np.logical_or(converged, exhausted)]
+    return preds, moments.count.copy()
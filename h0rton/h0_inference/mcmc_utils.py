@@ -3,9 +3,11 @@ import pandas as pd
 import torch
 from lenstronomy.Sampling.parameters import Param
 import baobab.sim_utils.metadata_utils as metadata_utils
+from scipy.special import logsumexp
 import h0rton.losses
+from h0rton.h0_inference.bnn_posterior_export import get_mixture_params
 
-__all__ = ['get_lens_kwargs', 'get_ps_kwargs', 'get_ps_kwargs_src_plane', 'get_light_kwargs', 'get_special_kwargs', 'postprocess_mcmc_chain', "HybridBNNPenalty", "get_idx_for_params", "remove_parameters_from_pred", "split_component_param", "dict_to_array"]
+__all__ = ['get_lens_kwargs', 'get_ps_kwargs', 'get_ps_kwargs_src_plane', 'get_light_kwargs', 'get_special_kwargs', 'postprocess_mcmc_chain', "HybridBNNPenalty", "get_idx_for_params", "remove_parameters_from_pred", "split_component_param", "dict_to_array", "get_kwargs_index_map", "kwargs_to_array"]
 
 # Conversion from param to BNN column naming
 baobab_to_param = dict(zip(['lens_mass_theta_E', 'lens_mass_gamma', 'lens_mass_e1', 'lens_mass_e2', 'lens_mass_center_x', 'lens_mass_center_y', 'external_shear_gamma1', 'external_shear_gamma2', 'src_light_R_sersic', 'src_light_center_x', 'src_light_center_y', 'D_dt'],
@@ -181,89 +183,194 @@ def postprocess_mcmc_chain(kwargs_result, samples, kwargs_model, fixed_lens_kwar
 class HybridBNNPenalty:
     """Wrapper for subclasses of BaseGaussianNLL that allows MCMC methods to appropriately penalize parameter samples
 
+    The penalty is the negative of the NLL of the BNN posterior averaged over the MC dropout passes, as evaluated by the likelihood class. Since it is evaluated at every likelihood call of the sampler, the Gaussian mixture parameters of each pass -- means, Cholesky factors of the precision matrices, log determinants, and log mixture weights -- are precomputed once per lens in `set_bnn_post_params`, and the mapping from the lenstronomy kwargs to the BNN columns is compiled once at instantiation.
+
     """
-    def __init__(self, Y_cols, likelihood_class, mcmc_train_Y_mean, mcmc_train_Y_std, exclude_vel_disp, device):
+    def __init__(self, Y_cols, likelihood_class, mcmc_train_Y_mean, mcmc_train_Y_std, exclude_vel_disp, device, likelihood_kwargs={}):
         """
         Parameters
         ----------
-        Y_dim : int
-            number of parameters subject to penalty function
+        Y_cols : list of str
+            names of the parameters subject to penalty function
         likelihood_class : str
             name of subclass of BaseGaussianNLL to wrap around
         exclude_vel_disp : bool
             whether to add the NLL of velocity dispersion (not used)
         device : str
+        likelihood_kwargs : dict
+            keyword arguments of the likelihood class, e.g. `rank`
 
         """
         self.Y_cols = Y_cols
         self.Y_dim = len(self.Y_cols)
-        self.mcmc_train_Y_mean = mcmc_train_Y_mean
-        self.mcmc_train_Y_std = mcmc_train_Y_std
+        self.mcmc_train_Y_mean = np.asarray(mcmc_train_Y_mean).reshape(1, -1)
+        self.mcmc_train_Y_std = np.asarray(mcmc_train_Y_std).reshape(1, -1)
         self.constant_term = np.log(2*np.pi)*self.Y_dim*0.5
         #self.device = device
         self.exclude_vel_disp = exclude_vel_disp
-        self.nll = getattr(h0rton.losses, '{:s}CPU'.format(likelihood_class))(Y_dim=self.Y_dim)
+        loss = getattr(h0rton.losses, likelihood_class)(Y_dim=self.Y_dim, device=torch.device('cpu'), **likelihood_kwargs)
+        self.posterior_name = loss.posterior_name
+        self.posterior_kwargs = loss.posterior_kwargs
+        self.kwargs_index_map = get_kwargs_index_map(self.Y_cols)
 
     def set_bnn_post_params(self, bnn_post_params):
         """Set BNN posterior parameters, which define the penaty function
 
+        Parameters
+        ----------
+        bnn_post_params : np.array of shape `[n_dropout, out_dim]` or `[out_dim,]`
+            raw network outputs of the MC dropout passes for the lens
+
         """
-        self.bnn_post_params = bnn_post_params#.reshape(1, -1)
-        self.n_dropout = bnn_post_params.shape[0]
+        self.bnn_post_params = np.atleast_2d(bnn_post_params)
+        self.n_dropout = self.bnn_post_params.shape[0]
+        params = get_mixture_params(self.bnn_post_params, self.posterior_name, self.Y_dim, self.posterior_kwargs)
+        self.mu = params['mu'] # [n_dropout, n_components, Y_dim]
+        self.prec_tril = params['prec_tril'] # [n_dropout, n_components, Y_dim, Y_dim]
+        # log of the normalization of each component, -log|L| - 0.5*Y_dim*log(2 pi), with weight
+        with np.errstate(divide='ignore'):
+            log_weights = np.log(params['weights'])
+        logdet_term = np.sum(np.log(np.diagonal(self.prec_tril, axis1=-2, axis2=-1)), axis=-1)
+        self.log_norm = log_weights + logdet_term - self.constant_term # [n_dropout, n_components]
+
+    def evaluate_many(self, Y):
+        """Evaluate the penalty of many parameter vectors, e.g. the positions of all walkers, in one vectorized call
+
+        Parameters
+        ----------
+        Y : np.array of shape `[n_walkers, Y_dim]`
+            unwhitened parameters, ordered as `Y_cols`
+
+        Returns
+        -------
+        np.array of shape `[n_walkers,]`
+            log likelihood of the BNN posterior averaged over the MC dropout passes
+
+        """
+        # Whiten the mcmc array
+        Y = (np.atleast_2d(Y) - self.mcmc_train_Y_mean)/self.mcmc_train_Y_std
+        y_diff = Y[:, np.newaxis, np.newaxis, :] - self.mu[np.newaxis, ...] # [n_walkers, n_dropout, n_components, Y_dim]
+        # Mahalanobis distance |L^T (y - mu)|^2 for precision matrix L L^T
+        z = np.einsum('wnki,nkij->wnkj', y_diff, self.prec_tril)
+        log_ll = logsumexp(self.log_norm[np.newaxis, ...] - 0.5*np.sum(z**2.0, axis=-1), axis=-1) # [n_walkers, n_dropout]
+        return np.mean(log_ll, axis=1)
 
     def evaluate(self, kwargs_lens, kwargs_source, kwargs_lens_light=None, kwargs_ps=None, kwargs_special=None, kwargs_extinction=None):
         #kwargs_lens[1]['ra_0'] = kwargs_lens[0]['center_x']
         #kwargs_lens[1]['dec_0'] = kwargs_lens[0]['center_y']
-        to_eval = dict_to_array(self.Y_cols, kwargs_lens, kwargs_source, kwargs_lens_light, kwargs_ps) # shape [1, self.Y_dim]
-        # Whiten the mcmc array
-        to_eval = (to_eval - self.mcmc_train_Y_mean)/self.mcmc_train_Y_std
-        #print(self.bnn_post_params[:, :self.Y_dim], to_eval)
-        to_eval = np.repeat(to_eval, repeats=self.n_dropout, axis=0)
-        ll = -self.nll(self.bnn_post_params, to_eval)
+        to_eval = kwargs_to_array(self.kwargs_index_map, kwargs_lens, kwargs_source, kwargs_lens_light, kwargs_ps) # shape [1, self.Y_dim]
+        ll = self.evaluate_many(to_eval)[0]
         return ll #+ self.constant_term
 
-def get_idx_for_params(out_dim, Y_cols, params_to_remove, likelihood_class, debug=False):
+def _get_component_idx(Y_dim, param_idx, cov_type, rank):
+    """Get the indices of certain parameters within the output block of a single Gaussian component
+
+    Parameters
+    ----------
+    Y_dim : int
+    param_idx : np.array of type int
+        indices of the parameters in Y_cols
+    cov_type : str
+        one of `mixture_cov_types`
+    rank : int
+        rank of the low-rank component, only used if `cov_type` is 'low_rank'
+
+    Returns
+    -------
+    idx : np.array of type int
+        indices of the columns of the component block that involve the parameters
+    component_dim : int
+        length of the component block
+    tril_mask : np.array of type int or None
+        indices within the lower-triangular elements that involve the parameters, if `cov_type` is 'full_rank'
+
+    """
+    tril_mask = None
+    if cov_type == 'diagonal':
+        idx = np.concatenate([param_idx, Y_dim + param_idx])
+        component_dim = 2*Y_dim
+    elif cov_type == 'low_rank':
+        # F is laid out as [Y_dim, rank], so each parameter owns `rank` consecutive columns
+        F_idx = (param_idx[:, np.newaxis]*rank + np.arange(rank)[np.newaxis, :]).reshape(-1)
+        idx = np.concatenate([param_idx, Y_dim + param_idx, 2*Y_dim + F_idx])
+        component_dim = (2 + rank)*Y_dim
+    elif cov_type == 'full_rank':
+        tril_idx_dim0, tril_idx_dim1 = np.tril_indices(Y_dim)
+        tril_len = len(tril_idx_dim0)
+        tril_mask = np.logical_or(np.isin(tril_idx_dim0, param_idx), np.isin(tril_idx_dim1, param_idx)).nonzero()[0]
+        idx = np.concatenate([param_idx, Y_dim + tril_mask])
+        component_dim = Y_dim + tril_len
+    else:
+        raise ValueError("cov_type must be one of {:s}.".format(str(h0rton.losses.mixture_cov_types)))
+    return idx.astype(int), component_dim, tril_mask
+
+def get_idx_for_params(out_dim, Y_cols, params_to_remove, likelihood_class, debug=False, likelihood_kwargs={}):
     """Get columns corresponding to certain parameters from the BNN output
 
+    The layout of the output is read off the likelihood, so that the low-rank `F` blocks of any rank, the lower-triangular blocks, and the components of a mixture are sliced correctly. The mixture weights (`alpha` or the logits) don't involve any single parameter and are always kept.
+
     Parameters
     ----------
     out_dim : int
+        output dimension of the likelihood over the remaining parameters
     Y_cols : list of str
+    params_to_remove : list of str
+        names of the parameters in Y_cols to remove
+    likelihood_class : str
+        name of the likelihood class in `h0rton.losses` used in training
+    likelihood_kwargs : dict
+        keyword arguments of the likelihood class besides `Y_dim` and `device`, e.g. `rank` or `n_components`
     
     Returns
     -------
-    remove_idx : list
-        indices of the columns removed in orig_pred
-    remove_param_idx : list
+    remove_param_idx : np.array
         indices of the parameters in Y_cols
+    remove_idx : np.array
+        indices of the columns removed in orig_pred
+
+    Raises
+    ------
+    ValueError
+        if the likelihood class is not supported or `out_dim` doesn't match the output dimension of the likelihood over the remaining parameters
 
     """
     Y_dim = len(Y_cols)
     col_to_idx = dict(zip(Y_cols, range(Y_dim)))
-    param_idx = np.array([col_to_idx[i] for i in params_to_remove]) # indices corresponding to primary mean
-    if likelihood_class in ['FullRankGaussianNLL', 'DoubleGaussianNLL']:
-        tril_idx = np.tril_indices(Y_dim)
-        tril_idx_dim0 = tril_idx[0]
-        tril_idx_dim1 = tril_idx[1]
-        tril_len = len(tril_idx_dim0)
-        tril_mask = np.logical_or(np.isin(tril_idx_dim0, param_idx), np.isin(tril_idx_dim1, param_idx)).nonzero()[0]
-        idx_within_tril1 = list(Y_dim + tril_mask)
-        idx_within_tril2 = list(2*Y_dim + tril_len + tril_mask)
-        idx = list(param_idx) + idx_within_tril1 + list(Y_dim + tril_len + param_idx) + idx_within_tril2
-        if debug:
-            to_test = dict(
-                           tril_mask=tril_mask,
-                           idx_within_tril1=idx_within_tril1,
-                           idx_within_tril2=idx_within_tril2,
-                           param_idx=param_idx,
-                           idx=idx,
-                           )
-            return to_test
-    else: # tested for 'DoubleLowRankGaussianNLL':
-        tiling_by_Y_dim = np.arange(out_dim//Y_dim)*Y_dim
-        idx = [tile + i for tile in tiling_by_Y_dim for i in param_idx]
-    param_idx = np.array(param_idx, dtype=int)
-    idx = np.array(idx, dtype=int)
+    param_idx = np.array([col_to_idx[i] for i in params_to_remove], dtype=int) # indices corresponding to primary mean
+    loss = getattr(h0rton.losses, likelihood_class)(Y_dim=Y_dim, device=torch.device('cpu'), **likelihood_kwargs)
+    rank = getattr(loss, 'rank', None)
+    if loss.posterior_name == 'DiagonalGaussianBNNPosterior':
+        cov_type, n_components = 'diagonal', 1
+    elif loss.posterior_name == 'LowRankGaussianBNNPosterior':
+        cov_type, n_components = 'low_rank', 1
+    elif loss.posterior_name == 'DoubleLowRankGaussianBNNPosterior':
+        cov_type, n_components = 'low_rank', 2
+    elif loss.posterior_name == 'FullRankGaussianBNNPosterior':
+        cov_type, n_components = 'full_rank', 1
+    elif loss.posterior_name == 'DoubleGaussianBNNPosterior':
+        cov_type, n_components = 'full_rank', 2
+    elif loss.posterior_name == 'MixtureGaussianBNNPosterior':
+        cov_type, n_components = loss.cov_type, loss.n_components
+    else:
+        raise ValueError("Removing parameters from the output of {:s} is not supported.".format(likelihood_class))
+    if cov_type == 'low_rank' and rank is None:
+        raise ValueError("The rank of the low-rank blocks of {:s} is unknown.".format(likelihood_class))
+    component_idx, component_dim, tril_mask = _get_component_idx(Y_dim, param_idx, cov_type, rank)
+    # Components are stored one after the other, followed by the weights
+    idx = np.concatenate([k*component_dim + component_idx for k in range(n_components)])
+    if out_dim != loss.out_dim - len(idx):
+        raise ValueError("out_dim {:d} doesn't match the output dimension {:d} of {:s} over the remaining parameters.".format(out_dim, loss.out_dim - len(idx), likelihood_class))
+    if debug:
+        to_test = dict(
+                       param_idx=param_idx,
+                       idx=idx,
+                       )
+        if cov_type == 'full_rank':
+            to_test['tril_mask'] = tril_mask
+            to_test['idx_within_tril1'] = list(Y_dim + tril_mask)
+            if n_components == 2:
+                to_test['idx_within_tril2'] = list(component_dim + Y_dim + tril_mask)
+        return to_test
     return param_idx, idx 
 
 def remove_parameters_from_pred(orig_pred, remove_idx, return_as_tensor=True, device='cpu'):
@@ -309,31 +416,60 @@ def split_component_param(string, sep='_', pos=2):
     substring_list = string.split(sep)
     return sep.join(substring_list[:pos]), sep.join(substring_list[pos:])
 
-def dict_to_array(Y_cols, kwargs_lens, kwargs_source, kwargs_lens_light=None, kwargs_ps=None,):
-    """Reformat kwargs into np array. Used to feed the current iteration of MCMC kwargs into the BNN posterior evaluation.
+def get_kwargs_index_map(Y_cols):
+    """Compile the lookup of each BNN column in the lenstronomy kwargs, so that it isn't parsed again at every MCMC iteration
+
+    Parameters
+    ----------
+    Y_cols : list of str
+        the Baobab parameter names (column names)
+
+    Returns
+    -------
+    list of tuple
+        for each column, the (kwargs name, list index, key) of its value in the kwargs and that of a value to subtract from it, or None
 
     """
-    return_array = np.ones((len(Y_cols)))
-    for i, col_name in enumerate(Y_cols):
+    index_map = []
+    for col_name in Y_cols:
         component, param = split_component_param(col_name, '_', 2)
         if component == 'lens_mass':
-            return_array[i] = kwargs_lens[0][param]
+            index_map.append((('kwargs_lens', 0, param), None))
         elif component == 'external_shear':
-            return_array[i] = kwargs_lens[1][param]
+            index_map.append((('kwargs_lens', 1, param), None))
         elif component == 'src_light':
+            # The source position is stored relative to the lens center
             if param == 'center_x':
-                return_array[i] = kwargs_ps[0]['ra_source'] - kwargs_lens[0]['center_x']
+                index_map.append((('kwargs_ps', 0, 'ra_source'), ('kwargs_lens', 0, 'center_x')))
             elif param == 'center_y':
-                return_array[i] = kwargs_ps[0]['dec_source'] - kwargs_lens[0]['center_y']
+                index_map.append((('kwargs_ps', 0, 'dec_source'), ('kwargs_lens', 0, 'center_y')))
             else:
-                return_array[i] = kwargs_source[0][param]
+                index_map.append((('kwargs_source', 0, param), None))
         #elif component == 'lens_light':
-        #    return_array[i] = kwargs_lens_light[0][param]
+        #    index_map.append((('kwargs_lens_light', 0, param), None))
         else:
             # Ignore kwargs_ps since image position likelihood is separate.
             raise ValueError("Component doesn't exist.")
+    return index_map
+
+def kwargs_to_array(kwargs_index_map, kwargs_lens, kwargs_source, kwargs_lens_light=None, kwargs_ps=None):
+    """Reformat kwargs into np array using the index map compiled by `get_kwargs_index_map`
+
+    """
+    kwargs = dict(kwargs_lens=kwargs_lens, kwargs_source=kwargs_source, kwargs_lens_light=kwargs_lens_light, kwargs_ps=kwargs_ps)
+    return_array = np.empty(len(kwargs_index_map))
+    for i, (value, offset) in enumerate(kwargs_index_map):
+        return_array[i] = kwargs[value[0]][value[1]][value[2]]
+        if offset is not None:
+            return_array[i] -= kwargs[offset[0]][offset[1]][offset[2]]
     return return_array.reshape(1, -1)
 
+def dict_to_array(Y_cols, kwargs_lens, kwargs_source, kwargs_lens_light=None, kwargs_ps=None,):
+    """Reformat kwargs into np array. Used to feed the current iteration of MCMC kwargs into the BNN posterior evaluation.
+
+    """
+    return kwargs_to_array(get_kwargs_index_map(Y_cols), kwargs_lens, kwargs_source, kwargs_lens_light, kwargs_ps)
+
 def reorder_to_param_class(bnn_Y_cols, param_class_Y_cols, bnn_array, D_dt_array):
     """Reorder an array with the given axis ordered according to the BNN's bnn_Y_cols to the Lenstronomy Param's param_class_Y_cols convention
 
@@ -33,16 +33,18 @@ def gaussian(x, mean, standard_deviation, amplitude):
 def lognormal(x, mu, sig):
     return np.exp(-0.5*(np.log(x) - mu)**2.0/sig**2.0)/(x*sig*(2.0*np.pi)**0.5)
 
-def plot_weighted_h0_histogram(all_samples, all_weights, lens_i=0, true_h0=None, include_fit_gaussian=True, save_dir='.'):
+def plot_weighted_h0_histogram(all_samples, all_weights=None, lens_i=0, true_h0=None, include_fit_gaussian=True, save_dir='.', all_log_weights=None):
     """Plot the histogram of H0 samples, overlaid with a Gaussian fit and truth H0
 
     all_samples : np.array
         H0 samples
     all_weights : np.array
         H0 weights corresponding to `all_samples`, possibly including nan values
+    all_log_weights : np.array
+        log of the H0 weights, used instead of `all_weights` if given
 
     """
-    stats = h0_utils.get_normal_stats_naive(all_samples, all_weights)
+    stats = h0_utils.get_normal_stats_naive(all_samples, all_weights, all_log_weights)
     _ = plt.hist(stats['samples'], weights=stats['weights'], bins=290, alpha=0.5, density=True, edgecolor='k', color='tab:blue', range=[10.0, 300.0])
     #print(mean, std)
     x_interval_for_fit = np.linspace(10, 300, 1000) 
@@ -60,20 +62,23 @@ def plot_weighted_h0_histogram(all_samples, all_weights, lens_i=0, true_h0=None,
         plt.close()
     return stats
 
-def plot_weighted_D_dt_histogram(all_samples, all_weights, lens_i=0, true_D_dt=None, save_dir='.'):
+def plot_weighted_D_dt_histogram(all_samples, all_weights=None, lens_i=0, true_D_dt=None, save_dir='.', all_log_weights=None):
     """Plot the histogram of H0 samples, overlaid with a Gaussian fit and truth H0
 
     all_samples : np.array
         H0 samples
     all_weights : np.array
         H0 weights corresponding to `all_samples`, possibly including nan values
+    all_log_weights : np.array
+        log of the H0 weights, used instead of `all_weights` if given
 
     """
     # Normalize weights to unity
-    is_nan_mask = np.logical_or(np.isnan(all_weights), ~np.isfinite(all_weights))
-    all_weights[~is_nan_mask] = all_weights[~is_nan_mask]/np.sum(all_weights[~is_nan_mask])
-    samples = all_samples[~is_nan_mask]
-    weights = all_weights[~is_nan_mask]
+    if all_log_weights is None:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            all_log_weights = np.zeros_like(all_samples) if all_weights is None else np.log(all_weights)
+    is_valid, weights = h0_utils.get_normalized_weights(all_log_weights, all_samples)
+    samples = all_samples[is_valid]
     bin_heights, bin_borders, _ = plt.hist(samples, weights=weights, bins=200, alpha=0.5, density=True, edgecolor='k', color='tab:blue', range=[0.0, 15000.0])
     bin_centers = bin_borders[:-1] + np.diff(bin_borders) / 2
     
@@ -0,0 +1,157 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+__all__ = ['PredictionStore', 'hash_file', 'get_data_cfg_for_key']
+
+# TrainValConfig fields that change what the network sees or how its output is interpreted
+data_cfg_key_fields = ['Y_cols', 'float_type', 'define_src_pos_wrt_lens', 'rescale_pixels', 'rescale_pixels_type', 'log_pixels', 'add_pixel_noise', 'eff_exposure_time', 'train_baobab_cfg_path']
+model_cfg_key_fields = ['architecture', 'dropout_rate', 'likelihood_class']
+
+def hash_file(path, chunk_size=2**20):
+    """Compute the SHA-256 digest of a file's contents, reading it in chunks
+
+    Parameters
+    ----------
+    path : str or os.path object
+        path to the file
+    chunk_size : int
+        number of bytes read at a time
+
+    Returns
+    -------
+    str
+        hex digest
+
+    """
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def get_data_cfg_for_key(train_val_cfg):
+    """Collect the `TrainValConfig` fields relevant to the BNN predictions
+
+    Parameters
+    ----------
+    train_val_cfg : TrainValConfig
+
+    Returns
+    -------
+    dict
+        JSON-serializable subset of the `data` and `model` fields
+
+    """
+    data = {k: train_val_cfg.data[k] for k in data_cfg_key_fields if k in train_val_cfg.data}
+    model = {k: train_val_cfg.model[k] for k in model_cfg_key_fields if k in train_val_cfg.model}
+    return json.loads(json.dumps(dict(data=data, model=model), default=str))
+
+class PredictionStore:
+    """Content-addressed on-disk store of raw BNN predictions, shared across inference runs
+
+    Each entry holds the raw MC dropout outputs of shape `[n_lenses, n_dropout, out_dim]` along with the whitening stats, keyed by a hash of everything that determines them. Inference runs that differ only in downstream numerics (e.g. MCMC settings or the time delay error) resolve to the same key and can skip the network entirely.
+
+    """
+    def __init__(self, store_dir):
+        """
+        Parameters
+        ----------
+        store_dir : str or os.path object
+            directory holding the stored predictions. Created if it doesn't exist.
+
+        """
+        self.store_dir = store_dir
+        if not os.path.exists(self.store_dir):
+            os.makedirs(self.store_dir)
+
+    @staticmethod
+    def get_key(checkpoint_path, data_cfg, test_dataset_id, noise_seed, n_dropout):
+        """Compute the key under which a set of predictions is stored
+
+        Parameters
+        ----------
+        checkpoint_path : str or os.path object
+            path to the trained state dict. The file contents, not the path, enter the key.
+        data_cfg : dict
+            relevant training config fields, e.g. the output of `get_data_cfg_for_key`
+        test_dataset_id : dict
+            identifies the test dataset, e.g. the path to its Baobab config and the number of lenses
+        noise_seed : int
+            seed governing the pixel noise realizations and dropout masks
+        n_dropout : int or dict
+            number of MC dropout passes, or the adaptive MC dropout config
+
+        Returns
+        -------
+        key : str
+            hex digest identifying the predictions
+        key_dict : dict
+            the inputs that went into the key
+
+        """
+        key_dict = dict(
+                        checkpoint=hash_file(checkpoint_path),
+                        data_cfg=data_cfg,
+                        test_dataset_id=test_dataset_id,
+                        noise_seed=noise_seed,
+                        n_dropout=n_dropout,
+                        )
+        key_str = json.dumps(key_dict, sort_keys=True, default=str)
+        return hashlib.sha256(key_str.encode('utf-8')).hexdigest(), key_dict
+
+    def _get_path(self, key, ext):
+        return os.path.join(self.store_dir, '{:s}.{:s}'.format(key, ext))
+
+    def contains(self, key):
+        """Whether predictions are stored under `key`
+
+        """
+        return os.path.exists(self._get_path(key, 'npz'))
+
+    def load(self, key):
+        """Load the predictions stored under `key`
+
+        Parameters
+        ----------
+        key : str
+
+        Returns
+        -------
+        dict or None
+            contains `pred`, `n_dropout_per_lens`, `Y_mean`, and `Y_std`, or None if nothing is stored under `key`
+
+        """
+        if not self.contains(key):
+            return None
+        with np.load(self._get_path(key, 'npz')) as stored:
+            return {k: stored[k] for k in stored.files}
+
+    def save(self, key, pred, Y_mean, Y_std, n_dropout_per_lens=None, key_dict=None):
+        """Persist predictions under `key`
+
+        Parameters
+        ----------
+        key : str
+        pred : np.array of shape `[n_lenses, n_dropout, out_dim]`
+            raw network outputs
+        Y_mean : np.array of shape `[1, Y_dim]`
+            training-set mean used for whitening
+        Y_std : np.array of shape `[1, Y_dim]`
+            training-set std used for whitening
+        n_dropout_per_lens : np.array of shape `[n_lenses,]`
+            number of valid passes per lens. Default: all `n_dropout` passes
+        key_dict : dict
+            inputs to the key, saved alongside for bookkeeping
+
+        """
+        if n_dropout_per_lens is None:
+            n_dropout_per_lens = np.full(pred.shape[0], pred.shape[1])
+        # Write to a temporary file first so concurrent runs never read a partial entry
+        tmp_path = self._get_path(key, 'tmp.npz')
+        np.savez(tmp_path, pred=pred, n_dropout_per_lens=n_dropout_per_lens, Y_mean=Y_mean, Y_std=Y_std)
+        os.replace(tmp_path, self._get_path(key, 'npz'))
+        if key_dict is not None:
+            with open(self._get_path(key, 'json'), 'w') as f:
+                json.dump(key_dict, f, indent=2, sort_keys=True, default=str)
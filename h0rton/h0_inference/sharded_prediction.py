@@ -0,0 +1,281 @@
+"""Sharded MC dropout prediction over large test catalogs
+
+The test set is split into shards of consecutive lenses that worker processes take from a queue. The network weights are moved to shared memory once and read by every worker, so memory use grows with the number of workers only through the images and predictions of the shards being processed. Each shard is written to its own file as soon as it's done, so an interrupted run resumes from the missing shards. Once all shards exist, an index maps each lens ID to its shard and offset.
+
+"""
+import os
+import json
+import time
+import queue
+import traceback
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import DataLoader, Subset
+import h0rton.losses
+from h0rton.h0_inference.mc_dropout_utils import get_mc_dropout_preds
+from h0rton.h0_inference.bnn_posterior_export import ParametricBNNPosterior
+
+__all__ = ['get_shard_path', 'predict_sharded', 'load_shard_index', 'load_sharded_predictions']
+
+valid_outputs = ['pred', 'params']
+manifest_filename = 'manifest.json'
+index_filename = 'index.csv'
+worker_poll_interval = 1.0 # seconds between checks that the workers are still alive
+
+def get_shard_path(out_dir, shard_idx):
+    """Path of the output file of a shard
+
+    """
+    return os.path.join(out_dir, 'shard_{:05d}.npz'.format(shard_idx))
+
+def _predict_shard(net, dataset, shard_idx, start, end, settings, out_dir):
+    """Run the MC dropout passes on one shard and write its output file
+
+    The file is written under a temporary name and renamed once complete, so a shard file that exists is always whole.
+
+    """
+    # Seeding per shard makes the dropout masks and pixel noise independent of which worker took the shard
+    torch.manual_seed(settings['seed'] + shard_idx)
+    np.random.seed(settings['seed'] + shard_idx)
+    loader = DataLoader(Subset(dataset, range(start, end)), batch_size=settings['batch_size'], shuffle=False)
+    pred = np.concatenate([get_mc_dropout_preds(net, X, settings['n_dropout']) for X, Y in loader], axis=0) # [shard_size, n_dropout, out_dim]
+    to_save = dict(lens_idx=np.arange(start, end))
+    if settings['output'] == 'pred':
+        to_save['pred'] = pred.astype(np.float32)
+    else:
+        bnn_post = ParametricBNNPosterior.from_pred(pred, settings['posterior_name'], settings['Y_mean'], settings['Y_std'], posterior_kwargs=settings['posterior_kwargs'])
+        # Same keys as `ParametricBNNPosterior.save`, so each shard can also be read with `ParametricBNNPosterior.from_file`
+        to_save.update(mu=bnn_post.mu, prec_tril=bnn_post.prec_tril, weights=bnn_post.weights, Y_mean=bnn_post.Y_mean, Y_std=bnn_post.Y_std, n_dropout_per_lens=bnn_post.n_dropout_per_lens)
+        if settings['Y_cols'] is not None:
+            to_save['Y_cols'] = np.array(settings['Y_cols'])
+    shard_path = get_shard_path(out_dir, shard_idx)
+    tmp_path = shard_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **to_save)
+    os.replace(tmp_path, shard_path)
+
+def _prediction_worker(net, dataset, settings, out_dir, shard_queue, result_queue):
+    """Process the shards put on `shard_queue` until it receives None, reporting each one on `result_queue`
+
+    """
+    torch.set_num_threads(settings['n_threads_per_worker'])
+    while True:
+        shard = shard_queue.get()
+        if shard is None:
+            break
+        try:
+            _predict_shard(net, dataset, *shard, settings, out_dir)
+            result_queue.put((shard[0], None))
+        except Exception:
+            result_queue.put((shard[0], traceback.format_exc()))
+
+def _collect_results(workers, result_queue, shard_ids):
+    """Wait for the workers to report on every shard in `shard_ids`
+
+    A worker that dies without reporting, e.g. when killed for running out of memory, would otherwise leave the main process waiting forever, so the workers are checked whenever no report arrives for `worker_poll_interval` seconds.
+
+    Returns
+    -------
+    list of str
+        the errors reported by the workers
+
+    """
+    errors = []
+    unfinished = set(shard_ids)
+    while len(unfinished) > 0:
+        try:
+            shard_idx, error = result_queue.get(timeout=worker_poll_interval)
+        except queue.Empty:
+            dead = [worker for worker in workers if not worker.is_alive()]
+            if any(worker.exitcode != 0 for worker in dead) or len(dead) == len(workers):
+                # Reports posted just before a worker exited may still be in the queue
+                time.sleep(worker_poll_interval)
+                while True:
+                    try:
+                        shard_idx, error = result_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    unfinished.discard(shard_idx)
+                    if error is not None:
+                        errors.append("Shard {:d} failed:\n{:s}".format(shard_idx, error))
+                if len(unfinished) == 0:
+                    break
+                for worker in workers:
+                    if worker.is_alive():
+                        worker.terminate()
+                exitcodes = [worker.exitcode for worker in dead]
+                raise RuntimeError("Worker processes exited with codes {} before finishing shards {}. The shards already written are kept, so rerun to resume.".format(exitcodes, sorted(unfinished)))
+            continue
+        unfinished.discard(shard_idx)
+        if error is not None:
+            errors.append("Shard {:d} failed:\n{:s}".format(shard_idx, error))
+    return errors
+
+def _check_manifest(out_dir, manifest):
+    """Write the manifest of a new run, or check that a resumed run has the same settings
+
+    """
+    manifest_path = os.path.join(out_dir, manifest_filename)
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            existing = json.load(f)
+        if existing != manifest:
+            raise ValueError("{:s} holds the output of a run with different settings. Use another out_dir.".format(out_dir))
+    else:
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f, indent=4)
+
+def predict_sharded(net, dataset, out_dir, n_dropout, likelihood_class, Y_mean, Y_std, Y_cols=None, likelihood_kwargs={}, lens_ids=None, output='pred', shard_size=1000, batch_size=100, n_workers=0, n_threads_per_worker=1, seed=123, run_info=None, mp_context=None):
+    """Get MC dropout predictions for a large test set, shard by shard, optionally across worker processes
+
+    Parameters
+    ----------
+    net : torch.nn.Module
+        BNN on the CPU whose dropout layers stay active at evaluation time. Its parameters are moved to shared memory.
+    dataset : torch.utils.data.Dataset
+        test set yielding `(X, Y)`. Like for a `DataLoader`, it must be picklable if `mp_context` is `spawn`.
+    out_dir : str or os.path object
+        directory of the shards, manifest, and index. Created if it doesn't exist. If it holds shards of an earlier run with the same settings, only the missing shards are computed.
+    n_dropout : int
+        number of MC dropout passes
+    likelihood_class : str
+        name of the likelihood class in `h0rton.losses` used in training
+    Y_mean : np.array of shape `[Y_dim,]`
+        training-set mean used for whitening
+    Y_std : np.array of shape `[Y_dim,]`
+        training-set std used for whitening
+    Y_cols : list of str
+        names of the predicted parameters
+    likelihood_kwargs : dict
+        keyword arguments of the likelihood class besides `Y_dim` and `device`, e.g. `n_components` for `MixtureGaussianNLL`
+    lens_ids : array-like of length `len(dataset)`
+        IDs of the lenses, e.g. image filenames. Default: the dataset indices
+    output : str
+        `pred` to store the raw network outputs of shape `[n_lenses, n_dropout, out_dim]`, or `params` to store the Gaussian mixture parameters of `ParametricBNNPosterior` instead
+    shard_size : int
+        number of lenses per shard
+    batch_size : int
+        number of images per forward pass
+    n_workers : int
+        number of worker processes. Default: process all shards in this process
+    n_threads_per_worker : int
+        number of intra-op CPU threads of each worker
+    seed : int
+        base seed. Shard `i` is seeded with `seed + i`.
+    run_info : dict
+        JSON-serializable description of the run, e.g. the checkpoint path, stored in the manifest and compared on resume
+    mp_context : str
+        multiprocessing start method. Default: the platform default, as for a `DataLoader`
+
+    Returns
+    -------
+    pd.DataFrame
+        the index, as returned by `load_shard_index`
+
+    """
+    if output not in valid_outputs:
+        raise ValueError("output must be one of {}.".format(valid_outputs))
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    n_lenses = len(dataset)
+    lens_ids = np.arange(n_lenses) if lens_ids is None else np.asarray(lens_ids)
+    if len(lens_ids) != n_lenses:
+        raise ValueError("lens_ids must have one entry per lens in the dataset.")
+    Y_mean = np.asarray(Y_mean, dtype=float).reshape(-1)
+    Y_std = np.asarray(Y_std, dtype=float).reshape(-1)
+    manifest = dict(n_lenses=n_lenses,
+                    shard_size=shard_size,
+                    n_dropout=n_dropout,
+                    output=output,
+                    seed=seed,
+                    likelihood_class=likelihood_class,
+                    likelihood_kwargs=dict(likelihood_kwargs),
+                    Y_cols=None if Y_cols is None else list(Y_cols),
+                    Y_mean=Y_mean.tolist(),
+                    Y_std=Y_std.tolist(),
+                    run_info=run_info)
+    manifest = json.loads(json.dumps(manifest, default=str))
+    _check_manifest(out_dir, manifest)
+    loss_fn = getattr(h0rton.losses, likelihood_class)(Y_dim=len(Y_mean), device=torch.device('cpu'), **likelihood_kwargs)
+    settings = dict(n_dropout=n_dropout, output=output, seed=seed, batch_size=batch_size, n_threads_per_worker=n_threads_per_worker,
+                    posterior_name=loss_fn.posterior_name, posterior_kwargs=loss_fn.posterior_kwargs, Y_mean=Y_mean, Y_std=Y_std, Y_cols=manifest['Y_cols'])
+    shards = [(shard_idx, start, min(start + shard_size, n_lenses)) for shard_idx, start in enumerate(range(0, n_lenses, shard_size))]
+    pending = [shard for shard in shards if not os.path.exists(get_shard_path(out_dir, shard[0]))]
+    net = net.cpu().eval()
+    if n_workers == 0:
+        for shard in pending:
+            _predict_shard(net, dataset, *shard, settings, out_dir)
+    elif len(pending) > 0:
+        net.share_memory()
+        ctx = torch.multiprocessing.get_context(mp_context)
+        shard_queue = ctx.Queue()
+        result_queue = ctx.Queue()
+        for shard in pending:
+            shard_queue.put(shard)
+        n_workers = min(n_workers, len(pending))
+        for i in range(n_workers):
+            shard_queue.put(None)
+        workers = [ctx.Process(target=_prediction_worker, args=(net, dataset, settings, out_dir, shard_queue, result_queue), daemon=True) for i in range(n_workers)]
+        for worker in workers:
+            worker.start()
+        errors = _collect_results(workers, result_queue, [shard[0] for shard in pending])
+        for worker in workers:
+            worker.join()
+        if len(errors) > 0:
+            raise RuntimeError("\n".join(errors))
+    # Index of lens ID to shard and offset
+    index = []
+    for shard_idx, start, end in shards:
+        index.append(pd.DataFrame(dict(lens_id=lens_ids[start:end], lens_idx=np.arange(start, end), shard=shard_idx, offset=np.arange(end - start))))
+    index = pd.concat(index, ignore_index=True)
+    index.to_csv(os.path.join(out_dir, index_filename), index=False)
+    return index
+
+def load_shard_index(out_dir):
+    """Read the index mapping each lens ID to its shard and offset
+
+    Parameters
+    ----------
+    out_dir : str or os.path object
+        output directory of `predict_sharded`
+
+    Returns
+    -------
+    pd.DataFrame
+        columns `lens_id`, `lens_idx` (position in the test set), `shard`, and `offset` (position within the shard)
+
+    """
+    return pd.read_csv(os.path.join(out_dir, index_filename))
+
+def load_sharded_predictions(out_dir, lens_ids=None):
+    """Gather the stored outputs of some lenses across shards, reading only the shards that hold them
+
+    Parameters
+    ----------
+    out_dir : str or os.path object
+        output directory of `predict_sharded`
+    lens_ids : array-like
+        IDs of the lenses to load, in the order of the returned arrays. Default: all lenses
+
+    Returns
+    -------
+    dict
+        `pred` of shape `[n_lenses, n_dropout, out_dim]`, or `mu`, `prec_tril`, and `weights` as in `ParametricBNNPosterior`, along with `lens_id`
+
+    """
+    index = load_shard_index(out_dir)
+    if lens_ids is not None:
+        index = index.set_index('lens_id', drop=False).loc[list(lens_ids)].reset_index(drop=True)
+    with open(os.path.join(out_dir, manifest_filename), 'r') as f:
+        manifest = json.load(f)
+    keys = ['pred'] if manifest['output'] == 'pred' else ['mu', 'prec_tril', 'weights']
+    gathered = {}
+    for shard_idx, rows in index.groupby('shard'):
+        with np.load(get_shard_path(out_dir, shard_idx)) as shard:
+            for k in keys:
+                if k not in gathered:
+                    gathered[k] = np.empty((len(index),) + shard[k].shape[1:], dtype=shard[k].dtype)
+                gathered[k][rows.index.values] = shard[k][rows['offset'].values]
+    gathered['lens_id'] = index['lens_id'].values
+    return gathered
@@ -27,7 +27,9 @@ from h0rton.configs import TrainValConfig, TestConfig
 import h0rton.losses
 import h0rton.train_utils as train_utils
 import h0rton.script_utils as script_utils
-from h0rton.h0_inference import h0_utils, plotting_utils, mcmc_utils
+from h0rton.h0_inference import h0_utils, plotting_utils, mcmc_utils, mc_dropout_utils
+from h0rton.h0_inference.prediction_store import PredictionStore, get_data_cfg_for_key
+from h0rton.h0_inference.bnn_posterior_export import ParametricBNNPosterior
 from h0rton.trainval_data import XYData
 
 def main():
@@ -116,77 +118,139 @@ def main():
     # Instantiate original loss function with all BNN-predicted params
     orig_Y_cols = cfg.data.Y_cols
     loss_fn = getattr(h0rton.losses, cfg.model.likelihood_class)(Y_dim=test_data.Y_dim, 
-                                                                 device=device)
+                                                                 device=device, **cfg.model.likelihood_kwargs)
     # Not all predicted params will be sampled via MCMC
     params_to_remove = [] #'lens_light_R_sersic', 'src_light_R_sersic'] 
     mcmc_Y_cols = [col for col in orig_Y_cols if col not in params_to_remove]
     mcmc_Y_dim = len(mcmc_Y_cols)
     # Instantiate loss function with just the MCMC params
     mcmc_loss_fn = getattr(h0rton.losses, cfg.model.likelihood_class)(Y_dim=test_data.Y_dim - len(params_to_remove), 
-                                                                      device=device)
+                                                                      device=device, **cfg.model.likelihood_kwargs)
     remove_param_idx, remove_idx = mcmc_utils.get_idx_for_params(mcmc_loss_fn.out_dim, 
                                                                  orig_Y_cols, 
                                                                  params_to_remove, 
-                                                                 cfg.model.likelihood_class)
+                                                                 cfg.model.likelihood_class,
+                                                                 likelihood_kwargs=cfg.model.likelihood_kwargs)
     mcmc_train_Y_mean = np.delete(train_data.train_Y_mean, remove_param_idx)
     mcmc_train_Y_std = np.delete(train_data.train_Y_std, remove_param_idx)
-    parameter_penalty = mcmc_utils.HybridBNNPenalty(mcmc_Y_cols, cfg.model.likelihood_class, mcmc_train_Y_mean, mcmc_train_Y_std, test_cfg.h0_posterior.exclude_velocity_dispersion, device)
+    parameter_penalty = mcmc_utils.HybridBNNPenalty(mcmc_Y_cols, cfg.model.likelihood_class, mcmc_train_Y_mean, mcmc_train_Y_std, test_cfg.h0_posterior.exclude_velocity_dispersion, device, cfg.model.likelihood_kwargs)
     custom_logL_addition = parameter_penalty.evaluate
     null_spread = False
 
     ###################
     # BNN predictions #
     ###################
-    # Instantiate BNN model
-    net = getattr(h0rton.models, cfg.model.architecture)(num_classes=loss_fn.out_dim, dropout_rate=cfg.model.dropout_rate)
-    net.to(device)
-    # Load trained weights from saved state
-    net, epoch = train_utils.load_state_dict_test(test_cfg.state_dict_path, net, cfg.optim.n_epochs, device)
     # When only generating BNN predictions (and not running MCMC), we can afford more n_dropout
     # otherwise, we fix n_dropout = mcmc_Y_dim + 1
+    n_walkers = test_cfg.numerics.mcmc.walkerRatio*(mcmc_Y_dim + 1) # (BNN params + D_dt) times walker ratio
     if test_cfg.export.pred:
         n_dropout = 20
-        n_samples_per_dropout = test_cfg.numerics.mcmc.walkerRatio
     else:
-        n_walkers = test_cfg.numerics.mcmc.walkerRatio*(mcmc_Y_dim + 1) # (BNN params + D_dt) times walker ratio
         n_dropout = n_walkers//test_cfg.numerics.mcmc.walkerRatio
-        n_samples_per_dropout = test_cfg.numerics.mcmc.walkerRatio
+    n_samples_per_dropout = test_cfg.numerics.mcmc.walkerRatio
+    mc_dropout_cfg = test_cfg.numerics.mc_dropout
+    if mc_dropout_cfg.adaptive and test_cfg.export.pred:
+        n_dropout = mc_dropout_cfg.max_passes
+    # Optionally reuse the raw BNN predictions of a previous run with the same checkpoint, data, seed, and dropout settings
+    stored = None
+    if test_cfg.prediction_store_dir:
+        store = PredictionStore(test_cfg.prediction_store_dir)
+        test_dataset_id = dict(test_baobab_cfg_path=test_cfg.data.test_baobab_cfg_path, n_lenses=batch_size)
+        n_dropout_id = mc_dropout_cfg.to_dict() if mc_dropout_cfg.adaptive else n_dropout
+        store_key, store_key_dict = store.get_key(test_cfg.state_dict_path, get_data_cfg_for_key(cfg), test_dataset_id, test_cfg.global_seed, n_dropout_id)
+        stored = store.load(store_key)
+    if stored is not None:
+        print("Loading stored BNN predictions with key {:s}...".format(store_key))
+        raw_pred = stored['pred']
+        n_dropout_per_lens = stored['n_dropout_per_lens']
+        for X_, Y_ in test_loader:
+            Y = Y_.to(device)
+            break
+    else:
+        if test_cfg.state_dict_path.endswith('.safetensors'):
+            # Build the BNN directly from the memory-mapped inference-only artifact
+            net, _ = h0rton.models.load_inference_artifact(test_cfg.state_dict_path, device)
+        else:
+            # Instantiate BNN model
+            net = getattr(h0rton.models, cfg.model.architecture)(num_classes=loss_fn.out_dim, dropout_rate=cfg.model.dropout_rate)
+            net.to(device)
+            # Load trained weights from saved state
+            net, epoch = train_utils.load_state_dict_test(test_cfg.state_dict_path, net, cfg.optim.n_epochs, device)
+        with torch.no_grad():
+            net.train()
+            # Send some empty forward passes through the test data without backprop to adjust batchnorm weights
+            # (This is often not necessary. Beware if using for just 1 lens.)
+            for nograd_pass in range(5):
+                for X_, Y_ in test_loader:
+                    X = X_.to(device)
+                    _ = net(X)
+            # Obtain MC dropout samples
+            if mc_dropout_cfg.adaptive:
+                # Passes are drawn in blocks on a single noise realization of the images until the predictive moments converge
+                for X_, Y_ in test_loader:
+                    X = X_.to(device)
+                    Y = Y_.to(device)
+                    break
+                raw_pred, n_dropout_per_lens = mc_dropout_utils.get_adaptive_mc_dropout_preds(net, X, test_data.Y_dim, 
+                                                                                              block_size=mc_dropout_cfg.block_size, 
+                                                                                              min_passes=mc_dropout_cfg.min_passes, 
+                                                                                              max_passes=mc_dropout_cfg.max_passes, 
+                                                                                              tol=mc_dropout_cfg.tol)
+            else:
+                raw_pred = np.empty([batch_size, n_dropout, loss_fn.out_dim])
+                for d in range(n_dropout):
+                    net.eval()
+                    for X_, Y_ in test_loader:
+                        X = X_.to(device)
+                        Y = Y_.to(device)
+                        pred = net(X)
+                        break
+                    raw_pred[:, d, :] = pred.cpu().numpy()
+                n_dropout_per_lens = np.full(batch_size, n_dropout)
+        if test_cfg.prediction_store_dir:
+            store.save(store_key, raw_pred, train_data.train_Y_mean, train_data.train_Y_std, n_dropout_per_lens=n_dropout_per_lens, key_dict=store_key_dict)
     # Initialize arrays that will store samples and BNN predictions
     init_pos = np.empty([batch_size, n_dropout, n_samples_per_dropout, mcmc_Y_dim])
-    mcmc_pred = np.empty([batch_size, n_dropout, mcmc_loss_fn.out_dim])
-    with torch.no_grad():
-        net.train()
-        # Send some empty forward passes through the test data without backprop to adjust batchnorm weights
-        # (This is often not necessary. Beware if using for just 1 lens.)
-        for nograd_pass in range(5):
-            for X_, Y_ in test_loader:
-                X = X_.to(device)
-                _ = net(X)
-        # Obtain MC dropout samples
-        for d in range(n_dropout):
-            net.eval()
-            for X_, Y_ in test_loader:
-                X = X_.to(device)
-                Y = Y_.to(device)
-                pred = net(X)
-                break
-            mcmc_pred_d = pred.cpu().numpy()
-            # Replace BNN posterior's primary gaussian mean with truth values
-            if test_cfg.lens_posterior_type == 'default_with_truth_mean':
-                mcmc_pred_d[:, :len(mcmc_Y_cols)] = Y[:, :len(mcmc_Y_cols)].cpu().numpy()
-            # Leave only the MCMC parameters in pred
-            mcmc_pred_d = mcmc_utils.remove_parameters_from_pred(mcmc_pred_d, remove_idx, return_as_tensor=False)
-            # Populate pred that will define the MCMC penalty function
-            mcmc_pred[:, d, :] = mcmc_pred_d
-            # Instantiate posterior to generate BNN samples, which will serve as initial positions for walkers
-            bnn_post = getattr(h0rton.h0_inference.gaussian_bnn_posterior_cpu, loss_fn.posterior_name + 'CPU')(mcmc_Y_dim,  mcmc_train_Y_mean, mcmc_train_Y_std)
-            bnn_post.set_sliced_pred(mcmc_pred_d)
-            init_pos[:, d, :, :] = bnn_post.sample(n_samples_per_dropout, sample_seed=test_cfg.global_seed+d) # contains just the lens model params, no D_dt
-            gc.collect()
+    mcmc_pred = np.full([batch_size, raw_pred.shape[1], mcmc_loss_fn.out_dim], np.nan)
+    for d in range(raw_pred.shape[1]):
+        mcmc_pred_d = raw_pred[:, d, :]
+        # Replace BNN posterior's primary gaussian mean with truth values
+        if test_cfg.lens_posterior_type == 'default_with_truth_mean':
+            mcmc_pred_d[:, :len(mcmc_Y_cols)] = Y[:, :len(mcmc_Y_cols)].cpu().numpy()
+        # Leave only the MCMC parameters in pred
+        mcmc_pred_d = mcmc_utils.remove_parameters_from_pred(mcmc_pred_d, remove_idx, return_as_tensor=False)
+        # Populate pred that will define the MCMC penalty function
+        mcmc_pred[:, d, :] = mcmc_pred_d
+    # Optionally export the BNN posterior as per-pass mixture parameters, from which any number of samples can be drawn later
+    if test_cfg.export.pred and test_cfg.export.pred_format == 'mixture':
+        import sys
+        np.save(os.path.join(out_dir, 'n_dropout_per_lens.npy'), n_dropout_per_lens)
+        bnn_post = ParametricBNNPosterior.from_pred(mcmc_pred, mcmc_loss_fn.posterior_name, mcmc_train_Y_mean, mcmc_train_Y_std, n_dropout_per_lens, mcmc_Y_cols, mcmc_loss_fn.posterior_kwargs)
+        bnn_post.save(os.path.join(out_dir, 'bnn_posterior.npz'))
+        # Optionally also materialize samples on disk, streamed in chunks so that memory doesn't grow with their number
+        if test_cfg.export.n_samples_per_dropout:
+            bnn_post.save_samples(os.path.join(out_dir, 'samples.npy'), test_cfg.export.n_samples_per_dropout, chunk_size=test_cfg.numerics.sample_chunk_size or 1000, sample_seed=test_cfg.global_seed)
+        sys.exit()
+    # If the lenses used different numbers of passes, walker slot d is initialized from pass d (mod n_dropout of that lens)
+    # but exported predictions are simply padded with NaN
+    slot_pass_idx = np.arange(n_dropout)[np.newaxis, :] % n_dropout_per_lens[:, np.newaxis] # [batch_size, n_dropout]
+    sample_chunk_size = test_cfg.numerics.sample_chunk_size or n_samples_per_dropout
+    for d in range(n_dropout):
+        # Instantiate posterior to generate BNN samples, which will serve as initial positions for walkers
+        bnn_post = getattr(h0rton.h0_inference.gaussian_bnn_posterior_cpu, loss_fn.posterior_name + 'CPU')(mcmc_Y_dim,  mcmc_train_Y_mean, mcmc_train_Y_std, **mcmc_loss_fn.posterior_kwargs)
+        bnn_post.set_sliced_pred(mcmc_pred[np.arange(batch_size), slot_pass_idx[:, d], :])
+        # Filled chunk by chunk, so that only one chunk of samples is held on top of init_pos
+        start = 0
+        for chunk in bnn_post.sample_chunks(n_samples_per_dropout, sample_chunk_size, sample_seed=test_cfg.global_seed+d):
+            init_pos[:, d, start:start + chunk.shape[1], :] = chunk # contains just the lens model params, no D_dt
+            start += chunk.shape[1]
+        gc.collect()
+    np.save(os.path.join(out_dir, 'n_dropout_per_lens.npy'), n_dropout_per_lens)
     # Terminate right after generating BNN predictions (no MCMC)
     if test_cfg.export.pred:
         import sys
         samples_path = os.path.join(out_dir, 'samples.npy')
+        init_pos[np.arange(n_dropout)[np.newaxis, :] >= n_dropout_per_lens[:, np.newaxis]] = np.nan
         np.save(samples_path, init_pos)
         sys.exit()
 
@@ -219,7 +283,7 @@ def main():
         ###########################
         data_i = master_truth.iloc[lens_i].copy()
         # Set BNN pred defining parameter penalty for this lens, batch processes across n_dropout
-        parameter_penalty.set_bnn_post_params(mcmc_pred[lens_i, :, :])
+        parameter_penalty.set_bnn_post_params(mcmc_pred[lens_i, :n_dropout_per_lens[lens_i], :])
         # Initialize lens model params walkers at the predictive mean
         init_info = dict(zip(mcmc_Y_cols, pred_mean[lens_i, :]*mcmc_train_Y_std + mcmc_train_Y_mean))
         lcdm = LCDM(z_lens=data_i['z_lens'], z_source=data_i['z_src'], flat=True)
@@ -301,6 +365,7 @@ def main():
                                    D_dt_samples=D_dt_samples, # kappa_ext=0 for these samples
                                    inference_time=inference_time,
                                    true_D_dt=true_D_dt, 
+                                   n_dropout=n_dropout_per_lens[lens_i],
                                    )
         lens_inference_dict_save_path = os.path.join(out_dir, 'D_dt_dict_{0:04d}.npy'.format(lens_i))
         np.save(lens_inference_dict_save_path, lens_inference_dict)
@@ -8,6 +8,8 @@ To run this script, pass in the path to the user-defined training config file as
     
     $ infer_h0 h0rton/h0_inference_config.json
 
+By default, `h0_posterior.n_samples` H0 samples are drawn per lens. If `h0_posterior.target_n_eff` is set, samples are instead drawn in blocks of `h0_posterior.block_size` (Default: `n_samples`) until the effective sample size of the weights reaches `target_n_eff` or `h0_posterior.max_n_samples` (Default: 10 times `n_samples`) samples are drawn. With `h0_posterior.adapt_proposal`, the H0 and kappa_ext proposal is refined towards the high-weight region after each block (see `h0rton.h0_inference.h0_utils.sample_h0_adaptive`). The effective sample size and number of samples of each lens are saved in its H0 dict and in `h0_stats`.
+
 """
 import os
 import time
@@ -25,7 +27,7 @@ from baobab import BaobabConfig
 from h0rton.configs import TrainValConfig, TestConfig
 import h0rton.losses
 import h0rton.script_utils as script_utils
-from h0rton.h0_inference import H0Posterior, plot_weighted_h0_histogram
+from h0rton.h0_inference import H0Posterior, plot_weighted_h0_histogram, h0_utils
 from h0rton.trainval_data import XYData
 from astropy.cosmology import FlatLambdaCDM
 
@@ -94,9 +96,9 @@ def main():
     # Load trained state #
     ######################
     # Instantiate loss function
-    loss_fn = getattr(h0rton.losses, cfg.model.likelihood_class)(Y_dim=train_data.Y_dim, device=device)
+    loss_fn = getattr(h0rton.losses, cfg.model.likelihood_class)(Y_dim=train_data.Y_dim, device=device, **cfg.model.likelihood_kwargs)
     # Instantiate posterior (for logging)
-    bnn_post = getattr(h0rton.h0_inference.gaussian_bnn_posterior, loss_fn.posterior_name)(train_data.Y_dim, device, train_data.train_Y_mean, train_data.train_Y_std)
+    bnn_post = getattr(h0rton.h0_inference.gaussian_bnn_posterior, loss_fn.posterior_name)(train_data.Y_dim, device, train_data.train_Y_mean, train_data.train_Y_std, **loss_fn.posterior_kwargs)
     with torch.no_grad(): # TODO: skip this if lens_posterior_type == 'truth'
         for X_, Y_ in test_loader:
             X = X_.to(device)
@@ -147,7 +149,12 @@ def main():
     # Lens Model Posterior #
     ########################
     n_samples = test_cfg.h0_posterior.n_samples # number of h0 samples per lens
-    sampling_buffer = test_cfg.h0_posterior.sampling_buffer # FIXME: dynamically sample more if we run out of samples
+    # Adaptive sampling, if a target effective sample size is given
+    target_n_eff = test_cfg.h0_posterior.target_n_eff
+    max_n_samples = test_cfg.h0_posterior.max_n_samples or 10*n_samples
+    block_size = test_cfg.h0_posterior.block_size or n_samples
+    adapt_proposal = bool(test_cfg.h0_posterior.adapt_proposal)
+    sampling_buffer = test_cfg.h0_posterior.sampling_buffer # only sets how many noisy lens models are drawn; the H0 samples are governed by n_samples or target_n_eff
     actual_n_samples = int(n_samples*sampling_buffer)
 
     # Add artificial noise around the truth values
@@ -161,9 +168,10 @@ def main():
     mean_h0_set = np.zeros(n_test)
     std_h0_set = np.zeros(n_test)
     inference_time_set = np.zeros(n_test)
+    n_eff_set = np.zeros(n_test)
+    n_samples_set = np.zeros(n_test, dtype=int)
     # For each lens system...
     total_progress = tqdm(total=n_test)
-    sampling_progress = tqdm(total=n_samples)
     prerealized_time_delays = test_cfg.error_model.prerealized_time_delays
     if prerealized_time_delays:
         realized_time_delays = pd.read_csv(test_cfg.error_model.realized_time_delays_path, index_col=None)
@@ -208,45 +216,33 @@ def main():
                                           kappa_ext=cosmo['kappa_ext'], # not necessary
                                           )
         h0_post.set_truth_lens_model(sampled_lens_model_raw=bnn_sample_df.iloc[0])
-        # Initialize output array
-        h0_samples = np.full(n_samples, np.nan)
-        h0_weights = np.zeros(n_samples)
-        # For each sample from the lens model posterior of this lens system...
-        sampling_progress.reset()
-        valid_sample_i = 0
-        sample_i = 0
-        while valid_sample_i < n_samples:
-            if sample_i > actual_n_samples - 1:
-                break
-            #try:
-            # Each sample for a given lens gets a unique random state for H0, k_ext, and aniso_param realizations.
-            rs_sample = np.random.RandomState(int(str(lens_i) + str(sample_i).zfill(5)))
-            h0, weight = h0_post.get_h0_sample_truth(rs_sample)
-            h0_samples[valid_sample_i] = h0
-            h0_weights[valid_sample_i] = weight
-            sampling_progress.update(1)
-            time.sleep(0.001)
-            valid_sample_i += 1
-            sample_i += 1
-            #except:
-            #    sample_i += 1
-            #    continue
-        sampling_progress.refresh()
+        if target_n_eff:
+            # Draw blocks of H0 and k_ext samples until the weights reach the target effective sample size
+            h0_samples, h0_log_weights, sampling_info = h0_post.get_h0_samples_truth_adaptive(target_n_eff, max_n_samples, block_size, rs_lens, adapt_proposal=adapt_proposal)
+        else:
+            # Draw all H0 and k_ext samples for this lens at once, rescaling the time delays of the lens model computed at a fiducial H0
+            h0_samples, h0_log_weights = h0_post.get_h0_samples_truth(n_samples, rs_lens)
+            sampling_info = dict(n_eff=h0_utils.get_n_eff(h0_log_weights), n_samples=n_samples, n_blocks=1, reached_target=None) # no target without adaptive sampling
+        sample_i = sampling_info['n_samples']
         lens_i_end_time = time.time()
         inference_time = (lens_i_end_time - lens_i_start_time)/60.0 # min
         h0_dict = dict(
                        h0_samples=h0_samples,
-                       h0_weights=h0_weights,
+                       h0_log_weights=h0_log_weights,
                        n_sampling_attempts=sample_i,
+                       n_eff=sampling_info['n_eff'],
+                       reached_target_n_eff=sampling_info['reached_target'],
                        measured_td_wrt0=measured_td_wrt0,
                        inference_time=inference_time
                        )
         h0_dict_save_path = os.path.join(out_dir, 'h0_dict_{0:04d}.npy'.format(lens_i))
         np.save(h0_dict_save_path, h0_dict)
-        h0_stats = plot_weighted_h0_histogram(h0_samples, h0_weights, lens_i, cosmo['H0'], include_fit_gaussian=test_cfg.plotting.include_fit_gaussian, save_dir=out_dir)
+        h0_stats = plot_weighted_h0_histogram(h0_samples, lens_i=lens_i, true_h0=cosmo['H0'], include_fit_gaussian=test_cfg.plotting.include_fit_gaussian, save_dir=out_dir, all_log_weights=h0_log_weights)
         mean_h0_set[i] = h0_stats['mean']
         std_h0_set[i] = h0_stats['std']
         inference_time_set[i] = inference_time
+        n_eff_set[i] = sampling_info['n_eff']
+        n_samples_set[i] = sample_i
         total_progress.update(1)
     total_progress.close()
     if not prerealized_time_delays:
@@ -255,6 +251,8 @@ def main():
                     mean=mean_h0_set,
                     std=std_h0_set,
                     inference_time=inference_time_set,
+                    n_eff=n_eff_set,
+                    n_samples=n_samples_set,
                     )
     h0_stats_save_path = os.path.join(out_dir, 'h0_stats')
     np.save(h0_stats_save_path, h0_stats)
@@ -1,3 +1,4 @@
 from .gaussian_nll import *
 from .gaussian_nll_cpu import *
-from .gaussian_nll_native import *
\ No newline at end of file
+from .gaussian_nll_native import *
+from .backend_selection import *
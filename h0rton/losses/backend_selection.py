@@ -0,0 +1,222 @@
+"""Benchmarking the interchangeable implementations of the Gaussian NLLs and picking the fastest one on the current machine
+
+The same likelihoods are implemented in three backends, whose class names differ by a suffix:
+
+* `gaussian_nll`, the default, e.g. `DoubleGaussianNLL`,
+* `gaussian_nll_native`, built on `torch.distributions`, e.g. `DoubleGaussianNLLNative`,
+* `gaussian_nll_cpu`, in numpy, e.g. `DoubleGaussianNLLCPU`. It only evaluates the NLL, so it can be timed but not trained with.
+
+All backends are checked against the default backend evaluated in float64 on the same inputs, for both the loss and its gradient with respect to the network output.
+
+"""
+import time
+import inspect
+import contextlib
+import numpy as np
+import pandas as pd
+import torch
+from . import gaussian_nll, gaussian_nll_native, gaussian_nll_cpu
+
+__all__ = ['likelihood_backends', 'trainable_backends', 'get_backend_class_name', 'get_backend_likelihood_kwargs', 'benchmark_likelihood_backends', 'select_likelihood_backend']
+
+likelihood_backends = {'gaussian_nll': '', 'gaussian_nll_native': 'Native', 'gaussian_nll_cpu': 'CPU'} # backend module name --> class name suffix
+trainable_backends = ['gaussian_nll', 'gaussian_nll_native']
+_backend_modules = {'gaussian_nll': gaussian_nll, 'gaussian_nll_native': gaussian_nll_native, 'gaussian_nll_cpu': gaussian_nll_cpu}
+agreement_rtol = {torch.float32: 1.e-4, torch.float64: 1.e-8}
+
+def get_backend_class_name(likelihood_class, backend):
+    """Get the name of the class implementing a likelihood in the given backend
+
+    Parameters
+    ----------
+    likelihood_class : str
+        name of the likelihood class in the default backend, e.g. `DoubleGaussianNLL`
+    backend : str
+        one of `likelihood_backends`
+
+    Returns
+    -------
+    str or None
+        the class name, or None if the backend does not implement the likelihood
+
+    """
+    if backend not in likelihood_backends:
+        raise ValueError("Likelihood backend must be one of {}.".format(list(likelihood_backends.keys())))
+    class_name = likelihood_class + likelihood_backends[backend]
+    return class_name if class_name in _backend_modules[backend].__all__ else None
+
+def get_backend_likelihood_kwargs(likelihood_class, backend, likelihood_kwargs):
+    """Keep the keyword arguments of a likelihood that its class in the given backend accepts
+
+    Options specific to one implementation, like `packed` of the default `FullRankGaussianNLL`, don't change the network output layout, so the other backends can drop them.
+
+    Parameters
+    ----------
+    likelihood_class : str
+        name of the likelihood class in the default backend, e.g. `FullRankGaussianNLL`
+    backend : str
+        one of `likelihood_backends`
+    likelihood_kwargs : dict
+        keyword arguments of the likelihood class in the default backend
+
+    Returns
+    -------
+    dict
+        the keyword arguments to pass to the class in `backend`, besides `Y_dim` and `device`
+
+    """
+    loss_class = getattr(_backend_modules[backend], get_backend_class_name(likelihood_class, backend))
+    params = inspect.signature(loss_class.__init__).parameters
+    return {k: v for k, v in likelihood_kwargs.items() if k in params and k not in ['Y_dim', 'device']}
+
+def _get_loss_fn(likelihood_class, backend, Y_dim, device, likelihood_kwargs):
+    """Instantiate the likelihood in the given backend. The numpy backend takes neither the device nor the keyword arguments.
+
+    """
+    loss_class = getattr(_backend_modules[backend], get_backend_class_name(likelihood_class, backend))
+    if backend == 'gaussian_nll_cpu':
+        return loss_class(Y_dim=Y_dim)
+    return loss_class(Y_dim=Y_dim, device=device, **get_backend_likelihood_kwargs(likelihood_class, backend, likelihood_kwargs))
+
+@contextlib.contextmanager
+def _default_dtype(dtype):
+    """Temporarily set the default torch dtype, with which the losses create their internal tensors
+
+    """
+    orig_dtype = torch.get_default_dtype()
+    torch.set_default_dtype(dtype)
+    try:
+        yield
+    finally:
+        torch.set_default_dtype(orig_dtype)
+
+def _time_loss(loss_fn, pred, target, n_repeats, is_numpy):
+    """Time the forward and backward passes of a loss on a fixed batch, returning the fastest of `n_repeats` calls after a warm-up call (or the warm-up call alone if `n_repeats` is 0)
+
+    """
+    if is_numpy:
+        pred_np, target_np = pred.cpu().numpy(), target.cpu().numpy()
+    forward_times, backward_times = [], []
+    for _ in range(n_repeats + 1):
+        if is_numpy:
+            start = time.perf_counter()
+            loss = float(loss_fn(pred_np, target_np))
+            forward_times.append(time.perf_counter() - start)
+            grad = None
+            continue
+        pred_rg = pred.clone().requires_grad_(True)
+        if pred.is_cuda:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        loss_t = loss_fn(pred_rg, target)
+        if pred.is_cuda:
+            torch.cuda.synchronize()
+        forward_times.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        loss_t.backward()
+        if pred.is_cuda:
+            torch.cuda.synchronize()
+        backward_times.append(time.perf_counter() - start)
+        loss, grad = loss_t.item(), pred_rg.grad.double().cpu().numpy()
+    forward_time = min(forward_times[1:] or forward_times)
+    backward_time = min(backward_times[1:] or backward_times) if backward_times else np.nan
+    return forward_time, backward_time, loss, grad
+
+def benchmark_likelihood_backends(likelihood_class, Y_dim, batch_sizes, dtypes=[torch.float32, torch.float64], device=torch.device('cpu'), n_repeats=10, likelihood_kwargs={}, backends=None, seed=123):
+    """Time the forward and backward passes of a likelihood in each backend, and check their agreement
+
+    Parameters
+    ----------
+    likelihood_class : str
+        name of the likelihood class in the default backend, e.g. `DoubleGaussianNLL`
+    Y_dim : int
+        number of parameters to predict
+    batch_sizes : list of int
+        batch sizes to time
+    dtypes : list of torch.dtype
+        float types to time
+    device : torch.device
+        device on which to run the torch backends. The numpy backend always runs on the CPU.
+    n_repeats : int
+        number of timed calls, of which the fastest is reported
+    likelihood_kwargs : dict
+        keyword arguments of the likelihood class, e.g. `rank`
+    backends : list of str
+        backends to time. Default: all backends implementing `likelihood_class`
+    seed : int
+        seed of the random network outputs and labels
+
+    Returns
+    -------
+    pd.DataFrame
+        one row per backend, batch size, and dtype, with columns `backend`, `class_name`, `batch_size`, `dtype`, `forward_time`, `backward_time` (NaN for the numpy backend), `total_time`, `loss_diff` and `grad_diff`, the largest absolute differences from the float64 default backend, and `agrees`
+
+    """
+    if backends is None:
+        backends = [b for b in likelihood_backends if get_backend_class_name(likelihood_class, b) is not None]
+    generator = torch.Generator().manual_seed(seed)
+    rows = []
+    for batch_size in batch_sizes:
+        # Reference evaluation in float64
+        with _default_dtype(torch.float64):
+            ref_fn = _get_loss_fn(likelihood_class, 'gaussian_nll', Y_dim, device, likelihood_kwargs)
+            # Small elements of the covariance factors, for well-conditioned covariance matrices
+            pred = 0.1*torch.randn(batch_size, ref_fn.out_dim, generator=generator, dtype=torch.float64).to(device)
+            target = torch.randn(batch_size, Y_dim, generator=generator, dtype=torch.float64).to(device)
+            _, _, ref_loss, ref_grad = _time_loss(ref_fn, pred, target, 0, False)
+        for dtype in dtypes:
+            with _default_dtype(dtype):
+                for backend in backends:
+                    loss_fn = _get_loss_fn(likelihood_class, backend, Y_dim, device, likelihood_kwargs)
+                    is_numpy = (backend == 'gaussian_nll_cpu')
+                    forward_time, backward_time, loss, grad = _time_loss(loss_fn, pred.to(dtype), target.to(dtype), n_repeats, is_numpy)
+                    loss_diff = abs(loss - ref_loss)
+                    grad_diff = np.nan if grad is None else np.max(np.abs(grad - ref_grad))
+                    rtol = agreement_rtol[dtype]
+                    agrees = (loss_diff <= rtol*max(1.0, abs(ref_loss))) and (grad is None or grad_diff <= rtol*max(1.0, np.max(np.abs(ref_grad))))
+                    rows.append(dict(backend=backend,
+                                     class_name=get_backend_class_name(likelihood_class, backend),
+                                     batch_size=batch_size,
+                                     dtype=str(dtype).replace('torch.', ''),
+                                     forward_time=forward_time,
+                                     backward_time=backward_time,
+                                     total_time=forward_time + (0.0 if is_numpy else backward_time),
+                                     loss_diff=loss_diff,
+                                     grad_diff=grad_diff,
+                                     agrees=bool(agrees)))
+    return pd.DataFrame(rows)
+
+def select_likelihood_backend(likelihood_class, Y_dim, batch_size, dtype=torch.float32, device=torch.device('cpu'), n_repeats=10, likelihood_kwargs={}):
+    """Pick the fastest trainable backend of a likelihood that agrees with the float64 default backend, for the training batch size and dtype on the current machine
+
+    Parameters
+    ----------
+    likelihood_class : str
+        name of the likelihood class in the default backend, e.g. `DoubleGaussianNLL`
+    Y_dim : int
+        number of parameters to predict
+    batch_size : int
+        training batch size
+    dtype : torch.dtype
+        training float type
+    device : torch.device
+        training device
+    n_repeats : int
+        number of timed calls per backend
+    likelihood_kwargs : dict
+        keyword arguments of the likelihood class
+
+    Returns
+    -------
+    tuple
+        the selected backend, the name of its likelihood class, and the benchmark `pd.DataFrame` (see `benchmark_likelihood_backends`) on which the selection was based. Falls back to the default backend if no other backend agrees.
+
+    """
+    backends = [b for b in trainable_backends if get_backend_class_name(likelihood_class, b) is not None]
+    benchmark = benchmark_likelihood_backends(likelihood_class, Y_dim, [batch_size], [dtype], device, n_repeats, likelihood_kwargs, backends)
+    candidates = benchmark[benchmark['agrees']]
+    if len(candidates) == 0:
+        backend = 'gaussian_nll'
+    else:
+        backend = candidates.loc[candidates['total_time'].idxmin(), 'backend']
+    return backend, get_backend_class_name(likelihood_class, backend), benchmark
@@ -1,10 +1,81 @@
 from abc import ABC, abstractmethod
 import numpy as np
 import torch
-__all__ = ['BaseGaussianNLL', 'DiagonalGaussianNLL', 'LowRankGaussianNLL', 'DoubleLowRankGaussianNLL', 'FullRankGaussianNLL', 'DoubleGaussianNLL']
+__all__ = ['BaseGaussianNLL', 'DiagonalGaussianNLL', 'LowRankGaussianNLL', 'DoubleLowRankGaussianNLL', 'FullRankGaussianNLL', 'DoubleGaussianNLL', 'MixtureGaussianNLL', 'mixture_cov_types']
 
 log_2_pi = 1.8378770664093453
 log_2 = 0.6931471805599453
+# Covariance families of the components of `MixtureGaussianNLL`
+mixture_cov_types = ['diagonal', 'low_rank', 'full_rank']
+
+def get_packed_tril_ops(Y_dim, device):
+    """Get the index tensors that map the packed lower-triangular elements of a `Y_dim x Y_dim` matrix to its rows and columns
+
+    Parameters
+    ----------
+    Y_dim : int
+        number of rows and columns
+    device : torch.device object
+
+    Returns
+    -------
+    tuple
+        `row_idx` and `col_idx` of shape `[tril_len,]`, the boolean `is_diag` of shape `[tril_len,]`, and the one-hot `row_onehot` and `col_onehot` of shape `[tril_len, Y_dim]`, which sum the packed elements by row and column as a matrix product
+
+    """
+    row_idx, col_idx = torch.tril_indices(Y_dim, Y_dim, offset=0, device=device)
+    is_diag = (row_idx == col_idx)
+    eye = torch.eye(Y_dim, device=device)
+    return row_idx, col_idx, is_diag, eye[row_idx], eye[col_idx]
+
+class PackedFullRankNLL(torch.autograd.Function):
+    """Per-example NLL of a Gaussian parameterized by the lower-triangular Cholesky factor `L` of its precision matrix, evaluated on the packed elements of `L`
+
+    The diagonal elements of `L` are given as logs, as in the network output. The NLL is `-sum(log diag(L)) + 0.5*|L^T (mu - y)|^2 + 0.5*Y_dim*log(2 pi)`, where `z = L^T (mu - y)` is summed directly over the packed elements, so neither `L` nor the precision matrix `L L^T` is formed. The backward pass is written out in terms of `z`: the gradient is `L z` with respect to `mu - y` and `z_j (mu - y)_i` with respect to `L_ij`.
+
+    """
+    @staticmethod
+    def forward(ctx, y_diff, tril_elements, row_idx, col_idx, is_diag, row_onehot, col_onehot):
+        """
+        Parameters
+        ----------
+        y_diff : torch.Tensor of shape [batch_size, Y_dim]
+            `mu - target`
+        tril_elements : torch.Tensor of shape [batch_size, tril_len]
+            packed elements of `L`, with the log of the diagonal elements
+        row_idx, col_idx, is_diag, row_onehot, col_onehot : torch.Tensor
+            output of `get_packed_tril_ops`
+
+        Returns
+        -------
+        torch.Tensor of shape [batch_size,]
+            NLL values
+
+        """
+        Y_dim = y_diff.shape[1]
+        row_onehot = row_onehot.to(y_diff.dtype)
+        col_onehot = col_onehot.to(y_diff.dtype)
+        tril_vals = torch.where(is_diag, torch.exp(tril_elements), tril_elements) # [batch_size, tril_len]
+        y_diff_rows = y_diff[:, row_idx] # [batch_size, tril_len]
+        z = torch.matmul(tril_vals*y_diff_rows, col_onehot) # [batch_size, Y_dim]
+        logdet_term = -torch.sum(tril_elements*is_diag, dim=1) # [batch_size,]
+        ctx.save_for_backward(tril_vals, y_diff_rows, z, col_idx, is_diag, row_onehot)
+        return logdet_term + 0.5*torch.sum(z**2.0, dim=1) + 0.5*Y_dim*log_2_pi
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    def backward(ctx, grad_loss):
+        tril_vals, y_diff_rows, z, col_idx, is_diag, row_onehot = ctx.saved_tensors
+        grad_loss = grad_loss.unsqueeze(1) # [batch_size, 1]
+        z_cols = z[:, col_idx] # [batch_size, tril_len]
+        grad_y_diff = grad_tril_elements = None
+        if ctx.needs_input_grad[0]:
+            grad_y_diff = grad_loss*torch.matmul(tril_vals*z_cols, row_onehot) # [batch_size, Y_dim]
+        if ctx.needs_input_grad[1]:
+            grad_tril_vals = z_cols*y_diff_rows
+            # Chain rule through the exponentiated diagonal, plus the log-determinant term
+            grad_tril_elements = grad_loss*torch.where(is_diag, grad_tril_vals*tril_vals - 1.0, grad_tril_vals) # [batch_size, tril_len]
+        return grad_y_diff, grad_tril_elements, None, None, None, None, None
 
 class BaseGaussianNLL(ABC):
     """Abstract base class to represent the Gaussian negative log likelihood (NLL).
@@ -25,6 +96,7 @@ class BaseGaussianNLL(ABC):
         self.device = device
         self.sigmoid = torch.nn.Sigmoid()
         self.logsigmoid = torch.nn.LogSigmoid()
+        self.posterior_kwargs = {} # keyword arguments of the matching posterior class in `h0rton.h0_inference`, besides `Y_dim`
 
     @abstractmethod
     def slice(self, pred):
@@ -52,7 +124,7 @@ class BaseGaussianNLL(ABC):
         """
         return NotImplemented
 
-    def nll_diagonal(self, target, mu, logvar):
+    def nll_diagonal(self, target, mu, logvar, reduce=True):
         """Evaluate the NLL for single Gaussian with diagonal covariance matrix
 
         Parameters
@@ -63,6 +135,8 @@ class BaseGaussianNLL(ABC):
             network prediction of the mu (mean parameter) of the BNN posterior
         logvar : torch.Tensor of shape [batch_size, Y_dim]
             network prediction of the log of the diagonal elements of the covariance matrix
+        reduce : bool
+            whether to take the mean across the batch
 
         Returns
         -------
@@ -76,11 +150,16 @@ class BaseGaussianNLL(ABC):
         # Restore prefactors
         loss += np.log(2.0*np.pi)
         loss *= 0.5
-        return torch.mean(torch.sum(loss, dim=1), dim=0)
+        if reduce:
+            return torch.mean(torch.sum(loss, dim=1), dim=0)
+        else:
+            return torch.sum(loss, dim=1) # [batch_size,]
 
     def nll_low_rank(self, target, mu, logvar, F, reduce=True):
         """Evaluate the NLL for a single Gaussian with a full but low-rank plus diagonal covariance matrix
 
+        The inverse and determinant of the covariance matrix are never formed. Only the `[rank, rank]` capacitance matrix is factorized, at a cost of O(batch_size*Y_dim*rank + batch_size*rank^3).
+
         Parameters
         ----------
         target : torch.Tensor of shape [batch_size, Y_dim]
@@ -100,39 +179,22 @@ class BaseGaussianNLL(ABC):
             NLL values
 
         """
-        # 1/(Y_dim - 1) * (sq_mahalanobis + log(det of \Sigma))
-        batch_size, _ = target.shape # self.Y_dim = Y_dim - 1
-        rank = 2 # FIXME: hardcoded for rank 2
-        F = F.reshape([batch_size, self.Y_dim, rank]) 
-        inv_var = torch.exp(-logvar) # [batch_size, self.Y_dim]
-        diag_inv_var = torch.diag_embed(inv_var).float()  # [batch_size, self.Y_dim, self.Y_dim]
-        diag_prod = F**2.0 * inv_var.reshape([batch_size, self.Y_dim, 1]) # [batch_size, self.Y_dim, rank] after broadcasting
-        off_diag_prod = torch.prod(F, dim=2)*inv_var # [batch_size, self.Y_dim]
-        #batchdiag = torch.diag_embed(torch.exp(logvar)) # [batch_size, self.Y_dim, self.Y_dim]
-        #batch_eye = torch.eye(rank).reshape(1, rank, rank).repeat(batch_size, 1, 1) # [batch_size, rank, rank]
-        # (25), (26) in Miller et al 2016
-        log_det = torch.sum(logvar, dim=1) # [batch_size]
-        M00 = torch.sum(diag_prod[:, :, 0], dim=1) + 1.0 # [batch_size]
-        M11 = torch.sum(diag_prod[:, :, 1], dim=1) + 1.0 # [batch_size]
-        M12 = torch.sum(off_diag_prod, dim=1) # [batch_size]
-        det_M = M00*M11 - M12**2.0 # [batch_size]
-        log_det += torch.log(det_M) # [batch_size,]
-
-        inv_M = torch.ones([batch_size, rank, rank], device=self.device, dtype=None)
-        inv_M[:, 0, 0] = M11
-        inv_M[:, 1, 1] = M00
-        inv_M[:, 1, 0] = -M12
-        inv_M[:, 0, 1] = -M12
-        inv_M /= det_M.reshape(batch_size, 1, 1)
-
-        # (27) in Miller et al 2016
-        inv_cov = diag_inv_var - torch.bmm(torch.bmm(torch.bmm(torch.bmm(diag_inv_var, F), inv_M), torch.transpose(F, 1, 2)), diag_inv_var) # [batch_size, self.Y_dim, self.Y_dim]
-        sq_mahalanobis = torch.bmm(torch.bmm((mu - target).reshape(batch_size, 1, self.Y_dim), inv_cov), (mu - target).reshape(batch_size, self.Y_dim, 1)).reshape(-1) # [batch_size,]
-        
+        batch_size, _ = target.shape
+        F = F.reshape([batch_size, self.Y_dim, self.rank])
+        inv_var = torch.exp(-logvar) # [batch_size, Y_dim]
+        y_diff = target - mu # [batch_size, Y_dim]
+        # Woodbury identity and matrix determinant lemma with the capacitance matrix I + F^T D^{-1} F, (25)-(27) in Miller et al 2016
+        inv_var_F = inv_var.unsqueeze(-1)*F # [batch_size, Y_dim, rank]
+        capacitance = torch.eye(self.rank, device=F.device, dtype=F.dtype) + torch.bmm(torch.transpose(F, 1, 2), inv_var_F) # [batch_size, rank, rank]
+        capacitance_tril = torch.linalg.cholesky(capacitance) # [batch_size, rank, rank]
+        log_det = torch.sum(logvar, dim=1) + 2.0*torch.sum(torch.log(torch.diagonal(capacitance_tril, dim1=1, dim2=2)), dim=1) # [batch_size,]
+        proj = torch.bmm(torch.transpose(inv_var_F, 1, 2), y_diff.unsqueeze(-1)) # [batch_size, rank, 1]
+        whitened_proj = torch.linalg.solve_triangular(capacitance_tril, proj, upper=False) # [batch_size, rank, 1]
+        sq_mahalanobis = torch.sum(inv_var*y_diff**2.0, dim=1) - torch.sum(whitened_proj**2.0, dim=(1, 2)) # [batch_size,]
         # Loss kernel
         loss = sq_mahalanobis + log_det
         # Restore prefactors
-        loss += self.Y_dim*np.log(2.0*np.pi)
+        loss += self.Y_dim*log_2_pi
         loss *= 0.5
 
         if reduce==True:
@@ -254,6 +316,34 @@ class BaseGaussianNLL(ABC):
         log_nll = -torch.logsumexp(stacked, dim=1)
         return torch.mean(log_nll)
 
+    def nll_full_rank_packed(self, target, mu, tril_elements, reduce=True):
+        """Evaluate the NLL for a single Gaussian with a full-rank covariance matrix, without forming the precision matrix
+
+        Equivalent to `nll_full_rank`, but evaluated with `PackedFullRankNLL` on the packed lower-triangular elements. See `nll_full_rank` for the parameters and return value.
+
+        """
+        loss = PackedFullRankNLL.apply(mu - target, tril_elements, *self.packed_tril_ops) # [batch_size,]
+        if reduce:
+            return torch.mean(loss, dim=0) # float
+        else:
+            return loss # [batch_size,]
+
+    def nll_mixture_packed(self, target, mu, tril_elements, mu2, tril_elements2, alpha):
+        """Evaluate the NLL for a mixture of two Gaussians with full-rank covariance matrices, without forming the precision matrices
+
+        Equivalent to `nll_mixture`, but the two Gaussians are stacked along the batch dimension and evaluated together with `PackedFullRankNLL`. See `nll_mixture` for the parameters and return value.
+
+        """
+        batch_size, _ = target.shape
+        alpha = alpha.reshape(-1)
+        y_diff = torch.cat([mu, mu2], dim=0) - target.repeat(2, 1) # [2*batch_size, Y_dim]
+        nll = PackedFullRankNLL.apply(y_diff, torch.cat([tril_elements, tril_elements2], dim=0), *self.packed_tril_ops).reshape(2, batch_size)
+        log_w1p1 = torch.log1p(2.0*torch.exp(-alpha)) - log_2 - torch.log1p(torch.exp(-alpha)) - nll[0] # [batch_size]
+        log_w2p2 = -log_2 + self.logsigmoid(alpha) - nll[1] # [batch_size]
+        stacked = torch.stack([log_w1p1, log_w2p2], dim=1)
+        log_nll = -torch.logsumexp(stacked, dim=1)
+        return torch.mean(log_nll)
+
 class DiagonalGaussianNLL(BaseGaussianNLL):
     """The negative log likelihood (NLL) for a single Gaussian with diagonal covariance matrix
         
@@ -276,37 +366,43 @@ class DiagonalGaussianNLL(BaseGaussianNLL):
 class LowRankGaussianNLL(BaseGaussianNLL):
     """The negative log likelihood (NLL) for a single Gaussian with a full but constrained as low-rank plus diagonal covariance matrix
         
-    Only rank 2 is currently supported. `BaseGaussianNLL.__init__` docstring for the parameter description.
+    See `BaseGaussianNLL.__init__` docstring for the parameter description. `rank` is the rank of the low-rank portion of the covariance matrix.
 
     """
     posterior_name = 'LowRankGaussianBNNPosterior'
 
-    def __init__(self, Y_dim, device):
+    def __init__(self, Y_dim, device, rank=2):
         super(LowRankGaussianNLL, self).__init__(Y_dim, device)
-        self.out_dim = Y_dim*4
+        self.rank = rank
+        self.posterior_kwargs = dict(rank=rank)
+        self.out_dim = Y_dim*(2 + rank)
 
     def __call__(self, pred, target):
         return self.nll_low_rank(target, *self.slice(pred), reduce=True)
 
     def slice(self, pred):
         d = self.Y_dim # for readability
-        return torch.split(pred, [d, d, 2*d], dim=1)
+        return torch.split(pred, [d, d, self.rank*d], dim=1)
 
 class FullRankGaussianNLL(BaseGaussianNLL):
     """The negative log likelihood (NLL) for a single Gaussian with a full-rank covariance matrix
         
-    See `BaseGaussianNLL.__init__` docstring for the parameter description.
+    See `BaseGaussianNLL.__init__` docstring for the parameter description. If `packed` (default), the NLL is evaluated with `nll_full_rank_packed` rather than `nll_full_rank`.
 
     """
     posterior_name = 'FullRankGaussianBNNPosterior'
 
-    def __init__(self, Y_dim, device):
+    def __init__(self, Y_dim, device, packed=True):
         super(FullRankGaussianNLL, self).__init__(Y_dim, device)
         self.tril_idx = torch.tril_indices(self.Y_dim, self.Y_dim, offset=0, device=device) # lower-triangular indices
         self.tril_len = len(self.tril_idx[0])
         self.out_dim = self.Y_dim + self.Y_dim*(self.Y_dim + 1)//2
+        self.packed = packed
+        self.packed_tril_ops = get_packed_tril_ops(self.Y_dim, device)
 
     def __call__(self, pred, target):
+        if self.packed:
+            return self.nll_full_rank_packed(target, *self.slice(pred), reduce=True)
         return self.nll_full_rank(target, *self.slice(pred), reduce=True)
 
     def slice(self, pred):
@@ -316,14 +412,16 @@ class FullRankGaussianNLL(BaseGaussianNLL):
 class DoubleLowRankGaussianNLL(BaseGaussianNLL):
     """The negative log likelihood (NLL) for a mixture of two Gaussians, each with a full but constrained as low-rank plus diagonal covariance 
         
-    Only rank 2 is currently supported. `BaseGaussianNLL.__init__` docstring for the parameter description.
+    See `BaseGaussianNLL.__init__` docstring for the parameter description. `rank` is the rank of the low-rank portion of each covariance matrix.
 
     """
     posterior_name = 'DoubleLowRankGaussianBNNPosterior'
 
-    def __init__(self, Y_dim, device):
+    def __init__(self, Y_dim, device, rank=2):
         super(DoubleLowRankGaussianNLL, self).__init__(Y_dim, device)
-        self.out_dim = Y_dim*8 + 1
+        self.rank = rank
+        self.posterior_kwargs = dict(rank=rank)
+        self.out_dim = 2*Y_dim*(2 + rank) + 1
 
     def __call__(self, pred, target):
         return self.nll_mixture_low_rank(target, *self.slice(pred))
@@ -331,25 +429,105 @@ class DoubleLowRankGaussianNLL(BaseGaussianNLL):
     def slice(self, pred):
         d = self.Y_dim # for readability
         #mu, logvar, F, mu2, logvar2, F2, alpha
-        return torch.split(pred, [d, d, 2*d, d, d, 2*d, 1], dim=1)
+        return torch.split(pred, [d, d, self.rank*d, d, d, self.rank*d, 1], dim=1)
 
 class DoubleGaussianNLL(BaseGaussianNLL):
     """The negative log likelihood (NLL) for a mixture of two Gaussians, each with a full but constrained as low-rank plus diagonal covariance 
         
-    Only rank 2 is currently supported. `BaseGaussianNLL.__init__` docstring for the parameter description.
+    Only rank 2 is currently supported. `BaseGaussianNLL.__init__` docstring for the parameter description. If `packed` (default), the NLL is evaluated with `nll_mixture_packed` rather than `nll_mixture`.
 
     """
     posterior_name = 'DoubleGaussianBNNPosterior'
 
-    def __init__(self, Y_dim, device):
+    def __init__(self, Y_dim, device, packed=True):
         super(DoubleGaussianNLL, self).__init__(Y_dim, device)
         self.tril_idx = torch.tril_indices(self.Y_dim, self.Y_dim, offset=0, device=device) # lower-triangular indices
         self.tril_len = len(self.tril_idx[0])
         self.out_dim = self.Y_dim**2 + 3*self.Y_dim + 1
+        self.packed = packed
+        self.packed_tril_ops = get_packed_tril_ops(self.Y_dim, device)
 
     def __call__(self, pred, target):
+        if self.packed:
+            return self.nll_mixture_packed(target, *self.slice(pred))
         return self.nll_mixture(target, *self.slice(pred))
 
     def slice(self, pred):
         d = self.Y_dim # for readability
-        return torch.split(pred, [d, self.tril_len, d, self.tril_len, 1], dim=1)
\ No newline at end of file
+        return torch.split(pred, [d, self.tril_len, d, self.tril_len, 1], dim=1)
+
+class MixtureGaussianNLL(BaseGaussianNLL):
+    """The negative log likelihood (NLL) for a mixture of `n_components` Gaussians with covariance matrices of the same family
+
+    The network predicts the parameters of each component, one component after the other, followed by the `n_components` logits of the mixture weights. The components are laid out as in `DiagonalGaussianNLL`, `LowRankGaussianNLL`, or `FullRankGaussianNLL`, depending on `cov_type`. All the components are evaluated in one batched call of the corresponding NLL, and combined with a `logsumexp` over the components.
+
+    See `BaseGaussianNLL.__init__` docstring for the parameter description. `n_components` is the number of Gaussians, `cov_type` one of `mixture_cov_types`, and `rank` the rank of the low-rank portion of the covariance matrices if `cov_type` is `low_rank`.
+
+    """
+    posterior_name = 'MixtureGaussianBNNPosterior'
+
+    def __init__(self, Y_dim, device, n_components=3, cov_type='full_rank', rank=2):
+        super(MixtureGaussianNLL, self).__init__(Y_dim, device)
+        d = self.Y_dim # for readability
+        if cov_type == 'diagonal':
+            self.component_split = [d, d]
+        elif cov_type == 'low_rank':
+            self.component_split = [d, d, rank*d]
+        elif cov_type == 'full_rank':
+            self.tril_idx = torch.tril_indices(self.Y_dim, self.Y_dim, offset=0, device=device) # lower-triangular indices
+            self.tril_len = len(self.tril_idx[0])
+            self.packed_tril_ops = get_packed_tril_ops(self.Y_dim, device)
+            self.component_split = [d, self.tril_len]
+        else:
+            raise ValueError("cov_type must be one of {:s}.".format(str(mixture_cov_types)))
+        self.n_components = n_components
+        self.cov_type = cov_type
+        self.rank = rank
+        self.component_dim = sum(self.component_split)
+        self.out_dim = n_components*(self.component_dim + 1)
+        self.posterior_kwargs = dict(n_components=n_components, cov_type=cov_type, rank=rank)
+
+    def __call__(self, pred, target):
+        return self.nll_mixture_components(target, *self.slice(pred))
+
+    def slice(self, pred):
+        """Slice the raw network prediction into the parameters of all the components, stacked along the batch dimension, and the logits of the weights
+
+        Returns
+        -------
+        tuple
+            the component parameters of shape `[batch_size*n_components, ...]`, ordered by example then component, followed by the logits of shape `[batch_size, n_components]`
+
+        """
+        K = self.n_components # for readability
+        components = pred[:, :K*self.component_dim].reshape(-1, self.component_dim)
+        return (*torch.split(components, self.component_split, dim=1), pred[:, K*self.component_dim:])
+
+    def nll_mixture_components(self, target, *args):
+        """Evaluate the NLL of the mixture from the sliced network prediction
+
+        Parameters
+        ----------
+        target : torch.Tensor of shape [batch_size, Y_dim]
+            Y labels
+        args : torch.Tensor
+            output of `slice`, i.e. the component parameters followed by the logits of the weights
+
+        Returns
+        -------
+        torch.Tensor
+            NLL averaged over the batch
+
+        """
+        *component_params, logits = args
+        batch_size, _ = target.shape
+        target = target.repeat_interleave(self.n_components, dim=0) # [batch_size*n_components, Y_dim]
+        if self.cov_type == 'diagonal':
+            nll = self.nll_diagonal(target, *component_params, reduce=False)
+        elif self.cov_type == 'low_rank':
+            nll = self.nll_low_rank(target, *component_params, reduce=False)
+        else:
+            nll = self.nll_full_rank_packed(target, *component_params, reduce=False)
+        log_weighted_ll = torch.log_softmax(logits, dim=1) - nll.reshape(batch_size, self.n_components)
+        log_nll = -torch.logsumexp(log_weighted_ll, dim=1)
+        return torch.mean(log_nll)
@@ -27,6 +27,7 @@ class BaseGaussianNLLNative(ABC):
         self.device = device
         self.sigmoid = torch.nn.Sigmoid()
         self.logsigmoid = torch.nn.LogSigmoid()
+        self.posterior_kwargs = {} # keyword arguments of the matching posterior class in `h0rton.h0_inference`, besides `Y_dim`
 
     @abstractmethod
     def slice(self, pred):
@@ -102,10 +103,8 @@ class BaseGaussianNLLNative(ABC):
             NLL values
 
         """
-        # 1/(Y_dim - 1) * (sq_mahalanobis + log(det of \Sigma))
-        batch_size, _ = target.shape # self.Y_dim = Y_dim - 1
-        rank = 2 # FIXME: hardcoded for rank 2
-        F = F.reshape([batch_size, self.Y_dim, rank]) 
+        batch_size, _ = target.shape
+        F = F.reshape([batch_size, self.Y_dim, self.rank])
         lr_mvn = LowRankMultivariateNormal(loc=mu, cov_factor=F, cov_diag=torch.exp(logvar))
         loss = -lr_mvn.log_prob(target)
 
@@ -244,21 +243,23 @@ class DiagonalGaussianNLLNative(BaseGaussianNLLNative):
 class LowRankGaussianNLLNative(BaseGaussianNLLNative):
     """The negative log likelihood (NLLNative) for a single Gaussian with a full but constrained as low-rank plus diagonal covariance matrix
         
-    Only rank 2 is currently supported. `BaseGaussianNLLNative.__init__` docstring for the parameter description.
+    See `BaseGaussianNLLNative.__init__` docstring for the parameter description. `rank` is the rank of the low-rank portion of the covariance matrix.
 
     """
     posterior_name = 'LowRankGaussianBNNPosterior'
 
-    def __init__(self, Y_dim, device):
+    def __init__(self, Y_dim, device, rank=2):
         super(LowRankGaussianNLLNative, self).__init__(Y_dim, device)
-        self.out_dim = Y_dim*4
+        self.rank = rank
+        self.posterior_kwargs = dict(rank=rank)
+        self.out_dim = Y_dim*(2 + rank)
 
     def __call__(self, pred, target):
         return self.nll_low_rank(target, *self.slice(pred), reduce=True)
 
     def slice(self, pred):
         d = self.Y_dim # for readability
-        return torch.split(pred, [d, d, 2*d], dim=1)
+        return torch.split(pred, [d, d, self.rank*d], dim=1)
 
 class FullRankGaussianNLLNative(BaseGaussianNLLNative):
     """The negative log likelihood (NLLNative) for a single Gaussian with a full-rank covariance matrix
@@ -284,14 +285,16 @@ class FullRankGaussianNLLNative(BaseGaussianNLLNative):
 class DoubleLowRankGaussianNLLNative(BaseGaussianNLLNative):
     """The negative log likelihood (NLLNative) for a mixture of two Gaussians, each with a full but constrained as low-rank plus diagonal covariance 
         
-    Only rank 2 is currently supported. `BaseGaussianNLLNative.__init__` docstring for the parameter description.
+    See `BaseGaussianNLLNative.__init__` docstring for the parameter description. `rank` is the rank of the low-rank portion of each covariance matrix.
 
     """
     posterior_name = 'DoubleLowRankGaussianBNNPosterior'
 
-    def __init__(self, Y_dim, device):
+    def __init__(self, Y_dim, device, rank=2):
         super(DoubleLowRankGaussianNLLNative, self).__init__(Y_dim, device)
-        self.out_dim = Y_dim*8 + 1
+        self.rank = rank
+        self.posterior_kwargs = dict(rank=rank)
+        self.out_dim = 2*Y_dim*(2 + rank) + 1
 
     def __call__(self, pred, target):
         return self.nll_mixture_low_rank(target, *self.slice(pred))
@@ -299,7 +302,7 @@ class DoubleLowRankGaussianNLLNative(BaseGaussianNLLNative):
     def slice(self, pred):
         d = self.Y_dim # for readability
         #mu, logvar, F, mu2, logvar2, F2, alpha
-        return torch.split(pred, [d, d, 2*d, d, d, 2*d, 1], dim=1)
+        return torch.split(pred, [d, d, self.rank*d, d, d, self.rank*d, 1], dim=1)
 
 class DoubleGaussianNLLNative(BaseGaussianNLLNative):
     """The negative log likelihood (NLLNative) for a mixture of two Gaussians, each with a full but constrained as low-rank plus diagonal covariance 
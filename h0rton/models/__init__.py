@@ -1 +1,7 @@
-from .bayesian_resnet import *
\ No newline at end of file
+from .bayesian_resnet import *
+from .bayesian_mobilenet import *
+from .model_card import *
+from .inference_artifact import *
+from .graph_export import *
+from .quantization import *
+from .pruning import *
\ No newline at end of file
@@ -0,0 +1,137 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+__all__ = ['mobilenet_v2', 'mobilenet_v2_half']
+
+class BayesianInvertedResidual(nn.Module):
+    """Inverted residual block of MobileNetV2 with MC dropout before each convolution
+
+    The block expands the channels with a pointwise convolution, filters them with a depthwise convolution, and projects them back down with another pointwise convolution.
+
+    """
+    # Convolutions and the batchnorm layers that immediately follow them
+    conv_bn_pairs = [('conv_expand', 'bn_expand'), ('conv_dw', 'bn_dw'), ('conv_project', 'bn_project')]
+
+    def __init__(self, inplanes, planes, stride, expand_ratio, dropout_rate=0.0):
+        """
+        Parameters
+        ----------
+        inplanes : int
+            number of input filters
+        planes : int
+            number of output filters
+        stride : int
+            stride of the depthwise convolution
+        expand_ratio : int
+            factor by which the pointwise expansion multiplies the number of filters
+        dropout_rate : float
+            MC dropout rate
+
+        """
+        super(BayesianInvertedResidual, self).__init__()
+        hidden_dim = inplanes*expand_ratio
+        self.dropout_rate = dropout_rate
+        self.use_res_connect = (stride == 1 and inplanes == planes)
+        self.conv_expand = nn.Conv2d(inplanes, hidden_dim, kernel_size=1, bias=False)
+        self.bn_expand = nn.BatchNorm2d(hidden_dim)
+        self.conv_dw = nn.Conv2d(hidden_dim, hidden_dim, kernel_size=3, stride=stride, padding=1, groups=hidden_dim, bias=False)
+        self.bn_dw = nn.BatchNorm2d(hidden_dim)
+        self.conv_project = nn.Conv2d(hidden_dim, planes, kernel_size=1, bias=False)
+        self.bn_project = nn.BatchNorm2d(planes)
+        self.relu = nn.ReLU6(inplace=True)
+
+    def forward(self, x):
+        out = F.dropout(x, p=self.dropout_rate)
+        out = self.relu(self.bn_expand(self.conv_expand(out)))
+        out = F.dropout(out, p=self.dropout_rate)
+        out = self.relu(self.bn_dw(self.conv_dw(out)))
+        out = F.dropout(out, p=self.dropout_rate)
+        out = self.bn_project(self.conv_project(out))
+        if self.use_res_connect:
+            out = out + x
+        return out
+
+class BayesianMobileNet(nn.Module):
+    """MobileNetV2-style BNN built from depthwise-separable convolutions
+
+    Like `BayesianResNet`, dropout is applied with `F.dropout` so that it stays active at evaluation time.
+
+    """
+    # Convolutions and the batchnorm layers that immediately follow them
+    conv_bn_pairs = [('conv1', 'bn1'), ('conv_last', 'bn_last')]
+    # (expand_ratio, planes, n_blocks, stride) for each stage, as in MobileNetV2 but with fewer channels in the last stages
+    default_setting = [[1, 16, 1, 1],
+                       [6, 24, 2, 2],
+                       [6, 32, 3, 2],
+                       [6, 64, 4, 2],
+                       [6, 96, 3, 1],
+                       [6, 160, 3, 2],]
+
+    def __init__(self, num_classes=1000, dropout_rate=0.0, width_mult=1.0, inverted_residual_setting=None, last_channel=512):
+        """
+        Parameters
+        ----------
+        num_classes : int
+            output dimension
+        dropout_rate : float
+            MC dropout rate
+        width_mult : float
+            factor by which to multiply the number of filters in every layer
+        inverted_residual_setting : list
+            `[expand_ratio, planes, n_blocks, stride]` for each stage. Default: `default_setting`
+        last_channel : int
+            number of filters of the last pointwise convolution, before multiplying by `width_mult`
+
+        """
+        super(BayesianMobileNet, self).__init__()
+        self.dropout_rate = dropout_rate
+        if inverted_residual_setting is None:
+            inverted_residual_setting = self.default_setting
+        inplanes = int(32*width_mult)
+        self.last_channel = int(last_channel*width_mult)
+        self.conv1 = nn.Conv2d(1, inplanes, kernel_size=3, stride=2, padding=1, bias=False)
+        self.bn1 = nn.BatchNorm2d(inplanes)
+        self.relu = nn.ReLU6(inplace=True)
+        blocks = []
+        for expand_ratio, planes, n_blocks, stride in inverted_residual_setting:
+            planes = int(planes*width_mult)
+            for i in range(n_blocks):
+                blocks.append(BayesianInvertedResidual(inplanes, planes, stride if i == 0 else 1, expand_ratio, dropout_rate=dropout_rate))
+                inplanes = planes
+        self.blocks = nn.Sequential(*blocks)
+        self.conv_last = nn.Conv2d(inplanes, self.last_channel, kernel_size=1, bias=False)
+        self.bn_last = nn.BatchNorm2d(self.last_channel)
+        self.avgpool = nn.AdaptiveAvgPool2d((1, 1))
+        self.fc = nn.Linear(self.last_channel, num_classes)
+        for m in self.modules():
+            if isinstance(m, nn.Conv2d):
+                nn.init.kaiming_normal_(m.weight, mode='fan_out', nonlinearity='relu')
+            elif isinstance(m, nn.BatchNorm2d):
+                nn.init.constant_(m.weight, 1)
+                nn.init.constant_(m.bias, 0)
+
+    def forward(self, x):
+        x = F.dropout(x, p=self.dropout_rate) # F not NN b/c activated during eval
+        x = self.relu(self.bn1(self.conv1(x)))
+        x = self.blocks(x)
+        x = F.dropout(x, p=self.dropout_rate)
+        x = self.relu(self.bn_last(self.conv_last(x)))
+        x = self.avgpool(x)
+        x = torch.flatten(x, 1)
+        x = F.dropout(x, p=self.dropout_rate)
+        x = self.fc(x)
+        return x
+
+def mobilenet_v2(**kwargs):
+    """MobileNetV2-style BNN from
+    `"MobileNetV2: Inverted Residuals and Linear Bottlenecks" <https://arxiv.org/abs/1801.04381>`_
+
+    """
+    return BayesianMobileNet(**kwargs)
+
+def mobilenet_v2_half(**kwargs):
+    """MobileNetV2-style BNN with half the number of filters in every layer
+
+    """
+    return BayesianMobileNet(width_mult=0.5, **kwargs)
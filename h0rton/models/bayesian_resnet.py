@@ -4,7 +4,7 @@ from torchvision.models.resnet import conv1x1, BasicBlock
 import torch.nn as nn
 import torch.nn.functional as F
 
-__all__ = ['resnet34', 'resnet44', 'resnet50', 'resnet56', 'resnet101']
+__all__ = ['resnet18', 'resnet18_half', 'resnet34', 'resnet34_half', 'resnet44', 'resnet50', 'resnet56', 'resnet101']
 
 
 
@@ -12,6 +12,9 @@ class BayesianBasicBlock(BasicBlock):
     """Basic block of ResNet BNN with architectural modifications from the torchvision implementation
 
     """
+    # Convolutions and the batchnorm layers that immediately follow them
+    conv_bn_pairs = [('conv1', 'bn1'), ('conv2', 'bn2'), ('downsample.0', 'downsample.1')]
+
     def __init__(self, inplanes, planes, stride=1, downsample=None, groups=1,
                  base_width=64, dilation=1, norm_layer=None, dropout_rate=0.0):
         super(BayesianBasicBlock, self).__init__(inplanes, planes, stride, downsample, groups,
@@ -40,22 +43,42 @@ class BayesianResNet(models.ResNet):
     """ResNet BNN with architectural modifications from the torchvision implementation
 
     """
+    # Convolutions and the batchnorm layers that immediately follow them
+    conv_bn_pairs = [('conv1', 'bn1')]
+
     def __init__(self, block, layers, num_classes=1000, zero_init_residual=False,
                  groups=1, width_per_group=64, replace_stride_with_dilation=None,
-                 norm_layer=None, dropout_rate=0.0):
+                 norm_layer=None, dropout_rate=0.0, width_mult=1.0):
         self.dropout_rate = dropout_rate
         self.inplanes = 64
         super(BayesianResNet, self).__init__(block, layers, num_classes, zero_init_residual,
                  groups, width_per_group, replace_stride_with_dilation,
                  norm_layer)
+        self.width_mult = width_mult
+        widths = [int(64*width_mult*2**i) for i in range(4)]
+        if width_mult != 1.0:
+            # Rebuild the layers with reduced number of filters
+            self.inplanes = widths[0]
+            self.dilation = 1
+            self.bn1 = self._norm_layer(widths[0])
+            dilate = [False, False, False] if replace_stride_with_dilation is None else replace_stride_with_dilation
+            self.layer1 = self._make_layer(block, widths[0], layers[0])
+            self.layer2 = self._make_layer(block, widths[1], layers[1], stride=2, dilate=dilate[0])
+            self.layer3 = self._make_layer(block, widths[2], layers[2], stride=2, dilate=dilate[1])
+            self.layer4 = self._make_layer(block, widths[3], layers[3], stride=2, dilate=dilate[2])
+            for m in self.modules():
+                if isinstance(m, nn.Conv2d):
+                    nn.init.kaiming_normal_(m.weight, mode='fan_out', nonlinearity='relu')
         # Override first conv layer 
-        self.conv1 = nn.Conv2d(1, 64, kernel_size=7, stride=2, padding=3, bias=False)
+        self.conv1 = nn.Conv2d(1, widths[0], kernel_size=7, stride=2, padding=3, bias=False)
         self.include_layer4 = False if layers[-1] == 1 else True
         # If removing layer4, number of filters in FC should be 256, not 512
         if self.include_layer4:
+            if width_mult != 1.0:
+                self.fc = nn.Linear(widths[3] * block.expansion, num_classes)
             self._forward_impl = self._forward_impl_4layer
         else:
-            self.fc = nn.Linear(256 * block.expansion, num_classes)
+            self.fc = nn.Linear(widths[2] * block.expansion, num_classes)
             self._forward_impl = self._forward_impl_3layer
 
     def _make_layer(self, block, planes, blocks, stride=1, dilate=False):
@@ -159,6 +182,25 @@ def _resnet(arch, block, layers, progress, **kwargs):
     model = BayesianResNet(block, layers, **kwargs)
     return model
 
+def resnet18(progress=True, **kwargs):
+    r"""ResNet-18 model from
+    `"Deep Residual Learning for Image Recognition" <https://arxiv.org/pdf/1512.03385.pdf>`_
+
+    Args:
+        progress (bool): If True, displays a progress bar of the download to stderr
+    """
+    return _resnet('resnet18', BayesianBasicBlock, [2, 2, 2, 2], progress,
+                   **kwargs)
+
+def resnet18_half(progress=True, **kwargs):
+    r"""ResNet-18 model with half the number of filters in every layer
+
+    Args:
+        progress (bool): If True, displays a progress bar of the download to stderr
+    """
+    return _resnet('resnet18_half', BayesianBasicBlock, [2, 2, 2, 2], progress,
+                   width_mult=0.5, **kwargs)
+
 def resnet34(progress=True, **kwargs):
     r"""ResNet-34 model from
     `"Deep Residual Learning for Image Recognition" <https://arxiv.org/pdf/1512.03385.pdf>`_
@@ -170,6 +212,15 @@ def resnet34(progress=True, **kwargs):
     return _resnet('resnet34', BayesianBasicBlock, [3, 4, 6, 3], progress,
                    **kwargs)
 
+def resnet34_half(progress=True, **kwargs):
+    r"""ResNet-34 model with half the number of filters in every layer
+
+    Args:
+        progress (bool): If True, displays a progress bar of the download to stderr
+    """
+    return _resnet('resnet34_half', BayesianBasicBlock, [3, 4, 6, 3], progress,
+                   width_mult=0.5, **kwargs)
+
 def resnet50(progress=True, **kwargs):
     r"""ResNet-50 model from
     `"Deep Residual Learning for Image Recognition" <https://arxiv.org/pdf/1512.03385.pdf>`_
@@ -0,0 +1,173 @@
+"""Export of the BNN to ONNX and TorchScript for serving outside the training environment
+
+MC dropout runs with `net.eval()`, so batchnorm is folded into the preceding convolutions before export while the dropout ops are kept in the graph in training mode. Every call of the exported graph is then one stochastic MC dropout pass, as with the PyTorch model. ONNX Runtime is only needed to run the ONNX graph and is imported when an ONNX graph is loaded.
+
+"""
+import copy
+import json
+import warnings
+import numpy as np
+import torch
+from h0rton.models.inference_artifact import fold_batchnorm, parse_inference_metadata
+
+__all__ = ['export_torchscript', 'export_onnx', 'ExportedBNN']
+
+def _prepare_for_export(net, fold_bn):
+    """Copy the network to the CPU in eval mode, optionally with batchnorm folded
+
+    """
+    net = copy.deepcopy(net).cpu().eval()
+    if fold_bn:
+        fold_batchnorm(net)
+    return net
+
+def export_torchscript(net, path, X_dim, fold_bn=True, metadata=None):
+    """Trace the BNN into a TorchScript graph whose dropout ops stay stochastic
+
+    Parameters
+    ----------
+    net : BayesianResNet or BayesianMobileNet
+        trained network. Not modified.
+    path : str or os.path object
+        destination, conventionally with the `.pt` extension
+    X_dim : int
+        number of pixels on each side of the input image
+    fold_bn : bool
+        whether to fold the batchnorm layers into the convolutions
+    metadata : dict
+        output of `get_inference_metadata`, stored alongside the graph
+
+    """
+    net = _prepare_for_export(net, fold_bn)
+    example_X = torch.zeros(2, 1, X_dim, X_dim)
+    with torch.no_grad(), warnings.catch_warnings():
+        # The tracer warns that the dropout nodes are nondeterministic, which is the point
+        warnings.simplefilter('ignore')
+        traced = torch.jit.trace(net, example_X, check_trace=False)
+    extra_files = {'metadata.json': json.dumps(metadata if metadata is not None else {})}
+    torch.jit.save(traced, path, _extra_files=extra_files)
+
+def export_onnx(net, path, X_dim, fold_bn=True, metadata=None, opset_version=17):
+    """Export the BNN to an ONNX graph whose dropout ops stay stochastic
+
+    The dropout calls in the h0rton architectures are always in training mode, so they are exported as `Dropout` nodes with `training_mode=True` even though the rest of the graph is exported in eval mode. The batch dimension is dynamic.
+
+    Parameters
+    ----------
+    net : BayesianResNet or BayesianMobileNet
+        trained network. Not modified.
+    path : str or os.path object
+        destination, conventionally with the `.onnx` extension
+    X_dim : int
+        number of pixels on each side of the input image
+    fold_bn : bool
+        whether to fold the batchnorm layers into the convolutions
+    metadata : dict
+        output of `get_inference_metadata`, stored in the model metadata
+    opset_version : int
+        ONNX opset. Must be at least 12, the first with a training-mode `Dropout`.
+
+    """
+    import onnx
+    if opset_version < 12:
+        raise ValueError("opset_version must be at least 12 to keep dropout active at inference time.")
+    net = _prepare_for_export(net, fold_bn)
+    example_X = torch.zeros(2, 1, X_dim, X_dim)
+    with torch.no_grad(), warnings.catch_warnings():
+        # The exporter warns that the dropout ops are exported in training mode, which is the point
+        warnings.simplefilter('ignore')
+        torch.onnx.export(net, (example_X,), path,
+                          input_names=['X'],
+                          output_names=['pred'],
+                          dynamic_axes={'X': {0: 'batch_size'}, 'pred': {0: 'batch_size'}},
+                          opset_version=opset_version,
+                          training=torch.onnx.TrainingMode.EVAL,
+                          dynamo=False)
+    if metadata is not None:
+        model = onnx.load(path)
+        onnx.helper.set_model_props(model, metadata)
+        onnx.save(model, path)
+
+class ExportedBNN:
+    """Runner for a BNN exported by `export_onnx` or `export_torchscript`
+
+    The format is inferred from the extension: `.onnx` for ONNX, anything else for TorchScript.
+
+    """
+    def __init__(self, path, batch_size=None, n_threads=None):
+        """
+        Parameters
+        ----------
+        path : str or os.path object
+            path to the exported graph
+        batch_size : int
+            maximum number of images per forward pass. Default: all lenses at once
+        n_threads : int
+            number of intra-op CPU threads. Default: the runtime default
+
+        """
+        self.path = str(path)
+        self.batch_size = batch_size
+        self.is_onnx = self.path.endswith('.onnx')
+        if self.is_onnx:
+            import onnxruntime
+            options = onnxruntime.SessionOptions()
+            if n_threads is not None:
+                options.intra_op_num_threads = n_threads
+            self.session = onnxruntime.InferenceSession(self.path, options, providers=['CPUExecutionProvider'])
+            raw_metadata = self.session.get_modelmeta().custom_metadata_map
+        else:
+            if n_threads is not None:
+                torch.set_num_threads(n_threads)
+            extra_files = {'metadata.json': ''}
+            self.module = torch.jit.load(self.path, map_location=torch.device('cpu'), _extra_files=extra_files)
+            raw_metadata = json.loads(extra_files['metadata.json'] or '{}')
+        # Decoded metadata of the trained network, if it was exported with it
+        self.metadata = parse_inference_metadata(dict(raw_metadata)) if raw_metadata else {}
+
+    def forward(self, X):
+        """Run one stochastic MC dropout pass
+
+        Parameters
+        ----------
+        X : np.array or torch.Tensor of shape `[n_lenses, n_filters, X_dim, X_dim]`
+            input images
+
+        Returns
+        -------
+        np.array of shape `[n_lenses, out_dim]`
+            raw network outputs
+
+        """
+        X = X.detach().cpu().numpy() if isinstance(X, torch.Tensor) else np.asarray(X)
+        X = X.astype(np.float32, copy=False)
+        batch_size = X.shape[0] if self.batch_size is None else self.batch_size
+        pred = []
+        for start in range(0, X.shape[0], batch_size):
+            X_batch = X[start:start + batch_size]
+            if self.is_onnx:
+                pred.append(self.session.run(None, {'X': X_batch})[0])
+            else:
+                with torch.no_grad():
+                    pred.append(self.module(torch.from_numpy(X_batch)).numpy())
+        return np.concatenate(pred, axis=0)
+
+    __call__ = forward
+
+    def get_mc_dropout_preds(self, X, n_dropout):
+        """Get a fixed number of MC dropout predictions for every lens, as `h0rton.h0_inference.mc_dropout_utils.get_mc_dropout_preds` does with the PyTorch model
+
+        Parameters
+        ----------
+        X : np.array or torch.Tensor of shape `[n_lenses, n_filters, X_dim, X_dim]`
+            input images
+        n_dropout : int
+            number of MC dropout passes
+
+        Returns
+        -------
+        np.array of shape `[n_lenses, n_dropout, out_dim]`
+            raw network outputs for each pass
+
+        """
+        return np.stack([self.forward(X) for d in range(n_dropout)], axis=1)
@@ -0,0 +1,253 @@
+"""Inference-only model artifacts
+
+The artifact is a single file in the safetensors layout: an 8-byte little-endian header length, a JSON header describing each tensor and carrying string-valued `__metadata__`, then the raw tensor bytes. The tensor bytes are memory-mapped on load and handed to the network without a copy, so short-lived inference jobs don't pay for unpickling the optimizer and scheduler state of a full training checkpoint.
+
+"""
+import json
+import struct
+import numpy as np
+import torch
+import torch.nn as nn
+import h0rton.models
+import h0rton.losses
+from h0rton.models.pruning import resize_to_state_dict
+
+__all__ = ['fold_batchnorm', 'save_tensors', 'load_tensors', 'get_inference_metadata', 'parse_inference_metadata', 'save_inference_artifact', 'load_inference_artifact']
+
+# safetensors dtype codes
+np_to_dtype_code = {np.dtype('float64'): 'F64', np.dtype('float32'): 'F32', np.dtype('float16'): 'F16', np.dtype('int64'): 'I64', np.dtype('int32'): 'I32', np.dtype('int16'): 'I16', np.dtype('int8'): 'I8', np.dtype('uint8'): 'U8', np.dtype('bool'): 'BOOL'}
+dtype_code_to_np = {v: k for k, v in np_to_dtype_code.items()}
+
+def _fold_conv_bn(conv, bn):
+    """Fold an eval-mode batchnorm layer into the preceding convolution, in place
+
+    """
+    scale = bn.weight.detach()/torch.sqrt(bn.running_var + bn.eps) # [out_channels,]
+    bias = bn.bias.detach() - bn.running_mean*scale
+    if conv.bias is not None:
+        bias = bias + conv.bias.detach()*scale
+    conv.weight = nn.Parameter(conv.weight.detach()*scale.reshape(-1, 1, 1, 1))
+    conv.bias = nn.Parameter(bias)
+
+def fold_batchnorm(net):
+    """Fold every batchnorm layer of a BNN into the convolution preceding it
+
+    Each module lists its (convolution, batchnorm) pairs in its `conv_bn_pairs` attribute. In the h0rton architectures, dropout is applied before each convolution, never between a convolution and its batchnorm, so the folded network gives identical outputs for identical dropout masks. The running statistics at the time of folding are baked in, so batchnorm can no longer be adapted to the test data afterwards.
+
+    Parameters
+    ----------
+    net : BayesianResNet or BayesianMobileNet
+
+    Returns
+    -------
+    BayesianResNet or BayesianMobileNet
+        the same network, modified in place, with batchnorm layers replaced by `nn.Identity`
+
+    """
+    def _get_submodule(module, name):
+        for attr in name.split('.'):
+            if module is None:
+                return None
+            module = getattr(module, attr)
+        return module
+
+    with torch.no_grad():
+        for module in list(net.modules()):
+            for conv_name, bn_name in getattr(module, 'conv_bn_pairs', []):
+                conv = _get_submodule(module, conv_name)
+                bn = _get_submodule(module, bn_name)
+                if isinstance(bn, nn.BatchNorm2d):
+                    _fold_conv_bn(conv, bn)
+                    bn_parent_name, _, bn_attr = bn_name.rpartition('.')
+                    setattr(_get_submodule(module, bn_parent_name) if bn_parent_name else module, bn_attr, nn.Identity())
+    return net
+
+def save_tensors(path, tensors, metadata=None):
+    """Write tensors to a single file in the safetensors layout
+
+    Parameters
+    ----------
+    path : str or os.path object
+    tensors : dict
+        maps names to `torch.Tensor` or `np.array`
+    metadata : dict
+        maps str keys to str values, stored under `__metadata__`
+
+    """
+    header = {}
+    buffers = []
+    offset = 0
+    for name, tensor in tensors.items():
+        if isinstance(tensor, torch.Tensor):
+            tensor = tensor.detach().cpu().numpy()
+        array = np.ascontiguousarray(tensor)
+        buffer = array.astype(array.dtype.newbyteorder('<'), copy=False).tobytes()
+        header[name] = dict(dtype=np_to_dtype_code[array.dtype], shape=list(array.shape), data_offsets=[offset, offset + len(buffer)])
+        buffers.append(buffer)
+        offset += len(buffer)
+    if metadata is not None:
+        header['__metadata__'] = metadata
+    header_bytes = json.dumps(header).encode('utf-8')
+    # Pad with spaces so that the tensor data is 8-byte aligned
+    header_bytes += b' '*(-len(header_bytes) % 8)
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<Q', len(header_bytes)))
+        f.write(header_bytes)
+        for buffer in buffers:
+            f.write(buffer)
+
+def load_tensors(path):
+    """Memory-map the tensors in a file written in the safetensors layout
+
+    Parameters
+    ----------
+    path : str or os.path object
+
+    Returns
+    -------
+    tensors : dict
+        maps names to CPU `torch.Tensor` objects backed by the file (copy-on-write)
+    metadata : dict
+        the `__metadata__` entry of the header
+
+    """
+    with open(path, 'rb') as f:
+        header_len = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_len).decode('utf-8'))
+    metadata = header.pop('__metadata__', {})
+    tensors = {}
+    if len(header) == 0:
+        return tensors, metadata
+    data = np.memmap(path, dtype=np.uint8, mode='c', offset=8 + header_len)
+    for name, info in header.items():
+        start, end = info['data_offsets']
+        array = data[start:end].view(dtype_code_to_np[info['dtype']]).reshape(info['shape'])
+        tensors[name] = torch.from_numpy(array)
+    return tensors, metadata
+
+def get_inference_metadata(net, architecture, dropout_rate, likelihood_class, Y_cols, Y_mean, Y_std, likelihood_kwargs={}):
+    """Collect everything needed to rebuild a network and interpret its output, as str values
+
+    Parameters
+    ----------
+    net : BayesianResNet
+        trained network
+    architecture : str
+        name of the function in `h0rton.models` that builds the network
+    dropout_rate : float
+        MC dropout rate used in training
+    likelihood_class : str
+        name of the likelihood class in `h0rton.losses` used in training
+    Y_cols : list of str
+        names of the predicted parameters
+    Y_mean : np.array of shape `[Y_dim,]`
+        training-set mean used for whitening
+    Y_std : np.array of shape `[Y_dim,]`
+        training-set std used for whitening
+    likelihood_kwargs : dict
+        keyword arguments of the likelihood class besides `Y_dim` and `device`, e.g. `n_components` for `MixtureGaussianNLL`
+
+    Returns
+    -------
+    dict
+        maps str keys to str (JSON-encoded, except for the names) values
+
+    """
+    # The posterior needs the same settings as the loss to slice the network output
+    loss_fn = getattr(h0rton.losses, likelihood_class)(Y_dim=len(Y_cols), device=torch.device('cpu'), **likelihood_kwargs)
+    metadata = dict(
+                    architecture=architecture,
+                    dropout_rate=json.dumps(dropout_rate),
+                    likelihood_class=likelihood_class,
+                    num_classes=json.dumps(net.fc.out_features),
+                    Y_cols=json.dumps(list(Y_cols)),
+                    Y_mean=json.dumps(np.asarray(Y_mean, dtype=float).reshape(-1).tolist()),
+                    Y_std=json.dumps(np.asarray(Y_std, dtype=float).reshape(-1).tolist()),
+                    likelihood_kwargs=json.dumps(dict(likelihood_kwargs)),
+                    posterior_kwargs=json.dumps(loss_fn.posterior_kwargs),
+                    )
+    return metadata
+
+def parse_inference_metadata(raw_metadata):
+    """Decode the str values written by `get_inference_metadata`
+
+    Parameters
+    ----------
+    raw_metadata : dict
+        maps str keys to str values
+
+    Returns
+    -------
+    dict
+        the decoded metadata, with `Y_mean` and `Y_std` as np.array
+
+    """
+    metadata = {k: (v if k in ['architecture', 'likelihood_class'] else json.loads(v)) for k, v in raw_metadata.items()}
+    # Artifacts written before the likelihood settings were stored used the defaults
+    metadata.setdefault('likelihood_kwargs', {})
+    metadata.setdefault('posterior_kwargs', {})
+    metadata['Y_mean'] = np.array(metadata['Y_mean'])
+    metadata['Y_std'] = np.array(metadata['Y_std'])
+    return metadata
+
+def save_inference_artifact(path, net, architecture, dropout_rate, likelihood_class, Y_cols, Y_mean, Y_std, likelihood_kwargs={}, fold_bn=False):
+    """Save an inference-only artifact holding the trained weights and everything needed to interpret the network output
+
+    Parameters
+    ----------
+    path : str or os.path object
+        destination, conventionally with the `.safetensors` extension
+    net : BayesianResNet
+        trained network
+    architecture : str
+        name of the function in `h0rton.models` that builds the network
+    dropout_rate : float
+        MC dropout rate used in training
+    likelihood_class : str
+        name of the likelihood class in `h0rton.losses` used in training
+    Y_cols : list of str
+        names of the predicted parameters
+    Y_mean : np.array of shape `[Y_dim,]`
+        training-set mean used for whitening
+    Y_std : np.array of shape `[Y_dim,]`
+        training-set std used for whitening
+    likelihood_kwargs : dict
+        keyword arguments of the likelihood class besides `Y_dim` and `device`
+    fold_bn : bool
+        whether to fold the batchnorm layers into the convolutions. Modifies `net` in place.
+
+    """
+    if fold_bn:
+        fold_batchnorm(net)
+    metadata = get_inference_metadata(net, architecture, dropout_rate, likelihood_class, Y_cols, Y_mean, Y_std, likelihood_kwargs)
+    metadata['fold_bn'] = json.dumps(fold_bn)
+    save_tensors(path, net.state_dict(), metadata)
+
+def load_inference_artifact(path, device=torch.device('cpu')):
+    """Build a network directly from an inference-only artifact
+
+    Parameters
+    ----------
+    path : str or os.path object
+        path to an artifact written by `save_inference_artifact`
+    device : torch.device object
+        device on which to place the network
+
+    Returns
+    -------
+    net : BayesianResNet
+        network with the stored weights
+    metadata : dict
+        contains `architecture`, `dropout_rate`, `likelihood_class`, `num_classes`, `Y_cols`, `Y_mean`, `Y_std`, `likelihood_kwargs`, `posterior_kwargs`, and `fold_bn`
+
+    """
+    state_dict, raw_metadata = load_tensors(path)
+    metadata = parse_inference_metadata(raw_metadata)
+    net = getattr(h0rton.models, metadata['architecture'])(num_classes=metadata['num_classes'], dropout_rate=metadata['dropout_rate'])
+    if metadata['fold_bn']:
+        fold_batchnorm(net)
+    resize_to_state_dict(net, state_dict) # in case the channels were pruned
+    # Assign the memory-mapped tensors rather than copying them into freshly allocated parameters
+    net.load_state_dict(state_dict, assign=True)
+    net.to(device)
+    return net, metadata
@@ -0,0 +1,117 @@
+"""Cost summaries of the BNN architectures, for choosing one within an inference budget
+
+"""
+import time
+import torch
+import torch.nn as nn
+
+__all__ = ['count_parameters', 'count_flops', 'measure_latency', 'get_model_card']
+
+def count_parameters(net):
+    """Count the trainable parameters of a network
+
+    Parameters
+    ----------
+    net : torch.nn.Module
+
+    Returns
+    -------
+    int
+
+    """
+    return sum(p.numel() for p in net.parameters() if p.requires_grad)
+
+def count_flops(net, X_shape):
+    """Count the floating-point operations of the convolutions and fully-connected layers in one forward pass of a single image
+
+    A multiply-accumulate counts as two operations. Batchnorm, activations, pooling, and dropout are comparatively cheap and not counted.
+
+    Parameters
+    ----------
+    net : torch.nn.Module
+    X_shape : tuple
+        shape of a single input image, e.g. `(1, 64, 64)`
+
+    Returns
+    -------
+    int
+
+    """
+    flops = []
+
+    def _conv_hook(module, inp, out):
+        # Each output element takes (in_channels/groups)*kernel_size MACs
+        kernel_macs = module.in_channels//module.groups*module.kernel_size[0]*module.kernel_size[1]
+        flops.append(2*kernel_macs*out[0].numel())
+
+    def _linear_hook(module, inp, out):
+        flops.append(2*module.in_features*module.out_features)
+
+    handles = []
+    for module in net.modules():
+        if isinstance(module, nn.Conv2d):
+            handles.append(module.register_forward_hook(_conv_hook))
+        elif isinstance(module, nn.Linear):
+            handles.append(module.register_forward_hook(_linear_hook))
+    with torch.no_grad():
+        net(torch.zeros(1, *X_shape))
+    for handle in handles:
+        handle.remove()
+    return sum(flops)
+
+def measure_latency(net, X, n_repeats=10, n_warmup=2):
+    """Measure the wall-clock time of a forward pass
+
+    Parameters
+    ----------
+    net : torch.nn.Module
+    X : torch.Tensor
+        input batch
+    n_repeats : int
+        number of timed passes
+    n_warmup : int
+        number of untimed passes run first
+
+    Returns
+    -------
+    float
+        median time per forward pass, in seconds
+
+    """
+    times = []
+    with torch.no_grad():
+        for i in range(n_warmup + n_repeats):
+            start = time.perf_counter()
+            net(X)
+            if i >= n_warmup:
+                times.append(time.perf_counter() - start)
+    return sorted(times)[len(times)//2]
+
+def get_model_card(net, X_dim, batch_sizes=[1, 8, 32], n_repeats=10):
+    """Report the parameter count, FLOPs, and CPU latency of a network
+
+    Parameters
+    ----------
+    net : torch.nn.Module
+        network with a single-filter input, e.g. built from `h0rton.models` with the configured `num_classes`
+    X_dim : int
+        number of pixels on each side of the input image
+    batch_sizes : list of int
+        batch sizes at which to measure the latency
+    n_repeats : int
+        number of timed passes per batch size
+
+    Returns
+    -------
+    list of dict
+        one entry per batch size, with the keys `batch_size`, `n_params`, `flops_per_image`, `latency`, and `latency_per_image` (in seconds)
+
+    """
+    net = net.cpu().eval()
+    n_params = count_parameters(net)
+    flops = count_flops(net, (1, X_dim, X_dim))
+    card = []
+    for batch_size in batch_sizes:
+        latency = measure_latency(net, torch.randn(batch_size, 1, X_dim, X_dim), n_repeats=n_repeats)
+        card.append(dict(batch_size=batch_size, n_params=n_params, flops_per_image=flops, latency=latency, latency_per_image=latency/batch_size))
+    return card
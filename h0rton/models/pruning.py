@@ -0,0 +1,219 @@
+"""Structured channel pruning of `BayesianResNet`
+
+Channels are removed between the two convolutions of each `BayesianBasicBlock`, i.e. from the output of `conv1` and the input of `conv2`. The block input and output widths are tied by the residual connections and are left alone. Pruned layers are physically replaced by smaller ones, so the pruned network is cheaper to run and its state dict is smaller.
+
+"""
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from h0rton.models.bayesian_resnet import BayesianBasicBlock
+
+__all__ = ['get_l1_importance', 'get_taylor_importance', 'prune_block_channels', 'prune_channels', 'get_block_widths', 'resize_to_state_dict', 'fine_tune']
+
+def get_l1_importance(net):
+    """Score the inner channels of every block by the L1 norm of the corresponding `conv1` filter
+
+    Parameters
+    ----------
+    net : BayesianResNet
+
+    Returns
+    -------
+    dict
+        maps each block name to a tensor of shape `[n_channels,]` of importance scores
+
+    """
+    importance = {}
+    for name, module in net.named_modules():
+        if isinstance(module, BayesianBasicBlock):
+            importance[name] = module.conv1.weight.detach().abs().sum(dim=(1, 2, 3))
+    return importance
+
+def get_taylor_importance(net, loader, loss_fn, n_batches=1, device=torch.device('cpu')):
+    """Score the inner channels of every block by the first-order Taylor estimate of the change in loss upon removing them
+
+    The score of a channel is the absolute value of the product of its activation after `bn1` and the gradient of the loss with respect to that activation, summed over pixels and averaged over images. The activation is taken before the ReLU that follows `bn1`; since the ReLU passes on the gradient only where its input is positive, the score is the same as that of the activation after the ReLU.
+
+    Parameters
+    ----------
+    net : BayesianResNet
+    loader : iterable
+        yields batches of `(X, Y)`, e.g. a training or validation `DataLoader`
+    loss_fn : callable
+        likelihood from `h0rton.losses` used in training
+    n_batches : int
+        number of batches over which to accumulate the scores
+    device : torch.device object
+
+    Returns
+    -------
+    dict
+        maps each block name to a tensor of shape `[n_channels,]` of importance scores
+
+    """
+    activations = {}
+    handles = []
+    importance = {}
+
+    def _get_hook(name):
+        def _hook(module, inp, out):
+            out.retain_grad()
+            activations[name] = out
+            # The block applies an inplace ReLU next, which would otherwise overwrite the saved activation
+            return out.clone()
+        return _hook
+
+    for name, module in net.named_modules():
+        if isinstance(module, BayesianBasicBlock):
+            handles.append(module.bn1.register_forward_hook(_get_hook(name)))
+            importance[name] = torch.zeros(module.conv1.out_channels, device=device)
+    net.eval()
+    for batch_idx, (X, Y) in enumerate(loader):
+        if batch_idx == n_batches:
+            break
+        activations.clear()
+        net.zero_grad()
+        loss = loss_fn(net(X.to(device)), Y.to(device))
+        loss.backward()
+        for name, act in activations.items():
+            importance[name] += (act*act.grad).sum(dim=(2, 3)).abs().mean(dim=0).detach()
+    for handle in handles:
+        handle.remove()
+    net.zero_grad()
+    return importance
+
+def prune_block_channels(block, keep_idx):
+    """Replace the inner layers of a block with smaller ones holding only the kept channels
+
+    Parameters
+    ----------
+    block : BayesianBasicBlock
+    keep_idx : torch.LongTensor
+        indices of the `conv1` output channels to keep
+
+    """
+    keep_idx = keep_idx.to(block.conv1.weight.device)
+    n_keep = len(keep_idx)
+    conv1, bn1, conv2 = block.conv1, block.bn1, block.conv2
+    new_conv1 = nn.Conv2d(conv1.in_channels, n_keep, conv1.kernel_size, conv1.stride, conv1.padding, conv1.dilation, conv1.groups, bias=conv1.bias is not None)
+    new_conv2 = nn.Conv2d(n_keep, conv2.out_channels, conv2.kernel_size, conv2.stride, conv2.padding, conv2.dilation, conv2.groups, bias=conv2.bias is not None)
+    with torch.no_grad():
+        new_conv1.weight.copy_(conv1.weight[keep_idx])
+        if conv1.bias is not None:
+            new_conv1.bias.copy_(conv1.bias[keep_idx])
+        new_conv2.weight.copy_(conv2.weight[:, keep_idx])
+        if conv2.bias is not None:
+            new_conv2.bias.copy_(conv2.bias)
+        if isinstance(bn1, nn.BatchNorm2d):
+            new_bn1 = nn.BatchNorm2d(n_keep, eps=bn1.eps, momentum=bn1.momentum)
+            new_bn1.weight.copy_(bn1.weight[keep_idx])
+            new_bn1.bias.copy_(bn1.bias[keep_idx])
+            new_bn1.running_mean.copy_(bn1.running_mean[keep_idx])
+            new_bn1.running_var.copy_(bn1.running_var[keep_idx])
+            new_bn1.num_batches_tracked.copy_(bn1.num_batches_tracked)
+            new_bn1.train(bn1.training)
+            block.bn1 = new_bn1.to(conv1.weight.device)
+    block.conv1 = new_conv1.to(conv1.weight.device)
+    block.conv2 = new_conv2.to(conv2.weight.device)
+
+def prune_channels(net, importance, amount):
+    """Remove the least important fraction of the inner channels of every block
+
+    Parameters
+    ----------
+    net : BayesianResNet
+        network to prune, in place
+    importance : dict
+        importance scores from `get_l1_importance` or `get_taylor_importance`
+    amount : float
+        fraction of the channels of each block to remove. At least one channel is always kept.
+
+    Returns
+    -------
+    BayesianResNet
+        the pruned network
+
+    """
+    for name, module in net.named_modules():
+        if isinstance(module, BayesianBasicBlock):
+            scores = importance[name]
+            n_keep = max(1, int(round(len(scores)*(1.0 - amount))))
+            keep_idx = torch.sort(torch.argsort(scores, descending=True)[:n_keep])[0]
+            prune_block_channels(module, keep_idx)
+    return net
+
+def get_block_widths(net):
+    """Get the number of inner channels of every block
+
+    Parameters
+    ----------
+    net : BayesianResNet
+
+    Returns
+    -------
+    dict
+        maps each block name to its number of inner channels
+
+    """
+    return {name: module.conv1.out_channels for name, module in net.named_modules() if isinstance(module, BayesianBasicBlock)}
+
+def resize_to_state_dict(net, state_dict):
+    """Shrink the blocks of a freshly built network to the inner widths found in a (possibly pruned) state dict, so that the state dict can be loaded
+
+    Parameters
+    ----------
+    net : BayesianResNet
+        network to resize, in place
+    state_dict : dict
+        state dict whose weights will be loaded into `net`
+
+    Returns
+    -------
+    BayesianResNet
+        the resized network
+
+    """
+    for name, module in net.named_modules():
+        if isinstance(module, BayesianBasicBlock):
+            key = '{:s}.conv1.weight'.format(name)
+            if key in state_dict and state_dict[key].shape[0] != module.conv1.out_channels:
+                prune_block_channels(module, torch.arange(state_dict[key].shape[0]))
+    return net
+
+def fine_tune(net, loader, loss_fn, n_iter, learning_rate=1.e-4, weight_decay=0.0, device=torch.device('cpu')):
+    """Fine-tune a pruned network on the training objective
+
+    Parameters
+    ----------
+    net : BayesianResNet
+    loader : iterable
+        yields batches of `(X, Y)` of training data
+    loss_fn : callable
+        likelihood from `h0rton.losses` used in training
+    n_iter : int
+        number of optimization steps
+    learning_rate : float
+    weight_decay : float
+    device : torch.device object
+
+    Returns
+    -------
+    float
+        running average of the training loss over the fine-tuning steps
+
+    """
+    optimizer = optim.Adam(net.parameters(), lr=learning_rate, weight_decay=weight_decay)
+    train_loss = 0.0
+    i = 0
+    while i < n_iter:
+        for X, Y in loader:
+            if i == n_iter:
+                break
+            net.train()
+            optimizer.zero_grad()
+            loss = loss_fn(net(X.to(device)), Y.to(device))
+            loss.backward()
+            optimizer.step()
+            train_loss += (loss.detach().item() - train_loss)/(1 + i)
+            i += 1
+    return train_loss
@@ -0,0 +1,95 @@
+"""Post-training int8 quantization of `BayesianResNet` for CPU inference
+
+Two paths are provided. Dynamic quantization converts only the fully-connected head and needs no data. Static quantization also converts every convolution, with activation ranges calibrated on validation images. In both cases the MC dropout, residual additions, and pooling keep running in float, so the network stays stochastic at evaluation time.
+
+"""
+import copy
+import torch
+import torch.nn as nn
+import torch.ao.quantization as tq
+from h0rton.models.inference_artifact import fold_batchnorm
+
+__all__ = ['QuantizedConvWrapper', 'quantize_dynamic', 'quantize_static']
+
+class QuantizedConvWrapper(nn.Module):
+    """Convolution whose input is quantized on entry and output dequantized on exit
+
+    Isolating each convolution this way lets the surrounding `F.dropout` calls and residual additions of `BayesianBasicBlock` operate on float tensors.
+
+    """
+    def __init__(self, conv):
+        super(QuantizedConvWrapper, self).__init__()
+        self.quant = tq.QuantStub()
+        self.conv = conv
+        self.dequant = tq.DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.conv(self.quant(x)))
+
+def _wrap_convs(module):
+    """Recursively replace every `nn.Conv2d` child with a `QuantizedConvWrapper`
+
+    """
+    for name, child in module.named_children():
+        if isinstance(child, nn.Conv2d):
+            setattr(module, name, QuantizedConvWrapper(child))
+        else:
+            _wrap_convs(child)
+
+def quantize_dynamic(net):
+    """Quantize the fully-connected layers of a network to int8, with activations quantized on the fly
+
+    Parameters
+    ----------
+    net : BayesianResNet
+        trained float network. Left unchanged.
+
+    Returns
+    -------
+    BayesianResNet
+        quantized copy for CPU inference
+
+    """
+    net = copy.deepcopy(net).cpu().eval()
+    return tq.quantize_dynamic(net, {nn.Linear}, dtype=torch.qint8)
+
+def quantize_static(net, calibration_X, backend='x86', quantize_fc=True):
+    """Quantize all convolutions (and optionally the fully-connected head) of a network to int8, calibrating activation ranges on sample images
+
+    Batchnorm is first folded into the convolutions, which is exact for `BayesianResNet`. Calibration passes run with dropout active, so the observed ranges reflect MC dropout inference.
+
+    Parameters
+    ----------
+    net : BayesianResNet
+        trained float network. Left unchanged.
+    calibration_X : iterable of torch.Tensor
+        batches of input images of shape `[batch_size, 1, X_dim, X_dim]`, e.g. from the validation set
+    backend : str
+        quantized engine, one of `torch.backends.quantized.supported_engines`
+    quantize_fc : bool
+        whether to also quantize the fully-connected head, dynamically
+
+    Returns
+    -------
+    BayesianResNet
+        quantized copy for CPU inference
+
+    """
+    torch.backends.quantized.engine = backend
+    net = fold_batchnorm(copy.deepcopy(net).cpu().eval())
+    _wrap_convs(net)
+    if not getattr(net, 'include_layer4', True):
+        # layer4 is never run by the 3-layer architectures, so it gets neither observed nor converted
+        net.layer4 = nn.Identity()
+    qconfig = tq.get_default_qconfig(backend)
+    for module in net.modules():
+        if isinstance(module, QuantizedConvWrapper):
+            module.qconfig = qconfig
+    tq.prepare(net, inplace=True)
+    with torch.no_grad():
+        for X in calibration_X:
+            net(X.cpu())
+    tq.convert(net, inplace=True)
+    if quantize_fc:
+        net = tq.quantize_dynamic(net, {nn.Linear}, dtype=torch.qint8)
+    return net
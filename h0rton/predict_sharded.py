@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""Getting MC dropout predictions for a large test catalog, sharded across worker processes.
+
+The test set defined by the inference config is split into shards of `--shard_size` consecutive lenses. Each of the `--n_workers` processes takes shards from a queue and reads the network weights from shared memory, so the checkpoint is loaded only once. Every shard is written to `out_dir/shard_*.npz` as soon as it's done, either as the raw network outputs (`--output pred`) or as the Gaussian mixture parameters of the BNN posterior (`--output params`). Rerunning the same command after an interruption only computes the missing shards. At the end, `out_dir/index.csv` maps each lens ID (the image filename) to its shard and offset; use `h0rton.h0_inference.sharded_prediction.load_sharded_predictions` to read back the outputs of any subset of lenses.
+
+Example
+-------
+To run this script, pass in the path to the user-defined inference config file and the output directory::
+
+    $ python h0rton/predict_sharded.py mcmc_default.json test_preds --n_workers 8 --shard_size 1000 --output params
+
+"""
+import os
+import sys
+import argparse
+from addict import Dict
+import torch
+import h0rton.models
+import h0rton.losses
+import h0rton.train_utils as train_utils
+import h0rton.script_utils as script_utils
+from h0rton.configs import TrainValConfig, TestConfig
+from h0rton.trainval_data import XYData
+from h0rton.h0_inference.sharded_prediction import predict_sharded
+
+def parse_args():
+    """Parse command-line arguments
+
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('test_config_file_path', help='path to the user-defined inference config file')
+    parser.add_argument('out_dir', help='directory in which to save the shards and index')
+    parser.add_argument('--n_dropout', default=20, dest='n_dropout', type=int,
+                        help='number of MC dropout passes (Default: 20)')
+    parser.add_argument('--output', default='pred', dest='output', type=str,
+                        help='what to save per lens, one of [pred, params] (Default: pred)')
+    parser.add_argument('--shard_size', default=1000, dest='shard_size', type=int,
+                        help='number of lenses per shard (Default: 1000)')
+    parser.add_argument('--batch_size', default=100, dest='batch_size', type=int,
+                        help='number of images per forward pass (Default: 100)')
+    parser.add_argument('--n_workers', default=0, dest='n_workers', type=int,
+                        help='number of worker processes (Default: 0, i.e. predict in the main process)')
+    parser.add_argument('--n_threads_per_worker', default=1, dest='n_threads_per_worker', type=int,
+                        help='number of CPU threads of each worker (Default: 1)')
+    args = parser.parse_args()
+    # sys.argv rerouting for setuptools entry point
+    if args is None:
+        args = Dict()
+        args.test_config_file_path = sys.argv[0]
+    return args
+
+def main():
+    args = parse_args()
+    test_cfg = TestConfig.from_file(args.test_config_file_path)
+    cfg = TrainValConfig.from_file(test_cfg.train_val_config_file_path)
+    # Workers share the weights through CPU shared memory
+    device = torch.device('cpu')
+    torch.set_default_tensor_type('torch.' + cfg.data.float_type)
+    script_utils.seed_everything(test_cfg.global_seed)
+    train_data = XYData(is_train=True,
+                        Y_cols=cfg.data.Y_cols,
+                        float_type=cfg.data.float_type,
+                        define_src_pos_wrt_lens=cfg.data.define_src_pos_wrt_lens,
+                        rescale_pixels=cfg.data.rescale_pixels,
+                        rescale_pixels_type=cfg.data.rescale_pixels_type,
+                        log_pixels=cfg.data.log_pixels,
+                        add_pixel_noise=cfg.data.add_pixel_noise,
+                        eff_exposure_time=cfg.data.eff_exposure_time,
+                        train_Y_mean=None,
+                        train_Y_std=None,
+                        train_baobab_cfg_path=cfg.data.train_baobab_cfg_path,
+                        val_baobab_cfg_path=None,
+                        for_cosmology=False)
+    test_data = XYData(is_train=False,
+                       Y_cols=cfg.data.Y_cols,
+                       float_type=cfg.data.float_type,
+                       define_src_pos_wrt_lens=cfg.data.define_src_pos_wrt_lens,
+                       rescale_pixels=cfg.data.rescale_pixels,
+                       rescale_pixels_type=cfg.data.rescale_pixels_type,
+                       log_pixels=cfg.data.log_pixels,
+                       add_pixel_noise=cfg.data.add_pixel_noise,
+                       eff_exposure_time=cfg.data.eff_exposure_time,
+                       train_Y_mean=train_data.train_Y_mean,
+                       train_Y_std=train_data.train_Y_std,
+                       train_baobab_cfg_path=cfg.data.train_baobab_cfg_path,
+                       val_baobab_cfg_path=test_cfg.data.test_baobab_cfg_path,
+                       for_cosmology=False)
+    loss_fn = getattr(h0rton.losses, cfg.model.likelihood_class)(Y_dim=test_data.Y_dim, device=device, **cfg.model.likelihood_kwargs)
+    if test_cfg.state_dict_path.endswith('.safetensors'):
+        net, _ = h0rton.models.load_inference_artifact(test_cfg.state_dict_path, device)
+    else:
+        net = getattr(h0rton.models, cfg.model.architecture)(num_classes=loss_fn.out_dim, dropout_rate=cfg.model.dropout_rate)
+        net, _ = train_utils.load_state_dict_test(test_cfg.state_dict_path, net, cfg.optim.n_epochs, device)
+    lens_ids = [os.path.splitext(img_filename)[0] for img_filename in test_data.img_filenames]
+    run_info = dict(state_dict_path=os.path.abspath(test_cfg.state_dict_path),
+                    test_baobab_cfg_path=os.path.abspath(test_cfg.data.test_baobab_cfg_path))
+    print("Predicting on {:d} lenses in shards of {:d}...".format(len(test_data), args.shard_size))
+    # The images are loaded lazily by each worker, so the test set is never held in memory as a whole
+    index = predict_sharded(net, test_data, args.out_dir, args.n_dropout, cfg.model.likelihood_class,
+                            train_data.train_Y_mean, train_data.train_Y_std,
+                            Y_cols=cfg.data.Y_cols,
+                            likelihood_kwargs=cfg.model.likelihood_kwargs,
+                            lens_ids=lens_ids,
+                            output=args.output,
+                            shard_size=args.shard_size,
+                            batch_size=args.batch_size,
+                            n_workers=args.n_workers,
+                            n_threads_per_worker=args.n_threads_per_worker,
+                            seed=test_cfg.global_seed,
+                            run_info=run_info)
+    print("Saved {:d} shards and the index at {:s}".format(index['shard'].nunique(), args.out_dir))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""Pruning the inner channels of a trained BNN and fine-tuning the pruned networks.
+
+For each pruning amount, the least important channels of every `BayesianBasicBlock` are physically removed, the network is fine-tuned with the training likelihood, and the result is saved as a regular checkpoint that `h0rton.train_utils.load_state_dict_test` and the inference scripts load directly. A table of parameter sparsity, validation NLL, and CPU latency is printed and saved to `pruning_summary.csv`.
+
+Example
+-------
+To run this script, pass in the path to the training config file and the checkpoint::
+
+    $ python h0rton/prune.py experiments/v2/train_val_cfg.json resnet101_epoch=199.mdl --amounts 0.25 0.5 0.75 --importance taylor
+
+"""
+import os
+import sys
+import copy
+import argparse
+from addict import Dict
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import DataLoader
+from h0rton.trainval_data import XYData
+from h0rton.configs import TrainValConfig
+import h0rton.losses
+import h0rton.models
+import h0rton.train_utils as train_utils
+import h0rton.script_utils as script_utils
+
+def parse_args():
+    """Parse command-line arguments
+
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('user_cfg_path', help='path to the user-defined training config file')
+    parser.add_argument('checkpoint_path', help='path to the training checkpoint')
+    parser.add_argument('--amounts', default=[0.25, 0.5, 0.75], dest='amounts', type=float, nargs='+',
+                        help='fractions of the inner channels of each block to remove (Default: 0.25 0.5 0.75)')
+    parser.add_argument('--importance', default='l1', dest='importance', type=str,
+                        help='channel importance score, one of [l1, taylor] (Default: l1)')
+    parser.add_argument('--n_taylor_batches', default=4, dest='n_taylor_batches', type=int,
+                        help='number of training batches over which to accumulate the Taylor scores (Default: 4)')
+    parser.add_argument('--n_finetune_iter', default=1000, dest='n_finetune_iter', type=int,
+                        help='number of fine-tuning steps after pruning (Default: 1000)')
+    parser.add_argument('--out_dir', default='pruned', dest='out_dir', type=str,
+                        help='directory into which the pruned checkpoints and summary are saved (Default: pruned)')
+    args = parser.parse_args()
+    # sys.argv rerouting for setuptools entry point
+    if args is None:
+        args = Dict()
+        args.user_cfg_path = sys.argv[0]
+    return args
+
+def get_val_loss(net, val_loader, loss_fn, device):
+    """Average the likelihood over the validation set, as done during training
+
+    """
+    net.eval()
+    val_loss = 0.0
+    with torch.no_grad():
+        for batch_idx, (X_v, Y_v) in enumerate(val_loader):
+            loss_v = loss_fn(net(X_v.to(device)), Y_v.to(device))
+            val_loss += (loss_v.item() - val_loss)/(1 + batch_idx)
+    return val_loss
+
+def main():
+    args = parse_args()
+    cfg = TrainValConfig.from_file(args.user_cfg_path)
+    device = torch.device(cfg.device_type)
+    if device.type == 'cuda':
+        torch.set_default_tensor_type('torch.cuda.' + cfg.data.float_type)
+    else:
+        torch.set_default_tensor_type('torch.' + cfg.data.float_type)
+    script_utils.seed_everything(cfg.global_seed)
+    if not os.path.exists(args.out_dir):
+        os.makedirs(args.out_dir)
+    train_data = XYData(is_train=True,
+                        Y_cols=cfg.data.Y_cols,
+                        float_type=cfg.data.float_type,
+                        define_src_pos_wrt_lens=cfg.data.define_src_pos_wrt_lens,
+                        rescale_pixels=cfg.data.rescale_pixels,
+                        rescale_pixels_type=cfg.data.rescale_pixels_type,
+                        log_pixels=cfg.data.log_pixels,
+                        add_pixel_noise=cfg.data.add_pixel_noise,
+                        eff_exposure_time=cfg.data.eff_exposure_time,
+                        train_Y_mean=None,
+                        train_Y_std=None,
+                        train_baobab_cfg_path=cfg.data.train_baobab_cfg_path,
+                        val_baobab_cfg_path=cfg.data.val_baobab_cfg_path,
+                        for_cosmology=False)
+    train_loader = DataLoader(train_data, batch_size=cfg.optim.batch_size, shuffle=True, drop_last=True)
+    val_data = XYData(is_train=False,
+                      Y_cols=cfg.data.Y_cols,
+                      float_type=cfg.data.float_type,
+                      define_src_pos_wrt_lens=cfg.data.define_src_pos_wrt_lens,
+                      rescale_pixels=cfg.data.rescale_pixels,
+                      rescale_pixels_type=cfg.data.rescale_pixels_type,
+                      log_pixels=cfg.data.log_pixels,
+                      add_pixel_noise=cfg.data.add_pixel_noise,
+                      eff_exposure_time=cfg.data.eff_exposure_time,
+                      train_Y_mean=train_data.train_Y_mean,
+                      train_Y_std=train_data.train_Y_std,
+                      train_baobab_cfg_path=cfg.data.train_baobab_cfg_path,
+                      val_baobab_cfg_path=cfg.data.val_baobab_cfg_path,
+                      for_cosmology=False)
+    val_loader = DataLoader(val_data, batch_size=min(len(val_data), cfg.optim.batch_size), shuffle=False, drop_last=True)
+    loss_fn = getattr(h0rton.losses, cfg.model.likelihood_class)(Y_dim=val_data.Y_dim, device=device, **cfg.model.likelihood_kwargs)
+    net = getattr(h0rton.models, cfg.model.architecture)(num_classes=loss_fn.out_dim, dropout_rate=cfg.model.dropout_rate)
+    net.to(device)
+    net, epoch = train_utils.load_state_dict_test(args.checkpoint_path, net, cfg.optim.n_epochs, device)
+    # Latency is measured on the CPU, where MC dropout inference is run
+    X_latency = next(iter(val_loader))[0].cpu()
+    n_params = h0rton.models.count_parameters(net)
+    summary = [dict(amount=0.0, n_params=n_params, sparsity=0.0, val_nll=get_val_loss(net, val_loader, loss_fn, device), cpu_latency=h0rton.models.measure_latency(copy.deepcopy(net).cpu(), X_latency), path=args.checkpoint_path)]
+    for amount in args.amounts:
+        pruned_net = copy.deepcopy(net)
+        if args.importance == 'l1':
+            importance = h0rton.models.get_l1_importance(pruned_net)
+        elif args.importance == 'taylor':
+            importance = h0rton.models.get_taylor_importance(pruned_net, train_loader, loss_fn, n_batches=args.n_taylor_batches, device=device)
+        else:
+            raise ValueError("Importance score must be one of [l1, taylor].")
+        h0rton.models.prune_channels(pruned_net, importance, amount)
+        train_loss = h0rton.models.fine_tune(pruned_net, train_loader, loss_fn, args.n_finetune_iter, learning_rate=cfg.optim.learning_rate, weight_decay=cfg.optim.weight_decay, device=device)
+        val_loss = get_val_loss(pruned_net, val_loader, loss_fn, device)
+        # Save in the regular checkpoint format, with a fresh optimizer for any further training
+        optimizer = torch.optim.Adam(pruned_net.parameters(), lr=cfg.optim.learning_rate, weight_decay=cfg.optim.weight_decay)
+        lr_scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, mode='min')
+        amount_dir = os.path.join(args.out_dir, 'amount={:.2f}'.format(amount))
+        if not os.path.exists(amount_dir):
+            os.makedirs(amount_dir)
+        model_path = train_utils.save_state_dict(pruned_net, optimizer, lr_scheduler, train_loss, val_loss, amount_dir, cfg.model.architecture, epoch)
+        n_params_pruned = h0rton.models.count_parameters(pruned_net)
+        summary.append(dict(amount=amount, n_params=n_params_pruned, sparsity=1.0 - n_params_pruned/n_params, val_nll=val_loss, cpu_latency=h0rton.models.measure_latency(copy.deepcopy(pruned_net).cpu(), X_latency), path=model_path))
+    summary = pd.DataFrame(summary)
+    summary['speedup'] = summary['cpu_latency'].iloc[0]/summary['cpu_latency']
+    summary.to_csv(os.path.join(args.out_dir, 'pruning_summary.csv'), index=None)
+    print(summary.drop(columns='path').to_string(index=False))
+
+if __name__ == '__main__':
+    main()
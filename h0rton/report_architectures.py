@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""Reporting the cost of the available BNN architectures for a given training config.
+
+For each architecture, the parameter count, the FLOPs per image, and the measured CPU latency per batch size are printed, for the input size and output dimension implied by the config. The MC dropout cost of inference scales with these numbers times `n_dropout`.
+
+Example
+-------
+To run this script, pass in the path to the training config file::
+
+    $ python h0rton/report_architectures.py experiments/v2/train_val_cfg.json --batch_sizes 1 32 200
+
+"""
+import sys
+import argparse
+from addict import Dict
+import pandas as pd
+import torch
+from h0rton.configs import TrainValConfig
+import h0rton.losses
+import h0rton.models
+
+default_architectures = ['resnet18_half', 'resnet18', 'resnet34_half', 'resnet34', 'resnet44', 'resnet56', 'resnet101', 'mobilenet_v2_half', 'mobilenet_v2']
+
+def parse_args():
+    """Parse command-line arguments
+
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('user_cfg_path', help='path to the user-defined training config file')
+    parser.add_argument('--architectures', default=default_architectures, dest='architectures', type=str, nargs='+',
+                        help='names of the architectures in h0rton.models to report on (Default: all)')
+    parser.add_argument('--batch_sizes', default=[1, 8, 32], dest='batch_sizes', type=int, nargs='+',
+                        help='batch sizes at which to measure the latency (Default: 1 8 32)')
+    parser.add_argument('--X_dim', default=64, dest='X_dim', type=int,
+                        help='number of pixels on each side of the input image (Default: 64)')
+    parser.add_argument('--n_repeats', default=10, dest='n_repeats', type=int,
+                        help='number of timed forward passes per batch size (Default: 10)')
+    args = parser.parse_args()
+    # sys.argv rerouting for setuptools entry point
+    if args is None:
+        args = Dict()
+        args.user_cfg_path = sys.argv[0]
+    return args
+
+def main():
+    args = parse_args()
+    cfg = TrainValConfig.from_file(args.user_cfg_path)
+    torch.set_default_tensor_type('torch.FloatTensor')
+    loss_fn = getattr(h0rton.losses, cfg.model.likelihood_class)(Y_dim=len(cfg.data.Y_cols), device=torch.device('cpu'), **cfg.model.likelihood_kwargs)
+    cards = []
+    for architecture in args.architectures:
+        net = getattr(h0rton.models, architecture)(num_classes=loss_fn.out_dim, dropout_rate=cfg.model.dropout_rate)
+        for row in h0rton.models.get_model_card(net, args.X_dim, batch_sizes=args.batch_sizes, n_repeats=args.n_repeats):
+            row['architecture'] = architecture
+            cards.append(row)
+    cards = pd.DataFrame(cards)[['architecture', 'batch_size', 'n_params', 'flops_per_image', 'latency', 'latency_per_image']]
+    print("Input size: {:d}x{:d}, out_dim: {:d}".format(args.X_dim, args.X_dim, loss_fn.out_dim))
+    print(cards.to_string(index=False))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""Serving MC dropout predictions and BNN posterior samples from a long-lived local process.
+
+The networks are loaded from inference-only artifacts once and kept warm. Concurrent requests for the same network are coalesced into batches up to `max_batch_size` lenses or the `max_wait` latency deadline. Query the service with `h0rton.h0_inference.bnn_server.BNNClient`, e.g. from the demo notebooks::
+
+    >>> from h0rton.h0_inference.bnn_server import BNNClient
+    >>> client = BNNClient('http://127.0.0.1:8765')
+    >>> samples = client.predict(X, n_dropout=20, output='samples', whitened=False, n_samples_per_dropout=10)
+    >>> client.get_metrics()
+
+Example
+-------
+To run this script, pass in one or more `name=path` pairs pointing to inference-only artifacts::
+
+    $ python h0rton/serve_bnn.py resnet34=resnet34.safetensors resnet18=resnet18.safetensors --X_dim 64 --max_wait 0.02
+
+"""
+import sys
+import argparse
+from addict import Dict
+import torch
+from h0rton.h0_inference.bnn_server import BNNService, make_server
+
+def parse_args():
+    """Parse command-line arguments
+
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('artifacts', type=str, nargs='+',
+                        help='name=path pairs of inference-only artifacts to serve')
+    parser.add_argument('--host', default='127.0.0.1', dest='host', type=str,
+                        help='address to bind (Default: 127.0.0.1)')
+    parser.add_argument('--port', default=8765, dest='port', type=int,
+                        help='port to bind (Default: 8765)')
+    parser.add_argument('--X_dim', default=None, dest='X_dim', type=int,
+                        help='number of pixels on each side of the input image, for warming up the networks (Default: no warm-up)')
+    parser.add_argument('--max_batch_size', default=64, dest='max_batch_size', type=int,
+                        help='maximum number of lenses coalesced into a batch (Default: 64)')
+    parser.add_argument('--max_wait', default=0.01, dest='max_wait', type=float,
+                        help='latency deadline for closing a batch, in seconds (Default: 0.01)')
+    parser.add_argument('--forward_batch_size', default=None, dest='forward_batch_size', type=int,
+                        help='maximum number of images per forward pass (Default: the whole batch)')
+    parser.add_argument('--device', default='cpu', dest='device', type=str,
+                        help='device on which to run the networks (Default: cpu)')
+    args = parser.parse_args()
+    # sys.argv rerouting for setuptools entry point
+    if args is None:
+        args = Dict()
+        args.artifacts = sys.argv[0]
+    return args
+
+def main():
+    args = parse_args()
+    torch.set_default_tensor_type('torch.FloatTensor')
+    service = BNNService(device=torch.device(args.device),
+                         max_batch_size=args.max_batch_size,
+                         max_wait=args.max_wait,
+                         forward_batch_size=args.forward_batch_size)
+    for name_path in args.artifacts:
+        name, path = name_path.split('=', 1)
+        service.load_model(name, path, X_dim=args.X_dim)
+        print("Loaded {:s} from {:s}".format(name, path))
+    server = make_server(service, args.host, args.port)
+    print("Serving on http://{:s}:{:d}".format(args.host, server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+if __name__ == '__main__':
+    main()
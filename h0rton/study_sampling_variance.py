@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""Studying the Monte Carlo noise of the per-lens H0 posterior under each way of sampling the BNN posterior.
+
+For a few test lenses, the BNN posterior (a single MC dropout pass) is sampled `--n_samples` times with each method in `h0rton.h0_inference.gaussian_bnn_posterior_cpu.sampling_methods`, and the weighted mean and std of the H0 samples are computed as in the H0 inference scripts. This is repeated `--n_repeats` times with different sample seeds. The H0 and kappa_ext draws for the i-th lens-model sample are the same in every repeat and method, so the spread across repeats comes from the lens-model samples only. They are drawn with the vectorized sampler `H0Posterior.get_h0_samples`, which requires `h0_posterior.exclude_velocity_dispersion`. The script prints the variance of the H0 mean for each method, along with the number of plain MC samples that would give the same variance, which is how far `h0_posterior.n_samples` can be cut.
+
+Example
+-------
+To run this script, pass in the path to the user-defined inference config file::
+
+    $ python h0rton/study_sampling_variance.py h0rton/h0_inference_config.json --n_lenses 5 --n_samples 256 --n_repeats 20
+
+"""
+import sys
+import argparse
+from ast import literal_eval
+from addict import Dict
+import numpy as np
+import pandas as pd
+import scipy.stats as stats
+import torch
+from torch.utils.data import DataLoader
+from astropy.cosmology import FlatLambdaCDM
+from baobab import BaobabConfig
+import h0rton.models
+import h0rton.losses
+import h0rton.train_utils as train_utils
+import h0rton.script_utils as script_utils
+from h0rton.configs import TrainValConfig, TestConfig
+from h0rton.trainval_data import XYData
+from h0rton.h0_inference import H0Posterior, gaussian_bnn_posterior_cpu, h0_utils
+from h0rton.h0_inference.mc_dropout_utils import get_mc_dropout_preds
+
+def parse_args():
+    """Parse command-line arguments
+
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('test_config_file_path', help='path to the user-defined inference config file')
+    parser.add_argument('--n_lenses', default=5, dest='n_lenses', type=int,
+                        help='number of test lenses (Default: 5)')
+    parser.add_argument('--n_samples', default=256, dest='n_samples', type=int,
+                        help='number of lens-model samples per lens, best a power of 2 for QMC (Default: 256)')
+    parser.add_argument('--n_repeats', default=20, dest='n_repeats', type=int,
+                        help='number of repeats with different sample seeds (Default: 20)')
+    parser.add_argument('--sampling', default=gaussian_bnn_posterior_cpu.sampling_methods, dest='sampling', type=str, nargs='+',
+                        help='sampling methods to compare (Default: all)')
+    args = parser.parse_args()
+    # sys.argv rerouting for setuptools entry point
+    if args is None:
+        args = Dict()
+        args.test_config_file_path = sys.argv[0]
+    return args
+
+def get_weighted_h0_stats(h0_post, lens_model_samples, lens_i):
+    """Weighted mean and std of the H0 samples obtained from a set of lens-model samples
+
+    Parameters
+    ----------
+    h0_post : h0rton.h0_inference.H0Posterior
+        H0 posterior with the cosmology observables of the lens set
+    lens_model_samples : pd.DataFrame
+        lens-model samples, one per row
+    lens_i : int
+        index of the lens, used to seed the H0 and kappa_ext draws
+
+    Returns
+    -------
+    tuple of floats
+        weighted mean and std of H0
+
+    """
+    # One H0 and kappa_ext draw per lens-model sample, from a random state shared by all repeats and methods
+    h0_samples, h0_log_weights = h0_post.get_h0_samples(lens_model_samples, 1, np.random.RandomState(lens_i))
+    normal_stats = h0_utils.get_normal_stats_naive(h0_samples[:, 0], all_log_weights=h0_log_weights[:, 0])
+    return normal_stats['mean'], normal_stats['std']
+
+def main():
+    args = parse_args()
+    test_cfg = TestConfig.from_file(args.test_config_file_path)
+    baobab_cfg = BaobabConfig.from_file(test_cfg.data.test_baobab_cfg_path)
+    cfg = TrainValConfig.from_file(test_cfg.train_val_config_file_path)
+    device = torch.device('cpu')
+    torch.set_default_tensor_type('torch.FloatTensor')
+    script_utils.seed_everything(test_cfg.global_seed)
+    train_data = XYData(is_train=True,
+                        Y_cols=cfg.data.Y_cols,
+                        float_type=cfg.data.float_type,
+                        define_src_pos_wrt_lens=cfg.data.define_src_pos_wrt_lens,
+                        rescale_pixels=cfg.data.rescale_pixels,
+                        rescale_pixels_type=cfg.data.rescale_pixels_type,
+                        log_pixels=cfg.data.log_pixels,
+                        add_pixel_noise=cfg.data.add_pixel_noise,
+                        eff_exposure_time=cfg.data.eff_exposure_time,
+                        train_Y_mean=None,
+                        train_Y_std=None,
+                        train_baobab_cfg_path=cfg.data.train_baobab_cfg_path,
+                        val_baobab_cfg_path=None,
+                        for_cosmology=False)
+    test_data = XYData(is_train=False,
+                       Y_cols=cfg.data.Y_cols,
+                       float_type=cfg.data.float_type,
+                       define_src_pos_wrt_lens=cfg.data.define_src_pos_wrt_lens,
+                       rescale_pixels=cfg.data.rescale_pixels,
+                       rescale_pixels_type=cfg.data.rescale_pixels_type,
+                       log_pixels=cfg.data.log_pixels,
+                       add_pixel_noise=cfg.data.add_pixel_noise,
+                       eff_exposure_time=cfg.data.eff_exposure_time,
+                       train_Y_mean=train_data.train_Y_mean,
+                       train_Y_std=train_data.train_Y_std,
+                       train_baobab_cfg_path=cfg.data.train_baobab_cfg_path,
+                       val_baobab_cfg_path=test_cfg.data.test_baobab_cfg_path,
+                       for_cosmology=True)
+    cosmo_df = test_data.Y_df
+    X, _ = next(iter(DataLoader(test_data, batch_size=args.n_lenses, shuffle=False)))
+    # BNN posterior of each lens from a single MC dropout pass
+    loss_fn = getattr(h0rton.losses, cfg.model.likelihood_class)(Y_dim=test_data.Y_dim, device=device, **cfg.model.likelihood_kwargs)
+    net = getattr(h0rton.models, cfg.model.architecture)(num_classes=loss_fn.out_dim, dropout_rate=cfg.model.dropout_rate)
+    net, _ = train_utils.load_state_dict_test(test_cfg.state_dict_path, net, cfg.optim.n_epochs, device)
+    pred = get_mc_dropout_preds(net, X, 1)[:, 0, :] # [n_lenses, out_dim]
+    bnn_post = getattr(gaussian_bnn_posterior_cpu, loss_fn.posterior_name + 'CPU')(test_data.Y_dim, train_data.train_Y_mean, train_data.train_Y_std, **loss_fn.posterior_kwargs)
+    bnn_post.set_sliced_pred(pred.astype(np.float64))
+    # H0 posterior, set up as in infer_h0_simple_mc_truth
+    kwargs_model = dict(lens_model_list=['PEMD', 'SHEAR'],
+                        lens_light_model_list=['SERSIC_ELLIPSE'],
+                        source_light_model_list=['SERSIC_ELLIPSE'],
+                        point_source_model_list=['SOURCE_POSITION'],
+                        cosmo=FlatLambdaCDM(H0=70.0, Om0=0.3))
+    h0_post = H0Posterior(H0_prior=getattr(stats, test_cfg.h0_prior.dist)(**test_cfg.h0_prior.kwargs),
+                          kappa_ext_prior=getattr(stats, test_cfg.kappa_ext_prior.dist)(**test_cfg.kappa_ext_prior.kwargs),
+                          aniso_param_prior=getattr(stats, test_cfg.aniso_param_prior.dist)(**test_cfg.aniso_param_prior.kwargs),
+                          exclude_vel_disp=test_cfg.h0_posterior.exclude_velocity_dispersion,
+                          kwargs_model=kwargs_model,
+                          baobab_time_delays=test_cfg.time_delay_likelihood.baobab_time_delays,
+                          kinematics=baobab_cfg.bnn_omega.kinematics,
+                          kappa_transformed=test_cfg.kappa_ext_prior.transformed,
+                          Om0=baobab_cfg.bnn_omega.cosmology.Om0,
+                          define_src_pos_wrt_lens=cfg.data.define_src_pos_wrt_lens,
+                          kwargs_lens_eqn_solver={'min_distance': 0.05, 'search_window': baobab_cfg.instrument['pixel_scale']*baobab_cfg.image['num_pix'], 'num_iter_max': 100})
+    # Samples of all methods and repeats, [n_methods, n_repeats, n_lenses, n_samples, Y_dim]
+    samples = np.stack([np.stack([bnn_post.sample(args.n_samples, test_cfg.global_seed + r, sampling) for r in range(args.n_repeats)], axis=0) for sampling in args.sampling], axis=0)
+    h0_mean = np.zeros([len(args.sampling), args.n_repeats, args.n_lenses])
+    h0_std = np.zeros([len(args.sampling), args.n_repeats, args.n_lenses])
+    for lens_i in range(args.n_lenses):
+        rs_lens = np.random.RandomState(lens_i)
+        cosmo = cosmo_df.iloc[lens_i]
+        true_td = np.array(literal_eval(cosmo['true_td']))
+        true_img_dec = np.array(literal_eval(cosmo['y_image']))
+        true_img_ra = np.array(literal_eval(cosmo['x_image']))
+        increasing_dec_i = np.argsort(true_img_dec)
+        true_td = true_td[increasing_dec_i]
+        true_td = true_td[1:] - true_td[0]
+        h0_post.set_cosmology_observables(z_lens=cosmo['z_lens'],
+                                          z_src=cosmo['z_src'],
+                                          measured_vd=cosmo['true_vd']*(1.0 + rs_lens.randn()*test_cfg.error_model.velocity_dispersion_frac_error),
+                                          measured_vd_err=test_cfg.velocity_dispersion_likelihood.sigma,
+                                          measured_td_wrt0=true_td + rs_lens.randn(*true_td.shape)*test_cfg.error_model.time_delay_error,
+                                          measured_td_err=test_cfg.time_delay_likelihood.sigma,
+                                          abcd_ordering_i=np.arange(len(true_td) + 1),
+                                          true_img_dec=true_img_dec[increasing_dec_i],
+                                          true_img_ra=true_img_ra[increasing_dec_i],
+                                          kappa_ext=cosmo['kappa_ext'])
+        for m in range(len(args.sampling)):
+            for r in range(args.n_repeats):
+                lens_model_samples = pd.DataFrame(samples[m, r, lens_i], columns=cfg.data.Y_cols)
+                h0_mean[m, r, lens_i], h0_std[m, r, lens_i] = get_weighted_h0_stats(h0_post, lens_model_samples, lens_i)
+    mean_var = h0_mean.var(axis=1) # [n_methods, n_lenses]
+    mc_var = mean_var[args.sampling.index('mc')] if 'mc' in args.sampling else np.nan
+    summary = pd.DataFrame(dict(sampling=args.sampling,
+                                var_h0_mean=mean_var.mean(axis=1),
+                                var_ratio_to_mc=(mean_var/mc_var).mean(axis=1),
+                                mean_h0_std=h0_std.mean(axis=(1, 2)),
+                                mc_equivalent_n_samples=args.n_samples*(mc_var/mean_var).mean(axis=1)))
+    print("{:d} lenses, {:d} samples per lens, {:d} repeats".format(args.n_lenses, args.n_samples, args.n_repeats))
+    print(summary.to_string(index=False))
+
+if __name__ == '__main__':
+    main()
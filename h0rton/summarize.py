@@ -68,14 +68,19 @@ def summarize_simple_mc_default(samples_dir, test_cfg):
         # Read in H0 samples using lens identifier
         H0_dict = np.load(os.path.join(samples_dir, f_name), allow_pickle=True).item()
         H0_samples = H0_dict['h0_samples']
-        weights = H0_dict['h0_weights']
-        H0_normal_stats = h0_utils.get_normal_stats_naive(H0_samples, weights)
-        n_eff = np.sum(weights)**2.0/(np.sum(weights**2.0))
+        if 'h0_log_weights' in H0_dict:
+            log_weights = H0_dict['h0_log_weights']
+        else:
+            # Samples saved before the log weights were stored
+            with np.errstate(divide='ignore'):
+                log_weights = np.log(H0_dict['h0_weights'].astype(np.float64))
+        H0_normal_stats = h0_utils.get_normal_stats_naive(H0_samples, all_log_weights=log_weights)
+        n_eff = h0_utils.get_n_eff(log_weights)
         # Convert H0 H0_samples to D_dt
         cosmo_converter = h0_utils.CosmoConverter(z_lens, z_src)
         D_dt_samples = cosmo_converter.get_D_dt(H0_samples)
-        D_dt_stats = h0_utils.get_lognormal_stats_naive(D_dt_samples, weights)
-        D_dt_normal_stats = h0_utils.get_normal_stats_naive(D_dt_samples, weights)
+        D_dt_stats = h0_utils.get_lognormal_stats_naive(D_dt_samples, all_log_weights=log_weights)
+        D_dt_normal_stats = h0_utils.get_normal_stats_naive(D_dt_samples, all_log_weights=log_weights)
         summary_i = dict(
                          id=lens_i,
                          measured_td_wrt0=list(H0_dict['measured_td_wrt0']),
@@ -45,6 +45,26 @@ class TestTrainValConfig(unittest.TestCase):
         train_val_dict['data']['train_baobab_cfg_path'] = 'some_path'
         with np.testing.assert_raises(ValueError):
             train_val_cfg = TrainValConfig(train_val_dict)
+    def test_likelihood_backend(self):
+        """Test the default and validation of the likelihood backend
+
+        """
+        train_val_dict = copy.deepcopy(self.train_val_dict)
+        train_val_dict['data']['train_baobab_cfg_path'] = 'some_path'
+        train_val_dict['data']['val_baobab_cfg_path'] = 'some_other_path'
+        assert TrainValConfig(train_val_dict).model.likelihood_backend == 'gaussian_nll'
+        for backend in ['auto', 'gaussian_nll_native']:
+            train_val_dict['model']['likelihood_backend'] = backend
+            assert TrainValConfig(train_val_dict).model.likelihood_backend == backend
+        # The numpy backend can't be trained with
+        train_val_dict['model']['likelihood_backend'] = 'gaussian_nll_cpu'
+        with np.testing.assert_raises(ValueError):
+            TrainValConfig(train_val_dict)
+        # The backend must implement the likelihood
+        train_val_dict['model']['likelihood_class'] = 'MixtureGaussianNLL'
+        train_val_dict['model']['likelihood_backend'] = 'gaussian_nll_native'
+        with np.testing.assert_raises(ValueError):
+            TrainValConfig(train_val_dict)
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
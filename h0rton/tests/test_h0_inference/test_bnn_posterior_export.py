@@ -0,0 +1,168 @@
+import os
+import shutil
+import unittest
+import tempfile
+import numpy as np
+from h0rton.h0_inference.bnn_posterior_export import get_mixture_params, ParametricBNNPosterior, load_bnn_posterior_samples
+from h0rton.h0_inference.gaussian_bnn_posterior_cpu import sigmoid
+
+class TestBNNPosteriorExport(unittest.TestCase):
+    """A suite of tests for the h0rton.h0_inference.bnn_posterior_export package
+
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.out_dir = tempfile.mkdtemp()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.out_dir)
+
+    def setUp(self):
+        np.random.seed(1113)
+
+    def test_get_mixture_params_diagonal(self):
+        """Test that the diagonal covariance is recovered from the precision Cholesky factor
+
+        """
+        Y_dim = 3
+        mu = np.random.randn(4, Y_dim)
+        logvar = np.random.randn(4, Y_dim)
+        params = get_mixture_params(np.concatenate([mu, logvar], axis=1), 'DiagonalGaussianBNNPosterior', Y_dim)
+        np.testing.assert_array_equal(params['mu'][:, 0, :], mu)
+        np.testing.assert_array_equal(params['weights'], np.ones([4, 1]))
+        prec = params['prec_tril'][:, 0]@np.swapaxes(params['prec_tril'][:, 0], 1, 2)
+        for b in range(4):
+            np.testing.assert_array_almost_equal(np.linalg.inv(prec[b]), np.diag(np.exp(logvar[b])))
+
+    def test_get_mixture_params_low_rank(self):
+        """Test that the low-rank plus diagonal covariance is recovered from the precision Cholesky factor
+
+        """
+        Y_dim = 3
+        pred = np.random.randn(2, Y_dim*8 + 1)
+        params = get_mixture_params(pred, 'DoubleLowRankGaussianBNNPosterior', Y_dim)
+        F2 = pred[:, 6*Y_dim:8*Y_dim].reshape(2, Y_dim, 2)
+        cov2 = F2@np.swapaxes(F2, 1, 2) + np.apply_along_axis(np.diag, -1, np.exp(pred[:, 5*Y_dim:6*Y_dim]))
+        prec2 = params['prec_tril'][:, 1]@np.swapaxes(params['prec_tril'][:, 1], 1, 2)
+        np.testing.assert_array_almost_equal(np.linalg.inv(prec2), cov2)
+        np.testing.assert_array_almost_equal(params['weights'][:, 1], 0.5*sigmoid(pred[:, -1]))
+        np.testing.assert_array_almost_equal(params['weights'].sum(axis=1), np.ones(2))
+
+    def test_get_mixture_params_general_rank(self):
+        """Test that the rank of the low-rank covariances is read off the width of the network output
+
+        """
+        Y_dim, rank = 3, 4
+        pred = np.random.randn(2, 2*Y_dim*(2 + rank) + 1)
+        params = get_mixture_params(pred, 'DoubleLowRankGaussianBNNPosterior', Y_dim)
+        np.testing.assert_array_equal(params['mu'][:, 1], pred[:, (2 + rank)*Y_dim:(3 + rank)*Y_dim])
+        F2 = pred[:, (4 + rank)*Y_dim:(4 + 2*rank)*Y_dim].reshape(2, Y_dim, rank)
+        cov2 = F2@np.swapaxes(F2, 1, 2) + np.apply_along_axis(np.diag, -1, np.exp(pred[:, (3 + rank)*Y_dim:(4 + rank)*Y_dim]))
+        prec2 = params['prec_tril'][:, 1]@np.swapaxes(params['prec_tril'][:, 1], 1, 2)
+        np.testing.assert_array_almost_equal(np.linalg.inv(prec2), cov2)
+
+    def test_get_mixture_params_categorical(self):
+        """Test the conversion of the K-component mixture outputs, with softmax weights
+
+        """
+        Y_dim, n_components, rank = 3, 3, 2
+        component_dim = (2 + rank)*Y_dim
+        pred = np.random.randn(2, n_components*(component_dim + 1))
+        params = get_mixture_params(pred, 'MixtureGaussianBNNPosterior', Y_dim, dict(n_components=n_components, cov_type='low_rank', rank=rank))
+        logits = pred[:, -n_components:]
+        np.testing.assert_array_almost_equal(params['weights'], np.exp(logits)/np.sum(np.exp(logits), axis=1, keepdims=True))
+        component = pred[:, 2*component_dim:3*component_dim]
+        np.testing.assert_array_equal(params['mu'][:, 2], component[:, :Y_dim])
+        F = component[:, 2*Y_dim:].reshape(2, Y_dim, rank)
+        cov = F@np.swapaxes(F, 1, 2) + np.apply_along_axis(np.diag, -1, np.exp(component[:, Y_dim:2*Y_dim]))
+        prec = params['prec_tril'][:, 2]@np.swapaxes(params['prec_tril'][:, 2], 1, 2)
+        np.testing.assert_array_almost_equal(np.linalg.inv(prec), cov)
+
+    def test_get_mixture_params_full_rank(self):
+        """Test the Cholesky factor of the double Gaussian against its log-Cholesky parameterization
+
+        """
+        Y_dim = 2
+        tril_len = Y_dim*(Y_dim + 1)//2
+        pred = np.random.randn(2, Y_dim**2 + 3*Y_dim + 1)
+        params = get_mixture_params(pred, 'DoubleGaussianBNNPosterior', Y_dim)
+        tril_elements = pred[0, Y_dim:Y_dim + tril_len] # [log L_00, L_10, log L_11]
+        expected_tril = np.array([[np.exp(tril_elements[0]), 0.0], [tril_elements[1], np.exp(tril_elements[2])]])
+        np.testing.assert_array_almost_equal(params['prec_tril'][0, 0], expected_tril)
+        np.testing.assert_array_equal(params['mu'][:, 1, :], pred[:, Y_dim + tril_len:2*Y_dim + tril_len])
+        with self.assertRaises(NotImplementedError):
+            get_mixture_params(pred, 'SomeGaussianBNNPosterior', Y_dim)
+
+    def test_sample(self):
+        """Test that the sample moments match the exported mixture and that padded passes are NaN
+
+        """
+        Y_dim = 2
+        n_lenses, n_dropout = 2, 3
+        Y_mean = np.array([1.0, -2.0])
+        Y_std = np.array([0.5, 3.0])
+        tril_elements = np.array([np.log(2.0), 0.5, np.log(0.5)])
+        pred = np.empty([n_lenses, n_dropout, Y_dim + len(tril_elements)])
+        pred[:, :, :Y_dim] = np.array([0.3, -0.1])
+        pred[:, :, Y_dim:] = tril_elements
+        pred[1, 2, :] = np.nan # padding
+        post = ParametricBNNPosterior.from_pred(pred, 'FullRankGaussianBNNPosterior', Y_mean, Y_std, n_dropout_per_lens=[3, 2])
+        samples = post.sample(50000, sample_seed=123)
+        np.testing.assert_array_equal(samples.shape, [n_lenses, n_dropout, 50000, Y_dim])
+        assert np.all(np.isnan(samples[1, 2]))
+        assert np.all(np.isfinite(samples[0]))
+        tril = np.array([[2.0, 0.0], [0.5, 0.5]])
+        expected_cov = np.diag(Y_std)@np.linalg.inv(tril@tril.T)@np.diag(Y_std)
+        expected_mean = np.array([0.3, -0.1])*Y_std + Y_mean
+        np.testing.assert_allclose(samples[0, 0].mean(axis=0), expected_mean, atol=0.1)
+        np.testing.assert_allclose(np.cov(samples[0, 0].T), expected_cov, rtol=0.05)
+        # Reproducible with the same seed
+        np.testing.assert_array_equal(post.sample(5, sample_seed=1), post.sample(5, sample_seed=1))
+
+    def test_sample_mixture_weights(self):
+        """Test that the fraction of samples from the second component matches its weight
+
+        """
+        Y_dim = 1
+        pred = np.array([[[-10.0, 0.0, 10.0, 0.0, 0.5]]]) # [1, 1, Y_dim**2 + 3*Y_dim + 1]
+        post = ParametricBNNPosterior.from_pred(pred, 'DoubleGaussianBNNPosterior', np.zeros(1), np.ones(1))
+        samples = post.sample(20000, sample_seed=123)
+        np.testing.assert_almost_equal(np.mean(samples > 0.0), 0.5*sigmoid(0.5), decimal=2)
+
+    def test_save_load(self):
+        """Test the round trip through the parametric export file and the reader
+
+        """
+        Y_dim = 2
+        pred = np.random.randn(3, 4, Y_dim*4)
+        post = ParametricBNNPosterior.from_pred(pred, 'LowRankGaussianBNNPosterior', np.zeros(Y_dim), np.ones(Y_dim), Y_cols=['a', 'b'])
+        path = os.path.join(self.out_dir, 'bnn_posterior.npz')
+        post.save(path)
+        loaded = ParametricBNNPosterior.from_file(path)
+        np.testing.assert_array_equal(loaded.prec_tril, post.prec_tril)
+        assert loaded.Y_cols == ['a', 'b']
+        samples = load_bnn_posterior_samples(path, n_samples_per_dropout=7, sample_seed=0)
+        np.testing.assert_array_equal(samples, post.sample(7, sample_seed=0))
+        with self.assertRaises(ValueError):
+            load_bnn_posterior_samples(path)
+
+    def test_sample_chunks(self):
+        """Test chunked sampling, the streamed samples export, and the chunked reader
+
+        """
+        Y_dim = 2
+        pred = np.random.randn(3, 4, Y_dim**2 + 3*Y_dim + 1)
+        post = ParametricBNNPosterior.from_pred(pred, 'DoubleGaussianBNNPosterior', np.ones(Y_dim), 2.0*np.ones(Y_dim), n_dropout_per_lens=[4, 4, 2])
+        chunks = list(post.sample_chunks(7, chunk_size=3, sample_seed=0))
+        np.testing.assert_array_equal([chunk.shape[2] for chunk in chunks], [3, 3, 1])
+        np.testing.assert_array_equal(chunks[0], post.sample(3, sample_seed=0))
+        path = os.path.join(self.out_dir, 'samples.npy')
+        post.save_samples(path, 7, chunk_size=3, sample_seed=0)
+        np.testing.assert_array_equal(np.load(path), np.concatenate(chunks, axis=2))
+        read_chunks = list(load_bnn_posterior_samples(path, chunk_size=4))
+        np.testing.assert_array_equal([chunk.shape[2] for chunk in read_chunks], [4, 3])
+        np.testing.assert_array_equal(np.concatenate(read_chunks, axis=2), np.load(path))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,229 @@
+import os
+import shutil
+import unittest
+import tempfile
+import threading
+import numpy as np
+import torch
+import h0rton.models
+import h0rton.losses
+from h0rton.h0_inference.bnn_server import encode_array, decode_array, RequestBatcher, BNNService, make_server, BNNClient
+
+class TestBNNServer(unittest.TestCase):
+    """A suite of tests for the h0rton.h0_inference.bnn_server package
+
+    """
+    @classmethod
+    def setUpClass(cls):
+        torch.set_default_tensor_type(torch.FloatTensor)
+        cls.Y_dim = 2
+        cls.X_dim = 32
+        cls.likelihood_class = 'DoubleGaussianNLL'
+        cls.out_dim = getattr(h0rton.losses, cls.likelihood_class)(Y_dim=cls.Y_dim, device=torch.device('cpu')).out_dim
+        cls.Y_mean = np.array([0.5, -1.0])
+        cls.Y_std = np.array([2.0, 0.1])
+        cls.X = np.random.RandomState(1113).randn(3, 1, cls.X_dim, cls.X_dim).astype(np.float32)
+
+    def get_service(self, dropout_rate=0.1, **kwargs):
+        torch.manual_seed(1113)
+        net = h0rton.models.resnet18_half(num_classes=self.out_dim, dropout_rate=dropout_rate)
+        # Keep the predicted log-variances and mixture weights in a tame range
+        torch.nn.init.normal_(net.fc.weight, std=0.01)
+        service = BNNService(**kwargs)
+        service.add_model('net', net, self.likelihood_class, self.Y_mean, self.Y_std, Y_cols=['a', 'b'], X_dim=self.X_dim)
+        return service
+
+    def test_encode_decode_array(self):
+        """Test the round trip of an array through the JSON-safe encoding
+
+        """
+        array = np.random.randn(2, 3).astype(np.float32)
+        decoded = decode_array(encode_array(array))
+        assert decoded.dtype == array.dtype
+        np.testing.assert_array_equal(decoded, array)
+
+    def test_request_batcher(self):
+        """Test that concurrent requests are coalesced into batches and get their own results back
+
+        """
+        batch_sizes = []
+        def process_batch(payloads):
+            batch_sizes.append(len(payloads))
+            return [2*payload for payload in payloads]
+        batcher = RequestBatcher(process_batch, max_batch_size=100, max_wait=0.5)
+        results = {}
+        def submit(i):
+            results[i] = batcher.submit(i)
+        threads = [threading.Thread(target=submit, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        batcher.close()
+        assert results == {i: 2*i for i in range(8)}
+        assert len(batch_sizes) < 8
+        metrics = batcher.get_metrics()
+        assert metrics['n_requests'] == 8
+        assert metrics['n_batches'] == len(batch_sizes)
+        assert metrics['queue_depth'] == 0
+        assert metrics['latency_p95'] >= metrics['latency_p50'] >= metrics['queue_wait_p50'] >= 0.0
+
+    def test_request_batcher_limits(self):
+        """Test that batches are closed at the size limit and that errors reach the caller
+
+        """
+        batch_sizes = []
+        def process_batch(payloads):
+            if 'bad' in payloads:
+                raise ValueError("bad payload")
+            batch_sizes.append(sum(payloads))
+            return payloads
+        batcher = RequestBatcher(process_batch, max_batch_size=3, max_wait=0.5)
+        threads = [threading.Thread(target=batcher.submit, args=(2,), kwargs=dict(n_items=2)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Each batch is closed as soon as it reaches 3 items
+        assert all(batch_size <= 4 for batch_size in batch_sizes)
+        assert sum(batch_sizes) == 8
+        with self.assertRaises(ValueError):
+            batcher.submit('bad')
+        assert batcher.get_metrics()['n_errors'] == 1
+        batcher.close()
+
+    def test_service_outputs(self):
+        """Test the shape and units of each kind of output
+
+        """
+        service = self.get_service(dropout_rate=0.0)
+        pred = service.predict(self.X, n_dropout=4)
+        np.testing.assert_array_equal(pred.shape, [3, 4, self.out_dim])
+        mean_whitened = service.predict(self.X, n_dropout=4, output='mean')
+        mean = service.predict(self.X, n_dropout=4, output='mean', whitened=False)
+        np.testing.assert_array_equal(mean.shape, [3, 4, self.Y_dim])
+        # Without dropout, all passes are identical, so the two calls can be compared
+        np.testing.assert_allclose(mean, mean_whitened*self.Y_std + self.Y_mean, rtol=1.e-5)
+        samples = service.predict(self.X, n_dropout=4, output='samples', whitened=False, n_samples_per_dropout=5, sample_seed=0)
+        np.testing.assert_array_equal(samples.shape, [3, 4, 5, self.Y_dim])
+        with self.assertRaises(ValueError):
+            service.predict(self.X, output='pred', whitened=False)
+        with self.assertRaises(ValueError):
+            service.predict(self.X, model='missing')
+        service.close()
+
+    def test_service_checks_inputs(self):
+        """Test that requests that can't be batched with the others are refused before they reach the queue
+
+        """
+        service = self.get_service(max_wait=0.5)
+        results = {}
+        def predict(i, X):
+            try:
+                results[i] = service.predict(X, n_dropout=2)
+            except ValueError as e:
+                results[i] = e
+        bad_inputs = [self.X[:, :, :16, :16], np.concatenate([self.X, self.X], axis=1), self.X[0], self.X.astype(str)]
+        threads = [threading.Thread(target=predict, args=(i, X)) for i, X in enumerate([self.X] + bad_inputs + [self.X])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # The valid requests are unaffected by the invalid ones
+        for i in [0, 5]:
+            np.testing.assert_array_equal(results[i].shape, [3, 2, self.out_dim])
+        for i in range(1, 5):
+            assert isinstance(results[i], ValueError)
+        assert service.get_metrics()['net']['n_errors'] == 0
+        service.close()
+
+    def test_load_model_mixture(self):
+        """Test that a mixture network loaded from an artifact is sliced with its own number of components and covariance type
+
+        """
+        likelihood_kwargs = dict(n_components=2, cov_type='diagonal')
+        out_dim = h0rton.losses.MixtureGaussianNLL(Y_dim=self.Y_dim, device=torch.device('cpu'), **likelihood_kwargs).out_dim
+        torch.manual_seed(1113)
+        net = h0rton.models.resnet18_half(num_classes=out_dim, dropout_rate=0.0)
+        torch.nn.init.normal_(net.fc.weight, std=0.01)
+        out_dir = tempfile.mkdtemp()
+        try:
+            artifact_path = os.path.join(out_dir, 'mixture.safetensors')
+            h0rton.models.save_inference_artifact(artifact_path, net, 'resnet18_half', 0.0, 'MixtureGaussianNLL', ['a', 'b'], self.Y_mean, self.Y_std, likelihood_kwargs=likelihood_kwargs)
+            service = BNNService()
+            service.load_model('net', artifact_path, X_dim=self.X_dim)
+        finally:
+            shutil.rmtree(out_dir)
+        pred = service.predict(self.X, n_dropout=2)
+        mean = service.predict(self.X, n_dropout=2, output='mean', whitened=False)
+        service.close()
+        np.testing.assert_array_equal(mean.shape, [3, 2, self.Y_dim])
+        # Weighted mean of the two diagonal components laid out as [mu, log_var] then the logits
+        component_dim = 2*self.Y_dim
+        mu = pred[:, :, :2*component_dim].reshape(3, 2, 2, component_dim)[..., :self.Y_dim]
+        logits = pred[:, :, 2*component_dim:]
+        weights = np.exp(logits - logits.max(axis=-1, keepdims=True))
+        weights /= weights.sum(axis=-1, keepdims=True)
+        expected = np.sum(weights[..., np.newaxis]*mu, axis=2)*self.Y_std + self.Y_mean
+        np.testing.assert_allclose(mean, expected, rtol=1.e-4, atol=1.e-5)
+
+    def test_service_batches_requests(self):
+        """Test that concurrent requests with different numbers of passes are served in shared batches
+
+        """
+        service = self.get_service(max_wait=0.5)
+        results = {}
+        def predict(i):
+            results[i] = service.predict(self.X[:i + 1], n_dropout=i + 2)
+        threads = [threading.Thread(target=predict, args=(i,)) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for i in range(3):
+            np.testing.assert_array_equal(results[i].shape, [i + 1, i + 2, self.out_dim])
+        metrics = service.get_metrics()['net']
+        assert metrics['n_requests'] == 3
+        assert metrics['n_items'] == 6
+        assert metrics['n_batches'] < 3
+        service.close()
+
+    def test_http(self):
+        """Test the HTTP round trip with concurrent clients
+
+        """
+        service = self.get_service(max_wait=0.2)
+        server = make_server(service, port=0)
+        server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+        server_thread.start()
+        client = BNNClient('http://127.0.0.1:{:d}'.format(server.server_address[1]))
+        try:
+            assert client.get_model_info()['net']['Y_cols'] == ['a', 'b']
+            results = {}
+            def predict(i):
+                results[i] = client.predict(self.X, n_dropout=3, output='samples', n_samples_per_dropout=2)
+            threads = [threading.Thread(target=predict, args=(i,)) for i in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            for i in range(4):
+                np.testing.assert_array_equal(results[i].shape, [3, 3, 2, self.Y_dim])
+            metrics = client.get_metrics()['net']
+            assert metrics['n_requests'] == 4
+            assert metrics['n_batches'] < 4
+            with self.assertRaises(ValueError):
+                client.predict(self.X, output='unknown')
+            # Unexpected server errors are still answered
+            def fail(**kwargs):
+                raise RuntimeError("forward pass failed")
+            service.predict = fail
+            with self.assertRaisesRegex(ValueError, 'RuntimeError'):
+                client.predict(self.X)
+        finally:
+            server.shutdown()
+            server.server_close()
+            service.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import unittest
+import numpy as np
+from scipy.stats import norm, chi2
+from h0rton.h0_inference.bnn_posterior_export import ParametricBNNPosterior
+from h0rton.h0_inference.calibration import get_truth_levels, get_coverage_curves, get_coverage_summary
+
+class TestCalibration(unittest.TestCase):
+    """A suite of tests for the h0rton.h0_inference.calibration package
+
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.Y_dim = 3
+        cls.tril_len = cls.Y_dim*(cls.Y_dim + 1)//2
+
+    def setUp(self):
+        np.random.seed(1113)
+
+    def test_single_gaussian_levels(self):
+        """Test the truth levels of single Gaussians against the closed-form Mahalanobis and marginal levels
+
+        """
+        n_lenses = 4
+        Y_mean = np.array([1.0, -2.0, 0.5])
+        Y_std = np.array([0.5, 3.0, 1.0])
+        pred = np.concatenate([np.random.randn(n_lenses, 1, self.Y_dim), 0.3*np.random.randn(n_lenses, 1, self.tril_len)], axis=2)
+        bnn_post = ParametricBNNPosterior.from_pred(pred, 'FullRankGaussianBNNPosterior', Y_mean, Y_std)
+        Y = np.random.randn(n_lenses, self.Y_dim)
+        levels = get_truth_levels(bnn_post, Y)
+        prec_tril = bnn_post.prec_tril[:, 0, 0]
+        cov = np.linalg.inv(np.matmul(prec_tril, np.swapaxes(prec_tril, 1, 2)))
+        resid = Y - pred[:, 0, :self.Y_dim]
+        mahalanobis2 = np.einsum('ni,nij,nj->n', resid, np.linalg.inv(cov), resid)
+        np.testing.assert_allclose(levels['joint'], chi2.cdf(mahalanobis2, df=self.Y_dim), rtol=1.e-8)
+        z = resid/np.sqrt(np.diagonal(cov, axis1=1, axis2=2))
+        np.testing.assert_allclose(levels['marginal'], np.abs(2.0*norm.cdf(z) - 1.0), rtol=1.e-8)
+        # Unwhitened truths give the same levels
+        unwhitened = get_truth_levels(bnn_post, Y*Y_std + Y_mean, whitened=False)
+        np.testing.assert_allclose(unwhitened['joint'], levels['joint'], rtol=1.e-8)
+
+    def test_mc_dropout_coverage(self):
+        """Test that truths drawn from the MC dropout mixtures themselves are covered at the nominal levels
+
+        """
+        n_lenses = 4000
+        n_dropout = 5
+        pred = np.concatenate([0.3*np.random.randn(n_lenses, n_dropout, self.Y_dim),
+                               0.1*np.random.randn(n_lenses, n_dropout, self.tril_len),
+                               0.3*np.random.randn(n_lenses, n_dropout, self.Y_dim),
+                               0.1*np.random.randn(n_lenses, n_dropout, self.tril_len),
+                               np.random.randn(n_lenses, n_dropout, 1)], axis=2)
+        # Padded passes must not contribute
+        n_dropout_per_lens = np.random.randint(1, n_dropout + 1, size=n_lenses)
+        pred[np.arange(n_dropout)[np.newaxis, :] >= n_dropout_per_lens[:, np.newaxis]] = np.nan
+        bnn_post = ParametricBNNPosterior.from_pred(pred, 'DoubleGaussianBNNPosterior', np.zeros(self.Y_dim), np.ones(self.Y_dim), n_dropout_per_lens)
+        samples = bnn_post.sample(1, sample_seed=0)[:, :, 0, :] # [n_lenses, n_dropout, Y_dim]
+        Y = samples[np.arange(n_lenses), (np.random.rand(n_lenses)*n_dropout_per_lens).astype(int)]
+        levels = get_truth_levels(bnn_post, Y)
+        curves = get_coverage_curves(levels, ['a', 'b', 'c'], [0.5, 0.9])
+        np.testing.assert_array_equal(curves.columns, ['credible_level', 'joint', 'a', 'b', 'c'])
+        # The marginal levels are exact, the joint ones approximate the mixture by a Gaussian
+        np.testing.assert_allclose(curves[['a', 'b', 'c']].values, [[0.5]*3, [0.9]*3], atol=0.03)
+        np.testing.assert_allclose(curves['joint'].values, [0.5, 0.9], atol=0.05)
+        summary = get_coverage_summary(levels)
+        assert set(['coverage_68_joint', 'coverage_95_marginal', 'coverage_99_param_2']) <= set(summary.keys())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,9 @@
 import unittest
 import numpy as np
 import torch
-from h0rton.h0_inference import DiagonalGaussianBNNPosterior, LowRankGaussianBNNPosterior, DoubleLowRankGaussianBNNPosterior, FullRankGaussianBNNPosterior, DoubleGaussianBNNPosterior
+import h0rton.h0_inference.gaussian_bnn_posterior
+import h0rton.h0_inference.gaussian_bnn_posterior_cpu
+from h0rton.h0_inference import DiagonalGaussianBNNPosterior, LowRankGaussianBNNPosterior, DoubleLowRankGaussianBNNPosterior, FullRankGaussianBNNPosterior, DoubleGaussianBNNPosterior, MixtureGaussianBNNPosterior
 from h0rton.h0_inference.gaussian_bnn_posterior_cpu import sigmoid
 
 class TestGaussianBNNPosterior(unittest.TestCase):
@@ -217,5 +219,100 @@ class TestGaussianBNNPosterior(unittest.TestCase):
         np_mean = mu*w1 + mu2*w2
         np.testing.assert_array_almost_equal(h0rton_mean, np_mean, decimal=2)
 
+    def test_mixture_assignment(self):
+        """Test that every sample of `DoubleGaussianBNNPosterior` comes from one of the two components, in proportion to their weights
+
+        """
+        Y_dim = 2
+        batch_size = 4
+        tril_len = Y_dim*(Y_dim + 1)//2
+        # Well-separated components with narrow, full-rank covariances
+        mu = np.zeros([batch_size, Y_dim])
+        mu2 = np.full([batch_size, Y_dim], 100.0)
+        tril_elements = np.tile([3.0, 0.5, 3.0], [batch_size, 1])
+        alpha = np.array([[-2.0], [0.0], [2.0], [20.0]])
+        pred = np.concatenate([mu, tril_elements, mu2, tril_elements, alpha], axis=1)
+        post = DoubleGaussianBNNPosterior(Y_dim, torch.device('cpu'), np.zeros(Y_dim), np.ones(Y_dim))
+        post.set_sliced_pred(torch.Tensor(pred))
+        samples = post.sample(20000, 1113)
+        from_second = samples[:, :, 0] > 50.0
+        assert np.all(np.abs(samples[~from_second]) < 1.0)
+        assert np.all(np.abs(samples[from_second] - 100.0) < 1.0)
+        np.testing.assert_allclose(from_second.mean(axis=1), 0.5*sigmoid(alpha[:, 0]), atol=0.01)
+
+    def test_mixture_gaussian_bnn_posterior(self):
+        """Test that the samples of `MixtureGaussianBNNPosterior` come from each of its K components in proportion to the weights, for each covariance family
+
+        """
+        Y_dim = 2
+        batch_size = 3
+        n_components = 4
+        rank = 1
+        # Well-separated components with narrow covariances
+        logits = np.random.randn(batch_size, n_components)
+        weights = np.exp(logits)/np.sum(np.exp(logits), axis=1, keepdims=True)
+        for cov_type, cov_params in [('diagonal', [-6.0, -6.0]), ('low_rank', [-6.0, -6.0, 0.01, 0.01]), ('full_rank', [3.0, 0.5, 3.0])]:
+            components = [np.concatenate([np.full([batch_size, Y_dim], 10.0*k), np.tile(cov_params, [batch_size, 1])], axis=1) for k in range(n_components)]
+            pred = np.concatenate(components + [logits], axis=1)
+            post = MixtureGaussianBNNPosterior(Y_dim, torch.device('cpu'), np.zeros(Y_dim), np.ones(Y_dim), n_components=n_components, cov_type=cov_type, rank=rank)
+            assert post.out_dim == pred.shape[1]
+            post.set_sliced_pred(torch.Tensor(pred))
+            for sampling in ['mc', 'qmc']:
+                samples = post.sample(20000, 1113, sampling)
+                component = np.round(samples[:, :, 0]/10.0)
+                assert np.all(np.abs(samples - 10.0*component[:, :, np.newaxis]) < 1.0)
+                for k in range(n_components):
+                    np.testing.assert_allclose(np.mean(component == k, axis=1), weights[:, k], atol=0.015)
+            marginal_weights, marginal_mu, marginal_sd = [np.asarray(x) for x in post.get_marginal_components()]
+            np.testing.assert_allclose(marginal_weights, weights, rtol=1.e-5)
+            np.testing.assert_allclose(marginal_mu[:, 0, :], np.tile(10.0*np.arange(n_components), [batch_size, 1]))
+            assert np.all(marginal_sd < 0.2)
+
+    def test_variance_reduction(self):
+        """Test that antithetic and QMC sampling estimate the posterior mean with less variance than MC, and that QMC stratifies the mixture assignment
+
+        """
+        Y_dim = 2
+        tril_len = Y_dim*(Y_dim + 1)//2
+        device = torch.device('cpu')
+        pred = np.concatenate([np.random.randn(3, Y_dim), 0.3*np.random.randn(3, tril_len)], axis=1)
+        post = FullRankGaussianBNNPosterior(Y_dim, device, np.zeros(Y_dim), np.ones(Y_dim))
+        post.set_sliced_pred(torch.Tensor(pred))
+        np.testing.assert_allclose(post.sample(64, 1113, 'antithetic').mean(axis=1), pred[:, :Y_dim], atol=1.e-5)
+        mean_var = {}
+        for sampling in ['mc', 'qmc']:
+            means = np.stack([post.sample(256, seed, sampling).mean(axis=1) for seed in range(50)], axis=0)
+            mean_var[sampling] = means.var(axis=0).mean()
+        assert mean_var['qmc'] < 0.1*mean_var['mc']
+        mu = np.zeros([4, Y_dim])
+        tril_elements = np.tile([3.0, 0.5, 3.0], [4, 1])
+        alpha = np.array([[-2.0], [0.0], [2.0], [20.0]])
+        pred = np.concatenate([mu, tril_elements, mu + 100.0, tril_elements, alpha], axis=1)
+        post = DoubleGaussianBNNPosterior(Y_dim, device, np.zeros(Y_dim), np.ones(Y_dim))
+        post.set_sliced_pred(torch.Tensor(pred))
+        samples = post.sample(100, 1113, 'qmc')
+        n_second = (samples[:, :, 0] > 50.0).sum(axis=1)
+        assert np.all(np.abs(n_second - 100*0.5*sigmoid(alpha[:, 0])) < 1.0)
+
+    def test_marginal_intervals(self):
+        """Test that the analytic marginal quantiles and HPD intervals match those of the CPU classes
+
+        """
+        Y_dim = 2
+        batch_size = 3
+        tril_len = Y_dim*(Y_dim + 1)//2
+        Y_mean = np.array([1.0, -2.0])
+        Y_std = np.array([0.5, 3.0])
+        device = torch.device('cpu')
+        pred = np.concatenate([np.random.randn(batch_size, Y_dim), 0.3*np.random.randn(batch_size, tril_len), 3.0 + np.random.randn(batch_size, Y_dim), 0.3*np.random.randn(batch_size, tril_len), np.random.randn(batch_size, 1)], axis=1)
+        low_rank_pred = np.random.randn(batch_size, 8*Y_dim + 1)
+        for posterior_name, pred in [('DoubleGaussianBNNPosterior', pred), ('DoubleLowRankGaussianBNNPosterior', low_rank_pred)]:
+            post = getattr(h0rton.h0_inference.gaussian_bnn_posterior, posterior_name)(Y_dim, device, Y_mean, Y_std)
+            post.set_sliced_pred(torch.from_numpy(pred))
+            cpu_post = getattr(h0rton.h0_inference.gaussian_bnn_posterior_cpu, posterior_name + 'CPU')(Y_dim, Y_mean, Y_std)
+            cpu_post.set_sliced_pred(pred)
+            np.testing.assert_allclose(post.get_marginal_quantiles([0.1, 0.5]), cpu_post.get_marginal_quantiles([0.1, 0.5]), rtol=1.e-6)
+            np.testing.assert_allclose(post.get_hpd_interval(), cpu_post.get_hpd_interval(), rtol=1.e-6)
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,7 +1,7 @@
 import unittest
 import numpy as np
 import torch
-from h0rton.h0_inference.gaussian_bnn_posterior_cpu import DiagonalGaussianBNNPosteriorCPU, LowRankGaussianBNNPosteriorCPU, DoubleLowRankGaussianBNNPosteriorCPU, FullRankGaussianBNNPosteriorCPU, DoubleGaussianBNNPosteriorCPU
+from h0rton.h0_inference.gaussian_bnn_posterior_cpu import DiagonalGaussianBNNPosteriorCPU, LowRankGaussianBNNPosteriorCPU, DoubleLowRankGaussianBNNPosteriorCPU, FullRankGaussianBNNPosteriorCPU, DoubleGaussianBNNPosteriorCPU, MixtureGaussianBNNPosteriorCPU
 from h0rton.h0_inference.gaussian_bnn_posterior_cpu import sigmoid
 
 class TestGaussianBNNPosteriorCPU(unittest.TestCase):
@@ -122,6 +122,42 @@ class TestGaussianBNNPosteriorCPU(unittest.TestCase):
         exp_mean = mu*w1 + mu2*w2
         np.testing.assert_array_almost_equal(h0rton_mean, exp_mean, decimal=2)
 
+    def test_general_rank_gaussian_bnn_posterior_cpu(self):
+        """Test the sampling of `LowRankGaussianBNNPosteriorCPU` with a rank other than 2
+
+        """
+        Y_dim = 3
+        batch_size = 2
+        rank = 5
+        mu = np.random.randn(batch_size, Y_dim)
+        logvar = np.random.randn(batch_size, Y_dim)
+        F = 0.5*np.random.randn(batch_size, Y_dim, rank)
+        pred = np.concatenate([mu, logvar, F.reshape(batch_size, -1)], axis=1)
+        bnn_post = LowRankGaussianBNNPosteriorCPU(Y_dim, np.zeros(Y_dim), np.ones(Y_dim), rank=rank)
+        assert bnn_post.out_dim == pred.shape[1]
+        bnn_post.set_sliced_pred(pred)
+        samples = bnn_post.sample(10**6, 1113)
+        exp_cov = np.matmul(F, np.swapaxes(F, 1, 2)) + np.apply_along_axis(np.diag, -1, np.exp(logvar))
+        for b in range(batch_size):
+            np.testing.assert_array_almost_equal(np.cov(samples[b].T), exp_cov[b], decimal=2)
+
+    def test_low_rank_unwhitening_cpu(self):
+        """Test that the low-rank posteriors return samples in the unwhitened units, like the other posteriors
+
+        """
+        Y_dim = 2
+        batch_size = 3
+        Y_mean = np.array([100.0, 200.0])
+        Y_std = np.array([2.0, 5.0])
+        # Zero whitened mean, with a narrow low-rank plus diagonal covariance
+        low_rank_pred = np.concatenate([np.zeros([batch_size, Y_dim]), np.full([batch_size, Y_dim], -4.0), np.full([batch_size, 2*Y_dim], 0.1)], axis=1)
+        post = LowRankGaussianBNNPosteriorCPU(Y_dim, Y_mean, Y_std)
+        post.set_sliced_pred(low_rank_pred)
+        np.testing.assert_allclose(post.sample(20000, 1113).mean(axis=1), np.tile(Y_mean, [batch_size, 1]), atol=0.05)
+        post = DoubleLowRankGaussianBNNPosteriorCPU(Y_dim, Y_mean, Y_std)
+        post.set_sliced_pred(np.concatenate([low_rank_pred, low_rank_pred, np.zeros([batch_size, 1])], axis=1))
+        np.testing.assert_allclose(post.sample(20000, 1113).mean(axis=1), np.tile(Y_mean, [batch_size, 1]), atol=0.05)
+
     def test_full_rank_gaussian_bnn_posterior_cpu(self):
         """Test the sampling of `FullRankGaussianBNNPosteriorCPU`
 
@@ -206,5 +242,170 @@ class TestGaussianBNNPosteriorCPU(unittest.TestCase):
         np_mean = mu*w1 + mu2*w2
         np.testing.assert_array_almost_equal(h0rton_mean, np_mean, decimal=2)
 
+    def test_mixture_assignment_cpu(self):
+        """Test that every sample of `DoubleGaussianBNNPosteriorCPU` comes from one of the two components, in proportion to their weights
+
+        """
+        Y_dim = 2
+        batch_size = 4
+        tril_len = Y_dim*(Y_dim + 1)//2
+        # Well-separated components with narrow, full-rank covariances
+        mu = np.zeros([batch_size, Y_dim])
+        mu2 = np.full([batch_size, Y_dim], 100.0)
+        tril_elements = np.tile([3.0, 0.5, 3.0], [batch_size, 1])
+        alpha = np.array([[-2.0], [0.0], [2.0], [20.0]])
+        pred = np.concatenate([mu, tril_elements, mu2, tril_elements, alpha], axis=1)
+        post = DoubleGaussianBNNPosteriorCPU(Y_dim, np.zeros(Y_dim), np.ones(Y_dim))
+        post.set_sliced_pred(pred)
+        samples = post.sample(20000, 1113)
+        from_second = samples[:, :, 0] > 50.0
+        assert np.all(np.abs(samples[~from_second]) < 1.0)
+        assert np.all(np.abs(samples[from_second] - 100.0) < 1.0)
+        np.testing.assert_allclose(from_second.mean(axis=1), 0.5*sigmoid(alpha[:, 0]), atol=0.01)
+
+    def test_sample_chunks_cpu(self):
+        """Test that chunked sampling reproduces `sample` in a single chunk and is deterministic across chunks
+
+        """
+        Y_dim = 2
+        batch_size = 3
+        tril_len = Y_dim*(Y_dim + 1)//2
+        pred = np.random.randn(batch_size, 2*(Y_dim + tril_len) + 1)
+        post = DoubleGaussianBNNPosteriorCPU(Y_dim, np.zeros(Y_dim), np.ones(Y_dim))
+        post.set_sliced_pred(pred)
+        chunks = list(post.sample_chunks(10, chunk_size=10, sample_seed=1113))
+        assert len(chunks) == 1
+        np.testing.assert_array_equal(chunks[0], post.sample(10, 1113))
+        chunks = list(post.sample_chunks(25, chunk_size=10, sample_seed=1113))
+        np.testing.assert_array_equal([chunk.shape[1] for chunk in chunks], [10, 10, 5])
+        np.testing.assert_array_equal(chunks[0], post.sample(10, 1113))
+        # Later chunks are not repeats of the first one
+        assert not np.allclose(chunks[1], chunks[0])
+        chunks_again = list(post.sample_chunks(25, chunk_size=10, sample_seed=1113))
+        np.testing.assert_array_equal(np.concatenate(chunks, axis=1), np.concatenate(chunks_again, axis=1))
+
+    def test_mixture_gaussian_bnn_posterior_cpu(self):
+        """Test that the samples of `MixtureGaussianBNNPosteriorCPU` come from each of its K components in proportion to the weights, for each covariance family
+
+        """
+        Y_dim = 2
+        batch_size = 3
+        n_components = 4
+        rank = 1
+        # Well-separated components with narrow covariances
+        logits = np.random.randn(batch_size, n_components)
+        weights = np.exp(logits)/np.sum(np.exp(logits), axis=1, keepdims=True)
+        for cov_type, cov_params in [('diagonal', [-6.0, -6.0]), ('low_rank', [-6.0, -6.0, 0.01, 0.01]), ('full_rank', [3.0, 0.5, 3.0])]:
+            components = [np.concatenate([np.full([batch_size, Y_dim], 10.0*k), np.tile(cov_params, [batch_size, 1])], axis=1) for k in range(n_components)]
+            pred = np.concatenate(components + [logits], axis=1)
+            post = MixtureGaussianBNNPosteriorCPU(Y_dim, np.zeros(Y_dim), np.ones(Y_dim), n_components=n_components, cov_type=cov_type, rank=rank)
+            assert post.out_dim == pred.shape[1]
+            post.set_sliced_pred(pred)
+            for sampling in ['mc', 'qmc']:
+                samples = post.sample(20000, 1113, sampling)
+                component = np.round(samples[:, :, 0]/10.0)
+                assert np.all(np.abs(samples - 10.0*component[:, :, np.newaxis]) < 1.0)
+                for k in range(n_components):
+                    np.testing.assert_allclose(np.mean(component == k, axis=1), weights[:, k], atol=0.015)
+            marginal_weights, marginal_mu, marginal_sd = [np.asarray(x) for x in post.get_marginal_components()]
+            np.testing.assert_allclose(marginal_weights, weights, rtol=1.e-5)
+            np.testing.assert_allclose(marginal_mu[:, 0, :], np.tile(10.0*np.arange(n_components), [batch_size, 1]))
+            assert np.all(marginal_sd < 0.2)
+
+    def test_mixture_unwhitening_cpu(self):
+        """Test that all the covariance families of `MixtureGaussianBNNPosteriorCPU` return samples in the unwhitened units
+
+        """
+        Y_dim = 2
+        batch_size = 3
+        n_components = 2
+        Y_mean = np.array([100.0, 200.0])
+        Y_std = np.array([2.0, 5.0])
+        for cov_type, cov_params in [('diagonal', [-4.0, -4.0]), ('low_rank', [-4.0, -4.0, 0.1, 0.1]), ('full_rank', [2.0, 0.5, 2.0])]:
+            # Components with zero whitened mean
+            components = [np.concatenate([np.zeros([batch_size, Y_dim]), np.tile(cov_params, [batch_size, 1])], axis=1) for k in range(n_components)]
+            pred = np.concatenate(components + [np.zeros([batch_size, n_components])], axis=1)
+            post = MixtureGaussianBNNPosteriorCPU(Y_dim, Y_mean, Y_std, n_components=n_components, cov_type=cov_type, rank=1)
+            post.set_sliced_pred(pred)
+            np.testing.assert_allclose(post.sample(20000, 1113).mean(axis=1), np.tile(Y_mean, [batch_size, 1]), atol=0.05, err_msg=cov_type)
+
+    def test_variance_reduction_cpu(self):
+        """Test that antithetic and QMC sampling estimate the posterior mean with less variance than MC, and that QMC stratifies the mixture assignment
+
+        """
+        Y_dim = 2
+        tril_len = Y_dim*(Y_dim + 1)//2
+        pred = np.concatenate([np.random.randn(3, Y_dim), 0.3*np.random.randn(3, tril_len)], axis=1)
+        post = FullRankGaussianBNNPosteriorCPU(Y_dim, np.zeros(Y_dim), np.ones(Y_dim))
+        post.set_sliced_pred(pred)
+        # Antithetic pairs cancel exactly about the mean
+        np.testing.assert_allclose(post.sample(64, 1113, 'antithetic').mean(axis=1), pred[:, :Y_dim], atol=1.e-10)
+        mean_var = {}
+        for sampling in ['mc', 'qmc']:
+            means = np.stack([post.sample(256, seed, sampling).mean(axis=1) for seed in range(50)], axis=0)
+            mean_var[sampling] = means.var(axis=0).mean()
+        assert mean_var['qmc'] < 0.1*mean_var['mc']
+        with self.assertRaises(ValueError):
+            post.sample(10, 1113, 'sobol')
+        # Well-separated mixture components
+        mu = np.zeros([4, Y_dim])
+        tril_elements = np.tile([3.0, 0.5, 3.0], [4, 1])
+        alpha = np.array([[-2.0], [0.0], [2.0], [20.0]])
+        pred = np.concatenate([mu, tril_elements, mu + 100.0, tril_elements, alpha], axis=1)
+        post = DoubleGaussianBNNPosteriorCPU(Y_dim, np.zeros(Y_dim), np.ones(Y_dim))
+        post.set_sliced_pred(pred)
+        for sampling in ['antithetic', 'qmc']:
+            samples = post.sample(100, 1113, sampling)
+            n_second = (samples[:, :, 0] > 50.0).sum(axis=1)
+            assert np.all(np.abs(n_second - 100*0.5*sigmoid(alpha[:, 0])) < 1.0)
+
+    def test_marginal_intervals_cpu(self):
+        """Test the analytic marginal quantiles and HPD intervals against the covariance matrices and the mixture CDFs
+
+        """
+        from scipy.stats import norm
+        Y_dim = 2
+        batch_size = 3
+        tril_len = Y_dim*(Y_dim + 1)//2
+        Y_mean = np.array([1.0, -2.0])
+        Y_std = np.array([0.5, 3.0])
+        q = np.array([0.05, 0.5, 0.9])
+        # Full rank: Gaussian quantiles from the diagonal of the inverse precision matrix
+        pred = np.concatenate([np.random.randn(batch_size, Y_dim), 0.3*np.random.randn(batch_size, tril_len)], axis=1)
+        post = FullRankGaussianBNNPosteriorCPU(Y_dim, Y_mean, Y_std)
+        post.set_sliced_pred(pred)
+        cov = np.linalg.inv(np.matmul(post.prec_tril, np.swapaxes(post.prec_tril, 1, 2)))
+        sd = np.sqrt(np.diagonal(cov, axis1=1, axis2=2))*Y_std
+        mu = pred[:, :Y_dim]*Y_std + Y_mean
+        expected = mu[:, :, np.newaxis] + sd[:, :, np.newaxis]*norm.ppf(q)
+        np.testing.assert_allclose(post.get_marginal_quantiles(q), expected, rtol=1.e-8)
+        hpd = post.get_hpd_interval(0.9)
+        np.testing.assert_allclose(hpd, np.stack([mu - norm.ppf(0.95)*sd, mu + norm.ppf(0.95)*sd], axis=2), rtol=1.e-8)
+        # Low rank: the marginal variances include the low-rank portion
+        pred = np.random.randn(batch_size, 4*Y_dim)
+        post = LowRankGaussianBNNPosteriorCPU(Y_dim, Y_mean, Y_std)
+        post.set_sliced_pred(pred)
+        F = pred[:, 2*Y_dim:].reshape(batch_size, Y_dim, 2)
+        sd = np.sqrt(np.exp(pred[:, Y_dim:2*Y_dim]) + np.sum(F**2.0, axis=2))*Y_std
+        np.testing.assert_allclose(post.get_marginal_quantiles(0.5)[:, :, 0], pred[:, :Y_dim]*Y_std + Y_mean)
+        np.testing.assert_allclose(post.get_marginal_quantiles(norm.cdf(1.0))[:, :, 0], pred[:, :Y_dim]*Y_std + Y_mean + sd)
+        # The samples of the same posterior have the same quantiles
+        samples = post.sample(100000, 1113)
+        np.testing.assert_allclose(np.moveaxis(np.quantile(samples, q, axis=1), 0, -1), post.get_marginal_quantiles(q), atol=0.03*np.max(sd))
+        # Mixture: the CDF at the quantiles matches, and the HPD interval holds the requested mass and is no longer than the central one
+        pred = np.concatenate([np.random.randn(batch_size, Y_dim), 0.3*np.random.randn(batch_size, tril_len), 3.0 + np.random.randn(batch_size, Y_dim), 0.3*np.random.randn(batch_size, tril_len), np.random.randn(batch_size, 1)], axis=1)
+        post = DoubleGaussianBNNPosteriorCPU(Y_dim, Y_mean, Y_std)
+        post.set_sliced_pred(pred)
+        weights, mu, sd = post.get_marginal_components()
+        mu = mu*Y_std.reshape(1, -1, 1) + Y_mean.reshape(1, -1, 1)
+        sd = sd*Y_std.reshape(1, -1, 1)
+        def mixture_cdf(x):
+            return np.sum(weights[:, np.newaxis, np.newaxis, :]*norm.cdf(x[..., np.newaxis], mu[:, :, np.newaxis, :], sd[:, :, np.newaxis, :]), axis=-1)
+        np.testing.assert_allclose(mixture_cdf(post.get_marginal_quantiles(q)), np.broadcast_to(q, [batch_size, Y_dim, 3]), atol=1.e-8)
+        hpd = post.get_hpd_interval(0.9)
+        np.testing.assert_allclose(mixture_cdf(hpd[:, :, 1:]) - mixture_cdf(hpd[:, :, :1]), 0.9, atol=1.e-6)
+        central = post.get_marginal_quantiles([0.05, 0.95])
+        assert np.all(hpd[:, :, 1] - hpd[:, :, 0] <= central[:, :, 1] - central[:, :, 0] + 1.e-8)
+
 if __name__ == '__main__':
     unittest.main()
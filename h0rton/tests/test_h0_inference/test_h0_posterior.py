@@ -83,6 +83,19 @@ class TestH0Posterior(unittest.TestCase):
         np.testing.assert_almost_equal(np.mean(kappa_samples), self.kappa_loc, decimal=2, err_msg="original kappa")
         np.testing.assert_almost_equal(np.std(kappa_samples, ddof=1), self.kappa_std, decimal=2, err_msg="original kappa std")
 
+    def test_H0Posterior_kappa_sampling_many(self):
+        """Test the vectorized sampling of the original and transformed kappa
+
+        """
+        h0_post = H0Posterior(self.H0_prior, self.kappa_ext_prior_transformed, self.kwargs_model, self.baobab_time_delays, self.true_Om0, self.define_src_pos_wrt_lens, exclude_vel_disp=True, aniso_param_prior=None, kinematics=None, kappa_transformed=True, kwargs_lens_eqn_solver=self.kwargs_lens_eqn_solver)
+        kappa_samples = h0_post.sample_kappa_ext_many([100, 100], np.random.RandomState(0))
+        assert kappa_samples.shape == (100, 100)
+        kappa_transformed_samples = 1.0/(1.0 - kappa_samples)
+        np.testing.assert_almost_equal(np.mean(kappa_transformed_samples), self.transformed_kappa_loc, decimal=2, err_msg="transformed kappa mean")
+        np.testing.assert_almost_equal(np.std(kappa_transformed_samples, ddof=1), self.kappa_std, decimal=2, err_msg="transformed kappa std")
+        kappa_samples = h0_post.sample_kappa_ext_many(10000, np.random.RandomState(0), transformed=False)
+        np.testing.assert_almost_equal(np.mean(kappa_samples), self.transformed_kappa_loc, decimal=2, err_msg="original kappa")
+
     def test_H0Posterior_H0_sampling(self):
         """Test sampling of H0
 
@@ -121,14 +134,62 @@ class TestH0Posterior(unittest.TestCase):
         h0_post.set_cosmology_observables(self.z_lens, self.z_src, measured_td_wrt0, 0.25, abcd_ordering_i=range(len(true_y_image)), true_img_dec=true_y_image, true_img_ra=true_x_image, kappa_ext=self.true_kappa_ext)
         # "Infer" the H0 given the true time delays as measurement data, true kappa, and true lens model
         h0_samples = np.empty(5000)
-        h0_weights = np.empty(5000)
+        h0_log_weights = np.empty(5000)
         for i in range(5000):
-            h0_samples[i], h0_weights[i] = h0_post.get_h0_sample(self.lens_model, i)
-        normal_stats = h0_utils.get_normal_stats_naive(h0_samples, h0_weights)
+            h0_samples[i], h0_log_weights[i] = h0_post.get_h0_sample(self.lens_model, i)
+        normal_stats = h0_utils.get_normal_stats_naive(h0_samples, all_log_weights=h0_log_weights)
 
         # Compare the inferred central H0 with truth
         np.testing.assert_almost_equal(normal_stats['mean'], self.true_H0, decimal=1, err_msg="H0 sampling")
 
+    def test_H0Posterior_vectorized_H0_recovery(self):
+        """Test if the vectorized sampler recovers the true H0 and gives the same weights as the per-sample sampler
+
+        """
+        import pandas as pd
+        h0_post = H0Posterior(self.H0_prior, self.kappa_ext_prior_true, self.kwargs_model, self.baobab_time_delays, self.true_Om0, self.define_src_pos_wrt_lens, exclude_vel_disp=True, aniso_param_prior=None, kinematics=None, kappa_transformed=False, kwargs_lens_eqn_solver=self.kwargs_lens_eqn_solver)
+        formatted_lens_model = h0_post.format_lens_model(self.lens_model)
+        true_td, true_x_image, true_y_image = self.td_cosmo.time_delays(formatted_lens_model['kwargs_lens'], formatted_lens_model['kwargs_ps'], kappa_ext=self.true_kappa_ext)
+        increasing_dec_i = np.argsort(true_y_image)
+        measured_td = true_td[increasing_dec_i]
+        measured_td_wrt0 = measured_td[1:] - measured_td[0]
+        h0_post.set_cosmology_observables(self.z_lens, self.z_src, measured_td_wrt0, 0.25, abcd_ordering_i=range(len(true_y_image)), true_img_dec=true_y_image, true_img_ra=true_x_image, kappa_ext=self.true_kappa_ext)
+        lens_model_samples = pd.DataFrame([self.lens_model]*2)
+        h0_samples, h0_log_weights = h0_post.get_h0_samples(lens_model_samples, 2500, np.random.RandomState(0))
+        assert h0_samples.shape == (2, 2500)
+        normal_stats = h0_utils.get_normal_stats_naive(h0_samples.ravel(), all_log_weights=h0_log_weights.ravel())
+        np.testing.assert_almost_equal(normal_stats['mean'], self.true_H0, decimal=1, err_msg="vectorized H0 sampling")
+        # Same weight as the per-sample sampler for the same draw
+        h0_sample, log_weight = h0_post.get_h0_sample(self.lens_model, np.random.RandomState(1))
+        h0_samples, h0_log_weights = h0_post.get_h0_samples(lens_model_samples.iloc[:1], 1, np.random.RandomState(1))
+        np.testing.assert_almost_equal(h0_samples[0, 0], h0_sample)
+        np.testing.assert_allclose(h0_log_weights[0, 0], log_weight, rtol=1.e-6)
+
+    def test_batched_solver_fallback(self):
+        """Test that lens-model samples for which the batched lens equation solver misses images fall back to lenstronomy rather than being dropped
+
+        """
+        import pandas as pd
+        from unittest import mock
+        from h0rton.h0_inference import lens_equation_solver
+        h0_post = H0Posterior(self.H0_prior, self.kappa_ext_prior_true, self.kwargs_model, self.baobab_time_delays, self.true_Om0, self.define_src_pos_wrt_lens, exclude_vel_disp=True, aniso_param_prior=None, kinematics=None, kappa_transformed=False, kwargs_lens_eqn_solver=self.kwargs_lens_eqn_solver)
+        formatted_lens_model = h0_post.format_lens_model(self.lens_model)
+        true_td, true_x_image, true_y_image = self.td_cosmo.time_delays(formatted_lens_model['kwargs_lens'], formatted_lens_model['kwargs_ps'], kappa_ext=self.true_kappa_ext)
+        measured_td = true_td[np.argsort(true_y_image)]
+        h0_post.set_cosmology_observables(self.z_lens, self.z_src, measured_td[1:] - measured_td[0], 0.25, abcd_ordering_i=range(len(true_y_image)), true_img_dec=true_y_image, true_img_ra=true_x_image, kappa_ext=self.true_kappa_ext)
+        lens_model_samples = pd.DataFrame([self.lens_model]*3)
+        expected = h0_post.get_fiducial_td_wrt0_many(lens_model_samples)
+        solve_lens_equation = lens_equation_solver.solve_lens_equation
+        def solve_missing_images(*args, **kwargs):
+            images = solve_lens_equation(*args, **kwargs)
+            images['is_consistent'][0] = False
+            images['n_images'][1] = 1
+            return images
+        with mock.patch.object(lens_equation_solver, 'solve_lens_equation', solve_missing_images):
+            fiducial_td_wrt0 = h0_post.get_fiducial_td_wrt0_many(lens_model_samples)
+        assert np.all(np.isfinite(fiducial_td_wrt0))
+        np.testing.assert_allclose(fiducial_td_wrt0, expected, rtol=1.e-6)
+
     def test_chuck_images(self):
         """Test if the correct images are removed in the case of extra image detections
 
@@ -1,6 +1,6 @@
 import unittest
 import numpy as np
-from scipy.stats import norm, lognorm, multivariate_normal
+from scipy.stats import norm, lognorm, uniform, multivariate_normal
 from h0rton.h0_inference import h0_utils
 
 class TestH0Utils(unittest.TestCase):
@@ -36,6 +36,51 @@ class TestH0Utils(unittest.TestCase):
         pred = h0_utils.gaussian_ll_pdf(eval_x, m, s) - np.log(s) - 0.5*np.log(2.0*np.pi) 
         np.testing.assert_array_almost_equal(pred, truth)
 
+    def test_get_td_log_likelihood(self):
+        """Test the time-delay log likelihood of (H0, kappa_ext) draws, obtained by rescaling the time delays at a fiducial H0, against the time delays computed at each cosmology
+
+        """
+        from astropy.cosmology import FlatLambdaCDM
+        from lenstronomy.Cosmo.lens_cosmo import LensCosmo
+        z_lens, z_src, Om0 = 0.5, 1.5, 0.3
+        fermat_pot = np.array([[0.3, -0.2, 0.05], [0.1, 0.4, -0.3]]) # [n_lens_models, n_img - 1]
+        measured_td_wrt0 = np.array([20.0, -15.0, 4.0])
+        measured_td_err = np.array([0.25, 0.5, 1.0])
+        fiducial_td_wrt0 = LensCosmo(z_lens, z_src, cosmo=FlatLambdaCDM(H0=70.0, Om0=Om0)).time_delay_units(fermat_pot, kappa_ext=0.0)
+        h0 = np.random.uniform(50.0, 90.0, size=[2, 5])
+        kappa_ext = np.random.randn(2, 5)*0.05
+        actual = h0_utils.get_td_log_likelihood(fiducial_td_wrt0, 70.0, h0, kappa_ext, measured_td_wrt0, measured_td_err)
+        assert actual.shape == (2, 5)
+        for i in range(2):
+            for j in range(5):
+                td = LensCosmo(z_lens, z_src, cosmo=FlatLambdaCDM(H0=h0[i, j], Om0=Om0)).time_delay_units(fermat_pot[i], kappa_ext=kappa_ext[i, j])
+                expected = np.sum(h0_utils.gaussian_ll_pdf(td, measured_td_wrt0, measured_td_err))
+                np.testing.assert_allclose(actual[i, j], expected, rtol=1.e-8)
+
+    def test_sample_h0_adaptive(self):
+        """Test that the adaptive sampler stops at the target effective sample size or the sample budget, and that refining the proposal leaves the H0 posterior unchanged while needing fewer samples
+
+        """
+        fiducial_td_wrt0 = np.array([[30.0, -12.0, 50.0]])
+        measured_td_wrt0 = fiducial_td_wrt0[0]*70.0/74.0
+        log_likelihood_fn = lambda h0, kappa_ext: h0_utils.get_td_log_likelihood(fiducial_td_wrt0, 70.0, h0[np.newaxis, :], kappa_ext[np.newaxis, :], measured_td_wrt0, 0.25)[0]
+        h0_prior = uniform(loc=50.0, scale=40.0)
+        kappa_ext_prior = norm(loc=1.0, scale=0.025)
+        results = {}
+        for adapt_proposal in [False, True]:
+            h0, kappa_ext, log_w, info = h0_utils.sample_h0_adaptive(log_likelihood_fn, h0_prior, kappa_ext_prior, 500, 200000, 2000, 0, adapt_proposal=adapt_proposal)
+            assert info['reached_target']
+            assert h0.shape == kappa_ext.shape == log_w.shape == (info['n_samples'],)
+            np.testing.assert_almost_equal(info['n_eff'], h0_utils.get_n_eff(log_w))
+            results[adapt_proposal] = (h0_utils.get_normal_stats_naive(h0, all_log_weights=log_w), info)
+        assert results[True][1]['n_samples'] < results[False][1]['n_samples']
+        np.testing.assert_allclose(results[True][0]['mean'], results[False][0]['mean'], atol=0.3)
+        np.testing.assert_allclose(results[True][0]['std'], results[False][0]['std'], rtol=0.15)
+        # Without prior support for the likelihood peak, the sampler stops at the budget
+        h0, _, log_w, info = h0_utils.sample_h0_adaptive(log_likelihood_fn, uniform(loc=50.0, scale=5.0), h0_utils.DeltaFunction(1.0), 500, 3000, 2000, 0, adapt_proposal=True)
+        assert not info['reached_target']
+        assert info['n_samples'] == 3000 and info['n_blocks'] == 2
+
     def test_pred_to_natural_gaussian(self):
         """Test if the predicted mu, cov are being transformed back correctly into natural (original) space
 
@@ -146,6 +191,36 @@ class TestH0Utils(unittest.TestCase):
         stats = h0_utils.get_normal_stats_naive(samples, weights)
         np.testing.assert_almost_equal(stats['mean'], mean_in, decimal=2)
         np.testing.assert_almost_equal(stats['std'], std_in, decimal=2)
+        # Log weights offset far beyond the float range
+        log_weights = norm_obj.logpdf(samples) - 1.e4
+        log_weights[0] = np.nan
+        log_weights[1] = -np.inf
+        log_stats = h0_utils.get_normal_stats_naive(samples, all_log_weights=log_weights)
+        np.testing.assert_almost_equal(log_stats['mean'], stats['mean'], decimal=8)
+        np.testing.assert_almost_equal(log_stats['std'], stats['std'], decimal=8)
+
+    def test_get_normalized_weights(self):
+        """Test the normalization of log weights, including those that underflow when exponentiated, and the masking of invalid samples
+
+        """
+        log_weights = np.array([-1000.0, -1000.0 + np.log(3.0), np.nan, -np.inf, -1001.0])
+        samples = np.array([1.0, 2.0, 3.0, 4.0, np.nan])
+        is_valid, weights = h0_utils.get_normalized_weights(log_weights, samples)
+        np.testing.assert_array_equal(is_valid, [True, True, False, False, False])
+        np.testing.assert_array_almost_equal(weights, [0.25, 0.75])
+
+    def test_get_n_eff(self):
+        """Test the effective sample size of log weights against the one of the weights
+
+        """
+        weights = np.random.rand(100)
+        weights[0] = 0.0
+        expected = np.sum(weights)**2.0/np.sum(weights**2.0)
+        with np.errstate(divide='ignore'):
+            log_weights = np.log(weights)
+        np.testing.assert_almost_equal(h0_utils.get_n_eff(log_weights + 800.0), expected)
+        np.testing.assert_almost_equal(h0_utils.get_n_eff(np.zeros(10)), 10.0)
+        assert h0_utils.get_n_eff(np.full(3, -np.inf)) == 0.0
 
     def test_remove_outliers_from_lognormal(self):
         """Test if extreme outliers 3-STD away from the mean are removed
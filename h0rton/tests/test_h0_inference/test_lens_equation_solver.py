@@ -0,0 +1,109 @@
+import unittest
+import numpy as np
+import pandas as pd
+from astropy.cosmology import FlatLambdaCDM
+from lenstronomy.LensModel.lens_model import LensModel
+from lenstronomy.LensModel.Solver.lens_equation_solver import LensEquationSolver
+from lenstronomy.Cosmo.lens_cosmo import LensCosmo
+from h0rton.h0_inference import lens_equation_solver
+
+class TestLensEquationSolver(unittest.TestCase):
+    """A suite of tests verifying the batched PEMD + SHEAR lens equation solver against lenstronomy, evaluated with the equivalent `EPL` profile
+
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        rs = np.random.RandomState(123)
+        cls.n_samples = 20
+        n = cls.n_samples
+        cls.lens_model_samples = pd.DataFrame(dict(lens_mass_theta_E=rs.uniform(0.8, 1.4, n),
+                                                   lens_mass_gamma=rs.uniform(1.8, 2.2, n),
+                                                   lens_mass_e1=rs.normal(0.0, 0.1, n),
+                                                   lens_mass_e2=rs.normal(0.0, 0.1, n),
+                                                   lens_mass_center_x=rs.normal(0.0, 0.05, n),
+                                                   lens_mass_center_y=rs.normal(0.0, 0.05, n),
+                                                   external_shear_gamma1=rs.normal(0.0, 0.05, n),
+                                                   external_shear_gamma2=rs.normal(0.0, 0.05, n),
+                                                   src_light_center_x=rs.normal(0.0, 0.1, n),
+                                                   src_light_center_y=rs.normal(0.0, 0.1, n)))
+        cls.lens_params, cls.ra_source, cls.dec_source = lens_equation_solver.get_lens_params(cls.lens_model_samples, define_src_pos_wrt_lens=True)
+        cls.lens_model = LensModel(['EPL', 'SHEAR'])
+
+    def get_kwargs_lens(self, i):
+        """lenstronomy kwargs of the i-th lens-model sample
+
+        """
+        p = {k: v[i] for k, v in self.lens_params.items()}
+        return [dict(theta_E=p['theta_E'], gamma=p['gamma'], e1=p['e1'], e2=p['e2'], center_x=p['center_x'], center_y=p['center_y']),
+                dict(gamma1=p['gamma1'], gamma2=p['gamma2'], ra_0=p['ra_0'], dec_0=p['dec_0'])]
+
+    def test_get_lens_params(self):
+        """Test the conversion of the lens-model samples, with the source position defined relative to the lens center
+
+        """
+        np.testing.assert_array_equal(self.lens_params['ra_0'], self.lens_model_samples['lens_mass_center_x'].values)
+        np.testing.assert_array_almost_equal(self.ra_source, self.lens_model_samples['src_light_center_x'].values + self.lens_model_samples['lens_mass_center_x'].values)
+        _, ra_source, _ = lens_equation_solver.get_lens_params(self.lens_model_samples, define_src_pos_wrt_lens=False)
+        np.testing.assert_array_equal(ra_source, self.lens_model_samples['src_light_center_x'].values)
+
+    def test_lens_model_functions(self):
+        """Test the deflection, Hessian, and Fermat potential against lenstronomy
+
+        """
+        rs = np.random.RandomState(0)
+        x = rs.randn(self.n_samples, 5)
+        y = rs.randn(self.n_samples, 5)
+        alpha_x, alpha_y = lens_equation_solver.get_deflection(x, y, self.lens_params)
+        f_xx, f_xy, f_yy = lens_equation_solver.get_hessian(x, y, self.lens_params)
+        fermat_pot = lens_equation_solver.get_fermat_potential(x, y, self.lens_params)
+        for i in range(self.n_samples):
+            kwargs_lens = self.get_kwargs_lens(i)
+            expected_alpha_x, expected_alpha_y = self.lens_model.alpha(x[i], y[i], kwargs_lens)
+            expected_f_xx, expected_f_xy, _, expected_f_yy = self.lens_model.hessian(x[i], y[i], kwargs_lens)
+            np.testing.assert_array_almost_equal(alpha_x[i], expected_alpha_x, decimal=10)
+            np.testing.assert_array_almost_equal(alpha_y[i], expected_alpha_y, decimal=10)
+            np.testing.assert_array_almost_equal(f_xx[i], expected_f_xx, decimal=10)
+            np.testing.assert_array_almost_equal(f_xy[i], expected_f_xy, decimal=10)
+            np.testing.assert_array_almost_equal(f_yy[i], expected_f_yy, decimal=10)
+            np.testing.assert_array_almost_equal(fermat_pot[i], self.lens_model.fermat_potential(x[i], y[i], kwargs_lens), decimal=10)
+
+    def test_solve_lens_equation(self):
+        """Test the image positions against the lenstronomy solver, and the padding and mask of the output
+
+        """
+        solver = LensEquationSolver(self.lens_model)
+        # Warm start from the images of a round lens
+        init_ra, init_dec = solver.image_position_from_source(0.0, 0.05, [dict(theta_E=1.1, gamma=2.0, e1=0.0, e2=0.0, center_x=0.0, center_y=0.0), dict(gamma1=0.0, gamma2=0.0, ra_0=0.0, dec_0=0.0)])
+        images = lens_equation_solver.solve_lens_equation(self.lens_params, self.ra_source, self.dec_source, init_ra, init_dec, 0.0, 0.0, min_distance=0.01, max_images=5)
+        assert images['x_image'].shape == (self.n_samples, 5)
+        np.testing.assert_array_equal(images['mask'].sum(axis=1), images['n_images'])
+        assert np.all(np.isnan(images['x_image'][~images['mask']]))
+        assert np.all(images['is_consistent'])
+        for i in range(self.n_samples):
+            x_image, y_image = solver.image_position_from_source(self.ra_source[i], self.dec_source[i], self.get_kwargs_lens(i), min_distance=0.01, search_window=5, precision_limit=1.e-10, num_iter_max=100)
+            # Drop the central image
+            is_outer = np.hypot(x_image - self.lens_params['center_x'][i], y_image - self.lens_params['center_y'][i]) > 0.01
+            x_image, y_image = x_image[is_outer], y_image[is_outer]
+            increasing_dec_i = np.argsort(y_image)
+            n_images = images['n_images'][i]
+            assert n_images == len(x_image)
+            np.testing.assert_array_almost_equal(images['x_image'][i, :n_images], x_image[increasing_dec_i], decimal=6)
+            np.testing.assert_array_almost_equal(images['y_image'][i, :n_images], y_image[increasing_dec_i], decimal=6)
+
+    def test_get_time_delays(self):
+        """Test the time delays of padded image arrays against lenstronomy
+
+        """
+        cosmo = FlatLambdaCDM(H0=70.0, Om0=0.3)
+        images = lens_equation_solver.solve_lens_equation(self.lens_params, self.ra_source, self.dec_source)
+        td = lens_equation_solver.get_time_delays(images['x_image'], images['y_image'], self.lens_params, 0.5, 1.5, cosmo, kappa_ext=0.05)
+        np.testing.assert_array_equal(np.isnan(td), ~images['mask'])
+        lens_cosmo = LensCosmo(0.5, 1.5, cosmo=cosmo)
+        for i in range(self.n_samples):
+            mask = images['mask'][i]
+            fermat_pot = self.lens_model.fermat_potential(images['x_image'][i][mask], images['y_image'][i][mask], self.get_kwargs_lens(i))
+            np.testing.assert_allclose(td[i][mask], lens_cosmo.time_delay_units(fermat_pot, kappa_ext=0.05), rtol=1.e-8)
+
+if __name__ == '__main__':
+    unittest.main()
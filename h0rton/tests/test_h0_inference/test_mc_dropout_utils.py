@@ -0,0 +1,72 @@
+import unittest
+import numpy as np
+import torch
+from h0rton.h0_inference.mc_dropout_utils import RunningMoments, get_mc_dropout_preds, get_adaptive_mc_dropout_preds
+
+class NoisyIdentity(torch.nn.Module):
+    """Toy stochastic network whose output for each lens is the flattened input plus Gaussian noise scaled by the last pixel
+
+    """
+    def forward(self, x):
+        x = x.reshape(x.shape[0], -1)
+        return x[:, :-1] + x[:, -1:]*torch.randn(x.shape[0], x.shape[1] - 1)
+
+class TestMCDropoutUtils(unittest.TestCase):
+    """A suite of tests for the h0rton.h0_inference.mc_dropout_utils package
+
+    """
+    @classmethod
+    def setUpClass(cls):
+        torch.set_default_tensor_type(torch.FloatTensor)
+
+    def setUp(self):
+        np.random.seed(1113)
+        torch.manual_seed(1113)
+
+    def test_running_moments(self):
+        """Test the Welford updates against the batch mean and covariance
+
+        """
+        n_lenses, dim, n_obs = 3, 4, 50
+        x = np.random.randn(n_lenses, n_obs, dim)
+        moments = RunningMoments(n_lenses, dim)
+        for i in range(n_obs):
+            moments.update(x[:, i, :], np.arange(n_lenses))
+        np.testing.assert_array_almost_equal(moments.mean, x.mean(axis=1))
+        for b in range(n_lenses):
+            np.testing.assert_array_almost_equal(moments.cov[b], np.cov(x[b].T))
+        # Updating a subset leaves the others untouched
+        moments.update(np.zeros([1, dim]), np.array([1]))
+        np.testing.assert_array_equal(moments.count, [n_obs, n_obs + 1, n_obs])
+
+    def test_get_mc_dropout_preds(self):
+        """Test the shape of the fixed-size MC dropout predictions
+
+        """
+        X = torch.randn(5, 1, 1, 4)
+        preds = get_mc_dropout_preds(NoisyIdentity(), X, n_dropout=7, batch_size=2)
+        np.testing.assert_array_equal(preds.shape, [5, 7, 3])
+
+    def test_get_adaptive_mc_dropout_preds(self):
+        """Test that lenses with a narrow predictive spread stop early and that passes are padded
+
+        """
+        X = torch.zeros(2, 1, 1, 3)
+        X[0, 0, 0, -1] = 1.e-4 # narrow
+        X[1, 0, 0, -1] = 1.0 # broad
+        preds, n_passes = get_adaptive_mc_dropout_preds(NoisyIdentity(), X, Y_dim=2, block_size=5, min_passes=10, max_passes=60, tol=1.e-3)
+        np.testing.assert_array_equal(preds.shape, [2, 60, 2])
+        assert n_passes[0] == 10
+        assert n_passes[1] == 60
+        assert np.all(np.isnan(preds[0, 10:, :]))
+        assert np.all(np.isfinite(preds[1, :, :]))
+
+    def test_invalid_pass_limits(self):
+        """Test that inconsistent pass limits are rejected
+
+        """
+        with self.assertRaises(ValueError):
+            get_adaptive_mc_dropout_preds(NoisyIdentity(), torch.zeros(1, 1, 1, 3), Y_dim=2, min_passes=10, max_passes=5)
+
+if __name__ == '__main__':
+    unittest.main()
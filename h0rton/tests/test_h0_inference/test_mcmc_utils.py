@@ -1,5 +1,8 @@
 import numpy as np
+import h0rton.losses
+from h0rton.losses import LowRankGaussianNLL, MixtureGaussianNLL
 import h0rton.h0_inference.mcmc_utils as mcmc_utils
+from h0rton.h0_inference.gaussian_bnn_posterior_cpu import MixtureGaussianBNNPosteriorCPU
 import unittest
 
 class TestMCMCUtils(unittest.TestCase):
@@ -99,15 +102,41 @@ class TestMCMCUtils(unittest.TestCase):
         pass
 
     def test_HybridBNNPenalty(self):
-        # TODO
-        pass
+        """Test the precomputed penalty against the NLL of the repeated parameters, averaged over the MC dropout passes
+
+        """
+        import torch
+        import h0rton.losses
+        np.random.seed(123)
+        Y_cols = ['lens_mass_gamma', 'lens_mass_theta_E', 'external_shear_gamma1', 'src_light_center_x']
+        Y_dim = len(Y_cols)
+        Y_mean = np.array([2.0, 1.1, 0.0, 0.01])
+        Y_std = np.array([0.1, 0.2, 0.05, 0.1])
+        n_dropout = 5
+        n_walkers = 7
+        kwargs_lens = [{'gamma': 2.1, 'theta_E': 1.0, 'center_x': 0.02}, {'gamma1': -0.01}]
+        kwargs_ps = [{'ra_source': 0.05}]
+        Y = np.random.randn(n_walkers, Y_dim)*Y_std + Y_mean
+        for likelihood_class, likelihood_kwargs in [('DiagonalGaussianNLL', {}), ('FullRankGaussianNLL', {}), ('DoubleGaussianNLL', {}), ('DoubleLowRankGaussianNLL', dict(rank=3))]:
+            loss = getattr(h0rton.losses, likelihood_class)(Y_dim=Y_dim, device=torch.device('cpu'), **likelihood_kwargs)
+            pred = 0.3*np.random.randn(n_dropout, loss.out_dim)
+            penalty = mcmc_utils.HybridBNNPenalty(Y_cols, likelihood_class, Y_mean, Y_std, True, 'cpu', likelihood_kwargs)
+            penalty.set_bnn_post_params(pred)
+            actual = penalty.evaluate_many(Y)
+            # Mean over the passes of the NLL of each pass
+            Y_whitened = (Y - Y_mean)/Y_std
+            expected = [-loss(torch.from_numpy(pred), torch.from_numpy(np.repeat(Y_whitened[[w]], n_dropout, axis=0))).item() for w in range(n_walkers)]
+            np.testing.assert_allclose(actual, expected, rtol=1.e-8, err_msg=likelihood_class)
+            # Single evaluation from the lenstronomy kwargs
+            expected_single = penalty.evaluate_many(mcmc_utils.dict_to_array(Y_cols, kwargs_lens, None, None, kwargs_ps))[0]
+            assert penalty.evaluate(kwargs_lens, None, kwargs_ps=kwargs_ps) == expected_single
 
     def test_get_idx_for_params(self):
         """Test if `get_idx_for_params` returns the right indices
 
         """
         Y_dim = 4
-        out_dim = Y_dim**2 + 3*Y_dim + 1
+        out_dim = 2*(2 + 3) + 1 # over the two remaining parameters
         orig_Y_cols = ['a', 'b', 'c', 'd']
         to_test = mcmc_utils.get_idx_for_params(out_dim, orig_Y_cols, ['a', 'c'], 'DoubleGaussianNLL', debug=True)
         tril_mask = np.array([0, 1, 3, 4, 5, 6, 8])
@@ -117,6 +146,47 @@ class TestMCMCUtils(unittest.TestCase):
         np.testing.assert_array_equal(np.sort(to_test['tril_mask']), np.sort(tril_mask))
         np.testing.assert_array_equal(np.sort(to_test['idx_within_tril1']), np.sort(idx_within_tril1))
 
+    def test_get_idx_for_params_layouts(self):
+        """Test if removing the columns returned by `get_idx_for_params` gives the posterior of the remaining parameters, for every output layout
+
+        """
+        Y_dim = 4
+        orig_Y_cols = ['a', 'b', 'c', 'd']
+        params_to_remove = ['b', 'd']
+        keep = [0, 2]
+        rng = np.random.RandomState(123)
+        for cov_type in ['diagonal', 'low_rank', 'full_rank']:
+            likelihood_kwargs = dict(n_components=2, cov_type=cov_type, rank=3)
+            orig_post = MixtureGaussianBNNPosteriorCPU(Y_dim, np.zeros(Y_dim), np.ones(Y_dim), **likelihood_kwargs)
+            mcmc_post = MixtureGaussianBNNPosteriorCPU(Y_dim - 2, np.zeros(Y_dim - 2), np.ones(Y_dim - 2), **likelihood_kwargs)
+            mcmc_out_dim = MixtureGaussianNLL(Y_dim - 2, 'cpu', **likelihood_kwargs).out_dim
+            _, remove_idx = mcmc_utils.get_idx_for_params(mcmc_out_dim, orig_Y_cols, params_to_remove, 'MixtureGaussianNLL', likelihood_kwargs=likelihood_kwargs)
+            orig_pred = rng.randn(5, MixtureGaussianNLL(Y_dim, 'cpu', **likelihood_kwargs).out_dim)
+            orig_post.set_sliced_pred(orig_pred)
+            mcmc_post.set_sliced_pred(mcmc_utils.remove_parameters_from_pred(orig_pred, remove_idx, return_as_tensor=False))
+            np.testing.assert_array_equal(mcmc_post.mu, orig_post.mu[:, :, keep], err_msg=cov_type)
+            np.testing.assert_array_equal(mcmc_post.weights, orig_post.weights, err_msg=cov_type)
+            if cov_type == 'full_rank':
+                np.testing.assert_allclose(mcmc_post.prec_tril, orig_post.prec_tril[:, :, keep][:, :, :, keep], err_msg=cov_type)
+            else:
+                np.testing.assert_array_equal(mcmc_post.logvar, orig_post.logvar[:, :, keep], err_msg=cov_type)
+            if cov_type == 'low_rank':
+                np.testing.assert_array_equal(mcmc_post.F, orig_post.F[:, :, keep, :], err_msg=cov_type)
+        # The single- and double-Gaussian layouts match the components of a mixture, with the weights at the end
+        for likelihood_class, likelihood_kwargs, mixture_kwargs in [('DiagonalGaussianNLL', {}, dict(n_components=1, cov_type='diagonal')),
+                                                                    ('LowRankGaussianNLL', dict(rank=3), dict(n_components=1, cov_type='low_rank', rank=3)),
+                                                                    ('DoubleLowRankGaussianNLL', dict(rank=1), dict(n_components=2, cov_type='low_rank', rank=1)),
+                                                                    ('FullRankGaussianNLL', {}, dict(n_components=1, cov_type='full_rank')),
+                                                                    ('DoubleGaussianNLL', {}, dict(n_components=2, cov_type='full_rank'))]:
+            mcmc_out_dim = getattr(h0rton.losses, likelihood_class)(Y_dim - 2, 'cpu', **likelihood_kwargs).out_dim
+            _, remove_idx = mcmc_utils.get_idx_for_params(mcmc_out_dim, orig_Y_cols, params_to_remove, likelihood_class, likelihood_kwargs=likelihood_kwargs)
+            mixture_out_dim = MixtureGaussianNLL(Y_dim - 2, 'cpu', **mixture_kwargs).out_dim
+            _, mixture_remove_idx = mcmc_utils.get_idx_for_params(mixture_out_dim, orig_Y_cols, params_to_remove, 'MixtureGaussianNLL', likelihood_kwargs=mixture_kwargs)
+            np.testing.assert_array_equal(remove_idx, mixture_remove_idx, err_msg=likelihood_class)
+        # out_dim must describe the remaining parameters
+        with self.assertRaises(ValueError):
+            mcmc_utils.get_idx_for_params(LowRankGaussianNLL(Y_dim - 2, 'cpu', rank=2).out_dim, orig_Y_cols, params_to_remove, 'LowRankGaussianNLL', likelihood_kwargs=dict(rank=3))
+
     def test_remove_parameters_from_pred(self):
         """Test if correct parameters are removed from the NN output
 
@@ -154,6 +224,19 @@ class TestMCMCUtils(unittest.TestCase):
         expected = np.array([[2.0, 1.5, -0.05, 0.01, -0.01, 0.005, 0.3, 0.1 - (-0.05), -0.2 - 0.01]])
         np.testing.assert_array_equal(actual, expected, err_msg="test_dict_to_array")
 
+    def test_get_kwargs_index_map(self):
+        """Test the compiled lookup of the BNN columns in the lenstronomy kwargs
+
+        """
+        Y_cols = ['src_light_center_y', 'external_shear_gamma2', 'lens_mass_theta_E']
+        index_map = mcmc_utils.get_kwargs_index_map(Y_cols)
+        assert index_map == [(('kwargs_ps', 0, 'dec_source'), ('kwargs_lens', 0, 'center_y')), (('kwargs_lens', 1, 'gamma2'), None), (('kwargs_lens', 0, 'theta_E'), None)]
+        kwargs_lens = [{'theta_E': 1.5, 'center_y': 0.01}, {'gamma2': 0.005}]
+        kwargs_ps = [{'dec_source': -0.2}]
+        np.testing.assert_array_equal(mcmc_utils.kwargs_to_array(index_map, kwargs_lens, None, None, kwargs_ps), [[-0.2 - 0.01, 0.005, 1.5]])
+        with np.testing.assert_raises(ValueError):
+            mcmc_utils.get_kwargs_index_map(['lens_light_R_sersic'])
+
     def test_reorder_to_param_class(self):
         """Test if dict from MCMC iteration is converted into array form correctly
 
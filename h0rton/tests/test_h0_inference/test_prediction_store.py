@@ -0,0 +1,66 @@
+import os
+import shutil
+import unittest
+import tempfile
+import numpy as np
+from h0rton.h0_inference.prediction_store import PredictionStore
+
+class TestPredictionStore(unittest.TestCase):
+    """A suite of tests for the h0rton.h0_inference.prediction_store package
+
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.store_dir = tempfile.mkdtemp()
+        cls.checkpoint_path = os.path.join(cls.store_dir, 'checkpoint.mdl')
+        with open(cls.checkpoint_path, 'wb') as f:
+            f.write(b'weights')
+        cls.data_cfg = dict(data=dict(Y_cols=['a', 'b'], log_pixels=True), model=dict(dropout_rate=0.001))
+        cls.test_dataset_id = dict(test_baobab_cfg_path='test.json', n_lenses=3)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.store_dir)
+
+    def test_get_key(self):
+        """Test that the key is deterministic and sensitive to each of its inputs
+
+        """
+        key, key_dict = PredictionStore.get_key(self.checkpoint_path, self.data_cfg, self.test_dataset_id, 123, 20)
+        key_again, _ = PredictionStore.get_key(self.checkpoint_path, self.data_cfg, self.test_dataset_id, 123, 20)
+        assert key == key_again
+        assert key_dict['noise_seed'] == 123
+        assert key != PredictionStore.get_key(self.checkpoint_path, self.data_cfg, self.test_dataset_id, 124, 20)[0]
+        assert key != PredictionStore.get_key(self.checkpoint_path, self.data_cfg, self.test_dataset_id, 123, 21)[0]
+        other_data_cfg = dict(data=dict(Y_cols=['a', 'b'], log_pixels=False), model=dict(dropout_rate=0.001))
+        assert key != PredictionStore.get_key(self.checkpoint_path, other_data_cfg, self.test_dataset_id, 123, 20)[0]
+        # Same contents under a different path resolve to the same key
+        copy_path = os.path.join(self.store_dir, 'copy.mdl')
+        shutil.copyfile(self.checkpoint_path, copy_path)
+        assert key == PredictionStore.get_key(copy_path, self.data_cfg, self.test_dataset_id, 123, 20)[0]
+        # Different contents don't
+        with open(copy_path, 'wb') as f:
+            f.write(b'retrained weights')
+        assert key != PredictionStore.get_key(copy_path, self.data_cfg, self.test_dataset_id, 123, 20)[0]
+
+    def test_save_load(self):
+        """Test that saved predictions are loaded back unchanged
+
+        """
+        store = PredictionStore(os.path.join(self.store_dir, 'store'))
+        key, key_dict = PredictionStore.get_key(self.checkpoint_path, self.data_cfg, self.test_dataset_id, 123, 4)
+        assert store.load(key) is None
+        pred = np.random.randn(3, 4, 5)
+        Y_mean = np.random.randn(1, 2)
+        Y_std = np.random.rand(1, 2)
+        store.save(key, pred, Y_mean, Y_std, key_dict=key_dict)
+        assert store.contains(key)
+        stored = store.load(key)
+        np.testing.assert_array_equal(stored['pred'], pred)
+        np.testing.assert_array_equal(stored['Y_mean'], Y_mean)
+        np.testing.assert_array_equal(stored['Y_std'], Y_std)
+        np.testing.assert_array_equal(stored['n_dropout_per_lens'], [4, 4, 4])
+        assert os.path.exists(os.path.join(store.store_dir, '{:s}.json'.format(key)))
+
+if __name__ == '__main__':
+    unittest.main()
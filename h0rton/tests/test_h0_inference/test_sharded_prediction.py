@@ -0,0 +1,132 @@
+import os
+import shutil
+import unittest
+import tempfile
+import numpy as np
+import torch
+from torch.utils.data import TensorDataset
+import h0rton.models
+import h0rton.losses
+from h0rton.h0_inference.bnn_posterior_export import ParametricBNNPosterior
+from h0rton.h0_inference.sharded_prediction import get_shard_path, predict_sharded, load_shard_index, load_sharded_predictions
+
+class CrashingDataset(TensorDataset):
+    """Kills the process that loads lens 4, as the OOM killer would"""
+    def __getitem__(self, idx):
+        if idx == 4:
+            os._exit(9)
+        return super(CrashingDataset, self).__getitem__(idx)
+
+class TestShardedPrediction(unittest.TestCase):
+    """A suite of tests for the h0rton.h0_inference.sharded_prediction package
+
+    """
+    @classmethod
+    def setUpClass(cls):
+        torch.set_default_tensor_type(torch.FloatTensor)
+        cls.Y_dim = 2
+        cls.likelihood_class = 'DoubleGaussianNLL'
+        cls.out_dim = getattr(h0rton.losses, cls.likelihood_class)(Y_dim=cls.Y_dim, device=torch.device('cpu')).out_dim
+        cls.Y_mean = np.array([0.5, -1.0])
+        cls.Y_std = np.array([2.0, 0.1])
+        X = torch.randn(7, 1, 32, 32, generator=torch.Generator().manual_seed(1113))
+        cls.dataset = TensorDataset(X, torch.zeros(7, cls.Y_dim))
+        cls.lens_ids = ['lens_{:d}'.format(i) for i in range(7)]
+        torch.manual_seed(1113)
+        cls.net = h0rton.models.resnet18_half(num_classes=cls.out_dim, dropout_rate=0.1)
+        # Keep the predicted log-variances and mixture weights in a tame range
+        torch.nn.init.normal_(cls.net.fc.weight, std=0.01)
+
+    def setUp(self):
+        self.out_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+    def predict(self, **kwargs):
+        return predict_sharded(self.net, self.dataset, self.out_dir, 3, self.likelihood_class, self.Y_mean, self.Y_std,
+                               lens_ids=self.lens_ids, shard_size=3, batch_size=2, **kwargs)
+
+    def test_index_and_loading(self):
+        """Test the shard layout of the index and gathering a subset of lenses across shards
+
+        """
+        index = self.predict()
+        np.testing.assert_array_equal(index['shard'].values, [0, 0, 0, 1, 1, 1, 2])
+        np.testing.assert_array_equal(index['offset'].values, [0, 1, 2, 0, 1, 2, 0])
+        np.testing.assert_array_equal(load_shard_index(self.out_dir)['lens_id'].values, self.lens_ids)
+        everything = load_sharded_predictions(self.out_dir)
+        np.testing.assert_array_equal(everything['pred'].shape, [7, 3, self.out_dim])
+        subset = load_sharded_predictions(self.out_dir, ['lens_6', 'lens_1', 'lens_4'])
+        np.testing.assert_array_equal(subset['lens_id'], ['lens_6', 'lens_1', 'lens_4'])
+        np.testing.assert_array_equal(subset['pred'], everything['pred'][[6, 1, 4]])
+
+    def test_workers_match_main_process(self):
+        """Test that shards computed by worker processes sharing the weights match those computed in the main process
+
+        """
+        self.predict()
+        serial = load_sharded_predictions(self.out_dir)
+        parallel_dir = tempfile.mkdtemp()
+        try:
+            predict_sharded(self.net, self.dataset, parallel_dir, 3, self.likelihood_class, self.Y_mean, self.Y_std,
+                            lens_ids=self.lens_ids, shard_size=3, batch_size=2, n_workers=2)
+            parallel = load_sharded_predictions(parallel_dir)
+        finally:
+            shutil.rmtree(parallel_dir)
+        np.testing.assert_allclose(parallel['pred'], serial['pred'], rtol=1.e-5, atol=1.e-6)
+
+    def test_dead_worker(self):
+        """Test that a worker dying without reporting raises with the unfinished shard instead of hanging
+
+        """
+        dataset = CrashingDataset(*self.dataset.tensors)
+        with self.assertRaisesRegex(RuntimeError, r'\[1\]'):
+            predict_sharded(self.net, dataset, self.out_dir, 3, self.likelihood_class, self.Y_mean, self.Y_std,
+                            lens_ids=self.lens_ids, shard_size=3, batch_size=2, n_workers=2)
+        assert not os.path.exists(get_shard_path(self.out_dir, 1))
+
+    def test_resume(self):
+        """Test that only missing shards are recomputed and that a run with other settings is refused
+
+        """
+        self.predict()
+        before = load_sharded_predictions(self.out_dir)
+        os.remove(get_shard_path(self.out_dir, 1))
+        mtime_0 = os.path.getmtime(get_shard_path(self.out_dir, 0))
+        self.predict()
+        assert os.path.getmtime(get_shard_path(self.out_dir, 0)) == mtime_0
+        np.testing.assert_allclose(load_sharded_predictions(self.out_dir)['pred'], before['pred'], rtol=1.e-5, atol=1.e-6)
+        with self.assertRaises(ValueError):
+            self.predict(seed=124)
+
+    def test_params_output(self):
+        """Test that the posterior parameters of a shard can be read as a ParametricBNNPosterior
+
+        """
+        self.predict(output='params', Y_cols=['a', 'b'])
+        bnn_post = ParametricBNNPosterior.from_file(get_shard_path(self.out_dir, 2))
+        assert bnn_post.n_lenses == 1
+        assert bnn_post.Y_cols == ['a', 'b']
+        gathered = load_sharded_predictions(self.out_dir, ['lens_6'])
+        np.testing.assert_array_equal(gathered['mu'], bnn_post.mu)
+        np.testing.assert_array_equal(gathered['weights'].shape, [1, 3, 2])
+
+    def test_params_output_mixture(self):
+        """Test that the posterior parameters follow the number of components and covariance type of the likelihood
+
+        """
+        likelihood_kwargs = dict(n_components=2, cov_type='diagonal')
+        out_dim = h0rton.losses.MixtureGaussianNLL(Y_dim=self.Y_dim, device=torch.device('cpu'), **likelihood_kwargs).out_dim
+        torch.manual_seed(1113)
+        net = h0rton.models.resnet18_half(num_classes=out_dim, dropout_rate=0.1)
+        torch.nn.init.normal_(net.fc.weight, std=0.01)
+        predict_sharded(net, self.dataset, self.out_dir, 3, 'MixtureGaussianNLL', self.Y_mean, self.Y_std,
+                        likelihood_kwargs=likelihood_kwargs, lens_ids=self.lens_ids, output='params', shard_size=3, batch_size=2)
+        gathered = load_sharded_predictions(self.out_dir)
+        np.testing.assert_array_equal(gathered['mu'].shape, [7, 3, 2, self.Y_dim])
+        np.testing.assert_array_equal(gathered['weights'].shape, [7, 3, 2])
+        np.testing.assert_allclose(gathered['weights'].sum(axis=-1), 1.0, rtol=1.e-5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import unittest
+import numpy as np
+import torch
+from h0rton.losses import get_backend_class_name, get_backend_likelihood_kwargs, benchmark_likelihood_backends, select_likelihood_backend
+
+class TestBackendSelection(unittest.TestCase):
+    """A suite of tests for the benchmarking and selection of the likelihood backends
+    
+    """
+
+    def test_get_backend_class_name(self):
+        """Test the lookup of the likelihood classes across backends
+
+        """
+        assert get_backend_class_name('DoubleGaussianNLL', 'gaussian_nll') == 'DoubleGaussianNLL'
+        assert get_backend_class_name('DoubleGaussianNLL', 'gaussian_nll_native') == 'DoubleGaussianNLLNative'
+        assert get_backend_class_name('DoubleGaussianNLL', 'gaussian_nll_cpu') == 'DoubleGaussianNLLCPU'
+        assert get_backend_class_name('LowRankGaussianNLL', 'gaussian_nll_cpu') is None
+        assert get_backend_class_name('MixtureGaussianNLL', 'gaussian_nll_native') is None
+        with np.testing.assert_raises(ValueError):
+            get_backend_class_name('DoubleGaussianNLL', 'jax')
+
+    def test_get_backend_likelihood_kwargs(self):
+        """Test that options specific to one backend are dropped for the others
+
+        """
+        assert get_backend_likelihood_kwargs('FullRankGaussianNLL', 'gaussian_nll', dict(packed=False)) == dict(packed=False)
+        assert get_backend_likelihood_kwargs('FullRankGaussianNLL', 'gaussian_nll_native', dict(packed=False)) == {}
+        assert get_backend_likelihood_kwargs('LowRankGaussianNLL', 'gaussian_nll_native', dict(rank=1)) == dict(rank=1)
+        backend, class_name, benchmark = select_likelihood_backend('FullRankGaussianNLL', 3, 10, n_repeats=1, likelihood_kwargs=dict(packed=False))
+        assert len(benchmark) == 2
+
+    def test_benchmark_likelihood_backends(self):
+        """Test that all backends of a likelihood are timed and agree with one another, in both float types
+
+        """
+        benchmark = benchmark_likelihood_backends('FullRankGaussianNLL', 3, [5, 8], n_repeats=1)
+        assert len(benchmark) == 2*2*3
+        assert benchmark['agrees'].all()
+        np.testing.assert_array_equal(benchmark['backward_time'].isnull(), benchmark['backend'] == 'gaussian_nll_cpu')
+        assert (benchmark.loc[benchmark['dtype'] == 'float64', 'loss_diff'] < 1.e-10).all()
+        # The default dtype is restored
+        assert torch.get_default_dtype() == torch.float32
+
+    def test_select_likelihood_backend(self):
+        """Test that the selected backend is trainable and the fastest among the agreeing ones
+
+        """
+        backend, class_name, benchmark = select_likelihood_backend('LowRankGaussianNLL', 3, 10, n_repeats=1, likelihood_kwargs=dict(rank=1))
+        assert backend in ['gaussian_nll', 'gaussian_nll_native']
+        assert class_name == get_backend_class_name('LowRankGaussianNLL', backend)
+        assert benchmark.loc[benchmark['backend'] == backend, 'total_time'].item() == benchmark.loc[benchmark['agrees'], 'total_time'].min()
+        # Likelihoods with a single backend
+        backend, class_name, _ = select_likelihood_backend('MixtureGaussianNLL', 3, 10, n_repeats=1)
+        assert (backend, class_name) == ('gaussian_nll', 'MixtureGaussianNLL')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,7 +2,9 @@ import numpy as np
 import unittest
 from scipy.stats import multivariate_normal
 import torch
-from h0rton.losses import DiagonalGaussianNLL, LowRankGaussianNLL, DoubleLowRankGaussianNLL, FullRankGaussianNLL, DoubleGaussianNLL
+from h0rton.losses import DiagonalGaussianNLL, LowRankGaussianNLL, DoubleLowRankGaussianNLL, FullRankGaussianNLL, DoubleGaussianNLL, MixtureGaussianNLL
+from h0rton.losses.gaussian_nll import PackedFullRankNLL, get_packed_tril_ops
+from h0rton.losses.gaussian_nll_native import LowRankGaussianNLLNative, DoubleLowRankGaussianNLLNative
 from h0rton.h0_inference.gaussian_bnn_posterior_cpu import sigmoid
 
 class TestGaussianNLL(unittest.TestCase):
@@ -202,6 +204,105 @@ class TestGaussianNLL(unittest.TestCase):
             matched_nll += (-np.log((1.0 - 0.5*w2_b) * np.exp(-nll1) + 0.5*w2_b * np.exp(-nll2)))/batch_size # logsumexp
         np.testing.assert_array_almost_equal(h0rton_nll, matched_nll, decimal=5)
 
+    def test_packed_full_rank_nll(self):
+        """Test that the packed full-rank and mixture NLLs and their gradients match the ones evaluated with the dense precision matrix
+
+        """
+        Y_dim = 6
+        batch_size = 50
+        device = torch.device('cpu')
+        target = torch.randn(batch_size, Y_dim)
+        for loss_class in [FullRankGaussianNLL, DoubleGaussianNLL]:
+            packed_loss = loss_class(Y_dim, device)
+            dense_loss = loss_class(Y_dim, device, packed=False)
+            pred = 0.5*torch.randn(batch_size, packed_loss.out_dim)
+            packed_pred = pred.clone().requires_grad_(True)
+            dense_pred = pred.clone().requires_grad_(True)
+            packed_nll = packed_loss(packed_pred, target)
+            dense_nll = dense_loss(dense_pred, target)
+            packed_nll.backward()
+            dense_nll.backward()
+            np.testing.assert_allclose(packed_nll.item(), dense_nll.item(), rtol=1.e-6)
+            np.testing.assert_allclose(packed_pred.grad.numpy(), dense_pred.grad.numpy(), rtol=1.e-4, atol=1.e-6)
+
+    def test_packed_full_rank_nll_gradcheck(self):
+        """Test the hand-written backward pass of the packed full-rank NLL against finite differences
+
+        """
+        Y_dim = 4
+        batch_size = 3
+        tril_len = Y_dim*(Y_dim + 1)//2
+        y_diff = torch.randn(batch_size, Y_dim, dtype=torch.float64, requires_grad=True)
+        tril_elements = torch.randn(batch_size, tril_len, dtype=torch.float64, requires_grad=True)
+        ops = get_packed_tril_ops(Y_dim, torch.device('cpu'))
+        assert torch.autograd.gradcheck(lambda y, t: PackedFullRankNLL.apply(y, t, *ops), (y_diff, tril_elements))
+
+    def test_general_rank_low_rank_nll(self):
+        """Test the low-rank NLLs and their gradients against `torch.distributions` for ranks other than 2
+
+        """
+        Y_dim = 5
+        batch_size = 20
+        device = torch.device('cpu')
+        target = torch.randn(batch_size, Y_dim, dtype=torch.float64)
+        for rank in [1, 2, 4, 7]:
+            for loss_class, native_class in [(LowRankGaussianNLL, LowRankGaussianNLLNative), (DoubleLowRankGaussianNLL, DoubleLowRankGaussianNLLNative)]:
+                loss = loss_class(Y_dim, device, rank=rank)
+                native_loss = native_class(Y_dim, device, rank=rank)
+                assert loss.out_dim == native_loss.out_dim
+                pred = 0.5*torch.randn(batch_size, loss.out_dim, dtype=torch.float64)
+                pred_h0rton = pred.clone().requires_grad_(True)
+                pred_native = pred.clone().requires_grad_(True)
+                h0rton_nll = loss(pred_h0rton, target)
+                native_nll = native_loss(pred_native, target)
+                h0rton_nll.backward()
+                native_nll.backward()
+                np.testing.assert_allclose(h0rton_nll.item(), native_nll.item(), rtol=1.e-10)
+                np.testing.assert_allclose(pred_h0rton.grad.numpy(), pred_native.grad.numpy(), rtol=1.e-8, atol=1.e-10)
+
+    def test_mixture_gaussian_nll(self):
+        """Test the PDF evaluation of a mixture of K Gaussians for each covariance family
+
+        """
+        Y_dim = 3
+        n_components = 3
+        rank = 2
+        batch_size = 4
+        tril_idx = np.tril_indices(Y_dim)
+        device = torch.device('cpu')
+        target = np.random.randn(batch_size, Y_dim)
+        for cov_type in ['diagonal', 'low_rank', 'full_rank']:
+            loss = MixtureGaussianNLL(Y_dim, device, n_components=n_components, cov_type=cov_type, rank=rank)
+            pred = 0.5*np.random.randn(batch_size, loss.out_dim)
+            h0rton_nll = loss(torch.from_numpy(pred), torch.from_numpy(target))
+            # Get scipy evaluation
+            logits = pred[:, -n_components:]
+            weights = np.exp(logits)/np.sum(np.exp(logits), axis=1, keepdims=True)
+            matched_nll = 0.0
+            for b in range(batch_size):
+                pdf = 0.0
+                for k in range(n_components):
+                    component = pred[b, k*loss.component_dim:(k + 1)*loss.component_dim]
+                    mu_bk = component[:Y_dim]
+                    if cov_type == 'diagonal':
+                        cov_mat = np.diag(np.exp(component[Y_dim:]))
+                    elif cov_type == 'low_rank':
+                        F = component[2*Y_dim:].reshape(Y_dim, rank)
+                        cov_mat = np.diag(np.exp(component[Y_dim:2*Y_dim])) + F@F.T
+                    else:
+                        tril = np.zeros((Y_dim, Y_dim))
+                        tril[tril_idx[0], tril_idx[1]] = component[Y_dim:]
+                        tril[np.eye(Y_dim).astype(bool)] = np.exp(np.diagonal(tril))
+                        cov_mat = np.linalg.inv(tril@tril.T)
+                    pdf += weights[b, k]*multivariate_normal.pdf(target[b], mean=mu_bk, cov=cov_mat)
+                matched_nll += -np.log(pdf)/batch_size
+            np.testing.assert_allclose(h0rton_nll.item(), matched_nll, rtol=1.e-8)
+        # A single full-rank component reduces to FullRankGaussianNLL
+        single = MixtureGaussianNLL(Y_dim, device, n_components=1)
+        pred = np.random.randn(batch_size, single.out_dim)
+        np.testing.assert_allclose(single(torch.from_numpy(pred), torch.from_numpy(target)).item(),
+                                   FullRankGaussianNLL(Y_dim, device)(torch.from_numpy(pred[:, :-1]), torch.from_numpy(target)).item(), rtol=1.e-10)
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -0,0 +1,58 @@
+import unittest
+import numpy as np
+import torch
+import torch.nn as nn
+import h0rton.models as models
+
+class TestBayesianMobileNet(unittest.TestCase):
+    """A suite of tests on MobileNet models
+
+    """
+    @classmethod
+    def setUpClass(cls):
+        torch.set_default_tensor_type(torch.FloatTensor)
+        cls.out_dim = 9
+        cls.batch_size = 3
+        cls.dummy_X = torch.randn(cls.batch_size, 1, 64, 64)
+
+    def test_mobilenet_forward(self):
+        """Test instantiation and forward method of BayesianMobileNet
+
+        """
+        for architecture in ['mobilenet_v2', 'mobilenet_v2_half']:
+            net = getattr(models, architecture)(num_classes=self.out_dim, dropout_rate=0.1)
+            np.testing.assert_array_equal(net(self.dummy_X).shape, [self.batch_size, self.out_dim], err_msg="output shape of {:s}".format(architecture))
+        full = models.mobilenet_v2(num_classes=self.out_dim)
+        half = models.mobilenet_v2_half(num_classes=self.out_dim)
+        assert models.count_parameters(half) < 0.5*models.count_parameters(full)
+
+    def test_mobilenet_dropout(self):
+        """Test that dropout is propagated to the blocks and stays active in eval mode
+
+        """
+        net = models.mobilenet_v2(num_classes=self.out_dim, dropout_rate=0.2).eval()
+        assert all(block.dropout_rate == 0.2 for block in net.blocks)
+        with torch.no_grad():
+            assert not torch.allclose(net(self.dummy_X), net(self.dummy_X))
+
+    def test_mobilenet_fold_batchnorm(self):
+        """Test that folding batchnorm leaves the eval-mode output unchanged
+
+        """
+        torch.manual_seed(1113)
+        net = models.mobilenet_v2_half(num_classes=self.out_dim, dropout_rate=0.0)
+        for module in net.modules():
+            if isinstance(module, nn.BatchNorm2d):
+                module.running_mean.uniform_(-0.5, 0.5)
+                module.running_var.uniform_(0.5, 2.0)
+                module.weight.data.uniform_(0.5, 1.5)
+        net.eval()
+        with torch.no_grad():
+            expected = net(self.dummy_X)
+            models.fold_batchnorm(net)
+            folded = net(self.dummy_X)
+        assert not any(isinstance(m, nn.BatchNorm2d) for m in net.modules())
+        np.testing.assert_allclose(folded.numpy(), expected.numpy(), rtol=1.e-4, atol=1.e-4)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -79,5 +79,22 @@ class TestBayesianResNet(unittest.TestCase):
         np.testing.assert_array_equal(activations[7], [self.batch_size, 512, 1, 1], err_msg="after avgpool")
         np.testing.assert_array_equal(activations[-1], [self.batch_size, self.out_dim], err_msg="output")
 
+    def test_activation_maps_half_width(self):
+        """Test if the reduced-width BNN has half the filters in every layer
+
+        """
+        bnn = models.resnet18_half(num_classes=self.out_dim, dropout_rate=self.dropout_rate)
+        activations = bnn._forward_debug(self.dummy_X)
+        np.testing.assert_array_equal(activations[1], [self.batch_size, 32, 32, 32], err_msg="after conv1 with stride 2")
+        np.testing.assert_array_equal(activations[3], [self.batch_size, 32, 16, 16], err_msg="after layer1")
+        np.testing.assert_array_equal(activations[4], [self.batch_size, 64, 8, 8], err_msg="after layer2")
+        np.testing.assert_array_equal(activations[5], [self.batch_size, 128, 4, 4], err_msg="after layer3")
+        np.testing.assert_array_equal(activations[6], [self.batch_size, 256, 2, 2], err_msg="after layer4")
+        np.testing.assert_array_equal(activations[-1], [self.batch_size, self.out_dim], err_msg="output")
+        resnet18 = models.resnet18(num_classes=self.out_dim, dropout_rate=self.dropout_rate)
+        resnet34_half = models.resnet34_half(num_classes=self.out_dim, dropout_rate=self.dropout_rate)
+        np.testing.assert_array_equal(resnet18(self.dummy_X).shape, [self.batch_size, self.out_dim], err_msg="output shape of resnet18")
+        np.testing.assert_array_equal(resnet34_half(self.dummy_X).shape, [self.batch_size, self.out_dim], err_msg="output shape of resnet34_half")
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,134 @@
+import os
+import shutil
+import unittest
+import tempfile
+import importlib.util
+from unittest import mock
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import h0rton.models as models
+
+# ONNX export is optional, as onnx and onnxruntime aren't requirements
+has_onnx = importlib.util.find_spec('onnx') is not None and importlib.util.find_spec('onnxruntime') is not None
+
+class TestGraphExport(unittest.TestCase):
+    """A suite of tests on the ONNX and TorchScript export of the BNN
+
+    """
+    @classmethod
+    def setUpClass(cls):
+        torch.set_default_tensor_type(torch.FloatTensor)
+        cls.out_dir = tempfile.mkdtemp()
+        cls.out_dim = 5
+        cls.X_dim = 32
+        cls.dropout_rate = 0.2
+        cls.dummy_X = torch.randn(3, 1, cls.X_dim, cls.X_dim)
+        cls.metadata = models.get_inference_metadata(cls.get_net(), 'resnet18_half', cls.dropout_rate, 'DoubleGaussianNLL', ['a', 'b'], np.array([0.5, -1.0]), np.array([2.0, 0.1]))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.out_dir)
+
+    @classmethod
+    def get_net(cls):
+        torch.manual_seed(1113)
+        net = models.resnet18_half(num_classes=cls.out_dim, dropout_rate=cls.dropout_rate)
+        # Make the batchnorm layers nontrivial
+        for module in net.modules():
+            if isinstance(module, nn.BatchNorm2d):
+                module.running_mean.uniform_(-0.5, 0.5)
+                module.running_var.uniform_(0.5, 2.0)
+                module.weight.data.uniform_(0.5, 1.5)
+                module.bias.data.uniform_(-0.5, 0.5)
+        net.eval()
+        return net
+
+    def get_fixed_masks(self, net):
+        """Draw one set of dropout masks, scaled by 1/(1 - p), in the order of the dropout calls
+
+        """
+        masks = []
+        def _recording_dropout(x, p=0.5, training=True, inplace=False):
+            masks.append(torch.bernoulli(torch.full_like(x, 1.0 - p))/(1.0 - p))
+            return x*masks[-1]
+        with torch.no_grad(), mock.patch.object(F, 'dropout', _recording_dropout):
+            net(self.dummy_X)
+        return masks
+
+    def test_torchscript_parity(self):
+        """Test that the TorchScript graph reproduces the original model for the same dropout masks
+
+        """
+        net = self.get_net()
+        path = os.path.join(self.out_dir, 'net.pt')
+        models.export_torchscript(net, path, self.X_dim, fold_bn=True, metadata=self.metadata)
+        runner = models.ExportedBNN(path)
+        # The traced graph keeps the native dropout op, so the same seed gives the same masks
+        with torch.no_grad():
+            torch.manual_seed(0)
+            expected = net(self.dummy_X).numpy()
+        torch.manual_seed(0)
+        pred = runner(self.dummy_X)
+        np.testing.assert_allclose(pred, expected, rtol=1.e-4, atol=1.e-4)
+        assert not np.allclose(runner(self.dummy_X), runner(self.dummy_X))
+        assert runner.metadata['architecture'] == 'resnet18_half'
+        np.testing.assert_array_equal(runner.metadata['Y_std'], [2.0, 0.1])
+        # The original network is left unfolded
+        assert any(isinstance(m, nn.BatchNorm2d) for m in net.modules())
+
+    @unittest.skipUnless(has_onnx, "onnx and onnxruntime are not installed")
+    def test_onnx_parity(self):
+        """Test that the ONNX graph reproduces the original model for the same dropout masks
+
+        """
+        import onnx
+        import onnx.numpy_helper
+        net = self.get_net()
+        path = os.path.join(self.out_dir, 'net.onnx')
+        models.export_onnx(net, path, self.X_dim, fold_bn=True, metadata=self.metadata)
+        model = onnx.load(path)
+        dropout_nodes = [node for node in model.graph.node if node.op_type == 'Dropout']
+        assert len(dropout_nodes) > 0
+        assert not any(node.op_type == 'BatchNormalization' for node in model.graph.node)
+        # Replace each dropout node with a multiplication by a fixed mask
+        masks = self.get_fixed_masks(net)
+        assert len(masks) == len(dropout_nodes)
+        for i, (node, mask) in enumerate(zip(dropout_nodes, masks)):
+            mask_name = 'fixed_mask_{:d}'.format(i)
+            model.graph.initializer.append(onnx.numpy_helper.from_array(mask.numpy(), mask_name))
+            node_idx = list(model.graph.node).index(node)
+            model.graph.node.remove(node)
+            model.graph.node.insert(node_idx, onnx.helper.make_node('Mul', [node.input[0], mask_name], [node.output[0]]))
+        fixed_path = os.path.join(self.out_dir, 'net_fixed_masks.onnx')
+        onnx.save(model, fixed_path)
+        with torch.no_grad(), mock.patch.object(F, 'dropout', lambda x, *args, **kwargs: x*masks.pop(0)):
+            expected = net(self.dummy_X).numpy()
+        pred = models.ExportedBNN(fixed_path)(self.dummy_X)
+        np.testing.assert_allclose(pred, expected, rtol=1.e-4, atol=1.e-4)
+
+    @unittest.skipUnless(has_onnx, "onnx and onnxruntime are not installed")
+    def test_mc_dropout_preds(self):
+        """Test that the runner gives stochastic passes with the same output layout as the PyTorch path
+
+        """
+        net = self.get_net()
+        path = os.path.join(self.out_dir, 'net_runner.onnx')
+        models.export_onnx(net, path, self.X_dim, metadata=self.metadata)
+        runner = models.ExportedBNN(path, batch_size=2)
+        pred = runner.get_mc_dropout_preds(self.dummy_X, n_dropout=4)
+        np.testing.assert_array_equal(pred.shape, [3, 4, self.out_dim])
+        assert not np.allclose(pred[:, 0, :], pred[:, 1, :])
+        assert runner.metadata['likelihood_class'] == 'DoubleGaussianNLL'
+
+    @unittest.skipUnless(has_onnx, "onnx and onnxruntime are not installed")
+    def test_onnx_opset(self):
+        """Test that opsets without a training-mode dropout are rejected
+
+        """
+        with self.assertRaises(ValueError):
+            models.export_onnx(self.get_net(), os.path.join(self.out_dir, 'net_opset.onnx'), self.X_dim, opset_version=11)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+import os
+import shutil
+import unittest
+import tempfile
+import numpy as np
+import torch
+import torch.nn as nn
+import h0rton.models as models
+import h0rton.train_utils as train_utils
+
+class TestInferenceArtifact(unittest.TestCase):
+    """A suite of tests on the inference-only model artifact
+
+    """
+    @classmethod
+    def setUpClass(cls):
+        torch.set_default_tensor_type(torch.FloatTensor)
+        cls.out_dir = tempfile.mkdtemp()
+        cls.out_dim = 5
+        cls.dummy_X = torch.randn(3, 1, 32, 32)
+        cls.Y_cols = ['a', 'b']
+        cls.Y_mean = np.array([0.5, -1.0])
+        cls.Y_std = np.array([2.0, 0.1])
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.out_dir)
+
+    def get_net(self, dropout_rate=0.0):
+        torch.manual_seed(1113)
+        net = models.resnet44(num_classes=self.out_dim, dropout_rate=dropout_rate)
+        # Make the batchnorm layers nontrivial
+        for module in net.modules():
+            if isinstance(module, nn.BatchNorm2d):
+                module.running_mean.uniform_(-0.5, 0.5)
+                module.running_var.uniform_(0.5, 2.0)
+                module.weight.data.uniform_(0.5, 1.5)
+                module.bias.data.uniform_(-0.5, 0.5)
+        net.eval()
+        return net
+
+    def test_save_load_tensors(self):
+        """Test the round trip of tensors and metadata through the safetensors layout
+
+        """
+        path = os.path.join(self.out_dir, 'tensors.safetensors')
+        tensors = dict(a=torch.randn(2, 3), b=torch.arange(5), c=torch.ones(1, dtype=torch.float64))
+        models.save_tensors(path, tensors, metadata=dict(key='value'))
+        loaded, metadata = models.load_tensors(path)
+        assert metadata == dict(key='value')
+        for k, v in tensors.items():
+            assert loaded[k].dtype == v.dtype
+            np.testing.assert_array_equal(loaded[k].numpy(), v.numpy())
+        # The 8-byte header length is followed by an 8-byte-aligned JSON header
+        with open(path, 'rb') as f:
+            header_len = int.from_bytes(f.read(8), 'little')
+        assert header_len % 8 == 0
+
+    def test_fold_batchnorm(self):
+        """Test that folding batchnorm into the convolutions leaves the eval-mode output unchanged
+
+        """
+        net = self.get_net()
+        with torch.no_grad():
+            expected = net(self.dummy_X)
+            models.fold_batchnorm(net)
+            folded = net(self.dummy_X)
+        assert not any(isinstance(m, nn.BatchNorm2d) for m in net.modules())
+        np.testing.assert_allclose(folded.numpy(), expected.numpy(), rtol=1.e-4, atol=1.e-4)
+
+    def test_save_load_inference_artifact(self):
+        """Test that the network built from the artifact reproduces the original, with and without folding
+
+        """
+        for fold_bn in [False, True]:
+            net = self.get_net()
+            with torch.no_grad():
+                expected = net(self.dummy_X)
+            path = os.path.join(self.out_dir, 'net_fold={}.safetensors'.format(fold_bn))
+            models.save_inference_artifact(path, net, 'resnet44', 0.0, 'DoubleGaussianNLL', self.Y_cols, self.Y_mean, self.Y_std, fold_bn=fold_bn)
+            loaded_net, metadata = models.load_inference_artifact(path)
+            loaded_net.eval()
+            with torch.no_grad():
+                pred = loaded_net(self.dummy_X)
+            np.testing.assert_allclose(pred.numpy(), expected.numpy(), rtol=1.e-4, atol=1.e-4)
+            assert metadata['architecture'] == 'resnet44'
+            assert metadata['likelihood_class'] == 'DoubleGaussianNLL'
+            assert metadata['Y_cols'] == self.Y_cols
+            assert metadata['fold_bn'] == fold_bn
+            assert metadata['likelihood_kwargs'] == {}
+            assert metadata['posterior_kwargs'] == {}
+            np.testing.assert_array_equal(metadata['Y_mean'], self.Y_mean)
+            np.testing.assert_array_equal(metadata['Y_std'], self.Y_std)
+
+    def test_likelihood_kwargs(self):
+        """Test that the likelihood settings and the matching posterior settings are stored in the artifact
+
+        """
+        out_dim = 2*(2*len(self.Y_cols) + 1)
+        net = models.resnet44(num_classes=out_dim, dropout_rate=0.0)
+        path = os.path.join(self.out_dir, 'mixture.safetensors')
+        likelihood_kwargs = dict(n_components=2, cov_type='diagonal')
+        models.save_inference_artifact(path, net, 'resnet44', 0.0, 'MixtureGaussianNLL', self.Y_cols, self.Y_mean, self.Y_std, likelihood_kwargs=likelihood_kwargs)
+        _, metadata = models.load_inference_artifact(path)
+        assert metadata['likelihood_kwargs'] == likelihood_kwargs
+        assert metadata['posterior_kwargs'] == dict(n_components=2, cov_type='diagonal', rank=2)
+        # Artifacts saved without the likelihood settings fall back to the defaults
+        raw_metadata = models.get_inference_metadata(net, 'resnet44', 0.0, 'DoubleGaussianNLL', self.Y_cols, self.Y_mean, self.Y_std)
+        del raw_metadata['likelihood_kwargs'], raw_metadata['posterior_kwargs']
+        assert models.parse_inference_metadata(raw_metadata)['posterior_kwargs'] == {}
+
+    def test_export_inference_artifact(self):
+        """Test the conversion of a full training checkpoint into an artifact
+
+        """
+        net = self.get_net(dropout_rate=0.1)
+        checkpoint_path = os.path.join(self.out_dir, 'checkpoint.mdl')
+        torch.save(dict(model=net.state_dict(), optimizer={}, lr_scheduler={}, epoch=0, train_loss=1.0, val_loss=1.0), checkpoint_path)
+        artifact_path = os.path.join(self.out_dir, 'exported.safetensors')
+        train_utils.export_inference_artifact(checkpoint_path, artifact_path, 'resnet44', 0.1, 'DoubleGaussianNLL', self.Y_cols, self.Y_mean, self.Y_std)
+        loaded_net, metadata = models.load_inference_artifact(artifact_path)
+        assert metadata['dropout_rate'] == 0.1
+        assert metadata['num_classes'] == self.out_dim
+        for k, v in net.state_dict().items():
+            np.testing.assert_array_equal(loaded_net.state_dict()[k].numpy(), v.numpy())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import unittest
+import torch
+import torch.nn as nn
+import h0rton.models as models
+
+class TestModelCard(unittest.TestCase):
+    """A suite of tests on the architecture cost summaries
+
+    """
+    @classmethod
+    def setUpClass(cls):
+        torch.set_default_tensor_type(torch.FloatTensor)
+
+    def test_count_parameters_and_flops(self):
+        """Test the parameter and FLOP counts on a toy network with known costs
+
+        """
+        net = nn.Sequential(nn.Conv2d(1, 4, kernel_size=3, padding=1, bias=False), # 36 params, 2*9 FLOPs for each of 4*8*8 outputs
+                            nn.Conv2d(4, 4, kernel_size=3, padding=1, groups=4, bias=False), # 36 params, 2*9 FLOPs for each of 4*8*8 outputs
+                            nn.Flatten(),
+                            nn.Linear(4*8*8, 2)) # 514 params, 2*256*2 FLOPs
+        assert models.count_parameters(net) == 36 + 36 + 514
+        assert models.count_flops(net, (1, 8, 8)) == 2*9*256 + 2*9*256 + 2*256*2
+
+    def test_get_model_card(self):
+        """Test that the model card has one entry per batch size with positive latencies
+
+        """
+        net = models.resnet18_half(num_classes=5, dropout_rate=0.1)
+        card = models.get_model_card(net, 32, batch_sizes=[1, 4], n_repeats=2)
+        assert [row['batch_size'] for row in card] == [1, 4]
+        for row in card:
+            assert row['n_params'] == models.count_parameters(net)
+            assert row['flops_per_image'] > 0
+            assert row['latency'] > 0.0
+            assert row['latency_per_image'] == row['latency']/row['batch_size']
+
+    def test_measure_latency(self):
+        """Test that the latency is a positive duration
+
+        """
+        net = models.resnet18_half(num_classes=5, dropout_rate=0.0).eval()
+        assert models.measure_latency(net, torch.randn(2, 1, 32, 32), n_repeats=3, n_warmup=1) > 0.0
+
+if __name__ == '__main__':
+    unittest.main()
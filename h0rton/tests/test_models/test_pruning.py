@@ -0,0 +1,117 @@
+import os
+import shutil
+import unittest
+import tempfile
+import numpy as np
+import torch
+import h0rton.models as models
+from h0rton.models.bayesian_resnet import BayesianBasicBlock
+import h0rton.losses
+import h0rton.train_utils as train_utils
+
+class TestPruning(unittest.TestCase):
+    """A suite of tests on the structured channel pruning of BayesianResNet
+
+    """
+    @classmethod
+    def setUpClass(cls):
+        torch.set_default_tensor_type(torch.FloatTensor)
+        cls.Y_dim = 2
+        cls.loss_fn = h0rton.losses.DiagonalGaussianNLL(Y_dim=cls.Y_dim, device=torch.device('cpu'))
+        cls.loader = [(torch.randn(4, 1, 32, 32), torch.randn(4, cls.Y_dim)) for _ in range(2)]
+
+    def setUp(self):
+        torch.manual_seed(1113)
+        self.net = models.resnet44(num_classes=self.loss_fn.out_dim, dropout_rate=0.0).eval()
+
+    def test_importance_shapes(self):
+        """Test that there is one score per inner channel of each block
+
+        """
+        widths = models.get_block_widths(self.net)
+        for importance in [models.get_l1_importance(self.net), models.get_taylor_importance(self.net, self.loader, self.loss_fn, n_batches=2)]:
+            assert importance.keys() == widths.keys()
+            for name, scores in importance.items():
+                assert scores.shape == (widths[name],)
+                assert torch.all(scores >= 0.0)
+
+    def test_taylor_importance_inplace_relu(self):
+        """Test that the inplace ReLU of the blocks doesn't change the Taylor scores
+
+        """
+        importance = models.get_taylor_importance(self.net, self.loader, self.loss_fn, n_batches=2)
+        for module in self.net.modules():
+            if isinstance(module, BayesianBasicBlock):
+                module.relu = torch.nn.ReLU(inplace=False)
+        importance_not_inplace = models.get_taylor_importance(self.net, self.loader, self.loss_fn, n_batches=2)
+        for name, scores in importance.items():
+            np.testing.assert_allclose(scores.numpy(), importance_not_inplace[name].numpy(), rtol=1.e-5, atol=1.e-7, err_msg=name)
+
+    def test_prune_unimportant_channels(self):
+        """Test that removing channels that don't contribute leaves the output unchanged
+
+        """
+        block = self.net.layer1[0]
+        with torch.no_grad():
+            # Zero out the second half of the inner channels
+            block.conv2.weight[:, 32:] = 0.0
+            X = torch.randn(2, 1, 32, 32)
+            expected = self.net(X)
+            importance = {name: torch.ones(w) for name, w in models.get_block_widths(self.net).items()}
+            importance['layer1.0'] = block.conv2.weight.abs().sum(dim=(0, 2, 3))
+            # Prune only the zeroed channels, everything else untouched
+            models.prune_block_channels(block, torch.argsort(importance['layer1.0'], descending=True)[:32])
+            np.testing.assert_allclose(self.net(X).numpy(), expected.numpy(), rtol=1.e-5, atol=1.e-5)
+        assert block.conv1.out_channels == 32
+        assert block.conv2.in_channels == 32
+        assert block.bn1.num_features == 32
+
+    def test_prune_channels(self):
+        """Test that the network is physically smaller after pruning and can still be trained
+
+        """
+        n_params = sum(p.numel() for p in self.net.parameters())
+        models.prune_channels(self.net, models.get_l1_importance(self.net), 0.5)
+        for name, width in models.get_block_widths(self.net).items():
+            assert width in [32, 64, 128, 256]
+        assert sum(p.numel() for p in self.net.parameters()) < 0.7*n_params
+        train_loss = models.fine_tune(self.net, self.loader, self.loss_fn, n_iter=3)
+        assert np.isfinite(train_loss)
+        assert self.net(torch.randn(2, 1, 32, 32)).shape == (2, self.loss_fn.out_dim)
+
+    def test_load_pruned_checkpoint(self):
+        """Test that a pruned checkpoint loads into a freshly built network
+
+        """
+        models.prune_channels(self.net, models.get_l1_importance(self.net), 0.75)
+        out_dir = tempfile.mkdtemp()
+        optimizer = torch.optim.Adam(self.net.parameters())
+        lr_scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer)
+        model_path = train_utils.save_state_dict(self.net, optimizer, lr_scheduler, 1.0, 1.0, out_dir, 'resnet44', 0)
+        fresh_net = models.resnet44(num_classes=self.loss_fn.out_dim, dropout_rate=0.0)
+        loaded_net, epoch = train_utils.load_state_dict_test(model_path, fresh_net, 1, torch.device('cpu'))
+        assert models.get_block_widths(loaded_net) == models.get_block_widths(self.net)
+        shutil.rmtree(out_dir)
+
+    def test_resume_pruned_checkpoint(self):
+        """Test that resuming training from a pruned checkpoint optimizes every parameter of the resized network
+
+        """
+        models.prune_channels(self.net, models.get_l1_importance(self.net), 0.75)
+        out_dir = tempfile.mkdtemp()
+        optimizer = torch.optim.Adam(self.net.parameters(), lr=1.e-3)
+        lr_scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer)
+        model_path = train_utils.save_state_dict(self.net, optimizer, lr_scheduler, 1.0, 1.0, out_dir, 'resnet44', 0)
+        fresh_net = models.resnet44(num_classes=self.loss_fn.out_dim, dropout_rate=0.0)
+        fresh_optimizer = torch.optim.Adam(fresh_net.parameters(), lr=1.e-3)
+        fresh_lr_scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(fresh_optimizer)
+        epoch, loaded_net, loaded_optimizer, _, _ = train_utils.load_state_dict(model_path, fresh_net, fresh_optimizer, 1, torch.device('cpu'), lr_scheduler=fresh_lr_scheduler)
+        shutil.rmtree(out_dir)
+        optimized = set(id(p) for group in loaded_optimizer.param_groups for p in group['params'])
+        assert all(id(p) in optimized for p in loaded_net.parameters())
+        assert len(optimized) == len(list(loaded_net.parameters()))
+        assert loaded_optimizer.param_groups[0]['lr'] == 1.e-3
+        assert fresh_lr_scheduler.optimizer is loaded_optimizer
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import unittest
+import numpy as np
+import torch
+import torch.nn as nn
+import h0rton.models as models
+
+class TestQuantization(unittest.TestCase):
+    """A suite of tests on the int8 quantization of BayesianResNet
+
+    """
+    @classmethod
+    def setUpClass(cls):
+        torch.set_default_tensor_type(torch.FloatTensor)
+        torch.manual_seed(1113)
+        cls.out_dim = 5
+        cls.dummy_X = torch.randn(4, 1, 32, 32)
+        cls.calibration_X = [torch.randn(4, 1, 32, 32) for _ in range(3)]
+
+    def get_relative_error(self, pred, expected):
+        return (torch.norm(pred - expected)/torch.norm(expected)).item()
+
+    def test_quantize_dynamic(self):
+        """Test that dynamic quantization converts the FC head and approximately preserves the output
+
+        """
+        net = models.resnet44(num_classes=self.out_dim, dropout_rate=0.0).eval()
+        q_net = models.quantize_dynamic(net)
+        assert isinstance(net.fc, nn.Linear) # original left unchanged
+        assert not type(q_net.fc) is nn.Linear
+        with torch.no_grad():
+            assert self.get_relative_error(q_net(self.dummy_X), net(self.dummy_X)) < 0.05
+
+    def test_quantize_static(self):
+        """Test that static quantization converts the convolutions and approximately preserves the output
+
+        """
+        net = models.resnet44(num_classes=self.out_dim, dropout_rate=0.0).eval()
+        q_net = models.quantize_static(net, self.calibration_X)
+        assert isinstance(q_net.layer1[0].conv1, models.QuantizedConvWrapper)
+        assert not any(type(m) is nn.Conv2d for m in q_net.modules())
+        with torch.no_grad():
+            assert self.get_relative_error(q_net(self.dummy_X), net(self.dummy_X)) < 0.1
+
+    def test_quantized_dropout(self):
+        """Test that MC dropout stays active in the quantized model
+
+        """
+        net = models.resnet44(num_classes=self.out_dim, dropout_rate=0.2).eval()
+        q_net = models.quantize_static(net, self.calibration_X)
+        with torch.no_grad():
+            pred1 = q_net(self.dummy_X)
+            pred2 = q_net(self.dummy_X)
+        assert not torch.allclose(pred1, pred2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+import os
+import shutil
+import unittest
+import tempfile
+import numpy as np
+import torch
+from torch.utils.data import TensorDataset, DataLoader
+import h0rton.models
+import h0rton.losses
+import h0rton.train_utils as train_utils
+from h0rton.train_utils import evaluation_utils
+
+class TestEvaluationUtils(unittest.TestCase):
+    """A suite of tests for the multi-checkpoint evaluation
+
+    """
+    @classmethod
+    def setUpClass(cls):
+        torch.set_default_tensor_type(torch.FloatTensor)
+        cls.out_dir = tempfile.mkdtemp()
+        cls.Y_cols = ['a', 'b']
+        cls.Y_dim = len(cls.Y_cols)
+        cls.Y_mean = np.array([0.5, -1.0])
+        cls.Y_std = np.array([2.0, 0.1])
+        rng = np.random.RandomState(1113)
+        X = torch.from_numpy(rng.randn(12, 1, 32, 32).astype(np.float32))
+        Y = torch.from_numpy(rng.randn(12, cls.Y_dim).astype(np.float32))
+        cls.val_loader = DataLoader(TensorDataset(X, Y), batch_size=4, shuffle=False)
+        cls.specs = []
+        for i, likelihood_class in enumerate(['DoubleGaussianNLL', 'FullRankGaussianNLL', 'DiagonalGaussianNLL']):
+            torch.manual_seed(i)
+            out_dim = getattr(h0rton.losses, likelihood_class)(Y_dim=cls.Y_dim, device=torch.device('cpu')).out_dim
+            net = h0rton.models.resnet18_half(num_classes=out_dim, dropout_rate=0.1)
+            # Keep the predicted log-variances in a tame range
+            torch.nn.init.normal_(net.fc.weight, std=0.01)
+            checkpoint_path = os.path.join(cls.out_dir, 'net_{:d}.mdl'.format(i))
+            torch.save(dict(model=net.state_dict(), optimizer={}, lr_scheduler={}, epoch=i, train_loss=1.0, val_loss=2.0), checkpoint_path)
+            cls.specs.append(dict(name=likelihood_class, checkpoint_path=checkpoint_path, architecture='resnet18_half', likelihood_class=likelihood_class, dropout_rate=0.1))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.out_dir)
+
+    def test_get_interval_coverage(self):
+        """Test the coverage of central intervals on samples from the truth distribution
+
+        """
+        rng = np.random.RandomState(1113)
+        samples = rng.randn(2000, 500, 1)
+        truth = rng.randn(2000, 1)
+        np.testing.assert_almost_equal(train_utils.get_interval_coverage(samples, truth, 0.68), 0.68, decimal=1)
+        np.testing.assert_almost_equal(train_utils.get_interval_coverage(samples, truth, 0.95), 0.95, decimal=1)
+
+    def test_evaluate_checkpoints(self):
+        """Test that the comparison table has one row per checkpoint with the metrics of each likelihood
+
+        """
+        summary = train_utils.evaluate_checkpoints(self.specs, self.val_loader, self.Y_cols, self.Y_mean, self.Y_std, n_dropout=2, n_samples_per_dropout=20)
+        assert list(summary.index) == ['DoubleGaussianNLL', 'FullRankGaussianNLL', 'DiagonalGaussianNLL']
+        for col in ['nll', 'mae', 'mae_a', 'mae_b', 'coverage_68', 'coverage_95', 'epoch', 'val_loss']:
+            assert np.all(np.isfinite(summary[col].values.astype(float))), col
+        assert np.isfinite(summary.loc['DoubleGaussianNLL', 'logdet2_median'])
+        assert np.isfinite(summary.loc['FullRankGaussianNLL', 'logdet_median'])
+        assert np.isnan(summary.loc['DiagonalGaussianNLL', 'logdet_median'])
+        np.testing.assert_array_equal(summary['epoch'].values, [0, 1, 2])
+
+    def test_coverage_calibrated(self):
+        """Test that a network predicting the true distribution of the labels gets the nominal coverage, with nontrivial whitening
+
+        """
+        class StandardNormalNet(torch.nn.Module):
+            """Predicts a standard normal in the whitened space, i.e. zero mean, zero log-variance, and zero low-rank factors"""
+            def __init__(self, out_dim):
+                super(StandardNormalNet, self).__init__()
+                self.out_dim = out_dim
+            def forward(self, X):
+                return torch.zeros(X.shape[0], self.out_dim)
+        for likelihood_class in ['DiagonalGaussianNLL', 'LowRankGaussianNLL']:
+            out_dim = getattr(h0rton.losses, likelihood_class)(Y_dim=self.Y_dim, device=torch.device('cpu')).out_dim
+            rng = np.random.RandomState(1113)
+            evaluator = train_utils.CheckpointEvaluator(StandardNormalNet(out_dim), likelihood_class, self.Y_cols, np.array([100.0, 200.0]), np.array([5.0, 2.0]), n_samples_per_dropout=500)
+            for i in range(5):
+                Y = torch.from_numpy(rng.randn(400, self.Y_dim).astype(np.float32))
+                evaluator.update(torch.zeros(400, 1, 1, 1), Y)
+            summary = evaluator.get_summary()
+            np.testing.assert_allclose(summary['coverage_68'], 0.68, atol=0.02, err_msg=likelihood_class)
+            np.testing.assert_allclose(summary['coverage_95'], 0.95, atol=0.02, err_msg=likelihood_class)
+
+    def test_likelihood_kwargs(self):
+        """Test that a checkpoint trained with non-default likelihood settings is built and evaluated with them
+
+        """
+        likelihood_kwargs = dict(n_components=2, cov_type='diagonal')
+        out_dim = h0rton.losses.MixtureGaussianNLL(Y_dim=self.Y_dim, device=torch.device('cpu'), **likelihood_kwargs).out_dim
+        torch.manual_seed(0)
+        net = h0rton.models.resnet18_half(num_classes=out_dim, dropout_rate=0.1)
+        torch.nn.init.normal_(net.fc.weight, std=0.01)
+        checkpoint_path = os.path.join(self.out_dir, 'mixture.mdl')
+        torch.save(dict(model=net.state_dict(), optimizer={}, lr_scheduler={}, epoch=0, train_loss=1.0, val_loss=2.0), checkpoint_path)
+        spec = dict(name='mixture', checkpoint_path=checkpoint_path, architecture='resnet18_half', likelihood_class='MixtureGaussianNLL', likelihood_kwargs=likelihood_kwargs, dropout_rate=0.1)
+        summary = train_utils.evaluate_checkpoints([spec], self.val_loader, self.Y_cols, self.Y_mean, self.Y_std, n_dropout=2, n_samples_per_dropout=20)
+        assert 'likelihood_kwargs' not in summary.columns
+        for col in ['nll', 'mae', 'coverage_68', 'coverage_95']:
+            assert np.isfinite(summary.loc['mixture', col]), col
+
+    def test_evaluator_matches_single_checkpoint(self):
+        """Test that evaluating a network alongside others gives the same metrics as evaluating it alone
+
+        """
+        together = train_utils.evaluate_checkpoints(self.specs, self.val_loader, self.Y_cols, self.Y_mean, self.Y_std, n_dropout=2, n_samples_per_dropout=20)
+        alone = train_utils.evaluate_checkpoints(self.specs[1:2], self.val_loader, self.Y_cols, self.Y_mean, self.Y_std, n_dropout=2, n_samples_per_dropout=20)
+        for col in ['nll', 'mae', 'coverage_68', 'logdet_median']:
+            np.testing.assert_allclose(alone.loc['FullRankGaussianNLL', col], together.loc['FullRankGaussianNLL', col], rtol=1.e-5)
+
+    def test_evaluate_checkpoints_workers(self):
+        """Test that spreading the networks across worker processes gives the same table
+
+        """
+        serial = train_utils.evaluate_checkpoints(self.specs, self.val_loader, self.Y_cols, self.Y_mean, self.Y_std, n_dropout=2, n_samples_per_dropout=20)
+        parallel = train_utils.evaluate_checkpoints(self.specs, self.val_loader, self.Y_cols, self.Y_mean, self.Y_std, n_dropout=2, n_samples_per_dropout=20, n_workers=2)
+        assert list(parallel.index) == list(serial.index)
+        for col in ['nll', 'mae', 'coverage_68', 'coverage_95']:
+            np.testing.assert_allclose(parallel[col].values, serial[col].values, rtol=1.e-5)
+        # A worker that dies without reporting is detected rather than waited on forever
+        ctx = torch.multiprocessing.get_context('spawn')
+        dead_worker = ctx.Process(target=os._exit, args=(9,))
+        dead_worker.start()
+        dead_worker.join()
+        with self.assertRaisesRegex(RuntimeError, 'exited with code 9'):
+            evaluation_utils._get_result(ctx.Queue(), dead_worker, ['net'])
+        bad_specs = self.specs[:1] + [dict(self.specs[1], name='missing', checkpoint_path=os.path.join(self.out_dir, 'missing.mdl'))]
+        with self.assertRaises(FileNotFoundError):
+            train_utils.evaluate_checkpoints(bad_specs, self.val_loader, self.Y_cols, self.Y_mean, self.Y_std, n_workers=2)
+
+if __name__ == '__main__':
+    unittest.main()
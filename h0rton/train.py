@@ -28,6 +28,8 @@ from h0rton.configs import TrainValConfig
 import h0rton.losses
 import h0rton.models
 import h0rton.h0_inference
+from h0rton.h0_inference.bnn_posterior_export import ParametricBNNPosterior
+from h0rton.h0_inference.calibration import get_truth_levels, get_coverage_summary
 import h0rton.train_utils as train_utils
 import h0rton.script_utils as script_utils
 
@@ -101,10 +103,17 @@ def main():
     # Model #
     #########
     Y_dim = val_data.Y_dim
-    # Instantiate loss function
-    loss_fn = getattr(h0rton.losses, cfg.model.likelihood_class)(Y_dim=Y_dim, device=device)
+    # Instantiate loss function, in the fastest agreeing backend on this machine if requested
+    if cfg.model.likelihood_backend == 'auto':
+        likelihood_backend, likelihood_class, backend_benchmark = h0rton.losses.select_likelihood_backend(cfg.model.likelihood_class, Y_dim, cfg.optim.batch_size, torch.get_default_dtype(), device, likelihood_kwargs=cfg.model.likelihood_kwargs)
+        print(backend_benchmark.to_string(index=False))
+    else:
+        likelihood_backend = cfg.model.likelihood_backend
+        likelihood_class = h0rton.losses.get_backend_class_name(cfg.model.likelihood_class, likelihood_backend)
+    print("Likelihood backend: {:s} ({:s})".format(likelihood_backend, likelihood_class))
+    loss_fn = getattr(h0rton.losses, likelihood_class)(Y_dim=Y_dim, device=device, **h0rton.losses.get_backend_likelihood_kwargs(cfg.model.likelihood_class, likelihood_backend, cfg.model.likelihood_kwargs))
     # Instantiate posterior (for logging)
-    bnn_post = getattr(h0rton.h0_inference.gaussian_bnn_posterior, loss_fn.posterior_name)(val_data.Y_dim, device, val_data.train_Y_mean, val_data.train_Y_std)
+    bnn_post = getattr(h0rton.h0_inference.gaussian_bnn_posterior, loss_fn.posterior_name)(val_data.Y_dim, device, val_data.train_Y_mean, val_data.train_Y_std, **loss_fn.posterior_kwargs)
     # Instantiate model
     net = getattr(h0rton.models, cfg.model.architecture)(num_classes=loss_fn.out_dim, dropout_rate=cfg.model.dropout_rate)
     net.to(device)
@@ -116,8 +125,6 @@ def main():
     # Instantiate optimizer
     optimizer = optim.Adam(net.parameters(), lr=cfg.optim.learning_rate, amsgrad=False, weight_decay=cfg.optim.weight_decay)
     #optimizer = optim.SGD(net.parameters(), lr=cfg.optim.learning_rate, weight_decay=cfg.optim.weight_decay)
-    lr_scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer, mode='min', factor=0.75, patience=50, cooldown=50, min_lr=1e-5, verbose=True)
-    #lr_scheduler = optim.lr_scheduler.CyclicLR(optimizer, base_lr=cfg.optim.learning_rate*0.2, max_lr=cfg.optim.learning_rate, step_size_up=cfg.optim.lr_scheduler.step_size_up, step_size_down=None, mode='triangular2', gamma=1.0, scale_fn=None, scale_mode='cycle', cycle_momentum=True, base_momentum=0.8, max_momentum=0.9, last_epoch=-1)
     
     # Saving/loading state dicts
     checkpoint_dir = cfg.checkpoint.save_dir
@@ -125,16 +132,19 @@ def main():
         os.mkdir(checkpoint_dir)
 
     if cfg.model.load_state:
+        # The optimizer is rebuilt if the checkpoint was pruned, so the scheduler is built after loading
         epoch, net, optimizer, train_loss, val_loss = train_utils.load_state_dict(cfg.model.state_path, net, optimizer, cfg.optim.n_epochs, device)
         epoch += 1 # resume with next epoch
         last_saved_val_loss = val_loss
-        print(lr_scheduler.state_dict())
         print(optimizer.state_dict())
     else:
         epoch = 0
         last_saved_val_loss = np.inf
+    lr_scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer, mode='min', factor=0.75, patience=50, cooldown=50, min_lr=1e-5, verbose=True)
+    #lr_scheduler = optim.lr_scheduler.CyclicLR(optimizer, base_lr=cfg.optim.learning_rate*0.2, max_lr=cfg.optim.learning_rate, step_size_up=cfg.optim.lr_scheduler.step_size_up, step_size_down=None, mode='triangular2', gamma=1.0, scale_fn=None, scale_mode='cycle', cycle_momentum=True, base_momentum=0.8, max_momentum=0.9, last_epoch=-1)
 
     logger = SummaryWriter()
+    logger.add_text('model/likelihood_backend', "{:s} ({:s}, selected with likelihood_backend='{:s}')".format(likelihood_backend, likelihood_class, cfg.model.likelihood_backend))
     model_path = ''
     print("Training set size: {:d}".format(n_train))
     print("Validation set size: {:d}".format(n_val))
@@ -166,6 +176,8 @@ def main():
                 with torch.no_grad():
                     #net.apply(h0rton.models.deactivate_batchnorm)
                     val_loss = 0.0
+                    val_pred = []
+                    val_Y = []
            
                     for batch_idx, (X_v, Y_v) in enumerate(val_loader):
                         X_v = X_v.to(device)
@@ -173,6 +185,8 @@ def main():
                         pred_v = net.forward(X_v)
                         nograd_loss_v = loss_fn(pred_v, Y_v)
                         val_loss += (nograd_loss_v.detach().item() - val_loss)/(1 + batch_idx)
+                        val_pred.append(pred_v.cpu().numpy())
+                        val_Y.append(Y_v.cpu().numpy())
 
                     tqdm.write("Epoch [{}/{}]: VALID Loss: {:.4f}".format(epoch+1, cfg.optim.n_epochs, val_loss))
                     
@@ -191,6 +205,11 @@ def main():
                     #mae = train_utils.get_mae(mu, Y_plt)
                     mae_dict = train_utils.get_mae(mu_orig, Y_plt_orig, cfg.data.Y_cols)
                     logger.add_scalars('metrics/mae', mae_dict, n_iter)
+                    # Log coverage of the 1, 2, and 3 sigma credible regions over the whole validation set, evaluated analytically
+                    val_post = ParametricBNNPosterior.from_pred(np.concatenate(val_pred, axis=0)[:, np.newaxis, :], loss_fn.posterior_name, val_data.train_Y_mean, val_data.train_Y_std, posterior_kwargs=loss_fn.posterior_kwargs)
+                    coverage_dict = get_coverage_summary(get_truth_levels(val_post, np.concatenate(val_Y, axis=0)), cfg.data.Y_cols)
+                    logger.add_scalars('metrics/coverage_joint', {k: v for k, v in coverage_dict.items() if k.endswith('_joint')}, n_iter)
+                    logger.add_scalars('metrics/coverage_marginal', {k: v for k, v in coverage_dict.items() if k.endswith('_marginal')}, n_iter)
                     # Log log determinant of the covariance matrix
                     
                     if cfg.model.likelihood_class in ['DoubleGaussianNLL', 'FullRankGaussianNLL']:
@@ -1,2 +1,3 @@
 from .checkpoint_utils import *
-from .logging_utils import *
\ No newline at end of file
+from .logging_utils import *
+from .evaluation_utils import *
\ No newline at end of file
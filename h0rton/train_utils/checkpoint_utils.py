@@ -3,7 +3,8 @@ import numpy as np
 import random
 import datetime
 import torch
-__all__ = ['save_state_dict', 'load_state_dict', 'load_state_dict_test']
+import h0rton.models
+__all__ = ['save_state_dict', 'load_state_dict', 'load_state_dict_test', 'export_inference_artifact']
 
 
 def save_state_dict(model, optimizer, lr_scheduler, train_loss, val_loss, checkpoint_dir, model_architecture, epoch_idx):
@@ -63,10 +64,22 @@ def load_state_dict(checkpoint_path, model, optimizer, n_epochs, device, lr_sche
     str or os.path object
         path to the saved model
 
+    Note
+    ----
+    If the checkpoint was pruned, resizing the model replaces its parameters, so `optimizer` is rebuilt on the new parameters with its default hyperparameters (a single parameter group). Use the returned optimizer from then on, and build any lr_scheduler not passed in here on it.
+
     """
     state = torch.load(checkpoint_path)
+    params_before = list(model.parameters())
+    h0rton.models.resize_to_state_dict(model, state['model']) # in case the channels were pruned
     model.load_state_dict(state['model'])
     model.to(device)
+    params_after = list(model.parameters())
+    if len(params_after) != len(params_before) or any(p_after is not p_before for p_after, p_before in zip(params_after, params_before)):
+        # The optimizer would still hold the replaced, unpruned parameters
+        optimizer = type(optimizer)(params_after, **optimizer.defaults)
+        if lr_scheduler is not None:
+            lr_scheduler.optimizer = optimizer
     optimizer.load_state_dict(state['optimizer'])
     if lr_scheduler is not None:
         lr_scheduler.load_state_dict(state['lr_scheduler'])
@@ -101,6 +114,7 @@ def load_state_dict_test(checkpoint_path, model, n_epochs, device):
 
     """
     state = torch.load(checkpoint_path)
+    h0rton.models.resize_to_state_dict(model, state['model']) # in case the channels were pruned
     model.load_state_dict(state['model'])
     model.to(device)
     epoch = state['epoch']
@@ -109,4 +123,47 @@ def load_state_dict_test(checkpoint_path, model, n_epochs, device):
     print("Loaded weights at {:s}".format(checkpoint_path))
     print("Epoch [{}/{}]: TRAIN Loss: {:.4f}".format(epoch+1, n_epochs, train_loss))
     print("Epoch [{}/{}]: VALID Loss: {:.4f}".format(epoch+1, n_epochs, val_loss))
-    return model, epoch
\ No newline at end of file
+    return model, epoch
+
+def export_inference_artifact(checkpoint_path, artifact_path, architecture, dropout_rate, likelihood_class, Y_cols, Y_mean, Y_std, likelihood_kwargs={}, fold_bn=False):
+    """Convert a full training checkpoint into an inference-only artifact
+
+    The optimizer and scheduler states are dropped. See `h0rton.models.save_inference_artifact` for the format.
+
+    Parameters
+    ----------
+    checkpoint_path : str or os.path object
+        path of the training state dict, as saved by `save_state_dict`
+    artifact_path : str or os.path object
+        destination of the artifact, conventionally with the `.safetensors` extension
+    architecture : str
+        name of the function in `h0rton.models` that builds the network
+    dropout_rate : float
+        MC dropout rate used in training
+    likelihood_class : str
+        name of the likelihood class in `h0rton.losses` used in training
+    Y_cols : list of str
+        names of the predicted parameters
+    Y_mean : np.array of shape `[Y_dim,]`
+        training-set mean used for whitening
+    Y_std : np.array of shape `[Y_dim,]`
+        training-set std used for whitening
+    likelihood_kwargs : dict
+        keyword arguments of the likelihood class besides `Y_dim` and `device`
+    fold_bn : bool
+        whether to fold the batchnorm layers into the convolutions
+
+    Returns
+    -------
+    str or os.path object
+        path to the saved artifact
+
+    """
+    state = torch.load(checkpoint_path, map_location=torch.device('cpu'))
+    num_classes = state['model']['fc.weight'].shape[0]
+    model = getattr(h0rton.models, architecture)(num_classes=num_classes, dropout_rate=dropout_rate)
+    h0rton.models.resize_to_state_dict(model, state['model'])
+    model.load_state_dict(state['model'])
+    model.eval()
+    h0rton.models.save_inference_artifact(artifact_path, model, architecture, dropout_rate, likelihood_class, Y_cols, Y_mean, Y_std, likelihood_kwargs=likelihood_kwargs, fold_bn=fold_bn)
+    return artifact_path
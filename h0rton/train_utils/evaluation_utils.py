@@ -0,0 +1,329 @@
+import queue
+import numpy as np
+import pandas as pd
+import torch
+import h0rton.models
+import h0rton.losses
+from h0rton.h0_inference import gaussian_bnn_posterior_cpu
+from h0rton.train_utils.logging_utils import get_mae, get_logdet
+__all__ = ['get_interval_coverage', 'load_checkpoint_for_eval', 'CheckpointEvaluator', 'evaluate_checkpoints']
+
+worker_poll_interval = 1.0 # seconds between checks that the workers are still alive
+
+def get_interval_coverage(samples, truth, level):
+    """Fraction of the true values falling inside the central marginal intervals of the samples
+
+    Parameters
+    ----------
+    samples : np.array of shape `[n_lenses, n_samples, Y_dim]`
+    truth : np.array of shape `[n_lenses, Y_dim]`
+    level : float
+        probability content of the central interval
+
+    Returns
+    -------
+    float
+
+    """
+    lower = np.quantile(samples, 0.5 - 0.5*level, axis=1)
+    upper = np.quantile(samples, 0.5 + 0.5*level, axis=1)
+    return np.mean(np.logical_and(truth >= lower, truth <= upper))
+
+def load_checkpoint_for_eval(spec, Y_dim, device):
+    """Build a network from a training checkpoint or an inference-only artifact
+
+    Parameters
+    ----------
+    spec : dict
+        `checkpoint_path` and, unless it's a `.safetensors` artifact that stores them, `architecture`, `likelihood_class`, `dropout_rate`, and optionally `likelihood_kwargs`
+    Y_dim : int
+        number of predicted parameters
+    device : torch.device object
+
+    Returns
+    -------
+    net : torch.nn.Module
+        network with the stored weights, in eval mode
+    info : dict
+        `architecture`, `likelihood_class`, `likelihood_kwargs`, and `dropout_rate`, as well as the `epoch` and `val_loss` stored in a training checkpoint
+
+    """
+    if spec['checkpoint_path'].endswith('.safetensors'):
+        net, metadata = h0rton.models.load_inference_artifact(spec['checkpoint_path'], device)
+        info = dict(architecture=metadata['architecture'], likelihood_class=metadata['likelihood_class'], likelihood_kwargs=metadata['likelihood_kwargs'], dropout_rate=metadata['dropout_rate'], epoch=None, val_loss=None)
+    else:
+        state = torch.load(spec['checkpoint_path'], map_location=device)
+        likelihood_kwargs = spec.get('likelihood_kwargs', {})
+        loss_fn = getattr(h0rton.losses, spec['likelihood_class'])(Y_dim=Y_dim, device=device, **likelihood_kwargs)
+        net = getattr(h0rton.models, spec['architecture'])(num_classes=loss_fn.out_dim, dropout_rate=spec['dropout_rate'])
+        h0rton.models.resize_to_state_dict(net, state['model']) # in case the channels were pruned
+        net.load_state_dict(state['model'])
+        net.to(device)
+        info = dict(architecture=spec['architecture'], likelihood_class=spec['likelihood_class'], likelihood_kwargs=likelihood_kwargs, dropout_rate=spec['dropout_rate'], epoch=state.get('epoch'), val_loss=state.get('val_loss'))
+    net.eval()
+    return net, info
+
+class CheckpointEvaluator:
+    """Accumulates the validation metrics of one network, one batch at a time
+
+    The metrics are the NLL under the training likelihood, the MAE of the (unwhitened) predicted means from `get_mae`, taken over the components for `MixtureGaussianNLL`, the log determinant of the predicted covariance for the full-rank likelihoods, the weight of the second Gaussian for the double-Gaussian likelihoods, and the coverage of the central 68% and 95% marginal intervals of the MC dropout posterior.
+
+    """
+    def __init__(self, net, likelihood_class, Y_cols, Y_mean, Y_std, likelihood_kwargs={}, n_dropout=1, n_samples_per_dropout=50, seed=123, device=torch.device('cpu')):
+        """
+        Parameters
+        ----------
+        net : torch.nn.Module
+            BNN in eval mode, with dropout active
+        likelihood_class : str
+            name of the likelihood class in `h0rton.losses` used in training
+        Y_cols : list of str
+            names of the predicted parameters
+        Y_mean : np.array of shape `[Y_dim,]`
+            training-set mean used for whitening
+        Y_std : np.array of shape `[Y_dim,]`
+            training-set std used for whitening
+        likelihood_kwargs : dict
+            keyword arguments of the likelihood class besides `Y_dim` and `device`
+        n_dropout : int
+            number of MC dropout passes per batch
+        n_samples_per_dropout : int
+            number of posterior samples per MC dropout pass used for the interval coverage
+        seed : int
+            seed for the dropout masks and posterior samples. Each batch is seeded on its own, so the metrics don't depend on the other networks being evaluated alongside.
+        device : torch.device object
+
+        """
+        self.net = net
+        self.likelihood_class = likelihood_class
+        self.Y_cols = list(Y_cols)
+        self.Y_dim = len(self.Y_cols)
+        self.n_dropout = n_dropout
+        self.n_samples_per_dropout = n_samples_per_dropout
+        self.seed = seed
+        self.device = device
+        self.loss_fn = getattr(h0rton.losses, likelihood_class)(Y_dim=self.Y_dim, device=device, **likelihood_kwargs)
+        Y_mean = np.asarray(Y_mean, dtype=float).reshape(-1)
+        Y_std = np.asarray(Y_std, dtype=float).reshape(-1)
+        self.bnn_post = getattr(gaussian_bnn_posterior_cpu, self.loss_fn.posterior_name + 'CPU')(self.Y_dim, Y_mean, Y_std, **self.loss_fn.posterior_kwargs)
+        self.n_batches = 0
+        self.nll = []
+        self.mu_orig = []
+        self.Y_orig = []
+        self.logdet = []
+        self.logdet2 = []
+        self.w2 = []
+        self.coverage_68 = []
+        self.coverage_95 = []
+
+    def update(self, X, Y):
+        """Evaluate the network on a batch of validation data
+
+        Parameters
+        ----------
+        X : torch.Tensor of shape `[batch_size, n_filters, X_dim, X_dim]`
+        Y : torch.Tensor of shape `[batch_size, Y_dim]`
+            whitened labels
+
+        """
+        torch.manual_seed(self.seed + self.n_batches)
+        X = X.to(self.device)
+        Y = Y.to(self.device)
+        Y_np = Y.cpu().numpy()
+        mu = []
+        samples = []
+        with torch.no_grad():
+            for d in range(self.n_dropout):
+                pred = self.net(X)
+                self.nll.append(self.loss_fn(pred, Y).item())
+                self.bnn_post.set_sliced_pred(pred.cpu().numpy())
+                if hasattr(self.bnn_post, 'weights'):
+                    # Mean of the mixture, whose components are stacked along axis 1
+                    mu.append(np.sum(self.bnn_post.weights[:, :, np.newaxis]*self.bnn_post.mu, axis=1))
+                else:
+                    mu.append(self.bnn_post.mu)
+                if hasattr(self.bnn_post, 'tril_elements'):
+                    self.logdet.append(get_logdet(self.bnn_post.tril_elements, self.Y_dim))
+                if hasattr(self.bnn_post, 'tril_elements2'):
+                    self.logdet2.append(get_logdet(self.bnn_post.tril_elements2, self.Y_dim))
+                if hasattr(self.bnn_post, 'w2'):
+                    self.w2.append(self.bnn_post.w2.reshape(-1))
+                # Samples are unwhitened back to physical units
+                samples.append(self.bnn_post.sample(self.n_samples_per_dropout, sample_seed=self.seed + self.n_batches*self.n_dropout + d))
+        samples = np.concatenate(samples, axis=1) # [batch_size, n_dropout*n_samples_per_dropout, Y_dim]
+        Y_orig = self.bnn_post.transform_back_mu(Y_np).reshape(-1, self.Y_dim)
+        self.coverage_68.append(get_interval_coverage(samples, Y_orig, 0.68))
+        self.coverage_95.append(get_interval_coverage(samples, Y_orig, 0.95))
+        # MAE of the MC dropout mean of the primary Gaussian (or the mixture), in physical units
+        self.mu_orig.append(self.bnn_post.transform_back_mu(np.mean(mu, axis=0)).reshape(-1, self.Y_dim))
+        self.Y_orig.append(Y_orig)
+        self.n_batches += 1
+
+    def get_summary(self):
+        """Summarize the metrics over all the batches seen so far
+
+        Returns
+        -------
+        dict
+            `nll`, `mae`, `mae_<Y_col>` for each parameter, `coverage_68`, `coverage_95`, and, depending on the likelihood, `logdet_mean`, `logdet_median`, `logdet2_median`, and `w2_mean`
+
+        """
+        summary = dict(nll=np.mean(self.nll))
+        mae_dict = get_mae(np.concatenate(self.mu_orig, axis=0), np.concatenate(self.Y_orig, axis=0), self.Y_cols)
+        summary['mae'] = mae_dict.pop('mae')
+        for col, mae in mae_dict.items():
+            summary['mae_{:s}'.format(col)] = mae
+        if len(self.logdet) > 0:
+            logdet = np.concatenate(self.logdet)
+            summary['logdet_mean'] = np.mean(logdet)
+            summary['logdet_median'] = np.median(logdet)
+        if len(self.logdet2) > 0:
+            summary['logdet2_median'] = np.median(np.concatenate(self.logdet2))
+        if len(self.w2) > 0:
+            summary['w2_mean'] = np.mean(np.concatenate(self.w2))
+        summary['coverage_68'] = np.mean(self.coverage_68)
+        summary['coverage_95'] = np.mean(self.coverage_95)
+        return summary
+
+def _build_evaluators(specs, Y_cols, Y_mean, Y_std, eval_kwargs):
+    """Load the networks in `specs` and wrap each in a `CheckpointEvaluator`
+
+    """
+    evaluators = []
+    infos = []
+    for spec in specs:
+        net, info = load_checkpoint_for_eval(spec, len(Y_cols), eval_kwargs['device'])
+        # The kwargs dict stays out of the comparison table
+        likelihood_kwargs = info.pop('likelihood_kwargs')
+        evaluators.append(CheckpointEvaluator(net, info['likelihood_class'], Y_cols, Y_mean, Y_std, likelihood_kwargs=likelihood_kwargs, **eval_kwargs))
+        infos.append(info)
+    return evaluators, infos
+
+def _evaluation_worker(specs, Y_cols, Y_mean, Y_std, eval_kwargs, batch_queue, result_queue):
+    """Evaluate a group of networks on the batches put on `batch_queue` until it receives None
+
+    On error, the remaining batches are still drained so that the main process never blocks, and the error is sent back in place of the results.
+
+    """
+    error = None
+    try:
+        torch.set_num_threads(1)
+        evaluators, infos = _build_evaluators(specs, Y_cols, Y_mean, Y_std, eval_kwargs)
+    except Exception as e:
+        error = e
+    while True:
+        batch = batch_queue.get()
+        if batch is None:
+            break
+        if error is not None:
+            continue
+        try:
+            for evaluator in evaluators:
+                evaluator.update(*batch)
+        except Exception as e:
+            error = e
+    if error is not None:
+        result_queue.put(error)
+    else:
+        result_queue.put([dict(info, **evaluator.get_summary()) for info, evaluator in zip(infos, evaluators)])
+
+def _raise_dead_worker(worker, names):
+    """Raise if a worker has exited, e.g. when killed for running out of memory, so the main process doesn't wait on it forever
+
+    """
+    if not worker.is_alive():
+        raise RuntimeError("The worker evaluating {} exited with code {} before reporting its results.".format(names, worker.exitcode))
+
+def _put_batch(batch_queue, batch, worker, names):
+    """Put a batch on the bounded queue of a worker, checking that the worker is still alive to take it
+
+    """
+    while True:
+        try:
+            batch_queue.put(batch, timeout=worker_poll_interval)
+            return
+        except queue.Full:
+            _raise_dead_worker(worker, names)
+
+def _get_result(result_queue, worker, names):
+    """Wait for the results of a worker, checking that it's still alive to send them
+
+    """
+    while True:
+        try:
+            return result_queue.get(timeout=worker_poll_interval)
+        except queue.Empty:
+            if not worker.is_alive():
+                # Results posted just before the worker exited may still be in transit
+                try:
+                    return result_queue.get(timeout=worker_poll_interval)
+                except queue.Empty:
+                    _raise_dead_worker(worker, names)
+
+def evaluate_checkpoints(specs, val_loader, Y_cols, Y_mean, Y_std, n_dropout=1, n_samples_per_dropout=50, seed=123, device=torch.device('cpu'), n_workers=0):
+    """Evaluate several networks while loading each validation batch once
+
+    Parameters
+    ----------
+    specs : list of dict
+        one per network, with a unique `name` and the keys required by `load_checkpoint_for_eval`
+    val_loader : torch.utils.data.DataLoader
+        validation data, yielding whitened labels
+    Y_cols : list of str
+        names of the predicted parameters, shared by all the networks
+    Y_mean : np.array of shape `[Y_dim,]`
+        training-set mean used for whitening
+    Y_std : np.array of shape `[Y_dim,]`
+        training-set std used for whitening
+    n_workers : int
+        number of worker processes across which the networks are spread. Each batch is put in shared memory once and read by every worker. Default: evaluate all networks in this process
+
+    See `CheckpointEvaluator` for the other parameters.
+
+    Returns
+    -------
+    pd.DataFrame
+        one row per network, indexed by `name`
+
+    """
+    eval_kwargs = dict(n_dropout=n_dropout, n_samples_per_dropout=n_samples_per_dropout, seed=seed, device=device)
+    if n_workers == 0:
+        evaluators, infos = _build_evaluators(specs, Y_cols, Y_mean, Y_std, eval_kwargs)
+        for X, Y in val_loader:
+            for evaluator in evaluators:
+                evaluator.update(X, Y)
+        rows = [dict(info, **evaluator.get_summary()) for info, evaluator in zip(infos, evaluators)]
+    else:
+        n_workers = min(n_workers, len(specs))
+        ctx = torch.multiprocessing.get_context('spawn')
+        groups = [list(range(len(specs)))[i::n_workers] for i in range(n_workers)]
+        batch_queues = [ctx.Queue(maxsize=2) for i in range(n_workers)]
+        result_queues = [ctx.Queue() for i in range(n_workers)]
+        workers = [ctx.Process(target=_evaluation_worker, args=([specs[j] for j in group], Y_cols, Y_mean, Y_std, eval_kwargs, batch_queue, result_queue), daemon=True)
+                   for group, batch_queue, result_queue in zip(groups, batch_queues, result_queues)]
+        for worker in workers:
+            worker.start()
+        names = [[specs[j]['name'] for j in group] for group in groups]
+        try:
+            for X, Y in val_loader:
+                X, Y = X.share_memory_(), Y.share_memory_()
+                for batch_queue, worker, worker_names in zip(batch_queues, workers, names):
+                    _put_batch(batch_queue, (X, Y), worker, worker_names)
+            for batch_queue, worker, worker_names in zip(batch_queues, workers, names):
+                _put_batch(batch_queue, None, worker, worker_names)
+            results = [_get_result(result_queue, worker, worker_names) for result_queue, worker, worker_names in zip(result_queues, workers, names)]
+        except RuntimeError:
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+            raise
+        rows = [None]*len(specs)
+        for group, result, worker in zip(groups, results, workers):
+            worker.join()
+            if isinstance(result, Exception):
+                raise result
+            for j, row in zip(group, result):
+                rows[j] = row
+    for spec, row in zip(specs, rows):
+        row['name'] = spec['name']
+    return pd.DataFrame(rows).set_index('name')